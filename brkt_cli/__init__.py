@@ -38,10 +38,13 @@ SUBCOMMAND_MODULE_PATHS = [
     'brkt_cli.aws',
     'brkt_cli.brkt_jwt',
     'brkt_cli.config',
+    'brkt_cli.detach',
     'brkt_cli.gce',
     'brkt_cli.get_public_key',
     'brkt_cli.make_key',
-    'brkt_cli.make_user_data'
+    'brkt_cli.make_user_data',
+    'brkt_cli.serve',
+    'brkt_cli.update_all'
 ]
 
 log = logging.getLogger(__name__)
@@ -0,0 +1,232 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Limits how many brkt sessions on this host do something at the same
+time, for example run encryptor instances in one region and account.
+
+A HostSemaphore is a directory under ~/.brkt/admission.  Each waiter
+creates a ticket file whose name starts with a sequence number, and holds
+an flock on it for as long as it is waiting or admitted.  The first
+limit tickets in sequence order are admitted, so waiters are served in
+FIFO order.  A ticket whose flock can be taken belongs to a process that
+exited without releasing it, and is removed.
+
+    semaphore = HostSemaphore('aws-us-west-2-123456789012', limit=4)
+    semaphore.acquire()
+    try:
+        ...
+    finally:
+        semaphore.release()
+"""
+
+import errno
+import fcntl
+import logging
+import os
+import re
+import sys
+
+from brkt_cli import util
+from brkt_cli.config import CONFIG_DIR
+from brkt_cli.engine import Call, Sleep, run_sync
+from brkt_cli.util import BracketError
+
+log = logging.getLogger(__name__)
+
+ADMISSION_DIR = os.path.join(CONFIG_DIR, 'admission')
+
+_LOCK_FILE = 'lock'
+_SEQUENCE_FILE = 'sequence'
+_TICKET_PATTERN = re.compile(r'^(\d+)-(\S+)\.ticket$')
+
+
+class AdmissionTimeoutError(BracketError):
+    pass
+
+
+def make_semaphore_name(*parts):
+    """ Return a name that can be used as a directory name, based on the
+    given strings.
+    """
+    return '-'.join(re.sub(r'[^\w.-]', '_', str(p)) for p in parts)
+
+
+def _try_lock(fd):
+    """ Take an exclusive flock on the file without blocking.
+
+    :return True if the lock was taken
+    """
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except IOError as e:
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            return False
+        raise
+
+
+class HostSemaphore(object):
+    """ A counting semaphore that is shared by all processes on the host
+    that use the same name.  Not thread-safe: each thread or session uses
+    its own HostSemaphore object.
+    """
+
+    def __init__(self, name, limit, directory=None):
+        if limit < 1:
+            raise ValueError('limit must be at least 1')
+        self.name = name
+        self.limit = limit
+        self.path = os.path.join(directory or ADMISSION_DIR, name)
+        self._ticket_path = None
+        self._ticket_fd = None
+
+    def _open_lock(self):
+        """ Return the fd of the semaphore's lock file, locked. """
+        try:
+            os.makedirs(self.path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        fd = os.open(os.path.join(self.path, _LOCK_FILE),
+                     os.O_RDWR | os.O_CREAT, 0o600)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return fd
+
+    def _next_sequence(self):
+        """ Return the next sequence number.  Called with the lock held. """
+        path = os.path.join(self.path, _SEQUENCE_FILE)
+        sequence = 0
+        try:
+            with open(path) as f:
+                sequence = int(f.read().strip() or 0)
+        except (IOError, ValueError):
+            pass
+        sequence += 1
+        with open(path, 'w') as f:
+            f.write('%d\n' % sequence)
+        return sequence
+
+    def _get_tickets(self):
+        """ Return the live tickets in sequence order, and remove tickets
+        that belong to processes that have exited.  Called with the lock
+        held.
+        """
+        tickets = []
+        for filename in os.listdir(self.path):
+            m = _TICKET_PATTERN.match(filename)
+            if not m:
+                continue
+            path = os.path.join(self.path, filename)
+            if path != self._ticket_path:
+                try:
+                    fd = os.open(path, os.O_RDWR)
+                except OSError:
+                    continue
+                try:
+                    if _try_lock(fd):
+                        log.debug('Removing stale ticket %s', path)
+                        os.unlink(path)
+                        continue
+                finally:
+                    os.close(fd)
+            tickets.append((int(m.group(1)), path))
+        return [path for _, path in sorted(tickets)]
+
+    def enqueue(self):
+        """ Add this process to the end of the queue. """
+        if self._ticket_path:
+            raise ValueError('%s is already queued' % self.name)
+        lock_fd = self._open_lock()
+        try:
+            filename = '%012d-%d-%s.ticket' % (
+                self._next_sequence(), os.getpid(), util.make_nonce())
+            path = os.path.join(self.path, filename)
+            fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_EXCL, 0o600)
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            self._ticket_path = path
+            self._ticket_fd = fd
+        finally:
+            os.close(lock_fd)
+
+    def get_position(self):
+        """ Return this process's position in the queue.  0 means that the
+        semaphore has been acquired, and 1 means that this process is next.
+        """
+        if not self._ticket_path:
+            raise ValueError('%s is not queued' % self.name)
+        lock_fd = self._open_lock()
+        try:
+            tickets = self._get_tickets()
+        finally:
+            os.close(lock_fd)
+        index = tickets.index(self._ticket_path)
+        return max(0, index - self.limit + 1)
+
+    def acquire(self, timeout=None, poll_interval=5):
+        """ Wait until this process is admitted.
+
+        :raise AdmissionTimeoutError if the timeout expires
+        """
+        run_sync(self.acquire_co(
+            timeout=timeout, poll_interval=poll_interval))
+
+    def acquire_co(self, timeout=None, poll_interval=5):
+        """ Coroutine version of acquire().  Leaves the queue if waiting
+        fails or is interrupted.
+        """
+        if not self._ticket_path:
+            yield Call(self.enqueue)
+        deadline = util.Deadline(timeout) if timeout is not None else None
+        last_position = None
+        try:
+            while True:
+                position = yield Call(self.get_position)
+                if position == 0:
+                    break
+                if position != last_position:
+                    log.info(
+                        'Waiting for %s: position %d in queue',
+                        self.name, position)
+                    last_position = position
+                if deadline and deadline.is_expired():
+                    raise AdmissionTimeoutError(
+                        'Timed out waiting for %s' % self.name)
+                yield Sleep(poll_interval)
+        except:
+            exc_info = sys.exc_info()
+            yield Call(self.release)
+            raise exc_info[0], exc_info[1], exc_info[2]
+
+    def release(self):
+        """ Leave the queue, or release the semaphore if it was acquired. """
+        if not self._ticket_path:
+            return
+        # Hold the lock, so that another process that is checking for
+        # stale tickets doesn't see the ticket after its lock is released.
+        lock_fd = self._open_lock()
+        try:
+            os.unlink(self._ticket_path)
+            os.close(self._ticket_fd)
+        finally:
+            os.close(lock_fd)
+        self._ticket_path = None
+        self._ticket_fd = None
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
@@ -0,0 +1,407 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Python API for encrypting and updating images, for programs that would
+otherwise run the brkt command once per image.
+
+    def on_progress(future, progress):
+        log.info('%d%% complete', progress.percent_complete)
+
+    client = brkt_cli.api.Client(region='us-west-2')
+    future = client.encrypt_ami_async(
+        'ami-12345678', token=token, progress_callback=on_progress)
+    encrypted_ami_id = future.result()
+    client.shutdown()
+
+Each operation runs in its own session on one of the client's worker
+threads.  The client reuses EC2 connections, credentials and the encryptor
+AMI list across operations.
+"""
+
+import collections
+import logging
+import threading
+
+import brkt_cli
+from brkt_cli import encryptor_service, util
+from brkt_cli.aws import (
+    _get_updated_image_name,
+    _validate_ami,
+    _validate_guest_ami,
+    _validate_guest_encrypted_ami,
+    aws_service,
+    encrypt_ami,
+    get_encryptor_ami_from_map,
+    get_encryptor_ami_map
+)
+from brkt_cli.aws.connection_pool import ConnectionPool
+from brkt_cli.aws.update_ami import update_ami
+from brkt_cli.executor import Future, ThreadPoolExecutor
+from brkt_cli.gce import encrypt_gce_image, gce_service, update_gce_image
+from brkt_cli.instance_config import (
+    INSTANCE_CREATOR_MODE,
+    INSTANCE_UPDATER_MODE,
+    InstanceConfig
+)
+from brkt_cli.validation import ValidationError
+
+log = logging.getLogger(__name__)
+
+# Passed to progress callbacks.
+Progress = collections.namedtuple('Progress', ['state', 'percent_complete'])
+
+
+class _BaseClient(object):
+
+    def __init__(self, brkt_env=None, max_workers=4,
+                 enc_svc_cls=encryptor_service.EncryptorService):
+        self.brkt_env = brkt_env or brkt_cli.get_prod_brkt_env()
+        self.enc_svc_cls = enc_svc_cls
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='brkt-api')
+
+    def make_instance_config(self, token=None, ntp_servers=None,
+                             status_port=None, mode=INSTANCE_CREATOR_MODE):
+        """ Return an InstanceConfig for the client's Bracket environment.
+        """
+        brkt_config = {}
+        brkt_cli.add_brkt_env_to_brkt_config(self.brkt_env, brkt_config)
+        if token:
+            brkt_config['identity_token'] = token
+        if ntp_servers:
+            brkt_cli.validate_ntp_servers(ntp_servers)
+            brkt_config['ntp_servers'] = ntp_servers
+        brkt_config['status_port'] = (
+            status_port or encryptor_service.ENCRYPTOR_STATUS_PORT)
+        return InstanceConfig(brkt_config, mode)
+
+    def _submit(self, session, progress_callback, function, *args,
+                **kwargs):
+        """ Run the function on a worker thread, with the given session
+        active.
+
+        :return a Future whose session_id attribute is set to the id of the
+        session
+        """
+        future = Future()
+        future.session_id = session.session_id
+        if progress_callback:
+            future.add_progress_callback(progress_callback)
+        session.add_progress_callback(
+            lambda state, percent: future.set_progress(
+                Progress(state, percent))
+        )
+
+        def _run():
+            with session.activate():
+                return function(*args, **kwargs)
+
+        return self._executor.submit_future(future, _run)
+
+    def shutdown(self, wait=True):
+        """ Stop accepting new operations.  If wait is True, wait for
+        running operations to complete.
+        """
+        self._executor.shutdown(wait=wait)
+
+
+class Client(_BaseClient):
+    """ Encrypts and updates AMIs in one AWS region. """
+
+    def __init__(self, region, key_name=None, brkt_env=None, max_workers=4,
+                 retry_timeout=10.0, retry_initial_sleep_seconds=0.25,
+                 enc_svc_cls=encryptor_service.EncryptorService):
+        super(Client, self).__init__(
+            brkt_env=brkt_env,
+            max_workers=max_workers,
+            enc_svc_cls=enc_svc_cls
+        )
+        self.region = region
+        self.key_name = key_name
+        self.retry_timeout = retry_timeout
+        self.retry_initial_sleep_seconds = retry_initial_sleep_seconds
+
+        self._lock = threading.Lock()
+        self._connection_pool = None
+        # Maps the pv flag to the region -> AMI dictionary.
+        self._encryptor_ami_maps = {}
+
+    def _new_aws_service(self, session_id=None):
+        """ Return a new AWSService with its own session, that shares
+        connections with the other sessions created by this client.
+        """
+        with self._lock:
+            if not self._connection_pool:
+                self._connection_pool = ConnectionPool(self.region)
+        aws_svc = aws_service.AWSService(
+            session_id or util.make_nonce(),
+            retry_timeout=self.retry_timeout,
+            retry_initial_sleep_seconds=self.retry_initial_sleep_seconds
+        )
+        aws_svc.connect_with_pool(
+            self._connection_pool, key_name=self.key_name)
+        return aws_svc
+
+    def get_encryptor_ami(self, pv=False):
+        """ Return the latest encryptor AMI for the client's region.  The
+        list of AMIs is downloaded once and cached.
+
+        :raise ValidationError if the region is not supported
+        """
+        with self._lock:
+            ami_map = self._encryptor_ami_maps.get(pv)
+            if ami_map is None:
+                ami_map = get_encryptor_ami_map(pv=pv)
+                self._encryptor_ami_maps[pv] = ami_map
+        return get_encryptor_ami_from_map(ami_map, self.region)
+
+    def list_encrypted_images(self):
+        """ Return the encrypted AMIs that we own in the client's region,
+        with one DescribeImages call filtered by the BrktEncryptor tag.
+        """
+        aws_svc = self._new_aws_service()
+        return aws_svc.get_images(
+            filters={'tag-key': encrypt_ami.TAG_ENCRYPTOR}, owners=['self'])
+
+    def _set_default_tags(self, aws_svc, encryptor_ami, tags):
+        default_tags = encrypt_ami.get_default_tags(
+            aws_svc.session_id, encryptor_ami)
+        default_tags.update(tags or {})
+        aws_svc.default_tags = default_tags
+
+    def encrypt_ami_async(self, ami, encryptor_ami=None,
+                          encrypted_ami_name=None, subnet_id=None,
+                          security_group_ids=None,
+                          guest_instance_type='m3.medium', pv=False,
+                          instance_config=None, token=None, tags=None,
+                          save_encryptor_logs=True, status_port=None,
+                          validate=True, progress_callback=None,
+                          session_id=None):
+        """ Create an encrypted copy of an AMI.
+
+        :param ami the id of the guest AMI
+        :param encryptor_ami the id of the encryptor AMI, or None to use
+            the latest
+        :param instance_config the InstanceConfig that is passed to the
+            encryptor, or None to create one with make_instance_config()
+        :param tags a dictionary of tags that are applied to the resources
+            that are created
+        :param progress_callback called as progress_callback(future,
+            progress), where progress is a Progress object
+        :param session_id the id of the session, or None to generate one
+        :return a Future whose result is the encrypted AMI id
+        """
+        aws_svc = self._new_aws_service(session_id=session_id)
+        status_port = status_port or encryptor_service.ENCRYPTOR_STATUS_PORT
+        if instance_config is None:
+            instance_config = self.make_instance_config(
+                token=token, status_port=status_port)
+        if encrypted_ami_name:
+            aws_service.validate_image_name(encrypted_ami_name)
+
+        def _encrypt():
+            if validate:
+                guest_image = _validate_guest_ami(aws_svc, ami)
+            else:
+                guest_image = aws_svc.get_image(ami)
+            image_encryptor_ami = encryptor_ami or self.get_encryptor_ami(
+                pv=pv or guest_image.virtualization_type == 'paravirtual')
+            self._set_default_tags(aws_svc, image_encryptor_ami, tags)
+
+            return encrypt_ami.encrypt(
+                aws_svc=aws_svc,
+                enc_svc_cls=self.enc_svc_cls,
+                image_id=guest_image.id,
+                encryptor_ami=image_encryptor_ami,
+                encrypted_ami_name=encrypted_ami_name,
+                subnet_id=subnet_id,
+                security_group_ids=security_group_ids,
+                guest_instance_type=guest_instance_type,
+                instance_config=instance_config,
+                save_encryptor_logs=save_encryptor_logs,
+                status_port=status_port
+            )
+
+        return self._submit(aws_svc.session, progress_callback, _encrypt)
+
+    def update_ami_async(self, ami, encryptor_ami=None,
+                         encrypted_ami_name=None, subnet_id=None,
+                         security_group_ids=None,
+                         guest_instance_type='m3.medium',
+                         updater_instance_type='m3.medium', pv=False,
+                         instance_config=None, token=None, tags=None,
+                         status_port=None, validate=True,
+                         progress_callback=None, session_id=None):
+        """ Update an encrypted AMI with the latest Metavisor.  The
+        parameters are the same as encrypt_ami_async().
+
+        :return a Future whose result is the updated AMI id
+        """
+        aws_svc = self._new_aws_service(session_id=session_id)
+        status_port = status_port or encryptor_service.ENCRYPTOR_STATUS_PORT
+        if instance_config is None:
+            instance_config = self.make_instance_config(
+                token=token, status_port=status_port,
+                mode=INSTANCE_UPDATER_MODE)
+        if encrypted_ami_name:
+            aws_service.validate_image_name(encrypted_ami_name)
+
+        def _update():
+            encrypted_image = _validate_ami(aws_svc, ami)
+            image_encryptor_ami = encryptor_ami or self.get_encryptor_ami(
+                pv=pv or
+                encrypted_image.virtualization_type == 'paravirtual')
+            self._set_default_tags(aws_svc, image_encryptor_ami, tags)
+            if validate:
+                _validate_guest_encrypted_ami(
+                    aws_svc, encrypted_image.id, image_encryptor_ami)
+
+            mv_image = aws_svc.get_image(image_encryptor_ami)
+            if (encrypted_image.virtualization_type !=
+                    mv_image.virtualization_type):
+                raise ValidationError(
+                    'Virtualization type mismatch.  %s is %s, but '
+                    'encryptor %s is %s.' % (
+                        encrypted_image.id,
+                        encrypted_image.virtualization_type,
+                        mv_image.id,
+                        mv_image.virtualization_type
+                    )
+                )
+
+            name = encrypted_ami_name or _get_updated_image_name(
+                encrypted_image.name, aws_svc.session_id)
+            return update_ami(
+                aws_svc, encrypted_image.id, image_encryptor_ami, name,
+                subnet_id=subnet_id,
+                security_group_ids=security_group_ids,
+                enc_svc_class=self.enc_svc_cls,
+                guest_instance_type=guest_instance_type,
+                updater_instance_type=updater_instance_type,
+                instance_config=instance_config,
+                status_port=status_port
+            )
+
+        return self._submit(aws_svc.session, progress_callback, _update)
+
+
+class GCEClient(_BaseClient):
+    """ Encrypts and updates images in one GCE project.
+
+    Each session gets its own GCEService, since the underlying HTTP
+    connections are not thread-safe.  Credentials are loaded once and
+    shared.
+    """
+
+    def __init__(self, project, zone='us-central1-a', network='default',
+                 brkt_env=None, max_workers=4,
+                 enc_svc_cls=encryptor_service.EncryptorService):
+        super(GCEClient, self).__init__(
+            brkt_env=brkt_env,
+            max_workers=max_workers,
+            enc_svc_cls=enc_svc_cls
+        )
+        self.project = project
+        self.zone = zone
+        self.network = network
+
+        self._lock = threading.Lock()
+        self._credentials = None
+
+    def _new_gce_service(self, session_id=None):
+        with self._lock:
+            if not self._credentials:
+                self._credentials = \
+                    gce_service.GoogleCredentials.get_application_default()
+        return gce_service.GCEService(
+            self.project, session_id or util.make_nonce(), log,
+            credentials=self._credentials
+        )
+
+    def encrypt_image_async(self, image, encryptor_image=None,
+                            encrypted_image_name=None, image_project=None,
+                            keep_encryptor=False, image_file=None,
+                            image_bucket='prod', instance_config=None,
+                            token=None, status_port=None,
+                            progress_callback=None, session_id=None):
+        """ Create an encrypted copy of a GCE image.
+
+        :return a Future whose result is the encrypted image name
+        """
+        gce_svc = self._new_gce_service(session_id=session_id)
+        status_port = status_port or encryptor_service.ENCRYPTOR_STATUS_PORT
+        if instance_config is None:
+            instance_config = self.make_instance_config(
+                token=token, status_port=status_port)
+        encrypted_image_name = gce_service.get_image_name(
+            encrypted_image_name, image)
+        gce_service.validate_image_name(encrypted_image_name)
+
+        return self._submit(
+            gce_svc.session,
+            progress_callback,
+            encrypt_gce_image.encrypt,
+            gce_svc=gce_svc,
+            enc_svc_cls=self.enc_svc_cls,
+            image_id=image,
+            encryptor_image=encryptor_image,
+            encrypted_image_name=encrypted_image_name,
+            zone=self.zone,
+            instance_config=instance_config,
+            image_project=image_project,
+            keep_encryptor=keep_encryptor,
+            image_file=image_file,
+            image_bucket=image_bucket,
+            network=self.network,
+            status_port=status_port
+        )
+
+    def update_image_async(self, image, encryptor_image=None,
+                           encrypted_image_name=None, keep_encryptor=False,
+                           image_file=None, image_bucket='prod',
+                           instance_config=None, token=None,
+                           status_port=None, progress_callback=None,
+                           session_id=None):
+        """ Update an encrypted GCE image with the latest Metavisor.
+
+        :return a Future whose result is the updated image name
+        """
+        gce_svc = self._new_gce_service(session_id=session_id)
+        status_port = status_port or encryptor_service.ENCRYPTOR_STATUS_PORT
+        if instance_config is None:
+            instance_config = self.make_instance_config(
+                token=token, status_port=status_port,
+                mode=INSTANCE_UPDATER_MODE)
+        encrypted_image_name = gce_service.get_image_name(
+            encrypted_image_name, image)
+        gce_service.validate_image_name(encrypted_image_name)
+
+        return self._submit(
+            gce_svc.session,
+            progress_callback,
+            update_gce_image.update_gce_image,
+            gce_svc=gce_svc,
+            enc_svc_cls=self.enc_svc_cls,
+            image_id=image,
+            encryptor_image=encryptor_image,
+            encrypted_image_name=encrypted_image_name,
+            zone=self.zone,
+            instance_config=instance_config,
+            keep_encryptor=keep_encryptor,
+            image_file=image_file,
+            image_bucket=image_bucket,
+            network=self.network,
+            status_port=status_port
+        )
@@ -15,40 +15,76 @@ import json
 import logging
 import os
 import re
+import sys
+import threading
 import urllib2
 
 import boto
 from boto.exception import EC2ResponseError, NoAuthHandlerFound
 
 import brkt_cli
-from brkt_cli import brkt_jwt, encryptor_service, util
+from brkt_cli import brkt_jwt, encryptor_service, session, util
+from brkt_cli.detach import (
+    SessionStore,
+    get_detached_args,
+    setup_detach_args
+)
 from brkt_cli.aws import (
     aws_service,
+    cleanup_job,
     diag,
     encrypt_ami,
     share_logs
 )
+from brkt_cli.aws import catalog as aws_catalog
+from brkt_cli.aws import copy_ami as aws_copy_ami
+from brkt_cli.aws import launch_ami as aws_launch_ami
+from brkt_cli.aws import multi_account as aws_multi_account
+from brkt_cli.aws import orphans as aws_orphans
+from brkt_cli.aws import sessions as aws_sessions
+from brkt_cli.aws import share_ami as aws_share_ami
 from brkt_cli.instance_config import (
     INSTANCE_CREATOR_MODE,
+    INSTANCE_METAVISOR_MODE,
     INSTANCE_UPDATER_MODE
 )
 from brkt_cli.instance_config_args import (
     make_instance_config,
     setup_instance_config_args
 )
+from brkt_cli.catalog import (
+    CLOUD_AWS,
+    CLOUD_GCE,
+    OPERATION_COPY,
+    OPERATION_ENCRYPT,
+    OPERATION_UPDATE,
+    QUERY_FIELDS,
+    Catalog,
+    format_records
+)
+from brkt_cli.orphans import collect_garbage, setup_gc_args
 from brkt_cli.subcommand import Subcommand
+from brkt_cli.timeouts import TimeoutHistory, setup_phase_timeout_args
 from brkt_cli.util import BracketError
 from brkt_cli.validation import ValidationError
+from brkt_cli.aws.connection_pool import (
+    CREDENTIALS_DIR,
+    ConnectionPool,
+    CredentialCache
+)
 from brkt_cli.aws.encrypt_ami import (
     TAG_ENCRYPTOR,
     TAG_ENCRYPTOR_AMI,
     TAG_ENCRYPTOR_SESSION_ID)
 
+import brkt_cli.aws.copy_encrypted_ami_args
 import brkt_cli.aws.diag_args
 import brkt_cli.aws.encrypt_ami_args
+import brkt_cli.aws.launch_encrypted_ami_args
+import brkt_cli.aws.share_encrypted_ami_args
 import brkt_cli.aws.share_logs_args
 import brkt_cli.aws.update_encrypted_ami_args
-from brkt_cli.aws.update_ami import update_ami
+from brkt_cli.aws.update_ami import update_ami, update_amis
 
 log = logging.getLogger(__name__)
 
@@ -83,6 +119,63 @@ class DiagSubcommand(Subcommand):
         return _run_subcommand(self.name(), values)
 
 
+class LaunchEncryptedAMISubcommand(Subcommand):
+
+    def name(self):
+        return 'launch-encrypted-ami'
+
+    def init_logging(self, verbose):
+        # Set boto logging to FATAL, since boto logs auth errors and 401s
+        # at ERROR level.
+        boto.log.setLevel(logging.FATAL)
+
+    def verbose(self, values):
+        return values.launch_encrypted_ami_verbose
+
+    def register(self, subparsers, parsed_config):
+        parser = subparsers.add_parser(
+            self.name(),
+            description=(
+                'Launch instances of an encrypted AMI, spread across '
+                'subnets or availability zones.'
+            ),
+            formatter_class=brkt_cli.SortingHelpFormatter
+        )
+        launch_encrypted_ami_args.setup_launch_encrypted_ami_args(parser)
+        setup_instance_config_args(parser, mode=INSTANCE_METAVISOR_MODE)
+
+    def run(self, values):
+        return _run_subcommand(self.name(), values)
+
+
+class ShareEncryptedAMISubcommand(Subcommand):
+
+    def name(self):
+        return 'share-encrypted-ami'
+
+    def init_logging(self, verbose):
+        # Set boto logging to FATAL, since boto logs auth errors and 401s
+        # at ERROR level.
+        boto.log.setLevel(logging.FATAL)
+
+    def verbose(self, values):
+        return values.share_encrypted_ami_verbose
+
+    def register(self, subparsers, parsed_config):
+        parser = subparsers.add_parser(
+            self.name(),
+            description=(
+                'Share encrypted AMIs and their snapshots with other AWS '
+                'accounts.'
+            ),
+            formatter_class=brkt_cli.SortingHelpFormatter
+        )
+        share_encrypted_ami_args.setup_share_encrypted_ami_args(parser)
+
+    def run(self, values):
+        return _run_subcommand(self.name(), values)
+
+
 class ShareLogsSubcommand(Subcommand):
 
     def name(self):
@@ -130,6 +223,36 @@ class EncryptAMISubcommand(Subcommand):
         encrypt_ami_args.setup_encrypt_ami_args(encrypt_ami_parser)
         setup_instance_config_args(encrypt_ami_parser,
                                    mode=INSTANCE_CREATOR_MODE)
+        setup_phase_timeout_args(encrypt_ami_parser)
+        setup_detach_args(encrypt_ami_parser)
+
+    def run(self, values):
+        return _run_subcommand(self.name(), values)
+
+
+class CopyEncryptedAMISubcommand(Subcommand):
+
+    def name(self):
+        return 'copy-encrypted-ami'
+
+    def init_logging(self, verbose):
+        # Set boto logging to FATAL, since boto logs auth errors and 401s
+        # at ERROR level.
+        boto.log.setLevel(logging.FATAL)
+
+    def verbose(self, values):
+        return values.copy_encrypted_ami_verbose
+
+    def register(self, subparsers, parsed_config):
+        parser = subparsers.add_parser(
+            self.name(),
+            description=(
+                'Copy encrypted AMIs to other regions.  The copies are '
+                'tagged with the encryptor AMI for their region.'
+            ),
+            formatter_class=brkt_cli.SortingHelpFormatter
+        )
+        copy_encrypted_ami_args.setup_copy_encrypted_ami_args(parser)
 
     def run(self, values):
         return _run_subcommand(self.name(), values)
@@ -161,6 +284,243 @@ class UpdateAMISubcommand(Subcommand):
             update_encrypted_ami_parser)
         setup_instance_config_args(update_encrypted_ami_parser,
                                    mode=INSTANCE_UPDATER_MODE)
+        setup_phase_timeout_args(update_encrypted_ami_parser)
+
+    def run(self, values):
+        return _run_subcommand(self.name(), values)
+
+
+class CleanupSessionsSubcommand(Subcommand):
+
+    def name(self):
+        return 'cleanup-sessions'
+
+    def init_logging(self, verbose):
+        # Set boto logging to FATAL, since boto logs auth errors and 401s
+        # at ERROR level.
+        boto.log.setLevel(logging.FATAL)
+
+    def verbose(self, values):
+        return values.cleanup_sessions_verbose
+
+    def register(self, subparsers, parsed_config):
+        parser = subparsers.add_parser(
+            'cleanup-sessions',
+            description=(
+                'Finish the AMIs and delete the temporary resources of '
+                'encryption sessions that ran with --early-return.'
+            ),
+            formatter_class=brkt_cli.SortingHelpFormatter
+        )
+        parser.add_argument(
+            '--job',
+            metavar='PATH',
+            help=(
+                'Run only this cleanup job.  By default, all pending jobs '
+                'in %s are run.' % cleanup_job.CLEANUP_DIR
+            )
+        )
+        parser.add_argument(
+            '-v',
+            '--verbose',
+            dest='cleanup_sessions_verbose',
+            action='store_true',
+            help='Print status information to the console'
+        )
+
+    def run(self, values):
+        return _run_subcommand(self.name(), values)
+
+
+class CatalogSubcommand(Subcommand):
+
+    def name(self):
+        return 'catalog'
+
+    def init_logging(self, verbose):
+        boto.log.setLevel(logging.FATAL)
+
+    def verbose(self, values):
+        return values.catalog_verbose
+
+    def register(self, subparsers, parsed_config):
+        parser = subparsers.add_parser(
+            'catalog',
+            description=(
+                'Query the local catalog of images that were encrypted or '
+                'updated, or refresh it from the Bracket tags of the AMIs '
+                'in a region.'
+            ),
+            formatter_class=brkt_cli.SortingHelpFormatter
+        )
+        parser.add_argument(
+            '-v',
+            '--verbose',
+            dest='catalog_verbose',
+            action='store_true',
+            help='Print status information to the console'
+        )
+        catalog_subparsers = parser.add_subparsers(
+            dest='catalog_subcommand')
+
+        query_parser = catalog_subparsers.add_parser(
+            'query',
+            help='Print the images in the catalog',
+            description=(
+                'Print the images in the catalog that match all of the '
+                'given options, newest first.'
+            ),
+            formatter_class=brkt_cli.SortingHelpFormatter
+        )
+        query_parser.add_argument(
+            '--source-image',
+            metavar='ID',
+            dest='source_image',
+            help='The image that was encrypted or updated'
+        )
+        query_parser.add_argument(
+            '--encryptor-image',
+            metavar='ID',
+            dest='encryptor_image',
+            help='The encryptor or updater image'
+        )
+        query_parser.add_argument(
+            '--cloud',
+            choices=[CLOUD_AWS, CLOUD_GCE],
+            help='Only print images in this cloud'
+        )
+        query_parser.add_argument(
+            '--location',
+            metavar='NAME',
+            dest='location',
+            help='The AWS region or GCE project'
+        )
+        query_parser.add_argument(
+            '--session-id',
+            metavar='ID',
+            dest='session_id',
+            help='The session that created the image'
+        )
+        query_parser.add_argument(
+            '--lineage',
+            metavar='ID',
+            help=(
+                'Print the image and the images that it was based on, '
+                'instead of searching'
+            )
+        )
+        query_parser.add_argument(
+            '--json',
+            action='store_true',
+            help='Print the full records as JSON'
+        )
+
+        refresh_parser = catalog_subparsers.add_parser(
+            'refresh',
+            help='Add the encrypted AMIs in a region to the catalog',
+            description=(
+                'Add the encrypted AMIs that you own in a region to the '
+                'catalog, and remove the AMIs that no longer exist.'
+            ),
+            formatter_class=brkt_cli.SortingHelpFormatter
+        )
+        refresh_parser.add_argument(
+            '--region',
+            metavar='NAME',
+            help='AWS region (e.g. us-west-2)',
+            dest='region',
+            required=True
+        )
+
+    def run(self, values):
+        return _run_subcommand(self.name(), values)
+
+
+class GCSubcommand(Subcommand):
+
+    def name(self):
+        return 'gc'
+
+    def init_logging(self, verbose):
+        boto.log.setLevel(logging.FATAL)
+
+    def verbose(self, values):
+        return values.gc_verbose
+
+    def register(self, subparsers, parsed_config):
+        parser = subparsers.add_parser(
+            'gc',
+            description=(
+                'Delete the instances, volumes, snapshots and security '
+                'groups that interrupted encryption and update sessions '
+                'left behind in a region.'
+            ),
+            formatter_class=brkt_cli.SortingHelpFormatter
+        )
+        parser.add_argument(
+            '--region',
+            metavar='NAME',
+            help='AWS region (e.g. us-west-2)',
+            dest='region',
+            required=True
+        )
+        setup_gc_args(parser)
+        parser.add_argument(
+            '-v',
+            '--verbose',
+            dest='gc_verbose',
+            action='store_true',
+            help='Print status information to the console'
+        )
+
+    def run(self, values):
+        return _run_subcommand(self.name(), values)
+
+
+class SessionsSubcommand(Subcommand):
+
+    def name(self):
+        return 'sessions'
+
+    def init_logging(self, verbose):
+        boto.log.setLevel(logging.FATAL)
+
+    def verbose(self, values):
+        return values.sessions_verbose
+
+    def register(self, subparsers, parsed_config):
+        parser = subparsers.add_parser(
+            'sessions',
+            description=(
+                'List the encryption and update sessions that are running, '
+                'and the ones that stopped without finishing.'
+            ),
+            formatter_class=brkt_cli.SortingHelpFormatter
+        )
+        parser.add_argument(
+            '--region',
+            metavar='NAME',
+            dest='regions',
+            action='append',
+            required=True,
+            help=(
+                'AWS region (e.g. us-west-2).  May be specified multiple '
+                'times.'
+            )
+        )
+        parser.add_argument(
+            '--all',
+            dest='all_sessions',
+            action='store_true',
+            help='Also list sessions that completed'
+        )
+        parser.add_argument(
+            '-v',
+            '--verbose',
+            dest='sessions_verbose',
+            action='store_true',
+            help='Print status information to the console'
+        )
 
     def run(self, values):
         return _run_subcommand(self.name(), values)
@@ -168,18 +528,39 @@ class UpdateAMISubcommand(Subcommand):
 
 def get_subcommands():
     return [
+        CatalogSubcommand(),
+        CleanupSessionsSubcommand(),
+        CopyEncryptedAMISubcommand(),
         DiagSubcommand(),
         EncryptAMISubcommand(),
+        GCSubcommand(),
+        LaunchEncryptedAMISubcommand(),
+        SessionsSubcommand(),
+        ShareEncryptedAMISubcommand(),
         ShareLogsSubcommand(),
         UpdateAMISubcommand()]
 
 
 def _run_subcommand(subcommand, values):
     try:
+        if subcommand == 'catalog':
+            return command_catalog(values)
+        if subcommand == 'cleanup-sessions':
+            return command_cleanup_sessions(values)
+        if subcommand == 'copy-encrypted-ami':
+            return command_copy_encrypted_ami(values)
         if subcommand == 'diag':
             return command_diag(values)
         if subcommand == 'encrypt-ami':
             return command_encrypt_ami(values)
+        if subcommand == 'gc':
+            return command_gc(values)
+        if subcommand == 'launch-encrypted-ami':
+            return command_launch_encrypted_ami(values)
+        if subcommand == 'sessions':
+            return command_sessions(values)
+        if subcommand == 'share-encrypted-ami':
+            return command_share_encrypted_ami(values)
         if subcommand == 'share-logs':
             return command_share_logs(values)
         if subcommand == 'update-encrypted-ami':
@@ -406,11 +787,10 @@ def _use_pv_metavisor(values, guest_image):
     return values.pv or guest_image.virtualization_type == 'paravirtual'
 
 
-def _get_encryptor_ami(region_name, pv=False):
-    """ Read the list of AMIs from the AMI endpoint and return the AMI ID
-    for the given region.
+def get_encryptor_ami_map(pv=False):
+    """ Read the list of AMIs from the AMI endpoint.
 
-    :raise ValidationError if the region is not supported
+    :return a dictionary that maps region name to encryptor AMI id
     :raise BracketError if the list of AMIs cannot be read
     """
     if pv:
@@ -423,24 +803,91 @@ def _get_encryptor_ami(region_name, pv=False):
     if r.getcode() not in (200, 201):
         raise BracketError(
             'Getting %s gave response: %s' % (bucket_url, r.text))
-    resp_json = json.loads(r.read())
-    ami = resp_json.get(region_name)
+    return json.loads(r.read())
+
+
+def get_encryptor_ami_from_map(ami_map, region_name):
+    """ Return the encryptor AMI id for the given region.
 
+    :raise ValidationError if the region is not supported
+    """
+    ami = ami_map.get(region_name)
     if not ami:
-        regions = resp_json.keys()
+        regions = ami_map.keys()
         raise ValidationError(
             'Encryptor AMI is only available in %s' % ', '.join(regions))
     return ami
 
 
-def command_encrypt_ami(values):
-    session_id = util.make_nonce()
+def _get_encryptor_ami(region_name, pv=False):
+    """ Read the list of AMIs from the AMI endpoint and return the AMI ID
+    for the given region.
 
-    aws_svc = aws_service.AWSService(
+    :raise ValidationError if the region is not supported
+    :raise BracketError if the list of AMIs cannot be read
+    """
+    return get_encryptor_ami_from_map(get_encryptor_ami_map(pv), region_name)
+
+
+# Serializes the output of the threads that encrypt in several accounts.
+_output_lock = threading.Lock()
+
+
+def _print_output(line):
+    with _output_lock:
+        print(line)
+
+
+def _get_account_roles(values):
+    """ Return the roles specified with --account-role and
+    --account-roles-file, or an empty list if neither was specified.
+    """
+    roles = list(values.account_roles or [])
+    if values.account_roles_file:
+        roles += aws_multi_account.read_roles_file(values.account_roles_file)
+    return aws_multi_account.validate_roles(roles)
+
+
+def _validate_account_role_options(values):
+    """ Validate the encrypt-ami options that can't be used when
+    encrypting in other accounts.
+
+    :raise ValidationError if an option refers to a single account, or
+        would hand the session off to a process that doesn't assume the
+        account's role
+    """
+    if values.detach or values.session_id:
+        raise ValidationError(
+            '--detach is not supported with --account-role')
+    if values.early_return:
+        # Deferred cleanup runs with the default credentials, so it
+        # can't finish the session in another account.
+        raise ValidationError(
+            '--early-return is not supported with --account-role')
+    if values.subnet_id or values.security_group_ids:
+        raise ValidationError(
+            '--subnet and --security-group are not supported with '
+            '--account-role, since they belong to one account')
+
+
+def _make_encrypt_service(values, session_id):
+    return aws_service.AWSService(
         session_id,
         retry_timeout=values.retry_timeout,
         retry_initial_sleep_seconds=values.retry_initial_sleep_seconds
     )
+
+
+def command_encrypt_ami(values):
+    session_id = values.session_id or util.make_nonce()
+    if values.max_encryptors is not None and values.max_encryptors < 1:
+        raise ValidationError('--max-encryptors must be at least 1')
+
+    roles = _get_account_roles(values)
+    if roles:
+        _validate_account_role_options(values)
+
+    aws_svc = _make_encrypt_service(values, session_id)
     log.debug(
         'Retry timeout=%.02f, initial sleep seconds=%.02f',
         aws_svc.retry_timeout, aws_svc.retry_initial_sleep_seconds)
@@ -457,8 +904,53 @@ def command_encrypt_ami(values):
         if values.token:
             brkt_cli.check_jwt_auth(brkt_env, values.token)
 
+    if roles:
+        return _encrypt_ami_in_accounts(values, roles, brkt_env)
+
     aws_svc.connect(values.region, key_name=values.key_name)
+    return _encrypt_ami(aws_svc, values, brkt_env)
+
+
+def _encrypt_ami_in_accounts(values, roles, brkt_env):
+    """ Encrypt the AMI in each of the accounts concurrently, and print
+    "ACCOUNT ENCRYPTED-AMI" for each account.  Log messages are prefixed
+    with the session id of the account's encryption.
+
+    :return 0 if the AMI was encrypted in all of the accounts, otherwise 1
+    """
+    session.install_log_filter()
+    credential_cache = CredentialCache(
+        directory=CREDENTIALS_DIR if values.cache_credentials else None)
+
+    def _encrypt_in_account(aws_svc, account_id):
+        aws_svc.key_name = values.key_name
+        return _encrypt_ami(aws_svc, values, brkt_env, account_id=account_id)
+
+    results, failed = aws_multi_account.run_in_accounts(
+        roles,
+        values.region,
+        lambda: _make_encrypt_service(values, util.make_nonce()),
+        _encrypt_in_account,
+        session_name='brkt-encrypt-ami',
+        credential_cache=credential_cache
+    )
+    log.info('Encrypted %s in %d of %d accounts',
+             values.ami, len(roles) - len(failed), len(roles))
+    if failed or any(results.values()):
+        return 1
+    return 0
+
+
+def _encrypt_ami(aws_svc, values, brkt_env, account_id=None):
+    """ Encrypt the AMI with the connected AWSService, and copy it to the
+    target regions.
 
+    :param account_id the account that is being encrypted in, when
+        encrypting in several accounts.  Output lines are prefixed with
+        the account id.
+    :return 0 if the AMI was encrypted and copied, otherwise 1
+    """
+    session_id = aws_svc.session_id
     if values.validate:
         guest_image = _validate_guest_ami(aws_svc, values.ami)
     else:
@@ -478,25 +970,245 @@ def command_encrypt_ami(values):
         _validate(aws_svc, values, encryptor_ami)
         brkt_cli.validate_ntp_servers(values.ntp_servers)
 
-    encrypted_image_id = encrypt_ami.encrypt(
-        aws_svc=aws_svc,
-        enc_svc_cls=encryptor_service.EncryptorService,
-        image_id=guest_image.id,
-        encryptor_ami=encryptor_ami,
-        encrypted_ami_name=values.encrypted_ami_name,
-        subnet_id=values.subnet_id,
-        security_group_ids=values.security_group_ids,
-        guest_instance_type=values.guest_instance_type,
-        instance_config=make_instance_config(values, brkt_env),
-        status_port=values.status_port,
-        save_encryptor_logs=values.save_encryptor_logs
+    # Validate the target regions before encrypting, so that a typo
+    # doesn't waste an encryption.
+    target_svcs = {}
+    if values.copy_to_regions:
+        target_svcs = _connect_target_regions(
+            aws_svc, aws_copy_ami.parse_regions(values.copy_to_regions))
+        _set_copy_tags(
+            target_svcs,
+            _get_copy_encryptor_amis(aws_svc, encryptor_ami, target_svcs, pv),
+            values.tags
+        )
+
+    defer_cleanup = None
+    if values.early_return:
+        if values.background_cleanup:
+            defer_cleanup = cleanup_job.hand_off
+        else:
+            defer_cleanup = cleanup_job.save_job
+
+    if values.detach:
+        store = SessionStore()
+        try:
+            store.start(
+                session_id, 'encrypt-ami',
+                get_detached_args(sys.argv[1:], session_id),
+                region=values.region
+            )
+        finally:
+            store.close()
+        log.info(
+            'Run `brkt status %(id)s` or `brkt wait %(id)s` to follow the '
+            'session', {'id': session_id})
+        print(session_id)
+        return 0
+
+    timeout_history = TimeoutHistory()
+
+    def _encrypt():
+        return encrypt_ami.encrypt(
+            aws_svc=aws_svc,
+            enc_svc_cls=encryptor_service.EncryptorService,
+            image_id=guest_image.id,
+            encryptor_ami=encryptor_ami,
+            encrypted_ami_name=values.encrypted_ami_name,
+            subnet_id=values.subnet_id,
+            security_group_ids=values.security_group_ids,
+            guest_instance_type=values.guest_instance_type,
+            instance_config=make_instance_config(values, brkt_env),
+            status_port=values.status_port,
+            save_encryptor_logs=values.save_encryptor_logs,
+            max_encryptors=values.max_encryptors,
+            timeout_history=timeout_history,
+            timeout_overrides=dict(values.phase_timeouts or []),
+            defer_cleanup=defer_cleanup
+        )
+
+    if values.session_id:
+        # This is the background process for a detached session.
+        store = SessionStore()
+        try:
+            encrypted_image_id = store.run(aws_svc.session, _encrypt)
+        finally:
+            store.close()
+    else:
+        encrypted_image_id = _encrypt()
+    aws_catalog.record_image(
+        aws_svc, encrypted_image_id, values.region, OPERATION_ENCRYPT,
+        guest_image.id, encryptor_ami,
+        phase_durations=timeout_history.durations
     )
     # Print the AMI ID to stdout, in case the caller wants to process
     # the output.  Log messages go to stderr.
-    print(encrypted_image_id)
+    if account_id:
+        _print_output('%s %s' % (account_id, encrypted_image_id))
+    else:
+        print(encrypted_image_id)
+    if target_svcs:
+        return _copy_amis(
+            aws_svc, [encrypted_image_id], target_svcs,
+            account_id=account_id)
     return 0
 
 
+def _connect_target_regions(aws_svc, regions):
+    """ Return a dictionary of region name to a connected AWSService for
+    each region that AMIs are copied to.  The services share the session
+    id, retry settings and assumed-role credentials of aws_svc.
+
+    :raise ValidationError if a region is invalid
+    """
+    target_svcs = {}
+    for region in regions:
+        if region == aws_svc.region:
+            raise ValidationError(
+                'Cannot copy an AMI to its own region %s' % region)
+        _validate_region(aws_svc, region)
+        target_svc = aws_service.AWSService(
+            aws_svc.session_id,
+            retry_timeout=aws_svc.retry_timeout,
+            retry_initial_sleep_seconds=aws_svc.retry_initial_sleep_seconds
+        )
+        credentials = aws_svc.connection_pool.credentials
+        if credentials:
+            target_svc.connect_with_pool(
+                ConnectionPool(region, credentials=credentials))
+        else:
+            target_svc.connect(region)
+        target_svcs[region] = target_svc
+    return target_svcs
+
+
+def _get_copy_encryptor_amis(aws_svc, encryptor_ami, target_svcs, pv):
+    """ Return a dictionary of region name to the encryptor AMI that the
+    copies in that region are tagged with.  The published encryptor
+    AMI list is used if encryptor_ami is the latest encryptor in the
+    source region.  Otherwise, the encryptor AMI is looked up by name.
+    """
+    ami_map = get_encryptor_ami_map(pv=pv)
+    if ami_map.get(aws_svc.region) == encryptor_ami:
+        return {
+            region: get_encryptor_ami_from_map(ami_map, region)
+            for region in target_svcs
+        }
+    return aws_copy_ami.find_encryptor_amis(
+        aws_svc, encryptor_ami, target_svcs)
+
+
+def _set_copy_tags(target_svcs, encryptor_amis, tags):
+    for region, target_svc in target_svcs.iteritems():
+        default_tags = encrypt_ami.get_default_tags(
+            target_svc.session_id, encryptor_amis[region])
+        default_tags.update(brkt_cli.parse_tags(tags))
+        target_svc.default_tags = default_tags
+
+
+def _copy_amis(aws_svc, image_ids, target_svcs, account_id=None):
+    """ Copy the AMIs to the target regions, add the copies to the
+    catalog and print "REGION SOURCE-AMI COPIED-AMI" for each copy.
+
+    :param account_id if specified, output lines are prefixed with the
+        account id
+
+    :return 0 if all of the copies succeeded, otherwise 1
+    """
+    copies = aws_copy_ami.copy_amis(aws_svc, image_ids, target_svcs)
+    for region in sorted(copies):
+        target_svc = target_svcs[region]
+        for image_id in image_ids:
+            copy_id = copies[region][image_id]
+            aws_catalog.record_image(
+                target_svc, copy_id, region, OPERATION_COPY, image_id,
+                target_svc.default_tags[TAG_ENCRYPTOR_AMI]
+            )
+            line = '%s %s %s' % (region, image_id, copy_id)
+            if account_id:
+                _print_output('%s %s' % (account_id, line))
+            else:
+                print(line)
+    if len(copies) < len(target_svcs):
+        log.error(
+            'Copied to %d of %d regions', len(copies), len(target_svcs))
+        return 1
+    return 0
+
+
+def command_copy_encrypted_ami(values):
+    if len(set(values.amis)) != len(values.amis):
+        raise ValidationError('An AMI was specified more than once')
+    aws_svc = aws_service.AWSService(
+        util.make_nonce(),
+        retry_timeout=values.retry_timeout,
+        retry_initial_sleep_seconds=values.retry_initial_sleep_seconds
+    )
+    _validate_region(aws_svc, values.region)
+    aws_svc.connect(values.region)
+
+    images = [_validate_ami(aws_svc, ami) for ami in values.amis]
+    encryptor_amis = set()
+    for image in images:
+        if TAG_ENCRYPTOR not in image.tags:
+            raise ValidationError('%s is not an encrypted AMI' % image.id)
+        encryptor_amis.add(image.tags.get(TAG_ENCRYPTOR_AMI))
+    if len(encryptor_amis) != 1 or None in encryptor_amis:
+        raise ValidationError(
+            'The AMIs must be encrypted with the same encryptor AMI')
+    encryptor_ami = encryptor_amis.pop()
+
+    target_svcs = _connect_target_regions(
+        aws_svc, aws_copy_ami.parse_regions(values.to_regions))
+    _set_copy_tags(
+        target_svcs,
+        _get_copy_encryptor_amis(
+            aws_svc, encryptor_ami, target_svcs,
+            pv=images[0].virtualization_type == 'paravirtual'),
+        values.tags
+    )
+    return _copy_amis(aws_svc, values.amis, target_svcs)
+
+
+def command_cleanup_sessions(values):
+    if values.job:
+        paths = [values.job]
+    else:
+        paths = cleanup_job.get_pending_job_paths()
+        if not paths:
+            log.info('No pending cleanup jobs')
+            return 0
+
+    status = 0
+    for path in paths:
+        try:
+            lock = cleanup_job.lock_job(path)
+        except IOError as e:
+            log.error('Unable to open cleanup job %s: %s', path, e)
+            status = 1
+            continue
+        if not lock:
+            log.info('Skipping %s, which another process is running', path)
+            continue
+
+        try:
+            try:
+                job = cleanup_job.load_job(path)
+            except (IOError, ValueError) as e:
+                log.error('Unable to load cleanup job %s: %s', path, e)
+                status = 1
+                continue
+            log.info('Cleaning up session %s', job.session_id)
+            aws_svc = aws_service.AWSService(
+                job.session_id, default_tags=job.tags)
+            aws_svc.connect(job.region)
+            if not encrypt_ami.run_cleanup_job(aws_svc, job):
+                status = 1
+            os.remove(path)
+        finally:
+            lock.close()
+    return status
+
+
 def _get_updated_image_name(image_name, session_id):
     """ Generate a new name, based on the existing name of the encrypted
     image and the session id.
@@ -517,6 +1229,16 @@ def _get_updated_image_name(image_name, session_id):
 
 def command_update_encrypted_ami(values):
     nonce = util.make_nonce()
+    if values.max_encryptors is not None and values.max_encryptors < 1:
+        raise ValidationError('--max-encryptors must be at least 1')
+    if values.max_guests < 1:
+        raise ValidationError('--max-guests must be at least 1')
+    if len(values.amis) > 1 and values.encrypted_ami_name:
+        raise ValidationError(
+            '--encrypted-ami-name can only be specified when updating one '
+            'AMI')
+    if len(set(values.amis)) != len(values.amis):
+        raise ValidationError('An AMI was specified more than once')
 
     aws_svc = aws_service.AWSService(
         nonce,
@@ -540,7 +1262,8 @@ def command_update_encrypted_ami(values):
             brkt_cli.check_jwt_auth(brkt_env, values.token)
 
     aws_svc.connect(values.region, key_name=values.key_name)
-    encrypted_image = _validate_ami(aws_svc, values.ami)
+    encrypted_images = [_validate_ami(aws_svc, ami) for ami in values.amis]
+    encrypted_image = encrypted_images[0]
     pv = _use_pv_metavisor(values, encrypted_image)
     encryptor_ami = (
         values.encryptor_ami or
@@ -552,57 +1275,90 @@ def command_update_encrypted_ami(values):
     aws_svc.default_tags = default_tags
 
     if values.validate:
-        _validate_guest_encrypted_ami(
-            aws_svc, encrypted_image.id, encryptor_ami)
+        for image in encrypted_images:
+            _validate_guest_encrypted_ami(aws_svc, image.id, encryptor_ami)
         brkt_cli.validate_ntp_servers(values.ntp_servers)
         _validate(aws_svc, values, encryptor_ami)
-        _validate_guest_encrypted_ami(
-            aws_svc, encrypted_image.id, encryptor_ami)
     else:
         log.info('Skipping AMI validation.')
 
     mv_image = aws_svc.get_image(encryptor_ami)
-    if (encrypted_image.virtualization_type !=
-            mv_image.virtualization_type):
-        log.error(
-            'Virtualization type mismatch.  %s is %s, but encryptor %s is '
-            '%s.',
-            encrypted_image.id,
-            encrypted_image.virtualization_type,
-            mv_image.id,
-            mv_image.virtualization_type
-        )
-        return 1
-
-    encrypted_ami_name = values.encrypted_ami_name
-    if encrypted_ami_name:
-        # Check for name collision.
-        filters = {'name': encrypted_ami_name}
-        if aws_svc.get_images(filters=filters, owners=['self']):
+    for image in encrypted_images:
+        if image.virtualization_type != mv_image.virtualization_type:
+            log.error(
+                'Virtualization type mismatch.  %s is %s, but encryptor %s '
+                'is %s.',
+                image.id,
+                image.virtualization_type,
+                mv_image.id,
+                mv_image.virtualization_type
+            )
+            return 1
+
+    encrypted_ami_names = {}
+    for image in encrypted_images:
+        encrypted_ami_name = values.encrypted_ami_name
+        if encrypted_ami_name:
+            # Check for name collision.
+            filters = {'name': encrypted_ami_name}
+            if aws_svc.get_images(filters=filters, owners=['self']):
+                raise ValidationError(
+                    'You already own image named %s' % encrypted_ami_name)
+        else:
+            encrypted_ami_name = _get_updated_image_name(image.name, nonce)
+        log.debug('Image name: %s', encrypted_ami_name)
+        aws_service.validate_image_name(encrypted_ami_name)
+        if encrypted_ami_name in encrypted_ami_names.values():
             raise ValidationError(
-                'You already own image named %s' % encrypted_ami_name)
-    else:
-        encrypted_ami_name = _get_updated_image_name(
-            encrypted_image.name, nonce)
-    log.debug('Image name: %s', encrypted_ami_name)
-    aws_service.validate_image_name(encrypted_ami_name)
+                'More than one updated AMI would be named %s' %
+                encrypted_ami_name)
+        encrypted_ami_names[image.id] = encrypted_ami_name
 
     # Initial validation done
     log.info(
         'Updating %s with new metavisor %s',
-        encrypted_image.id, encryptor_ami
+        ', '.join(values.amis), encryptor_ami
     )
 
-    updated_ami_id = update_ami(
-        aws_svc, encrypted_image.id, encryptor_ami, encrypted_ami_name,
+    timeout_history = TimeoutHistory()
+    update_kwargs = dict(
         subnet_id=values.subnet_id,
         security_group_ids=values.security_group_ids,
         guest_instance_type=values.guest_instance_type,
         updater_instance_type=values.updater_instance_type,
         instance_config=make_instance_config(values, brkt_env),
         status_port=values.status_port,
+        max_encryptors=values.max_encryptors,
+        timeout_history=timeout_history,
+        timeout_overrides=dict(values.phase_timeouts or [])
     )
-    print(updated_ami_id)
+    if len(encrypted_images) == 1:
+        updated_ami_id = update_ami(
+            aws_svc, encrypted_image.id, encryptor_ami,
+            encrypted_ami_names[encrypted_image.id], **update_kwargs
+        )
+        updated = {encrypted_image.id: updated_ami_id}
+    else:
+        updated = update_amis(
+            aws_svc, values.amis, encryptor_ami, encrypted_ami_names,
+            max_guests=values.max_guests, **update_kwargs
+        )
+
+    for ami in values.amis:
+        if ami not in updated:
+            continue
+        aws_catalog.record_image(
+            aws_svc, updated[ami], values.region, OPERATION_UPDATE,
+            ami, encryptor_ami, phase_durations=timeout_history.durations
+        )
+        if len(values.amis) == 1:
+            print(updated[ami])
+        else:
+            print('%s %s' % (ami, updated[ami]))
+    if len(updated) < len(values.amis):
+        log.error(
+            'Updated %d of %d AMIs', len(updated), len(values.amis))
+        return 1
     return 0
 
 
@@ -614,6 +1370,86 @@ def _validate_log_snapshot(aws_svc, snapshot_id):
     pass
 
 
+def _get_log_instance_ids(aws_svc, values):
+    """ Return the instances specified with --instance, and the ones that
+    have the tags specified with --instance-tag.
+
+    :raise ValidationError if no instances have the tags
+    """
+    instance_ids = list(values.instance_ids or [])
+    if values.instance_tags:
+        tags = brkt_cli.parse_tags(values.instance_tags)
+        tagged_ids = share_logs.find_instance_ids(aws_svc, tags)
+        if not tagged_ids:
+            raise ValidationError(
+                'No instances found with tags %s' %
+                ', '.join(values.instance_tags))
+        log.info('Found %d instances with tags', len(tagged_ids))
+        instance_ids += [i for i in tagged_ids if i not in instance_ids]
+    return instance_ids
+
+
+def command_catalog(values, path=None):
+    image_catalog = Catalog(path) if path else Catalog()
+    try:
+        if values.catalog_subcommand == 'refresh':
+            aws_svc = aws_service.AWSService(util.make_nonce())
+            aws_svc.connect(values.region)
+            count = aws_catalog.refresh(aws_svc, values.region, image_catalog)
+            log.info(
+                'Found %d encrypted AMIs in %s', count, values.region)
+            return 0
+
+        if values.lineage:
+            records = image_catalog.get_lineage(values.lineage)
+        else:
+            records = image_catalog.query(
+                **{f: getattr(values, f, None) for f in QUERY_FIELDS})
+    finally:
+        image_catalog.close()
+
+    if values.json:
+        print(json.dumps(
+            [r._asdict() for r in records], indent=2, sort_keys=True))
+    elif records:
+        print(util.render_table_rows(format_records(records)))
+    return 0
+
+
+def command_gc(values):
+    if values.min_age > values.max_age:
+        raise ValidationError('--min-age must not be greater than --max-age')
+    aws_svc = aws_service.AWSService(util.make_nonce())
+    aws_svc.connect(values.region)
+    collect_garbage(
+        aws_orphans.list_resources(aws_svc),
+        lambda sessions: aws_orphans.delete_sessions(aws_svc, sessions),
+        min_age=values.min_age,
+        max_age=values.max_age,
+        dry_run=values.dry_run
+    )
+    return 0
+
+
+def command_sessions(values):
+    aws_svcs = {}
+    for region in set(values.regions):
+        aws_svc = aws_service.AWSService(util.make_nonce())
+        aws_svc.connect(region)
+        aws_svcs[region] = aws_svc
+    sessions = aws_sessions.describe_regions(aws_svcs)
+    if not values.all_sessions:
+        sessions = [
+            s for s in sessions
+            if s.status != aws_sessions.STATUS_COMPLETED
+        ]
+    if not sessions:
+        log.info('No sessions found')
+        return 0
+    print(aws_sessions.render_sessions(sessions, history=TimeoutHistory()))
+    return 0
+
+
 def command_diag(values):
     nonce = util.make_nonce()
 
@@ -626,13 +1462,10 @@ def command_diag(values):
         'Retry timeout=%.02f, initial sleep seconds=%.02f',
         aws_svc.retry_timeout, aws_svc.retry_initial_sleep_seconds)
 
-    if values.snapshot_id and values.instance_id:
-        raise ValidationError("Only one of --instance-id or --snapshot-id "
-                              "may be specified")
-
-    if not values.snapshot_id and not values.instance_id:
-        raise ValidationError("--instance-id or --snapshot-id "
-                              "must be specified")
+    if not (values.snapshot_ids or values.instance_ids or
+            values.instance_tags):
+        raise ValidationError(
+            "--instance, --instance-tag or --snapshot must be specified")
 
     if values.validate:
         # Validate the region before connecting.
@@ -647,23 +1480,137 @@ def command_diag(values):
     default_tags.update(brkt_cli.parse_tags(values.tags))
     aws_svc.default_tags = default_tags
 
+    instance_ids = _get_log_instance_ids(aws_svc, values)
     if values.validate:
         if values.key_name:
             aws_svc.get_key_pair(values.key_name)
-        if values.instance_id:
-            _validate_log_instance(
-                aws_svc, values.instance_id)
+        for instance_id in instance_ids:
+            _validate_log_instance(aws_svc, instance_id)
         _validate_subnet_and_security_groups(
             aws_svc, values.subnet_id, values.security_group_ids)
     else:
         log.info('Skipping validation.')
 
-    diag.diag(
+    failed = diag.diag(
         aws_svc,
-        instance_id=values.instance_id,
-        snapshot_id=values.snapshot_id,
+        region=values.region,
+        instance_ids=instance_ids,
+        snapshot_ids=values.snapshot_ids,
         ssh_keypair=values.key_name
     )
+    if failed:
+        log.error('Unable to snapshot the logs of %d instances', failed)
+        return 1
+    return 0
+
+
+def command_launch_encrypted_ami(values):
+    if values.count < 1:
+        raise ValidationError('--count must be at least 1')
+    if values.min_count is not None and not \
+            1 <= values.min_count <= values.count:
+        raise ValidationError('--min-count must be between 1 and --count')
+    if values.subnet_ids and values.zones:
+        raise ValidationError('Specify either --subnet or --zone')
+
+    aws_svc = aws_service.AWSService(
+        util.make_nonce(),
+        retry_timeout=values.retry_timeout,
+        retry_initial_sleep_seconds=values.retry_initial_sleep_seconds
+    )
+    brkt_env = (
+        brkt_cli.brkt_env_from_values(values) or
+        brkt_cli.get_prod_brkt_env()
+    )
+    if values.validate:
+        _validate_region(aws_svc, values.region)
+        if values.token:
+            brkt_cli.check_jwt_auth(brkt_env, values.token)
+    aws_svc.connect(values.region, key_name=values.key_name)
+    # Don't tag the instances with the session id, since they aren't
+    # temporary resources that brkt gc should delete.
+    aws_svc.default_tags = brkt_cli.parse_tags(values.tags)
+
+    if values.validate:
+        image = _validate_ami(aws_svc, values.ami)
+        if TAG_ENCRYPTOR not in image.tags:
+            raise ValidationError('%s is not an encrypted AMI' % image.id)
+        for subnet_id in values.subnet_ids or [None]:
+            _validate_subnet_and_security_groups(
+                aws_svc, subnet_id, values.security_group_ids)
+        if values.key_name:
+            aws_svc.get_key_pair(values.key_name)
+
+    groups = aws_launch_ami.plan_launch(
+        values.count, min_count=values.min_count,
+        subnet_ids=values.subnet_ids, zones=values.zones)
+    try:
+        instances = aws_launch_ami.launch(
+            aws_svc,
+            values.ami,
+            groups,
+            make_instance_config(
+                values, brkt_env, mode=INSTANCE_METAVISOR_MODE),
+            name=values.instance_name,
+            instance_type=values.instance_type,
+            security_group_ids=values.security_group_ids,
+            ebs_optimized=values.ebs_optimized
+        )
+    except aws_launch_ami.LaunchError as e:
+        # Print the instances that were launched, so that the caller
+        # can find them.
+        log.error(
+            'Launched instances: %s', ', '.join(e.instance_ids))
+        for instance_id in e.instance_ids:
+            print(instance_id)
+        raise
+    log.info('%d instances are running', len(instances))
+    for instance in instances:
+        print(instance.id)
+    return 0
+
+
+def command_share_encrypted_ami(values):
+    account_ids = list(values.accounts or [])
+    if values.accounts_file:
+        account_ids += aws_share_ami.read_accounts_file(values.accounts_file)
+    account_ids = aws_share_ami.validate_account_ids(account_ids)
+    if not account_ids:
+        raise ValidationError('Specify --account or --accounts-file')
+    if len(set(values.amis)) != len(values.amis):
+        raise ValidationError('An AMI was specified more than once')
+
+    aws_svc = aws_service.AWSService(
+        util.make_nonce(),
+        retry_timeout=values.retry_timeout,
+        retry_initial_sleep_seconds=values.retry_initial_sleep_seconds
+    )
+    _validate_region(aws_svc, values.region)
+    aws_svc.connect(values.region)
+
+    # Describe all of the AMIs with one call.
+    images = aws_svc.get_images(
+        filters={'image-id': values.amis}, owners=['self'])
+    missing = set(values.amis) - set(i.id for i in images)
+    if missing:
+        raise ValidationError(
+            'Unable to find %s' % ', '.join(sorted(missing)))
+    if values.validate:
+        for image in images:
+            if TAG_ENCRYPTOR not in image.tags:
+                raise ValidationError(
+                    '%s is not an encrypted AMI' % image.id)
+
+    not_shared = aws_share_ami.share_images(aws_svc, images, account_ids)
+    if not_shared:
+        log.error(
+            'Unable to share %s with all accounts',
+            ', '.join(sorted(not_shared)))
+        return 1
+    log.info(
+        'Shared %d AMIs with %d accounts', len(images), len(account_ids))
+    for ami in values.amis:
+        print(ami)
     return 0
 
 
@@ -679,13 +1626,10 @@ def command_share_logs(values):
         'Retry timeout=%.02f, initial sleep seconds=%.02f',
         aws_svc.retry_timeout, aws_svc.retry_initial_sleep_seconds)
 
-    if values.snapshot_id and values.instance_id:
-        raise ValidationError("Only one of --instance-id or --snapshot-id "
-                              "may be specified")
-
-    if not values.snapshot_id and not values.instance_id:
-        raise ValidationError("--instance-id or --snapshot-id "
-                              "must be specified")
+    if not (values.snapshot_ids or values.instance_ids or
+            values.instance_tags):
+        raise ValidationError(
+            "--instance, --instance-tag or --snapshot must be specified")
 
     if values.validate:
         # Validate the region before connecting.
@@ -697,16 +1641,20 @@ def command_share_logs(values):
 
     aws_svc.connect(values.region)
 
+    instance_ids = _get_log_instance_ids(aws_svc, values)
     if values.validate:
-        _validate_log_instance(
-            aws_svc, values.instance_id)
+        for instance_id in instance_ids:
+            _validate_log_instance(aws_svc, instance_id)
     else:
         log.info('Skipping instance validation.')
 
-    share_logs.share(
+    failed = share_logs.share(
         aws_svc,
-        instance_id=values.instance_id,
-        snapshot_id=values.snapshot_id,
+        instance_ids=instance_ids,
+        snapshot_ids=values.snapshot_ids,
         bracket_aws_account=values.bracket_aws_account
     )
+    if failed:
+        log.error('Unable to share the logs of %d instances', failed)
+        return 1
     return 0
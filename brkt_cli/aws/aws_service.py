@@ -18,12 +18,15 @@ import ssl
 import tempfile
 
 import boto
-import boto.sts
 import boto.vpc
 import logging
 from boto.exception import EC2ResponseError, BotoServerError
 
 from brkt_cli import util
+from brkt_cli.aws.connection_pool import (
+    AssumedRoleCredentials, ConnectionPool)
+from brkt_cli.engine import Call, Return, Sleep, run_sync
+from brkt_cli.session import SessionContext
 from brkt_cli.util import Deadline, BracketError
 from brkt_cli.validation import ValidationError
 
@@ -34,7 +37,11 @@ class BaseAWSService(object):
     __metaclass__ = abc.ABCMeta
 
     def __init__(self, session_id):
-        self.session_id = session_id
+        self.session = SessionContext(session_id)
+
+    @property
+    def session_id(self):
+        return self.session.session_id
 
     @abc.abstractmethod
     def get_regions(self):
@@ -57,14 +64,41 @@ class BaseAWSService(object):
                      instance_profile_name=None):
         pass
 
+    @abc.abstractmethod
+    def run_instances(self,
+                      image_id,
+                      min_count,
+                      max_count,
+                      security_group_ids=None,
+                      instance_type='c3.xlarge',
+                      placement=None,
+                      subnet_id=None,
+                      user_data=None,
+                      ebs_optimized=False,
+                      client_token=None):
+        """ Launch up to max_count instances with one RunInstances call.
+
+        :return a list of Instance objects
+        """
+        pass
+
     @abc.abstractmethod
     def get_instance(self, instance_id):
         pass
 
+    @abc.abstractmethod
+    def get_instances(self, filters=None, instance_ids=None):
+        pass
+
     @abc.abstractmethod
     def create_tags(self, resource_id, name=None, description=None):
         pass
 
+    @abc.abstractmethod
+    def tag_resources(self, resource_ids, name=None, description=None):
+        """ Tag several resources with one CreateTags call. """
+        pass
+
     @abc.abstractmethod
     def stop_instance(self, instance_id):
         pass
@@ -78,13 +112,17 @@ class BaseAWSService(object):
         pass
 
     @abc.abstractmethod
-    def get_volumes(self, tag_key=None, tag_value=None):
+    def get_volumes(self, tag_key=None, tag_value=None, filters=None):
         pass
 
     @abc.abstractmethod
     def get_snapshots(self, *snapshot_ids):
         pass
 
+    @abc.abstractmethod
+    def get_owned_snapshots(self, filters=None):
+        pass
+
     @abc.abstractmethod
     def get_snapshot(self, snapshot_id):
         pass
@@ -118,6 +156,11 @@ class BaseAWSService(object):
                        description=None):
         pass
 
+    @abc.abstractmethod
+    def copy_image(self, source_region, source_image_id, name=None,
+                   description=None):
+        pass
+
     @abc.abstractmethod
     def get_image(self, image_id, retry=False):
         pass
@@ -130,6 +173,26 @@ class BaseAWSService(object):
     def delete_snapshot(self, snapshot_id):
         pass
 
+    @abc.abstractmethod
+    def add_launch_permission(self, image_id, user_ids):
+        pass
+
+    @abc.abstractmethod
+    def get_launch_permission(self, image_id):
+        """ Return the ids of the AWS accounts that can launch the AMI. """
+        pass
+
+    @abc.abstractmethod
+    def add_create_volume_permission(self, snapshot_id, user_ids):
+        pass
+
+    @abc.abstractmethod
+    def get_create_volume_permission(self, snapshot_id):
+        """ Return the ids of the AWS accounts that can create volumes
+        from the snapshot.
+        """
+        pass
+
     @abc.abstractmethod
     def create_security_group(self, name, description, vpc_id=None):
         pass
@@ -138,6 +201,15 @@ class BaseAWSService(object):
     def get_security_group(self, sg_id, retry=False):
         pass
 
+    @abc.abstractmethod
+    def get_security_groups(self, filters=None):
+        pass
+
+    @abc.abstractmethod
+    def get_account_id(self):
+        """ Return the id of the AWS account that owns the credentials. """
+        pass
+
     @abc.abstractmethod
     def add_security_group_rule(self, sg_id, **kwargs):
         pass
@@ -154,6 +226,13 @@ class BaseAWSService(object):
     def get_console_output(self, instance_id):
         pass
 
+    @abc.abstractmethod
+    def get_instance_status(self, instance_id):
+        """ Return the boto InstanceStatus, which has the instance state
+        and the results of the EC2 status checks.
+        """
+        pass
+
     @abc.abstractmethod
     def get_subnet(self, subnet_id):
         pass
@@ -250,7 +329,16 @@ class AWSService(BaseAWSService):
         # These will be initialized by connect().
         self.key_name = None
         self.region = None
-        self.conn = None
+        self.connection_pool = None
+
+        self._account_id = None
+
+    @property
+    def conn(self):
+        """ The calling thread's EC2 connection. """
+        if not self.connection_pool:
+            return None
+        return self.connection_pool.get_connection()
 
     def get_regions(self):
         return boto.vpc.regions()
@@ -258,18 +346,34 @@ class AWSService(BaseAWSService):
     def connect(self, region, key_name=None):
         self.region = region
         self.key_name = key_name
-        self.conn = boto.vpc.connect_to_region(region)
-
-    def connect_as(self, role, region, session_name):
-        sts_conn = boto.sts.connect_to_region(region)
-        creds = sts_conn.assume_role(role, session_name)
-        conn = boto.vpc.connect_to_region(
-            region,
-            aws_access_key_id=creds.credentials.access_key,
-            aws_secret_access_key=creds.credentials.secret_key,
-            security_token=creds.credentials.session_token)
+        self.connection_pool = ConnectionPool(region)
+
+    def connect_with_pool(self, connection_pool, key_name=None):
+        """ Get connections from an existing ConnectionPool, which may be
+        shared with other AWSService objects.
+        """
+        self.region = connection_pool.region
+        self.key_name = key_name
+        self.connection_pool = connection_pool
+
+    def connect_as(self, role, region, session_name,
+                   credential_cache=None):
+        """ Connect with the credentials of an assumed IAM role.
+
+        :param credential_cache a CredentialCache that the credentials
+            are shared through, or None to assume the role just for this
+            service
+        """
+        if credential_cache:
+            credentials = credential_cache.get(role, region, session_name)
+        else:
+            credentials = AssumedRoleCredentials(role, region, session_name)
+        # Assume the role now, so that an error is raised here instead
+        # of on the first API call.
+        credentials.get()
         self.region = region
-        self.conn = conn
+        self.connection_pool = ConnectionPool(
+            region, credentials=credentials)
 
     def retry(self, function, error_code_regexp=None, timeout=None):
         """ Call the retry_boto function with this object's timeout and
@@ -329,21 +433,64 @@ class AWSService(BaseAWSService):
             log.debug('Failed to launch instance for %s', image_id)
             raise
 
+    def run_instances(self,
+                      image_id,
+                      min_count,
+                      max_count,
+                      security_group_ids=None,
+                      instance_type='c3.xlarge',
+                      placement=None,
+                      subnet_id=None,
+                      user_data=None,
+                      ebs_optimized=False,
+                      client_token=None):
+        log.debug(
+            'run_instances: %s, count=%d-%d, security groups=%s, subnet=%s, '
+            'zone=%s, type=%s',
+            image_id, min_count, max_count, security_group_ids, subnet_id,
+            placement, instance_type
+        )
+        run_instances = self.retry(self.conn.run_instances)
+        reservation = run_instances(
+            image_id=image_id,
+            min_count=min_count,
+            max_count=max_count,
+            placement=placement,
+            key_name=self.key_name,
+            instance_type=instance_type,
+            security_group_ids=security_group_ids or [],
+            subnet_id=subnet_id,
+            ebs_optimized=ebs_optimized,
+            user_data=user_data,
+            client_token=client_token
+        )
+        log.debug(
+            'Launched %s', ', '.join(i.id for i in reservation.instances))
+        return reservation.instances
+
     def get_instance(self, instance_id):
         get_only_instances = self.retry(
             self.conn.get_only_instances, r'InvalidInstanceID\.NotFound')
         instances = get_only_instances([instance_id])
         return _get_first_element(instances, 'InvalidInstanceID.NotFound')
 
+    def get_instances(self, filters=None, instance_ids=None):
+        get_only_instances = self.retry(
+            self.conn.get_only_instances, r'InvalidInstanceID\.NotFound')
+        return get_only_instances(instance_ids=instance_ids, filters=filters)
+
     def create_tags(self, resource_id, name=None, description=None):
+        self.tag_resources([resource_id], name=name, description=description)
+
+    def tag_resources(self, resource_ids, name=None, description=None):
         tags = dict(self.default_tags)
         if name:
             tags['Name'] = name
         if description:
             tags['Description'] = description
-        log.debug('Tagging %s with %s', resource_id, tags)
+        log.debug('Tagging %s with %s', ', '.join(resource_ids), tags)
         create_tags = self.retry(self.conn.create_tags, r'.*\.NotFound')
-        create_tags([resource_id], tags)
+        create_tags(resource_ids, tags)
 
     def stop_instance(self, instance_id):
         log.debug('Stopping instance %s', instance_id)
@@ -362,8 +509,8 @@ class AWSService(BaseAWSService):
         volumes = get_all_volumes(volume_ids=[volume_id])
         return _get_first_element(volumes, 'InvalidVolume.NotFound')
 
-    def get_volumes(self, tag_key=None, tag_value=None):
-        filters = {}
+    def get_volumes(self, tag_key=None, tag_value=None, filters=None):
+        filters = dict(filters or {})
         if tag_key and tag_value:
             filters['tag:%s' % tag_key] = tag_value
 
@@ -375,6 +522,10 @@ class AWSService(BaseAWSService):
             self.conn.get_all_snapshots, r'InvalidSnapshot\.NotFound')
         return get_all_snapshots(snapshot_ids)
 
+    def get_owned_snapshots(self, filters=None):
+        get_all_snapshots = self.retry(self.conn.get_all_snapshots)
+        return get_all_snapshots(owner='self', filters=filters)
+
     def get_snapshot(self, snapshot_id):
         snapshots = self.get_snapshots(snapshot_id)
         return _get_first_element(snapshots, 'InvalidSnapshot.NotFound')
@@ -427,6 +578,27 @@ class AWSService(BaseAWSService):
             virtualization_type='paravirtual'
         )
 
+    def copy_image(self, source_region, source_image_id, name=None,
+                   description=None):
+        """ Copy an AMI and its snapshots from another region to this
+        region.  The client token makes retries idempotent, so that a
+        retried request doesn't start a second copy.
+
+        :return the id of the new AMI
+        """
+        log.debug(
+            'Copying %s from %s to %s', source_image_id, source_region,
+            self.region)
+        copy_image = self.retry(self.conn.copy_image)
+        result = copy_image(
+            source_region,
+            source_image_id,
+            name=name,
+            description=description,
+            client_token='%s-%s' % (self.session_id, source_image_id)
+        )
+        return result.image_id
+
     def get_images(self, filters=None, owners=None):
         get_all_images = self.retry(self.conn.get_all_images)
         return get_all_images(filters=filters, owners=owners)
@@ -443,6 +615,42 @@ class AWSService(BaseAWSService):
         delete_snapshot = self.retry(self.conn.delete_snapshot)
         return delete_snapshot(snapshot_id)
 
+    def add_launch_permission(self, image_id, user_ids):
+        log.debug(
+            'Adding launch permission for %d accounts to %s',
+            len(user_ids), image_id)
+        modify_image_attribute = self.retry(self.conn.modify_image_attribute)
+        modify_image_attribute(
+            image_id,
+            attribute='launchPermission',
+            operation='add',
+            user_ids=user_ids
+        )
+
+    def get_launch_permission(self, image_id):
+        get_image_attribute = self.retry(self.conn.get_image_attribute)
+        attribute = get_image_attribute(image_id, 'launchPermission')
+        return attribute.attrs.get('user_ids', [])
+
+    def add_create_volume_permission(self, snapshot_id, user_ids):
+        log.debug(
+            'Adding create volume permission for %d accounts to %s',
+            len(user_ids), snapshot_id)
+        modify_snapshot_attribute = self.retry(
+            self.conn.modify_snapshot_attribute)
+        modify_snapshot_attribute(
+            snapshot_id,
+            attribute='createVolumePermission',
+            operation='add',
+            user_ids=user_ids
+        )
+
+    def get_create_volume_permission(self, snapshot_id):
+        get_snapshot_attribute = self.retry(self.conn.get_snapshot_attribute)
+        attribute = get_snapshot_attribute(
+            snapshot_id, 'createVolumePermission')
+        return attribute.attrs.get('user_ids', [])
+
     def create_security_group(self, name, description, vpc_id=None):
         log.debug(
             'Creating security group: name=%s, description=%s',
@@ -465,6 +673,24 @@ class AWSService(BaseAWSService):
         groups = get_all_security_groups(group_ids=[sg_id])
         return _get_first_element(groups, 'InvalidGroup.NotFound')
 
+    def get_security_groups(self, filters=None):
+        get_all_security_groups = self.retry(
+            self.conn.get_all_security_groups)
+        return get_all_security_groups(filters=filters)
+
+    def get_account_id(self):
+        # Every account has a security group named default, in each VPC
+        # and in EC2-Classic.
+        if not self._account_id:
+            get_all_security_groups = self.retry(
+                self.conn.get_all_security_groups)
+            groups = get_all_security_groups(
+                filters={'group-name': 'default'})
+            if not groups:
+                raise BracketError('Unable to determine the AWS account id')
+            self._account_id = groups[0].owner_id
+        return self._account_id
+
     def add_security_group_rule(self, sg_id, **kwargs):
         kwargs['group_id'] = sg_id
         authorize_security_group = self.retry(
@@ -490,6 +716,13 @@ class AWSService(BaseAWSService):
     def get_console_output(self, instance_id):
         return self.conn.get_console_output(instance_id)
 
+    def get_instance_status(self, instance_id):
+        get_all_instance_status = self.retry(
+            self.conn.get_all_instance_status, r'InvalidInstanceID\.NotFound')
+        statuses = get_all_instance_status(
+            instance_ids=[instance_id], include_all_instances=True)
+        return _get_first_element(statuses, 'InvalidInstanceID.NotFound')
+
     def get_subnet(self, subnet_id):
         subnets = self.conn.get_all_subnets(subnet_ids=[subnet_id])
         return _get_first_element(subnets, 'InvalidSubnetID.NotFound')
@@ -599,6 +832,12 @@ def wait_for_volume(aws_svc, volume_id, timeout=600.0, state='available'):
     :return the Volume object
     :raise VolumeError if the timeout is exceeded
     """
+    return run_sync(wait_for_volume_co(
+        aws_svc, volume_id, timeout=timeout, state=state))
+
+
+def wait_for_volume_co(aws_svc, volume_id, timeout=600.0, state='available'):
+    """ Coroutine version of wait_for_volume(). """
     log.debug(
         'Waiting for %s, timeout=%.02f, state=%s',
         volume_id, timeout, state)
@@ -606,10 +845,10 @@ def wait_for_volume(aws_svc, volume_id, timeout=600.0, state='available'):
     deadline = Deadline(timeout)
     sleep_time = 0.5
     while not deadline.is_expired():
-        volume = aws_svc.get_volume(volume_id)
+        volume = yield Call(aws_svc.get_volume, volume_id)
         if volume.status == state:
-            return volume
-        util.sleep(sleep_time)
+            raise Return(volume)
+        yield Sleep(sleep_time)
         sleep_time *= 2
     raise VolumeError(
         'Timed out waiting for %s to be in the %s state' %
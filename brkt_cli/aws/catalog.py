@@ -0,0 +1,118 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Adds encrypted AMIs to the local image catalog.  See brkt_cli.catalog.
+"""
+
+import logging
+import re
+
+from boto.exception import EC2ResponseError
+
+from brkt_cli import catalog
+from brkt_cli.aws.encrypt_ami import (
+    TAG_ENCRYPTOR,
+    TAG_ENCRYPTOR_AMI,
+    TAG_ENCRYPTOR_SESSION_ID
+)
+from brkt_cli.orphans import parse_time
+
+log = logging.getLogger(__name__)
+
+
+def _get_source_image(description):
+    """ Parse the source AMI from the description that encrypt-ami
+    gives the encrypted AMI.
+    """
+    m = re.match(r'Based on (ami-[0-9a-f]+)', description or '')
+    if m:
+        return m.group(1)
+    return None
+
+
+def make_image_record(image, region, operation=None,
+                      source_image=None, encryptor_image=None,
+                      session_id=None, phase_durations=None):
+    """ Return an ImageRecord for the given AMI.  Lineage that isn't
+    specified is read from the AMI's tags and description.
+    """
+    tags = image.tags or {}
+    snapshot_ids = []
+    volume_size_gb = None
+    for device_name, bdt in sorted(image.block_device_mapping.items()):
+        if bdt.snapshot_id:
+            snapshot_ids.append(bdt.snapshot_id)
+        if device_name == image.root_device_name:
+            volume_size_gb = bdt.size
+    return catalog.make_record(
+        image.id,
+        catalog.CLOUD_AWS,
+        location=region,
+        name=image.name,
+        operation=operation,
+        source_image=(
+            source_image or _get_source_image(image.description)),
+        encryptor_image=encryptor_image or tags.get(TAG_ENCRYPTOR_AMI),
+        session_id=session_id or tags.get(TAG_ENCRYPTOR_SESSION_ID),
+        created_time=parse_time(getattr(image, 'creationDate', None)),
+        volume_size_gb=volume_size_gb,
+        snapshot_ids=snapshot_ids,
+        phase_durations=phase_durations
+    )
+
+
+def record_image(aws_svc, image_id, region, operation, source_image,
+                 encryptor_image, phase_durations=None,
+                 path=catalog.CATALOG_PATH):
+    """ Add the AMI that a session created to the catalog.  Errors are
+    logged and ignored.
+    """
+    try:
+        image = aws_svc.get_image(image_id)
+    except EC2ResponseError as e:
+        log.warn('Unable to add %s to the catalog: %s', image_id, e)
+        return
+    catalog.record_image(
+        make_image_record(
+            image, region, operation=operation, source_image=source_image,
+            encryptor_image=encryptor_image,
+            session_id=aws_svc.session_id,
+            phase_durations=phase_durations
+        ),
+        path=path
+    )
+
+
+def refresh(aws_svc, region, image_catalog):
+    """ Add the encrypted AMIs that we own in the region to the catalog,
+    with one bulk call filtered by the BrktEncryptor tag.  What the
+    sessions recorded takes precedence over what the tags say.  AMIs that
+    are in the catalog but no longer exist are removed.
+
+    :return the number of AMIs that were found
+    """
+    images = aws_svc.get_images(
+        filters={'tag-key': TAG_ENCRYPTOR}, owners=['self'])
+    image_ids = set()
+    for image in images:
+        image_ids.add(image.id)
+        image_catalog.add(make_image_record(image, region), replace=False)
+
+    for record in image_catalog.query(
+            cloud=catalog.CLOUD_AWS, location=region):
+        if record.image_id not in image_ids:
+            log.debug('Removing %s from the catalog', record.image_id)
+            image_catalog.delete(record.image_id)
+    return len(images)
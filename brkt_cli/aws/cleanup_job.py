@@ -0,0 +1,153 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Work that an encryption session hands off when it returns as soon as the
+encrypted AMI is registered: waiting for the AMI to become available,
+tagging it, and deleting the instances, snapshots, volumes and security
+groups that the session created.
+
+A CleanupJob is saved as a JSON file under ~/.brkt/cleanup, so that it
+survives the process that runs it, and encrypt_ami.run_cleanup_job() does
+the work.  start_detached() runs the job in a background process that
+outlives brkt.  "brkt cleanup-sessions" runs the jobs that are still
+pending, for example after the background process was killed.
+"""
+
+import errno
+import json
+import logging
+import os
+import tempfile
+
+from brkt_cli import detach
+from brkt_cli.config import CONFIG_DIR
+from brkt_cli.detach import lock_file
+
+log = logging.getLogger(__name__)
+
+CLEANUP_DIR = os.path.join(CONFIG_DIR, 'cleanup')
+
+_FIELDS = (
+    'session_id', 'region', 'ami', 'snapshot_name', 'description',
+    'image_timeout', 'instance_ids', 'snapshot_ids', 'security_group_ids',
+    'tags'
+)
+
+
+class CleanupJob(object):
+
+    def __init__(self, session_id, region, ami=None, snapshot_name=None,
+                 description=None, image_timeout=None, instance_ids=None,
+                 snapshot_ids=None, security_group_ids=None, tags=None):
+        """
+        :param ami the AMI to wait for and tag, or None
+        :param snapshot_name the name of the AMI's root snapshot
+        :param tags the default tags that the session applied to
+            resources
+        """
+        self.session_id = session_id
+        self.region = region
+        self.ami = ami
+        self.snapshot_name = snapshot_name
+        self.description = description
+        self.image_timeout = image_timeout
+        self.instance_ids = instance_ids or []
+        self.snapshot_ids = snapshot_ids or []
+        self.security_group_ids = security_group_ids or []
+        self.tags = tags or {}
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in _FIELDS}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(**{name: d.get(name) for name in _FIELDS})
+
+
+def get_job_path(session_id, directory=None):
+    return os.path.join(directory or CLEANUP_DIR, session_id + '.json')
+
+
+def save_job(job, directory=None):
+    """ Write the job to the cleanup directory.
+
+    :return the path to the job file
+    """
+    directory = directory or CLEANUP_DIR
+    try:
+        os.makedirs(directory)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    path = get_job_path(job.session_id, directory)
+    fd, tmp_path = tempfile.mkstemp(dir=directory)
+    with os.fdopen(fd, 'w') as f:
+        json.dump(job.to_dict(), f, indent=2)
+    os.rename(tmp_path, path)
+    log.info('Saved cleanup job for session %s to %s', job.session_id, path)
+    return path
+
+
+def load_job(path):
+    with open(path) as f:
+        return CleanupJob.from_dict(json.load(f))
+
+
+def lock_job(path):
+    """ Take an exclusive lock on the job file, so that two processes
+    don't run the same job.
+
+    :return the file object that holds the lock, or None if another
+        process holds it
+    """
+    return lock_file(path)
+
+
+def get_pending_job_paths(directory=None):
+    """ Return the paths of the jobs that haven't completed, oldest
+    first.
+    """
+    directory = directory or CLEANUP_DIR
+    try:
+        filenames = os.listdir(directory)
+    except OSError as e:
+        if e.errno == errno.ENOENT:
+            return []
+        raise
+    paths = [
+        os.path.join(directory, f) for f in filenames if f.endswith('.json')
+    ]
+    return sorted(paths, key=os.path.getmtime)
+
+
+def start_detached(path):
+    """ Run "brkt cleanup-sessions --job path" in a new session, so that it
+    keeps running after this process exits.  Output is written to a log
+    file next to the job file.
+
+    :return the process id
+    """
+    log_path = os.path.splitext(path)[0] + '.log'
+    pid = detach.start_detached(
+        ['cleanup-sessions', '--job', path], log_path)
+    log.info(
+        'Cleaning up in the background, process %d.  Writing log to %s',
+        pid, log_path)
+    return pid
+
+
+def hand_off(job):
+    """ Save the job and run it in a detached process. """
+    start_detached(save_job(job))
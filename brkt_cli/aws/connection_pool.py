@@ -0,0 +1,263 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Per-thread EC2 connections.
+
+boto connections are not safe to share between threads, so the pool
+gives each thread its own connection.  A thread keeps using the same
+connection for every call, which lets boto reuse the underlying
+keep-alive HTTPS connection instead of doing a new TLS handshake.
+
+The region and credentials are shared by all threads.  Assumed-role
+credentials are refreshed in one place, before they expire.  When the
+credentials change, each thread opens a new connection the next time it
+asks for one.
+
+A CredentialCache shares assumed-role credentials between the pools that
+use the same role, for example one pool per region in each of several
+accounts.  It can also save the credentials under ~/.brkt/credentials,
+so that the next run of brkt reuses them until they are about to expire
+instead of calling AssumeRole again.
+"""
+
+import errno
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+
+import boto.sts
+import boto.vpc
+from boto.sts.credentials import Credentials
+
+from brkt_cli.config import CONFIG_DIR
+
+log = logging.getLogger(__name__)
+
+# Refresh assumed-role credentials when they are this close to expiring.
+DEFAULT_REFRESH_SECONDS = 300
+
+CREDENTIALS_DIR = os.path.join(CONFIG_DIR, 'credentials')
+
+
+class AssumedRoleCredentials(object):
+    """ Temporary credentials returned by STS AssumeRole.  The credentials
+    are cached and refreshed when they are about to expire.
+    """
+
+    def __init__(self, role, region, session_name,
+                 refresh_seconds=DEFAULT_REFRESH_SECONDS, cache_path=None):
+        """
+        :param cache_path the file that the credentials are saved to and
+            loaded from, or None to only cache them in memory
+        """
+        self.role = role
+        self.region = region
+        self.session_name = session_name
+        self.refresh_seconds = refresh_seconds
+        self.cache_path = cache_path
+        self._lock = threading.Lock()
+        self._credentials = None
+
+    def _assume_role(self):
+        sts_conn = boto.sts.connect_to_region(self.region)
+        return sts_conn.assume_role(self.role, self.session_name).credentials
+
+    def _is_expired(self, credentials):
+        return credentials.is_expired(
+            time_offset_seconds=self.refresh_seconds)
+
+    def _load(self):
+        """ Return the credentials saved in cache_path, or None if the
+        file doesn't exist, can't be read or has expired credentials.
+        """
+        try:
+            credentials = Credentials.load(self.cache_path)
+            if self._is_expired(credentials):
+                return None
+        except (IOError, ValueError, TypeError, AttributeError) as e:
+            if getattr(e, 'errno', None) != errno.ENOENT:
+                log.debug(
+                    'Unable to load credentials from %s: %s',
+                    self.cache_path, e)
+            return None
+        log.debug('Loaded credentials for %s from %s', self.role,
+                  self.cache_path)
+        return credentials
+
+    def _save(self, credentials):
+        """ Write the credentials to cache_path.  The file is only
+        readable by the owner.  A failure is logged and ignored, since the
+        credentials are still cached in memory.
+        """
+        directory = os.path.dirname(self.cache_path)
+        try:
+            try:
+                os.makedirs(directory, 0o700)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            fd, tmp_path = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(credentials.to_dict(), f)
+            os.rename(tmp_path, self.cache_path)
+        except (IOError, OSError) as e:
+            log.warn(
+                'Unable to save credentials to %s: %s', self.cache_path, e)
+
+    def get(self):
+        """ Return the current boto.sts.credentials.Credentials object,
+        calling AssumeRole if the cached credentials are missing or about
+        to expire.
+        """
+        with self._lock:
+            if self._credentials is None and self.cache_path:
+                self._credentials = self._load()
+            if (self._credentials is None or
+                    self._is_expired(self._credentials)):
+                log.debug('Assuming role %s', self.role)
+                self._credentials = self._assume_role()
+                if self.cache_path:
+                    self._save(self._credentials)
+            return self._credentials
+
+
+class CredentialCache(object):
+    """ Hands out one AssumedRoleCredentials object per role, so that the
+    services that use the same role share its credentials.  The roles are
+    assumed independently, so a slow AssumeRole call for one role doesn't
+    hold up the others.
+    """
+
+    credentials_class = AssumedRoleCredentials
+
+    def __init__(self, directory=None,
+                 refresh_seconds=DEFAULT_REFRESH_SECONDS):
+        """
+        :param directory the directory that credentials are saved in, or
+            None to only cache them in memory
+        """
+        self.directory = directory
+        self.refresh_seconds = refresh_seconds
+        self._lock = threading.Lock()
+        self._credentials = {}
+
+    def get_path(self, role):
+        """ Return the path to the file that the role's credentials are
+        saved in.
+        """
+        return os.path.join(
+            self.directory, re.sub(r'[^\w.-]', '_', role) + '.json')
+
+    def get(self, role, region, session_name):
+        """ Return the AssumedRoleCredentials object for the role.  The
+        role isn't assumed until the credentials are first used.
+        """
+        with self._lock:
+            credentials = self._credentials.get(role)
+            if credentials is None:
+                cache_path = None
+                if self.directory:
+                    cache_path = self.get_path(role)
+                credentials = self.credentials_class(
+                    role, region, session_name,
+                    refresh_seconds=self.refresh_seconds,
+                    cache_path=cache_path
+                )
+                self._credentials[role] = credentials
+            return credentials
+
+
+class ConnectionPool(object):
+    """ Hands out one EC2 connection per thread for the given region. """
+
+    def __init__(self, region, credentials=None, connect=None):
+        """
+        :param region the AWS region
+        :param credentials an AssumedRoleCredentials object, or None to
+            use boto's default credentials
+        :param connect the function that opens a new connection, with the
+            same signature as boto.vpc.connect_to_region()
+        """
+        self.region = region
+        self.credentials = credentials
+        self._connect = connect or boto.vpc.connect_to_region
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._all_connections = []
+
+    def _get_connect_args(self):
+        """ Return a tuple of the key that identifies the current
+        credentials and the keyword arguments that are passed to the
+        connect function.
+        """
+        if not self.credentials:
+            return None, {}
+        creds = self.credentials.get()
+        key = (creds.access_key, creds.session_token)
+        kwargs = {
+            'aws_access_key_id': creds.access_key,
+            'aws_secret_access_key': creds.secret_key,
+            'security_token': creds.session_token
+        }
+        return key, kwargs
+
+    def get_connection(self):
+        """ Return the calling thread's connection, creating it if
+        necessary.
+        """
+        key, kwargs = self._get_connect_args()
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None and self._local.key == key:
+            return conn
+
+        if conn is not None:
+            log.debug('Credentials changed, opening a new connection')
+            self._close(conn)
+
+        conn = self._connect(self.region, **kwargs)
+        self._local.conn = conn
+        self._local.key = key
+        with self._lock:
+            self._all_connections.append(conn)
+        log.debug(
+            'Opened connection to %s for thread %s',
+            self.region, threading.current_thread().name
+        )
+        return conn
+
+    def _close(self, conn):
+        with self._lock:
+            if conn in self._all_connections:
+                self._all_connections.remove(conn)
+        if conn is not None and hasattr(conn, 'close'):
+            conn.close()
+
+    def get_connection_count(self):
+        """ Return the number of open connections, across all threads. """
+        with self._lock:
+            return len(self._all_connections)
+
+    def close(self):
+        """ Close the connections that were opened by all threads. """
+        with self._lock:
+            connections = self._all_connections
+            self._all_connections = []
+        for conn in connections:
+            if conn is not None and hasattr(conn, 'close'):
+                conn.close()
+        self._local = threading.local()
@@ -0,0 +1,232 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Copies encrypted AMIs to other regions.
+
+An AMI only has to be encrypted once.  CopyImage copies the AMI and its
+snapshots to each target region, and all of the copies run at the same
+time, so the total time is the time of the slowest copy.  Each target
+region has a single poller that waits for all of the copies in that
+region.  Tags aren't copied by AWS, so the copies and their snapshots are
+tagged with the target AWSService's default tags, which include the
+encryptor AMI for the target region, and the snapshot names from the
+source region.
+"""
+
+import logging
+import time
+
+from brkt_cli.engine import Call, Engine, Return, Sleep, gather_co
+from brkt_cli.util import BracketError, Deadline
+from brkt_cli.validation import ValidationError
+
+log = logging.getLogger(__name__)
+
+# Cross-region copies of large snapshots can take much longer than
+# creating an image in the same region.
+DEFAULT_COPY_TIMEOUT = 3 * 60 * 60
+
+
+def parse_regions(regions_string):
+    """ Parse a comma-separated list of region names.
+
+    :raise ValidationError if a region is specified more than once
+    """
+    regions = [r.strip() for r in regions_string.split(',') if r.strip()]
+    if len(set(regions)) != len(regions):
+        raise ValidationError('Duplicate region in %s' % regions_string)
+    return regions
+
+
+def find_encryptor_amis(source_svc, encryptor_ami, target_svcs):
+    """ Find the copy of the encryptor AMI in each target region.  The
+    copies have the same name and owner as the encryptor AMI in the
+    source region.
+
+    :param target_svcs a dictionary of region name to AWSService
+    :return a dictionary of region name to encryptor AMI id
+    :raise ValidationError if the encryptor AMI isn't available in one of
+        the regions
+    """
+    encryptor_image = source_svc.get_image(encryptor_ami)
+    encryptor_amis = {}
+    for region, aws_svc in target_svcs.iteritems():
+        images = aws_svc.get_images(
+            filters={'name': encryptor_image.name},
+            owners=[encryptor_image.owner_id]
+        )
+        if not images:
+            raise ValidationError(
+                'Encryptor %s (%s) is not available in %s' %
+                (encryptor_ami, encryptor_image.name, region))
+        encryptor_amis[region] = images[0].id
+    return encryptor_amis
+
+
+def wait_for_images_co(aws_svc, image_ids, timeout=DEFAULT_COPY_TIMEOUT):
+    """ Wait for all of the AMIs to become available, with one
+    DescribeImages call per poll.  AMIs that haven't shown up yet are
+    treated as pending.
+
+    :raise BracketError if an AMI fails or the timeout expires
+    """
+    log.debug(
+        'Waiting for %s in %s, timeout=%d', ', '.join(image_ids),
+        aws_svc.region, timeout)
+    deadline = Deadline(timeout)
+    pending = set(image_ids)
+    while True:
+        images = yield Call(
+            aws_svc.get_images, filters={'image-id': list(pending)})
+        for image in images:
+            log.debug('%s: %s', image.id, image.state)
+            if image.state == 'failed':
+                raise BracketError(
+                    'Copy of %s failed in %s: %s' % (
+                        image.id, aws_svc.region,
+                        getattr(image, 'stateReason', None)))
+            if image.state == 'available':
+                pending.discard(image.id)
+        if not pending:
+            return
+        if deadline.is_expired():
+            break
+        yield Sleep(10)
+    raise BracketError(
+        '%s did not become available in %s after %d seconds' %
+        (', '.join(sorted(pending)), aws_svc.region, timeout))
+
+
+def _tag_copy_co(aws_svc, copy_id, snapshot_names):
+    image = yield Call(aws_svc.get_image, copy_id, retry=True)
+    for device_name, bdt in image.block_device_mapping.iteritems():
+        if bdt.snapshot_id:
+            yield Call(
+                aws_svc.create_tags,
+                bdt.snapshot_id,
+                name=snapshot_names.get(device_name)
+            )
+    yield Call(aws_svc.create_tags, copy_id)
+
+
+def copy_to_region_co(aws_svc, source_region, images, snapshot_names,
+                      timeout=DEFAULT_COPY_TIMEOUT):
+    """ Copy the AMIs to the region of aws_svc and tag the copies.
+
+    :param images the boto Image objects in the source region
+    :param snapshot_names a dictionary of AMI id to a dictionary of device
+        name to snapshot name
+    :return a dictionary of source AMI id to the id of its copy
+    """
+    copies = {}
+    for image in images:
+        copy_id = yield Call(
+            aws_svc.copy_image, source_region, image.id, name=image.name,
+            description=image.description)
+        log.info(
+            'Copying %s from %s to %s as %s', image.id, source_region,
+            aws_svc.region, copy_id)
+        copies[image.id] = copy_id
+
+    start = time.time()
+    yield wait_for_images_co(aws_svc, copies.values(), timeout=timeout)
+    log.info(
+        'Copied %d AMIs to %s in %d seconds', len(copies), aws_svc.region,
+        time.time() - start)
+
+    for image_id, copy_id in copies.iteritems():
+        yield _tag_copy_co(aws_svc, copy_id, snapshot_names[image_id])
+    raise Return(copies)
+
+
+def _copy_to_region_or_log_co(aws_svc, *args, **kwargs):
+    try:
+        copies = yield copy_to_region_co(aws_svc, *args, **kwargs)
+    except Exception as e:
+        log.error('Unable to copy to %s: %s', aws_svc.region, e)
+        log.debug('Copy failed', exc_info=1)
+        raise Return(None)
+    raise Return(copies)
+
+
+def _get_snapshot_names(source_svc, images):
+    """ Return a dictionary of AMI id to a dictionary of device name to
+    the name of the snapshot in the source region.
+    """
+    snapshot_ids = [
+        bdt.snapshot_id
+        for image in images
+        for bdt in image.block_device_mapping.values()
+        if bdt.snapshot_id
+    ]
+    names = {}
+    if snapshot_ids:
+        for snapshot in source_svc.get_snapshots(*snapshot_ids):
+            names[snapshot.id] = snapshot.tags.get('Name')
+
+    result = {}
+    for image in images:
+        result[image.id] = {
+            device_name: names.get(bdt.snapshot_id)
+            for device_name, bdt in image.block_device_mapping.iteritems()
+        }
+    return result
+
+
+def copy_amis_co(source_svc, image_ids, target_svcs,
+                 timeout=DEFAULT_COPY_TIMEOUT):
+    """ Coroutine version of copy_amis(). """
+    # The AMIs may have been registered with --early-return, and can't be
+    # copied until they're available.
+    yield wait_for_images_co(source_svc, image_ids, timeout=timeout)
+    images = []
+    for image_id in image_ids:
+        image = yield Call(source_svc.get_image, image_id)
+        images.append(image)
+    snapshot_names = yield Call(_get_snapshot_names, source_svc, images)
+
+    regions = sorted(target_svcs)
+    results = yield gather_co(*[
+        _copy_to_region_or_log_co(
+            target_svcs[region], source_svc.region, images, snapshot_names,
+            timeout=timeout)
+        for region in regions
+    ])
+    raise Return({
+        region: copies for region, copies in zip(regions, results)
+        if copies is not None
+    })
+
+
+def copy_amis(source_svc, image_ids, target_svcs,
+              timeout=DEFAULT_COPY_TIMEOUT):
+    """ Copy the AMIs to each of the target regions in parallel.  The
+    target services' default tags are applied to the copies, so they
+    should include the encryptor AMI for the target region.  A failure
+    in one region doesn't stop the copies to the other regions.
+
+    :param source_svc the AWSService for the region that has the AMIs
+    :param target_svcs a dictionary of region name to connected AWSService
+    :return a dictionary of region name to a dictionary of source AMI id
+        to copied AMI id.  Regions where the copy failed are omitted.
+    """
+    engine = Engine(max_workers=max(len(target_svcs), 1))
+    try:
+        return engine.run_until_complete(
+            copy_amis_co(source_svc, image_ids, target_svcs, timeout=timeout),
+            session=source_svc.session
+        )
+    finally:
+        engine.shutdown()
@@ -0,0 +1,72 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+
+
+def setup_copy_encrypted_ami_args(parser):
+    parser.add_argument(
+        'amis',
+        metavar='ID',
+        nargs='+',
+        help='The encrypted AMI that will be copied'
+    )
+    parser.add_argument(
+        '--region',
+        metavar='NAME',
+        help='The AWS region that has the encrypted AMI (e.g. us-west-2)',
+        dest='region',
+        required=True
+    )
+    parser.add_argument(
+        '--to-regions',
+        metavar='REGIONS',
+        dest='to_regions',
+        required=True,
+        help=(
+            'Comma-separated list of regions that the AMI is copied to.  '
+            'The copies run in parallel.'
+        )
+    )
+    parser.add_argument(
+        '--tag',
+        metavar='KEY=VALUE',
+        dest='tags',
+        action='append',
+        help=(
+            'Custom tag for the copied AMIs and snapshots. '
+            'May be specified multiple times.'
+        )
+    )
+    parser.add_argument(
+        '-v',
+        '--verbose',
+        dest='copy_encrypted_ami_verbose',
+        action='store_true',
+        help='Print status information to the console'
+    )
+    parser.add_argument(
+        '--retry-timeout',
+        metavar='SECONDS',
+        type=float,
+        help=argparse.SUPPRESS,
+        default=10.0
+    )
+    parser.add_argument(
+        '--retry-initial-sleep-seconds',
+        metavar='SECONDS',
+        type=float,
+        help=argparse.SUPPRESS,
+        default=0.25
+    )
@@ -13,18 +13,16 @@
 # limitations under the License.
 
 import logging
-import time
-from brkt_cli.aws.encrypt_ami import (
-    wait_for_instance,
-)
 
 from boto.ec2.blockdevicemapping import (
     BlockDeviceMapping,
     EBSBlockDeviceType,
 )
 
-from brkt_cli.aws.share_logs import snapshot_log_volume
+from brkt_cli.aws.encrypt_ami import wait_for_instance
+from brkt_cli.aws.share_logs import snapshot_log_volumes
 from brkt_cli.util import make_nonce
+from brkt_cli.validation import ValidationError
 
 # Security group names
 NAME_DIAG_SECURITY_GROUP = 'Bracket Diag %(nonce)s'
@@ -35,6 +33,13 @@ DESCRIPTION_DIAG_SECURITY_GROUP = (
 NAME_DIAG_INSTANCE = 'Bracket Diag for snapshot %(snapshot_id)s'
 DESCRIPTION_DIAG_INSTANCE = \
     'Diag instance with logs from %(snapshot_id)s'
+NAME_DIAG_INSTANCE_MULTI = 'Bracket Diag for %(count)d log snapshots'
+DESCRIPTION_DIAG_INSTANCE_MULTI = \
+    'Diag instance with logs from %(count)d snapshots'
+
+# Log volumes are attached to the diag instance at these devices, in
+# order.  /dev/sda3 is the first free mountpoint.
+DIAG_LOG_DEVICES = ['/dev/sda3'] + ['/dev/sd%s' % c for c in 'fghijklmnop']
 
 # NetBSD 6.1.5 images taken from https://wiki.netbsd.org/amazon_ec2/amis/
 # as of 7/18/2016
@@ -73,13 +78,35 @@ def create_diag_security_group(aws_svc, vpc_id=None):
 
 
 def diag(aws_svc=None, region='us-west-2',
-         instance_id=None, snapshot_id=None,
+         instance_ids=None, snapshot_ids=None,
          vpc_id=None, subnet_id=None, security_group_ids=None,
          diag_instance_type='m3.medium', ssh_keypair=None):
-    if instance_id:
-        snapshot_id = snapshot_log_volume(aws_svc, instance_id).id
-        log.info("Waiting for 30 seconds for snapshot to be available")
-        time.sleep(30)
+    """ Launch one diag instance with the log volumes of the instances
+    and the given log snapshots attached.  The log volumes of all of the
+    instances are snapshotted at once.
+
+    :return the number of instances whose logs couldn't be snapshotted
+    """
+    instance_ids = instance_ids or []
+    snapshot_ids = list(snapshot_ids or [])
+    if len(instance_ids) + len(snapshot_ids) > len(DIAG_LOG_DEVICES):
+        raise ValidationError(
+            'A diag instance can attach at most %d log volumes' %
+            len(DIAG_LOG_DEVICES))
+
+    sources = {snapshot_id: snapshot_id for snapshot_id in snapshot_ids}
+    failed = 0
+    if instance_ids:
+        snapshots = snapshot_log_volumes(aws_svc, instance_ids)
+        failed = len(instance_ids) - len(snapshots)
+        for instance_id in instance_ids:
+            if instance_id in snapshots:
+                snapshot_id = snapshots[instance_id].id
+                snapshot_ids.append(snapshot_id)
+                sources[snapshot_id] = instance_id
+    if not snapshot_ids:
+        log.error('No log snapshots to attach')
+        return failed
 
     diag_image = DIAG_IMAGES_BY_REGION[region]
 
@@ -93,13 +120,11 @@ def diag(aws_svc=None, region='us-west-2',
         temp_sg_id = create_diag_security_group(aws_svc, vpc_id=vpc_id).id
         security_group_ids = [temp_sg_id]
 
-    log_volume = EBSBlockDeviceType(
-        delete_on_termination=True,
-        snapshot_id=snapshot_id)
     bdm = BlockDeviceMapping()
-
-    # Choose /dev/sda3 since it is the first free mountpoint
-    bdm['/dev/sda3'] = log_volume
+    for device_name, snapshot_id in zip(DIAG_LOG_DEVICES, snapshot_ids):
+        bdm[device_name] = EBSBlockDeviceType(
+            delete_on_termination=True,
+            snapshot_id=snapshot_id)
 
     diag_instance = aws_svc.run_instance(
         diag_image,
@@ -109,11 +134,16 @@ def diag(aws_svc=None, region='us-west-2',
         security_group_ids=security_group_ids,
         block_device_map=bdm)
 
-    aws_svc.create_tags(
-        diag_instance.id,
-        name=NAME_DIAG_INSTANCE % {'snapshot_id': snapshot_id},
-        description=DESCRIPTION_DIAG_INSTANCE % {'snapshot_id': snapshot_id}
-    )
+    if len(snapshot_ids) == 1:
+        params = {'snapshot_id': snapshot_ids[0]}
+        name = NAME_DIAG_INSTANCE % params
+        description = DESCRIPTION_DIAG_INSTANCE % params
+    else:
+        # Tag values are limited to 255 characters.
+        params = {'count': len(snapshot_ids)}
+        name = NAME_DIAG_INSTANCE_MULTI % params
+        description = DESCRIPTION_DIAG_INSTANCE_MULTI % params
+    aws_svc.create_tags(diag_instance.id, name=name, description=description)
 
     wait_for_instance(aws_svc, diag_instance.id)
 
@@ -126,3 +156,9 @@ def diag(aws_svc=None, region='us-west-2',
     print "User: root"
     print "SSH Keypair: %s" % ssh_keypair
     print "Log volume mountpoint: /dev/xbd2a for PV, /dev/xbd2e for HVM"
+    if len(snapshot_ids) > 1:
+        print "Log volumes:"
+        for device_name, snapshot_id in zip(DIAG_LOG_DEVICES, snapshot_ids):
+            print "  %s: %s (%s)" % (
+                device_name, snapshot_id, sources[snapshot_id])
+    return failed
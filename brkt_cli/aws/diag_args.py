@@ -19,14 +19,34 @@ def setup_diag_args(parser):
     parser.add_argument(
         '--snapshot',
         metavar='ID',
-        dest='snapshot_id',
-        help='The snapshot with Bracket system logs'
+        dest='snapshot_ids',
+        action='append',
+        help=(
+            'The snapshot with Bracket system logs.  May be specified '
+            'multiple times.'
+        )
     )
     parser.add_argument(
         '--instance',
         metavar='ID',
-        dest='instance_id',
-        help='The instance with Bracket system logs'
+        dest='instance_ids',
+        action='append',
+        help=(
+            'The instance with Bracket system logs.  May be specified '
+            'multiple times.  The log volumes of all of the instances '
+            'are attached to one diag instance.'
+        )
+    )
+    parser.add_argument(
+        '--instance-tag',
+        metavar='KEY=VALUE',
+        dest='instance_tags',
+        action='append',
+        help=(
+            'Use the logs of the instances that have this tag.  May be '
+            'specified multiple times, to select instances that have all '
+            'of the tags.'
+        )
     )
     parser.add_argument(
         '--diag-instance-type',
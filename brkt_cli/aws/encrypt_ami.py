@@ -37,9 +37,10 @@ AWS_SECRET_ACCESS_KEY environment variables, like you would when
 running the AWS command line utility.
 """
 
+import collections
 import logging
-import os
 import string
+import sys
 import tempfile
 import time
 
@@ -51,15 +52,19 @@ from boto.ec2.instance import InstanceAttribute
 from boto.exception import EC2ResponseError
 
 from brkt_cli import encryptor_service
+from brkt_cli.admission import HostSemaphore, make_semaphore_name
 from brkt_cli.aws import aws_service
+from brkt_cli.aws.cleanup_job import CleanupJob
+from brkt_cli.engine import Call, Return, Sleep, run_sync
 from brkt_cli.instance_config import InstanceConfig
+from brkt_cli.timeouts import DEFAULT_TIMEOUTS, IMAGE, Timeouts, get_timeouts
 from brkt_cli.user_data import gzip_user_data
 from brkt_cli.util import (
     BracketError,
     Deadline,
     make_nonce,
-    sleep,
     append_suffix)
+from brkt_cli.workflow import Workflow
 from datetime import datetime
 
 # End user-visible terminology.  These are resource names and descriptions
@@ -167,17 +172,23 @@ def wait_for_instance(
     :raises InstanceError if a timeout occurs or the instance unexpectedly
         goes into an error or terminated state
     """
+    return run_sync(wait_for_instance_co(
+        aws_svc, instance_id, timeout=timeout, state=state))
 
+
+def wait_for_instance_co(
+        aws_svc, instance_id, timeout=300, state='running'):
+    """ Coroutine version of wait_for_instance(). """
     log.debug(
         'Waiting for %s, timeout=%d, state=%s',
         instance_id, timeout, state)
 
     deadline = Deadline(timeout)
     while not deadline.is_expired():
-        instance = aws_svc.get_instance(instance_id)
+        instance = yield Call(aws_svc.get_instance, instance_id)
         log.debug('Instance %s state=%s', instance.id, instance.state)
         if instance.state == state:
-            return instance
+            raise Return(instance)
         if instance.state == 'error':
             raise InstanceError(
                 'Instance %s is in an error state.  Cannot proceed.' %
@@ -187,20 +198,108 @@ def wait_for_instance(
             raise InstanceError(
                 'Instance %s was unexpectedly terminated.' % instance_id
             )
-        sleep(2)
+        yield Sleep(2)
     raise InstanceError(
         'Timed out waiting for %s to be in the %s state' %
         (instance_id, state)
     )
 
 
+def check_encryptor_instance(aws_svc, instance_id):
+    """ Check that the encryptor or updater instance is still running.
+
+    :raise EncryptorInstanceError if the instance has stopped or
+        terminated, or failed an EC2 status check
+    """
+    status = aws_svc.get_instance_status(instance_id)
+    if status.state_name in ('stopping', 'stopped', 'shutting-down',
+                             'terminated'):
+        raise encryptor_service.EncryptorInstanceError(
+            'Encryptor instance %s is %s' % (instance_id, status.state_name),
+            state=status.state_name
+        )
+    for name, check in (('system', status.system_status),
+                        ('instance', status.instance_status)):
+        if check.status == 'impaired':
+            raise encryptor_service.EncryptorInstanceError(
+                'Encryptor instance %s failed the EC2 %s status check' %
+                (instance_id, name)
+            )
+
+
+def make_instance_watcher(aws_svc, instance_id):
+    """ Return an InstanceWatcher that checks the instance state and
+    status checks, and scans the console output for signs of a crash.
+    """
+    def _get_console_output():
+        return aws_svc.get_console_output(instance_id).output
+
+    return encryptor_service.InstanceWatcher(
+        instance_id,
+        lambda: check_encryptor_instance(aws_svc, instance_id),
+        get_console_output=_get_console_output
+    )
+
+
+def collect_failure_info_co(aws_svc, e, instance_id,
+                            save_encryptor_logs=False, stop_timeout=300):
+    """ Gather what is needed to diagnose a failed encryptor or updater
+    instance: optionally start a snapshot of the log volume, stop the
+    instance, so that AWS captures the console output, and write the
+    console output once the instance has stopped.  The log snapshot
+    completes while the instance stops and the session is torn down, so
+    it isn't waited for.  Errors are logged, so that they don't hide the
+    original failure.
+    """
+    state = getattr(e, 'state', None)
+    if state in ('shutting-down', 'terminated'):
+        if save_encryptor_logs:
+            log.warn(
+                'Unable to save logs, since instance %s is %s',
+                instance_id, state)
+        yield Call(log_exception_console, aws_svc, e, instance_id)
+        return
+
+    if save_encryptor_logs:
+        log.info('Saving logs from encryptor instance in snapshot')
+        try:
+            # The snapshot captures the volume as soon as it's pending,
+            # so the instance can be terminated while it completes.
+            log_snapshot = yield snapshot_log_volume_co(
+                aws_svc, instance_id, wait=False)
+            log.info('Encryptor logs are being saved in snapshot '
+                     '%(snapshot_id)s. '
+                     'Run `brkt share-logs --region %(region)s '
+                     '--snapshot-id %(snapshot_id)s` '
+                     'to share this snapshot with Bracket support' %
+                     {'snapshot_id': log_snapshot.id,
+                      'region': aws_svc.region})
+        except Exception:
+            log.exception(
+                'Unable to save logs from instance %s', instance_id)
+
+    try:
+        yield Call(aws_svc.stop_instance, instance_id)
+        yield wait_for_instance_co(
+            aws_svc, instance_id, state='stopped', timeout=stop_timeout)
+    except Exception:
+        log.exception(
+            'Error while waiting for instance %s to stop', instance_id)
+    yield Call(log_exception_console, aws_svc, e, instance_id)
+
+
 def stop_and_wait(aws_svc, instance_id):
     """ Stop the given instance and wait for it to be in the stopped state.
     If an exception is thrown, log the error and return.
     """
+    run_sync(stop_and_wait_co(aws_svc, instance_id))
+
+
+def stop_and_wait_co(aws_svc, instance_id):
+    """ Coroutine version of stop_and_wait(). """
     try:
-        aws_svc.stop_instance(instance_id)
-        wait_for_instance(aws_svc, instance_id, state='stopped')
+        yield Call(aws_svc.stop_instance, instance_id)
+        yield wait_for_instance_co(aws_svc, instance_id, state='stopped')
     except:
         log.exception(
             'Error while waiting for instance %s to stop', instance_id)
@@ -235,12 +334,19 @@ def get_description_from_image(image):
     return description
 
 
-def wait_for_image(aws_svc, image_id):
-    log.debug('Waiting for %s to become available.', image_id)
-    for i in range(180):
-        sleep(5)
+def wait_for_image(aws_svc, image_id, timeout=DEFAULT_TIMEOUTS.image):
+    run_sync(wait_for_image_co(aws_svc, image_id, timeout=timeout))
+
+
+def wait_for_image_co(aws_svc, image_id, timeout=DEFAULT_TIMEOUTS.image):
+    """ Coroutine version of wait_for_image(). """
+    log.debug(
+        'Waiting for %s to become available, timeout=%d.', image_id, timeout)
+    deadline = Deadline(timeout)
+    while not deadline.is_expired():
+        yield Sleep(5)
         try:
-            image = aws_svc.get_image(image_id)
+            image = yield Call(aws_svc.get_image, image_id)
         except EC2ResponseError, e:
             if e.error_code == 'InvalidAMIID.NotFound':
                 log.debug('AWS threw a NotFound, ignoring')
@@ -254,24 +360,29 @@ def wait_for_image(aws_svc, image_id):
         log.debug("%s: %s reason: %s code: %s",
                   image.id, image.state, reason, code)
         if image.state == 'available':
-            break
+            return
         if image.state == 'failed':
             raise BracketError('Image state became failed')
-    else:
-        raise BracketError(
-            'Image failed to become available (%s)' % (image.state,))
+    raise BracketError(
+        'Image failed to become available after %d seconds (%s)' %
+        (timeout, image.state))
 
 
 def wait_for_snapshots(aws_svc, *snapshot_ids):
+    run_sync(wait_for_snapshots_co(aws_svc, *snapshot_ids))
+
+
+def wait_for_snapshots_co(aws_svc, *snapshot_ids):
+    """ Coroutine version of wait_for_snapshots(). """
     log.debug('Waiting for status "completed" for %s', str(snapshot_ids))
     last_progress_log = time.time()
 
     # Give AWS some time to propagate the snapshot creation.
     # If we create and get immediately, AWS may return 400.
-    sleep(20)
+    yield Sleep(20)
 
     while True:
-        snapshots = aws_svc.get_snapshots(*snapshot_ids)
+        snapshots = yield Call(aws_svc.get_snapshots, *snapshot_ids)
         log.debug('%s', {s.id: s.status for s in snapshots})
 
         done = True
@@ -298,7 +409,7 @@ def wait_for_snapshots(aws_svc, *snapshot_ids):
             log.info(_get_snapshot_progress_text(snapshots))
             last_progress_log = now
 
-        sleep(5)
+        yield Sleep(5)
 
 
 def create_encryptor_security_group(aws_svc, vpc_id=None, status_port=\
@@ -326,18 +437,35 @@ def create_encryptor_security_group(aws_svc, vpc_id=None, status_port=\
     return sg
 
 
-def _run_encryptor_instance(
-        aws_svc, encryptor_image_id, snapshot, root_size, guest_image_id,
-        security_group_ids=None, subnet_id=None, zone=None,
-        instance_config=None,
+def create_temporary_security_group_co(
+        aws_svc, subnet_id=None,
         status_port=encryptor_service.ENCRYPTOR_STATUS_PORT):
+    """ Create a temporary security group that allows brkt-cli to poll
+    the encryptor or updater for status.
+
+    :return the security group id
+    """
+    vpc_id = None
+    if subnet_id:
+        subnet = yield Call(aws_svc.get_subnet, subnet_id)
+        vpc_id = subnet.vpc_id
+    sg = yield Call(
+        create_encryptor_security_group,
+        aws_svc, vpc_id=vpc_id, status_port=status_port
+    )
+    raise Return(sg.id)
+
+
+def _run_encryptor_instance_co(
+        aws_svc, encryptor_image, snapshot, root_size, guest_image_id,
+        security_group_ids, temporary_security_group=False, subnet_id=None,
+        zone=None, instance_config=None):
     bdm = BlockDeviceMapping()
 
     if instance_config is None:
         instance_config = InstanceConfig()
 
-    image = aws_svc.get_image(encryptor_image_id)
-    virtualization_type = image.virtualization_type
+    virtualization_type = encryptor_image.virtualization_type
 
     # Use gp2 for fast burst I/O copying root drive
     guest_unencrypted_root = EBSBlockDeviceType(
@@ -364,20 +492,8 @@ def _run_encryptor_instance(
         bdm['/dev/sdf'] = guest_unencrypted_root
         bdm['/dev/sdg'] = guest_encrypted_root
 
-    # If security groups were not specified, create a temporary security
-    # group that allows us to poll the metavisor for encryption progress.
-    temp_sg_id = None
     run_instance = aws_svc.run_instance
-
-    if not security_group_ids:
-        vpc_id = None
-        if subnet_id:
-            subnet = aws_svc.get_subnet(subnet_id)
-            vpc_id = subnet.vpc_id
-        temp_sg_id = create_encryptor_security_group(
-            aws_svc, vpc_id=vpc_id, status_port=status_port).id
-        security_group_ids = [temp_sg_id]
-
+    if temporary_security_group:
         # Wrap with a retry, to handle eventual consistency issues with
         # the newly-created group.
         run_instance = aws_svc.retry(
@@ -387,40 +503,47 @@ def _run_encryptor_instance(
 
     user_data = instance_config.make_userdata()
     compressed_user_data = gzip_user_data(user_data)
-    instance = run_instance(
-        encryptor_image_id,
+    instance = yield Call(
+        run_instance,
+        encryptor_image.id,
         security_group_ids=security_group_ids,
         user_data=compressed_user_data,
         placement=zone,
         block_device_map=bdm,
         subnet_id=subnet_id
     )
-    aws_svc.create_tags(
-        instance.id,
-        name=NAME_ENCRYPTOR,
-        description=DESCRIPTION_ENCRYPTOR % {'image_id': guest_image_id}
-    )
-    instance = wait_for_instance(aws_svc, instance.id)
-    log.info('Launched encryptor instance %s', instance.id)
+    try:
+        yield Call(
+            aws_svc.create_tags,
+            instance.id,
+            name=NAME_ENCRYPTOR,
+            description=DESCRIPTION_ENCRYPTOR % {'image_id': guest_image_id}
+        )
+        instance = yield wait_for_instance_co(aws_svc, instance.id)
+        log.info('Launched encryptor instance %s', instance.id)
 
-    # Tag volumes.
-    bdm = instance.block_device_mapping
-    if virtualization_type == 'paravirtual':
-        aws_svc.create_tags(
-            bdm['/dev/sda5'].volume_id, name=NAME_ENCRYPTED_ROOT_VOLUME)
-        aws_svc.create_tags(
-            bdm['/dev/sda2'].volume_id, name=NAME_METAVISOR_ROOT_VOLUME)
-        aws_svc.create_tags(
-            bdm['/dev/sda1'].volume_id, name=NAME_METAVISOR_GRUB_VOLUME)
-        aws_svc.create_tags(
-            bdm['/dev/sda3'].volume_id, name=NAME_METAVISOR_LOG_VOLUME)
-    else:
-        aws_svc.create_tags(
-            bdm['/dev/sda1'].volume_id, name=NAME_METAVISOR_ROOT_VOLUME)
-        aws_svc.create_tags(
-            bdm['/dev/sdg'].volume_id, name=NAME_ENCRYPTED_ROOT_VOLUME)
+        # Tag volumes.
+        bdm = instance.block_device_mapping
+        if virtualization_type == 'paravirtual':
+            volume_names = [
+                ('/dev/sda5', NAME_ENCRYPTED_ROOT_VOLUME),
+                ('/dev/sda2', NAME_METAVISOR_ROOT_VOLUME),
+                ('/dev/sda1', NAME_METAVISOR_GRUB_VOLUME),
+                ('/dev/sda3', NAME_METAVISOR_LOG_VOLUME)
+            ]
+        else:
+            volume_names = [
+                ('/dev/sda1', NAME_METAVISOR_ROOT_VOLUME),
+                ('/dev/sdg', NAME_ENCRYPTED_ROOT_VOLUME)
+            ]
+        for device, name in volume_names:
+            yield Call(aws_svc.create_tags, bdm[device].volume_id, name=name)
+    except:
+        exc_info = sys.exc_info()
+        yield clean_up_co(aws_svc, instance_ids=[instance.id])
+        raise exc_info[0], exc_info[1], exc_info[2]
 
-    return instance, temp_sg_id
+    raise Return(instance)
 
 
 def run_guest_instance(aws_svc, image_id, subnet_id=None,
@@ -444,13 +567,18 @@ def _snapshot_root_volume(aws_svc, instance, image_id):
 
     :except SnapshotError if the snapshot goes into an error state
     """
+    return run_sync(_snapshot_root_volume_co(aws_svc, instance, image_id))
+
+
+def _snapshot_root_volume_co(aws_svc, instance, image_id):
+    """ Coroutine version of _snapshot_root_volume(). """
     log.info(
         'Stopping instance %s in order to create snapshot', instance.id)
-    aws_svc.stop_instance(instance.id)
-    wait_for_instance(aws_svc, instance.id, state='stopped')
+    yield Call(aws_svc.stop_instance, instance.id)
+    yield wait_for_instance_co(aws_svc, instance.id, state='stopped')
 
     # Snapshot root volume.
-    instance = aws_svc.get_instance(instance.id)
+    instance = yield Call(aws_svc.get_instance, instance.id)
     root_dev = instance.root_device_name
     bdm = instance.block_device_mapping
 
@@ -458,13 +586,15 @@ def _snapshot_root_volume(aws_svc, instance, image_id):
         # try stripping partition id
         root_dev = string.rstrip(root_dev, string.digits)
     root_vol = bdm[root_dev]
-    vol = aws_svc.get_volume(root_vol.volume_id)
-    aws_svc.create_tags(
+    vol = yield Call(aws_svc.get_volume, root_vol.volume_id)
+    yield Call(
+        aws_svc.create_tags,
         root_vol.volume_id,
         name=NAME_ORIGINAL_VOLUME % {'image_id': image_id}
     )
 
-    snapshot = aws_svc.create_snapshot(
+    snapshot = yield Call(
+        aws_svc.create_snapshot,
         vol.id,
         name=NAME_ORIGINAL_SNAPSHOT,
         description=DESCRIPTION_ORIGINAL_SNAPSHOT % {'image_id': image_id}
@@ -475,28 +605,31 @@ def _snapshot_root_volume(aws_svc, instance, image_id):
     )
 
     try:
-        wait_for_snapshots(aws_svc, snapshot.id)
+        yield wait_for_snapshots_co(aws_svc, snapshot.id)
 
         # Now try to detach the root volume.
         log.info('Detaching root volume %s from %s',
                  root_vol.volume_id, instance.id)
-        aws_svc.detach_volume(
+        yield Call(
+            aws_svc.detach_volume,
             root_vol.volume_id,
             instance_id=instance.id,
             force=True
         )
-        aws_service.wait_for_volume(aws_svc, root_vol.volume_id)
+        yield aws_service.wait_for_volume_co(aws_svc, root_vol.volume_id)
         # And now delete it
         log.info('Deleting root volume %s', root_vol.volume_id)
-        aws_svc.delete_volume(root_vol.volume_id)
+        yield Call(aws_svc.delete_volume, root_vol.volume_id)
     except:
-        clean_up(aws_svc, snapshot_ids=[snapshot.id])
-        raise
+        # Cleanup yields, so hold on to the original exception.
+        exc_info = sys.exc_info()
+        yield clean_up_co(aws_svc, snapshot_ids=[snapshot.id])
+        raise exc_info[0], exc_info[1], exc_info[2]
 
     ret_values = (
         snapshot.id, root_dev, vol.size, vol.type, root_vol.iops)
     log.debug('Returning %s', str(ret_values))
-    return ret_values
+    raise Return(ret_values)
 
 
 def write_console_output(aws_svc, instance_id):
@@ -530,6 +663,18 @@ def clean_up(aws_svc, instance_ids=None, volume_ids=None,
     Handle and log exceptions, to ensure that the script doesn't exit during
     cleanup.
     """
+    run_sync(clean_up_co(
+        aws_svc,
+        instance_ids=instance_ids,
+        volume_ids=volume_ids,
+        snapshot_ids=snapshot_ids,
+        security_group_ids=security_group_ids
+    ))
+
+
+def clean_up_co(aws_svc, instance_ids=None, volume_ids=None,
+                snapshot_ids=None, security_group_ids=None):
+    """ Coroutine version of clean_up(). """
     instance_ids = instance_ids or []
     volume_ids = volume_ids or []
     snapshot_ids = snapshot_ids or []
@@ -540,7 +685,7 @@ def clean_up(aws_svc, instance_ids=None, volume_ids=None,
     for instance_id in instance_ids:
         try:
             log.info('Terminating instance %s', instance_id)
-            aws_svc.terminate_instance(instance_id)
+            yield Call(aws_svc.terminate_instance, instance_id)
             terminated_instance_ids.add(instance_id)
         except EC2ResponseError as e:
             log.warn('Unable to terminate instance %s: %s', instance_id, e)
@@ -550,7 +695,7 @@ def clean_up(aws_svc, instance_ids=None, volume_ids=None,
     for snapshot_id in snapshot_ids:
         try:
             log.info('Deleting snapshot %s', snapshot_id)
-            aws_svc.delete_snapshot(snapshot_id)
+            yield Call(aws_svc.delete_snapshot, snapshot_id)
         except EC2ResponseError as e:
             log.warn('Unable to delete snapshot %s: %s', snapshot_id, e)
         except:
@@ -561,7 +706,7 @@ def clean_up(aws_svc, instance_ids=None, volume_ids=None,
     for id in terminated_instance_ids:
         log.info('Waiting for instance %s to terminate.', id)
         try:
-            wait_for_instance(aws_svc, id, state='terminated')
+            yield wait_for_instance_co(aws_svc, id, state='terminated')
         except (EC2ResponseError, InstanceError) as e:
             log.warn(
                 'An error occurred while waiting for instance to '
@@ -576,7 +721,7 @@ def clean_up(aws_svc, instance_ids=None, volume_ids=None,
     for volume_id in volume_ids:
         try:
             log.info('Deleting volume %s', volume_id)
-            aws_svc.delete_volume(volume_id)
+            yield Call(aws_svc.delete_volume, volume_id)
         except EC2ResponseError as e:
             log.warn('Unable to delete volume %s: %s', volume_id, e)
         except:
@@ -585,7 +730,7 @@ def clean_up(aws_svc, instance_ids=None, volume_ids=None,
     for sg_id in security_group_ids:
         try:
             log.info('Deleting security group %s', sg_id)
-            aws_svc.delete_security_group(sg_id)
+            yield Call(aws_svc.delete_security_group, sg_id)
         except EC2ResponseError as e:
             log.warn('Unable to delete security group %s: %s', sg_id, e)
         except:
@@ -615,17 +760,22 @@ def log_exception_console(aws_svc, e, id):
         )
 
 
-def snapshot_log_volume(aws_svc, instance_id):
+def snapshot_log_volume(aws_svc, instance_id, wait=True):
     """ Snapshot the log volume of the given instance.
 
+    :param wait if True, wait for the snapshot to complete.  Otherwise
+        return as soon as the snapshot is pending
     :except SnapshotError if the snapshot goes into an error state
     """
+    return run_sync(snapshot_log_volume_co(aws_svc, instance_id, wait=wait))
 
-    # Snapshot root volume.
-    instance = aws_svc.get_instance(instance_id)
-    bdm = instance.block_device_mapping
 
-    image = aws_svc.get_image(instance.image_id)
+def get_log_volume_id(instance, image):
+    """ Return the id of the volume that has the Bracket system logs.
+
+    :param image the AMI that the instance was launched from
+    """
+    bdm = instance.block_device_mapping
     if image.virtualization_type == 'paravirtual':
         log_vol = bdm["/dev/sda3"]
     elif image.virtualization_type == 'hvm':
@@ -633,83 +783,120 @@ def snapshot_log_volume(aws_svc, instance_id):
     else:
         raise Exception('Unknown virtualization type %s' %
                         image.virtualization_type)
+    return log_vol.volume_id
+
+
+def create_log_snapshot_co(aws_svc, instance, image):
+    """ Start a snapshot of the instance's log volume, without waiting
+    for it to complete.
 
-    vol = aws_svc.get_volume(log_vol.volume_id)
+    :return the Snapshot object
+    """
+    vol = yield Call(aws_svc.get_volume, get_log_volume_id(instance, image))
 
-    snapshot = aws_svc.create_snapshot(
+    snapshot = yield Call(
+        aws_svc.create_snapshot,
         vol.id,
-        name=NAME_LOG_SNAPSHOT % {'instance_id': instance_id},
+        name=NAME_LOG_SNAPSHOT % {'instance_id': instance.id},
         description=DESCRIPTION_LOG_SNAPSHOT % {
-            'instance_id': instance_id,
+            'instance_id': instance.id,
             'aws_account': image.owner_id,
             'timestamp': datetime.utcnow().strftime('%b %d %Y %I:%M%p UTC')
         }
     )
     log.info(
         'Creating snapshot %s of log volume for instance %s',
-        snapshot.id, instance_id
+        snapshot.id, instance.id
     )
+    raise Return(snapshot)
+
+
+def snapshot_log_volume_co(aws_svc, instance_id, wait=True):
+    """ Coroutine version of snapshot_log_volume(). """
+    instance = yield Call(aws_svc.get_instance, instance_id)
+    image = yield Call(aws_svc.get_image, instance.image_id)
+    snapshot = yield create_log_snapshot_co(aws_svc, instance, image)
+    if not wait:
+        if snapshot.status == 'error':
+            raise SnapshotError(
+                'Snapshot %s of log volume is in error state' % snapshot.id)
+        raise Return(snapshot)
 
     try:
-        wait_for_snapshots(aws_svc, snapshot.id)
+        yield wait_for_snapshots_co(aws_svc, snapshot.id)
     except:
-        clean_up(aws_svc, snapshot_ids=[snapshot.id])
-        raise
-    return snapshot
+        exc_info = sys.exc_info()
+        yield clean_up_co(aws_svc, snapshot_ids=[snapshot.id])
+        raise exc_info[0], exc_info[1], exc_info[2]
+    raise Return(snapshot)
 
 
 def snapshot_encrypted_instance(aws_svc, enc_svc_cls, encryptor_instance,
                        encryptor_image, image_id=None, vol_type='', iops=None,
                        legacy=False, save_encryptor_logs=True,
-                       status_port=encryptor_service.ENCRYPTOR_STATUS_PORT):
+                       status_port=encryptor_service.ENCRYPTOR_STATUS_PORT,
+                       timeouts=DEFAULT_TIMEOUTS):
+    return run_sync(snapshot_encrypted_instance_co(
+        aws_svc, enc_svc_cls, encryptor_instance, encryptor_image,
+        image_id=image_id, vol_type=vol_type, iops=iops, legacy=legacy,
+        save_encryptor_logs=save_encryptor_logs, status_port=status_port,
+        timeouts=timeouts
+    ))
+
+
+def snapshot_encrypted_instance_co(
+        aws_svc, enc_svc_cls, encryptor_instance, encryptor_image,
+        image_id=None, vol_type='', iops=None, legacy=False,
+        save_encryptor_logs=True,
+        status_port=encryptor_service.ENCRYPTOR_STATUS_PORT,
+        timeouts=DEFAULT_TIMEOUTS):
+    """ Coroutine version of snapshot_encrypted_instance().
+
+    :param timeouts the Timeouts for waiting for the encryptor
+    """
     # First wait for encryption to complete
     host_ips = []
     if encryptor_instance.ip_address:
         host_ips.append(encryptor_instance.ip_address)
     if encryptor_instance.private_ip_address:
         host_ips.append(encryptor_instance.private_ip_address)
-        log.info('Adding %s to NO_PROXY environment variable' %
-                 encryptor_instance.private_ip_address)
-        if os.environ.get('NO_PROXY'):
-            os.environ['NO_PROXY'] += "," + \
-                encryptor_instance.private_ip_address
-        else:
-            os.environ['NO_PROXY'] = encryptor_instance.private_ip_address
-
-    enc_svc = enc_svc_cls(host_ips, port=status_port)
+        log.debug(
+            'Bypassing proxy for %s', encryptor_instance.private_ip_address)
+        aws_svc.session.add_no_proxy_host(
+            encryptor_instance.private_ip_address)
+
+    enc_svc = enc_svc_cls(
+        host_ips,
+        port=status_port,
+        no_proxy_hosts=aws_svc.session.no_proxy_hosts
+    )
+    watcher = make_instance_watcher(aws_svc, encryptor_instance.id)
     try:
         log.info('Waiting for encryption service on %s (port %s on %s)',
              encryptor_instance.id, enc_svc.port, ', '.join(host_ips))
-        encryptor_service.wait_for_encryptor_up(enc_svc, Deadline(600))
-        log.info('Creating encrypted root drive.')
-        encryptor_service.wait_for_encryption(enc_svc)
+        yield encryptor_service.wait_for_encryptor_co(
+            enc_svc, timeouts=timeouts, watcher=watcher)
     except (BracketError, encryptor_service.EncryptionError) as e:
-        # Stop the encryptor instance, to make the console log available.
-        stop_and_wait(aws_svc, encryptor_instance.id)
-
-        log_exception_console(aws_svc, e, encryptor_instance.id)
-        if save_encryptor_logs:
-            log.info('Saving logs from encryptor instance in snapshot')
-            log_snapshot = snapshot_log_volume(aws_svc, encryptor_instance.id)
-            log.info('Encryptor logs saved in snapshot %(snapshot_id)s. '
-                     'Run `brkt share-logs --region %(region)s '
-                     '--snapshot-id %(snapshot_id)s` '
-                     'to share this snapshot with Bracket support' %
-                     {'snapshot_id': log_snapshot.id,
-                      'region': aws_svc.region})
-        raise
+        exc_info = sys.exc_info()
+        yield collect_failure_info_co(
+            aws_svc, e, encryptor_instance.id,
+            save_encryptor_logs=save_encryptor_logs)
+        raise exc_info[0], exc_info[1], exc_info[2]
 
     log.info('Encrypted root drive is ready.')
     # The encryptor instance may modify its volume attachments while running,
     # so we update the encryptor instance's local attributes before reading
     # them.
-    encryptor_instance = aws_svc.get_instance(encryptor_instance.id)
+    encryptor_instance = yield Call(
+        aws_svc.get_instance, encryptor_instance.id)
     encryptor_bdm = encryptor_instance.block_device_mapping
 
     # Stop the encryptor instance.
     log.info('Stopping encryptor instance %s', encryptor_instance.id)
-    aws_svc.stop_instance(encryptor_instance.id)
-    wait_for_instance(aws_svc, encryptor_instance.id, state='stopped')
+    yield Call(aws_svc.stop_instance, encryptor_instance.id)
+    yield wait_for_instance_co(
+        aws_svc, encryptor_instance.id, state='stopped',
+        timeout=timeouts.instance)
 
     description = DESCRIPTION_SNAPSHOT % {'image_id': image_id}
 
@@ -721,17 +908,20 @@ def snapshot_encrypted_instance(aws_svc, enc_svc_cls, encryptor_instance,
 
     # Snapshot volumes.
     if encryptor_image.virtualization_type == 'paravirtual':
-        snap_guest = aws_svc.create_snapshot(
+        snap_guest = yield Call(
+            aws_svc.create_snapshot,
             encryptor_bdm['/dev/sda5'].volume_id,
             name=NAME_ENCRYPTED_ROOT_SNAPSHOT,
             description=description
         )
-        snap_bsd = aws_svc.create_snapshot(
+        snap_bsd = yield Call(
+            aws_svc.create_snapshot,
             encryptor_bdm['/dev/sda2'].volume_id,
             name=NAME_METAVISOR_ROOT_SNAPSHOT,
             description=description
         )
-        snap_log = aws_svc.create_snapshot(
+        snap_log = yield Call(
+            aws_svc.create_snapshot,
             encryptor_bdm['/dev/sda3'].volume_id,
             name=NAME_METAVISOR_LOG_SNAPSHOT,
             description=description
@@ -740,7 +930,7 @@ def snapshot_encrypted_instance(aws_svc, enc_svc_cls, encryptor_instance,
             'Creating snapshots for the new encrypted AMI: %s, %s, %s',
             snap_guest.id, snap_bsd.id, snap_log.id)
 
-        wait_for_snapshots(
+        yield wait_for_snapshots_co(
             aws_svc, snap_guest.id, snap_bsd.id, snap_log.id)
 
         if vol_type is None:
@@ -762,7 +952,8 @@ def snapshot_encrypted_instance(aws_svc, enc_svc_cls, encryptor_instance,
         new_bdm['/dev/sda5'] = dev_guest_root
     else:
         # HVM instance type
-        snap_guest = aws_svc.create_snapshot(
+        snap_guest = yield Call(
+            aws_svc.create_snapshot,
             encryptor_bdm['/dev/sdg'].volume_id,
             name=NAME_ENCRYPTED_ROOT_SNAPSHOT,
             description=description
@@ -771,7 +962,7 @@ def snapshot_encrypted_instance(aws_svc, enc_svc_cls, encryptor_instance,
             'Creating snapshots for the new encrypted AMI: %s' % (
                     snap_guest.id)
         )
-        wait_for_snapshots(aws_svc, snap_guest.id)
+        yield wait_for_snapshots_co(aws_svc, snap_guest.id)
         dev_guest_root = EBSBlockDeviceType(volume_type=vol_type,
                                     snapshot_id=snap_guest.id,
                                     iops=iops,
@@ -781,18 +972,19 @@ def snapshot_encrypted_instance(aws_svc, enc_svc_cls, encryptor_instance,
 
     if not legacy:
         log.info("Detaching new guest root %s" % (mv_root_id,))
-        aws_svc.detach_volume(
+        yield Call(
+            aws_svc.detach_volume,
             mv_root_id,
             instance_id=encryptor_instance.id,
             force=True
         )
-        aws_service.wait_for_volume(aws_svc, mv_root_id)
-        aws_svc.create_tags(
-            mv_root_id, name=NAME_METAVISOR_ROOT_VOLUME)
+        yield aws_service.wait_for_volume_co(aws_svc, mv_root_id)
+        yield Call(
+            aws_svc.create_tags, mv_root_id, name=NAME_METAVISOR_ROOT_VOLUME)
 
     if image_id:
         log.debug('Getting image %s', image_id)
-        guest_image = aws_svc.get_image(image_id)
+        guest_image = yield Call(aws_svc.get_image, image_id)
         if guest_image is None:
             raise BracketError("Can't find image %s" % image_id)
 
@@ -805,7 +997,7 @@ def snapshot_encrypted_instance(aws_svc, enc_svc_cls, encryptor_instance,
                          (guest_vol.ephemeral_name, key))
                 new_bdm[key] = guest_vol
 
-    return mv_root_id, new_bdm
+    raise Return((mv_root_id, new_bdm))
 
 
 def wait_for_volume_attached(aws_svc, instance_id, device):
@@ -813,6 +1005,11 @@ def wait_for_volume_attached(aws_svc, instance_id, device):
     given instance.
     :return: the Instance object
     """
+    return run_sync(wait_for_volume_attached_co(aws_svc, instance_id, device))
+
+
+def wait_for_volume_attached_co(aws_svc, instance_id, device):
+    """ Coroutine version of wait_for_volume_attached(). """
     # Wait for attachment to complete.
     log.debug(
         'Waiting for %s in block device mapping of %s.',
@@ -824,14 +1021,14 @@ def wait_for_volume_attached(aws_svc, instance_id, device):
     instance = None
 
     for _ in xrange(20):
-        instance = aws_svc.get_instance(instance_id)
+        instance = yield Call(aws_svc.get_instance, instance_id)
         bdm = instance.block_device_mapping
         log.debug('Found devices: %s', bdm.keys())
         if device in bdm:
             found = True
             break
         else:
-            sleep(5)
+            yield Sleep(5)
 
     if not found:
         raise BracketError(
@@ -839,12 +1036,64 @@ def wait_for_volume_attached(aws_svc, instance_id, device):
             (device, instance_id)
         )
 
-    return instance
+    raise Return(instance)
 
 
 def register_ami(aws_svc, encryptor_instance, encryptor_image, name,
                  description, mv_bdm=None, legacy=False, guest_instance=None,
-                 mv_root_id=None):
+                 mv_root_id=None, timeouts=DEFAULT_TIMEOUTS):
+    return run_sync(register_ami_co(
+        aws_svc, encryptor_instance, encryptor_image, name, description,
+        mv_bdm=mv_bdm, legacy=legacy, guest_instance=guest_instance,
+        mv_root_id=mv_root_id, timeouts=timeouts
+    ))
+
+
+def register_ami_co(aws_svc, encryptor_instance, encryptor_image, name,
+                    description, mv_bdm=None, legacy=False,
+                    guest_instance=None, mv_root_id=None,
+                    timeouts=DEFAULT_TIMEOUTS):
+    """ Coroutine version of register_ami(). """
+    ami = yield create_ami_co(
+        aws_svc, encryptor_instance, name, description, mv_bdm=mv_bdm,
+        legacy=legacy, guest_instance=guest_instance, mv_root_id=mv_root_id)
+    yield finish_ami_co(
+        aws_svc, ami, get_metavisor_snapshot_name(encryptor_image),
+        description, timeouts=timeouts)
+
+    ami_info = {}
+    ami_info['volume_device_map'] = []
+    result_image = yield Call(aws_svc.get_image, ami, retry=True)
+    for attach_point, bdt in result_image.block_device_mapping.iteritems():
+        if bdt.snapshot_id:
+            bdt_snapshot = yield Call(aws_svc.get_snapshot, bdt.snapshot_id)
+            device_details = {
+                'attach_point': attach_point,
+                'description': bdt_snapshot.tags.get('Name', ''),
+                'size': bdt_snapshot.volume_size
+            }
+            ami_info['volume_device_map'].append(device_details)
+
+    ami_info['ami'] = ami
+    ami_info['name'] = name
+    raise Return(ami_info)
+
+
+def get_metavisor_snapshot_name(encryptor_image):
+    """ Return the name of the snapshot of the metavisor boot volume. """
+    if encryptor_image.virtualization_type == 'paravirtual':
+        return NAME_METAVISOR_GRUB_SNAPSHOT
+    return NAME_METAVISOR_ROOT_SNAPSHOT
+
+
+def create_ami_co(aws_svc, encryptor_instance, name, description,
+                  mv_bdm=None, legacy=False, guest_instance=None,
+                  mv_root_id=None):
+    """ Register the encrypted AMI.  The AMI is not available until
+    finish_ami_co() returns.
+
+    :return the AMI id
+    """
     if not mv_bdm:
         mv_bdm = BlockDeviceMapping()
     # Register the new AMI.
@@ -852,7 +1101,8 @@ def register_ami(aws_svc, encryptor_instance, encryptor_image, name,
         # The encryptor instance may modify its volume attachments while
         # running, so we update the encryptor instance's local attributes
         # before reading them.
-        encryptor_instance = aws_svc.get_instance(encryptor_instance.id)
+        encryptor_instance = yield Call(
+            aws_svc.get_instance, encryptor_instance.id)
         guest_id = encryptor_instance.id
         # Explicitly detach/delete all but root drive
         bdm = encryptor_instance.block_device_mapping
@@ -860,24 +1110,26 @@ def register_ami(aws_svc, encryptor_instance, encryptor_image, name,
                   '/dev/sda5', '/dev/sdf', '/dev/sdg']:
             if not bdm.get(d):
                 continue
-            aws_svc.detach_volume(
+            yield Call(
+                aws_svc.detach_volume,
                 bdm[d].volume_id,
                 instance_id=encryptor_instance.id,
                 force=True
             )
-            aws_service.wait_for_volume(aws_svc, bdm[d].volume_id)
-            aws_svc.delete_volume(bdm[d].volume_id)
+            yield aws_service.wait_for_volume_co(aws_svc, bdm[d].volume_id)
+            yield Call(aws_svc.delete_volume, bdm[d].volume_id)
     else:
         guest_id = guest_instance.id
         root_device_name = guest_instance.root_device_name
         # Explicitly attach new mv root to guest instance
         log.info('Attaching %s to %s', mv_root_id, guest_instance.id)
-        aws_svc.attach_volume(
+        yield Call(
+            aws_svc.attach_volume,
             mv_root_id,
             guest_instance.id,
             root_device_name,
         )
-        instance = wait_for_volume_attached(
+        instance = yield wait_for_volume_attached_co(
             aws_svc, guest_instance.id, root_device_name)
         bdm = instance.block_device_mapping
         mv_bdm[root_device_name] = bdm[root_device_name]
@@ -889,7 +1141,8 @@ def register_ami(aws_svc, encryptor_instance, encryptor_image, name,
     #   Create AMI from original (stopped) guest instance. This
     #   preserves any billing information found in
     #   the identity document (i.e. billingProduct)
-    ami = aws_svc.create_image(
+    ami = yield Call(
+        aws_svc.create_image,
         guest_id,
         name,
         description=description,
@@ -899,61 +1152,82 @@ def register_ami(aws_svc, encryptor_instance, encryptor_image, name,
 
     if not legacy:
         log.info("Deleting volume %s" % (mv_root_id,))
-        aws_svc.detach_volume(
+        yield Call(
+            aws_svc.detach_volume,
             mv_root_id,
             instance_id=guest_instance.id,
             force=True
         )
-        aws_service.wait_for_volume(aws_svc, mv_root_id)
-        aws_svc.delete_volume(mv_root_id)
+        yield aws_service.wait_for_volume_co(aws_svc, mv_root_id)
+        yield Call(aws_svc.delete_volume, mv_root_id)
 
     log.info('Registered AMI %s based on the snapshots.', ami)
-    wait_for_image(aws_svc, ami)
-    image = aws_svc.get_image(ami, retry=True)
-    if encryptor_image.virtualization_type == 'paravirtual':
-        name = NAME_METAVISOR_GRUB_SNAPSHOT
-    else:
-        name = NAME_METAVISOR_ROOT_SNAPSHOT
+    raise Return(ami)
+
+
+def finish_ami_co(aws_svc, ami, snapshot_name, description,
+                  timeouts=DEFAULT_TIMEOUTS):
+    """ Wait for the AMI to become available, and tag it and the
+    snapshot of its root volume.
+    """
+    start = time.time()
+    yield wait_for_image_co(aws_svc, ami, timeout=timeouts.image)
+    timeouts.record(IMAGE, time.time() - start)
+    image = yield Call(aws_svc.get_image, ami, retry=True)
     snap = image.block_device_mapping[image.root_device_name]
-    aws_svc.create_tags(
+    yield Call(
+        aws_svc.create_tags,
         snap.snapshot_id,
-        name=name,
+        name=snapshot_name,
         description=description
     )
-    aws_svc.create_tags(ami)
-
-    ami_info = {}
-    ami_info['volume_device_map'] = []
-    result_image = aws_svc.get_image(ami, retry=True)
-    for attach_point, bdt in result_image.block_device_mapping.iteritems():
-        if bdt.snapshot_id:
-            bdt_snapshot = aws_svc.get_snapshot(bdt.snapshot_id)
-            device_details = {
-                'attach_point': attach_point,
-                'description': bdt_snapshot.tags.get('Name', ''),
-                'size': bdt_snapshot.volume_size
-            }
-            ami_info['volume_device_map'].append(device_details)
-
-    ami_info['ami'] = ami
-    ami_info['name'] = name
-    return ami_info
+    yield Call(aws_svc.create_tags, ami)
 
 
 def encrypt(aws_svc, enc_svc_cls, image_id, encryptor_ami,
             encrypted_ami_name=None, subnet_id=None, security_group_ids=None,
             guest_instance_type='m3.medium', instance_config=None,
             save_encryptor_logs=True,
-            status_port=encryptor_service.ENCRYPTOR_STATUS_PORT):
-    log.info('Starting encryptor session %s', aws_svc.session_id)
+            status_port=encryptor_service.ENCRYPTOR_STATUS_PORT,
+            max_encryptors=None, timeout_history=None,
+            timeout_overrides=None, defer_cleanup=None):
+    """ Encrypt the given AMI.
+
+    :param timeout_history a TimeoutHistory that is used to adjust
+        timeouts, and is updated with the time that each phase took
+    :param timeout_overrides a dictionary of phase names to timeouts in
+        seconds, which override the timeouts based on volume size
+    :param defer_cleanup a function that takes a CleanupJob.  If
+        specified, encrypt() returns as soon as the AMI is registered,
+        and hands off waiting for the AMI and cleaning up to the function,
+        for example cleanup_job.hand_off().
+    :return the id of the encrypted AMI
+    """
+    return run_sync(encrypt_co(
+        aws_svc, enc_svc_cls, image_id, encryptor_ami,
+        encrypted_ami_name=encrypted_ami_name,
+        subnet_id=subnet_id,
+        security_group_ids=security_group_ids,
+        guest_instance_type=guest_instance_type,
+        instance_config=instance_config,
+        save_encryptor_logs=save_encryptor_logs,
+        status_port=status_port,
+        max_encryptors=max_encryptors,
+        timeout_history=timeout_history,
+        timeout_overrides=timeout_overrides,
+        defer_cleanup=defer_cleanup
+    ))
+
 
-    encryptor_instance = None
-    ami = None
-    snapshot_id = None
-    guest_instance = None
-    temp_sg_id = None
-    guest_image = aws_svc.get_image(image_id)
-    mv_image = aws_svc.get_image(encryptor_ami)
+# Steps in the encrypt workflow.  See brkt_cli.workflow.
+
+_Images = collections.namedtuple(
+    '_Images', ['guest_image', 'encryptor_image', 'legacy'])
+
+
+def _get_images_co(aws_svc, image_id, encryptor_ami):
+    guest_image = yield Call(aws_svc.get_image, image_id)
+    mv_image = yield Call(aws_svc.get_image, encryptor_ami)
 
     # Normal operation is both encryptor and guest match
     # on virtualization type, but we'll support a PV encryptor
@@ -981,93 +1255,332 @@ def encrypt(aws_svc, enc_svc_cls, image_id, encryptor_ami,
                  "preserved because the root disk is attached at %s "
                  "instead of /dev/sda1", guest_image.root_device_name)
         legacy = True
+    raise Return(_Images(guest_image, mv_image, legacy))
+
+
+def _delete_session_volumes_co(aws_svc, cleanup_job=None):
+    if cleanup_job:
+        # The cleanup job deletes the volumes.
+        return
+    yield delete_session_volumes_co(aws_svc)
+
+
+def delete_session_volumes_co(aws_svc):
+    # Delete volumes explicitly.  They should get cleaned up during
+    # instance deletion, but we've gotten reports that occasionally
+    # volumes can get orphaned.
     try:
-        guest_instance = run_guest_instance(aws_svc,
-            image_id, subnet_id=subnet_id, instance_type=guest_instance_type)
-        wait_for_instance(aws_svc, guest_instance.id)
-        snapshot_id, root_dev, size, vol_type, iops = _snapshot_root_volume(
-            aws_svc, guest_instance, image_id
+        volumes = yield Call(
+            aws_svc.get_volumes,
+            tag_key=TAG_ENCRYPTOR_SESSION_ID,
+            tag_value=aws_svc.session_id
         )
+    except EC2ResponseError as e:
+        log.warn('Unable to clean up orphaned volumes: %s', e)
+        return
+    except:
+        log.exception('Unable to clean up orphaned volumes')
+        return
+    yield clean_up_co(aws_svc, volume_ids=[v.id for v in volumes])
+
 
-        if guest_image.virtualization_type == 'hvm':
-            net_sriov_attr = aws_svc.get_instance_attribute(guest_instance.id,
-                                                            "sriovNetSupport")
-            if net_sriov_attr.get("sriovNetSupport") == "simple":
-                log.warn("Guest Operating System license information will not "
-                         "be preserved because guest has sriovNetSupport "
-                         "enabled and metavisor does not support sriovNet")
-                legacy = True
-
-        encryptor_instance, temp_sg_id = _run_encryptor_instance(
-            aws_svc=aws_svc,
-            encryptor_image_id=encryptor_ami,
-            snapshot=snapshot_id,
-            root_size=size,
-            guest_image_id=image_id,
-            security_group_ids=security_group_ids,
-            subnet_id=subnet_id,
-            zone=guest_instance.placement,
-            instance_config=instance_config,
-            status_port=status_port
+def acquire_instance_slot_co(aws_svc, max_encryptors):
+    """ Wait until fewer than max_encryptors brkt sessions on this host are
+    running encryptor or updater instances in the region and account.
+    Sessions are admitted in the order that they started waiting.
+
+    :return the acquired HostSemaphore, or None if max_encryptors is None
+    """
+    if not max_encryptors:
+        raise Return(None)
+    account_id = yield Call(aws_svc.get_account_id)
+    semaphore = HostSemaphore(
+        make_semaphore_name('aws', aws_svc.region, account_id),
+        max_encryptors
+    )
+    yield semaphore.acquire_co()
+    raise Return(semaphore)
+
+
+def release_instance_slot(instance_slot):
+    if instance_slot:
+        instance_slot.release()
+
+
+def _launch_guest_co(aws_svc, images, subnet_id, guest_instance_type,
+                     instance_slot):
+    # instance_slot is required so that instances are only launched
+    # after this session is admitted.
+    guest_instance = yield Call(run_guest_instance, aws_svc,
+        images.guest_image.id, subnet_id=subnet_id,
+        instance_type=guest_instance_type)
+    # The step has no result if it fails, so it cleans up after itself.
+    try:
+        guest_instance = yield wait_for_instance_co(
+            aws_svc, guest_instance.id)
+    except:
+        exc_info = sys.exc_info()
+        yield clean_up_co(aws_svc, instance_ids=[guest_instance.id])
+        raise exc_info[0], exc_info[1], exc_info[2]
+    raise Return(guest_instance)
+
+
+def _terminate_guest_co(aws_svc, guest_instance, cleanup_job=None):
+    if not cleanup_job:
+        yield clean_up_co(aws_svc, instance_ids=[guest_instance.id])
+
+
+def get_security_group_co(aws_svc, subnet_id, security_group_ids,
+                          status_port):
+    """ Create a temporary security group if the user didn't specify
+    security groups.
+
+    :return the temporary security group id, or None
+    """
+    if security_group_ids:
+        raise Return(None)
+    sg_id = yield create_temporary_security_group_co(
+        aws_svc, subnet_id=subnet_id, status_port=status_port)
+    raise Return(sg_id)
+
+
+def delete_security_group_co(aws_svc, security_group, cleanup_job=None):
+    if security_group and not cleanup_job:
+        yield clean_up_co(aws_svc, security_group_ids=[security_group])
+
+
+def _security_group_step_co(aws_svc, images, subnet_id, security_group_ids,
+                            status_port):
+    # Requires images, so that we don't create a security group for an
+    # invalid AMI.
+    sg_id = yield get_security_group_co(
+        aws_svc, subnet_id, security_group_ids, status_port)
+    raise Return(sg_id)
+
+
+def _snapshot_root_volume_step_co(aws_svc, guest_instance, image_id):
+    result = yield _snapshot_root_volume_co(aws_svc, guest_instance, image_id)
+    raise Return(result)
+
+
+def _get_timeouts(root_snapshot, timeout_history=None,
+                  timeout_overrides=None):
+    snapshot_id, root_dev, size, vol_type, iops = root_snapshot
+    return get_timeouts(
+        volume_size_gb=size, history=timeout_history,
+        overrides=timeout_overrides)
+
+
+def _delete_root_snapshot_co(aws_svc, root_snapshot, cleanup_job=None):
+    if not cleanup_job:
+        yield clean_up_co(aws_svc, snapshot_ids=[root_snapshot[0]])
+
+
+def _check_legacy_co(aws_svc, images, guest_instance):
+    if images.legacy:
+        raise Return(True)
+    if images.guest_image.virtualization_type == 'hvm':
+        net_sriov_attr = yield Call(
+            aws_svc.get_instance_attribute,
+            guest_instance.id,
+            "sriovNetSupport"
         )
+        if net_sriov_attr.get("sriovNetSupport") == "simple":
+            log.warn("Guest Operating System license information will not "
+                     "be preserved because guest has sriovNetSupport "
+                     "enabled and metavisor does not support sriovNet")
+            raise Return(True)
+    raise Return(False)
+
+
+def _launch_encryptor_co(aws_svc, images, image_id, root_snapshot,
+                         guest_instance, security_group, security_group_ids,
+                         subnet_id, instance_config):
+    snapshot_id, root_dev, size, vol_type, iops = root_snapshot
+    if security_group:
+        security_group_ids = [security_group]
+    instance = yield _run_encryptor_instance_co(
+        aws_svc=aws_svc,
+        encryptor_image=images.encryptor_image,
+        snapshot=snapshot_id,
+        root_size=size,
+        guest_image_id=image_id,
+        security_group_ids=security_group_ids,
+        temporary_security_group=bool(security_group),
+        subnet_id=subnet_id,
+        zone=guest_instance.placement,
+        instance_config=instance_config
+    )
+    raise Return(instance)
+
+
+def _terminate_encryptor_co(aws_svc, encryptor_instance, cleanup_job=None):
+    if not cleanup_job:
+        yield clean_up_co(aws_svc, instance_ids=[encryptor_instance.id])
+
+
+def _snapshot_encrypted_instance_step_co(
+        aws_svc, enc_svc_cls, images, image_id, encryptor_instance,
+        root_snapshot, legacy, save_encryptor_logs, status_port, timeouts):
+    snapshot_id, root_dev, size, vol_type, iops = root_snapshot
+    result = yield snapshot_encrypted_instance_co(
+        aws_svc, enc_svc_cls, encryptor_instance, images.encryptor_image,
+        image_id=image_id, vol_type=vol_type, iops=iops, legacy=legacy,
+        save_encryptor_logs=save_encryptor_logs, status_port=status_port,
+        timeouts=timeouts)
+    raise Return(result)
+
+
+def _register_ami_co(aws_svc, images, encrypted_ami_name, encryptor_instance,
+                     guest_instance, legacy, encrypted_snapshots, timeouts):
+    mv_root_id, mv_bdm = encrypted_snapshots
+    name = encrypted_ami_name or get_name_from_image(images.guest_image)
+    description = get_description_from_image(images.guest_image)
+    ami_info = yield register_ami_co(
+        aws_svc, encryptor_instance, images.encryptor_image, name,
+        description, legacy=legacy, guest_instance=guest_instance,
+        mv_root_id=mv_root_id, mv_bdm=mv_bdm, timeouts=timeouts)
+    raise Return(ami_info['ami'])
+
+
+def _create_ami_step_co(aws_svc, images, encrypted_ami_name,
+                        encryptor_instance, guest_instance, legacy,
+                        encrypted_snapshots):
+    mv_root_id, mv_bdm = encrypted_snapshots
+    name = encrypted_ami_name or get_name_from_image(images.guest_image)
+    description = get_description_from_image(images.guest_image)
+    ami = yield create_ami_co(
+        aws_svc, encryptor_instance, name, description, legacy=legacy,
+        guest_instance=guest_instance, mv_root_id=mv_root_id, mv_bdm=mv_bdm)
+    raise Return(ami)
+
+
+def _hand_off_cleanup_co(aws_svc, images, guest_instance, security_group,
+                         root_snapshot, encryptor_instance, ami, timeouts,
+                         defer_cleanup):
+    security_group_ids = []
+    if security_group:
+        security_group_ids.append(security_group)
+    job = CleanupJob(
+        aws_svc.session_id,
+        aws_svc.region,
+        ami=ami,
+        snapshot_name=get_metavisor_snapshot_name(images.encryptor_image),
+        description=get_description_from_image(images.guest_image),
+        image_timeout=timeouts.image,
+        instance_ids=[guest_instance.id, encryptor_instance.id],
+        snapshot_ids=[root_snapshot[0]],
+        security_group_ids=security_group_ids,
+        tags=getattr(aws_svc, 'default_tags', None)
+    )
+    yield Call(defer_cleanup, job)
+    raise Return(job)
 
-        log.debug('Getting image %s', image_id)
-        image = aws_svc.get_image(image_id)
-        if image is None:
-            raise BracketError("Can't find image %s" % image_id)
-        if encrypted_ami_name:
-            name = encrypted_ami_name
-        elif image_id:
-            name = get_name_from_image(image)
-        description = get_description_from_image(image)
-
-        mv_root_id, mv_bdm = snapshot_encrypted_instance(aws_svc, enc_svc_cls,
-                encryptor_instance, mv_image, image_id=image_id,
-                vol_type=vol_type, iops=iops, legacy=legacy,
-                save_encryptor_logs=save_encryptor_logs, status_port=status_port)
-        ami_info = register_ami(aws_svc, encryptor_instance, mv_image, name,
-                description, legacy=legacy, guest_instance=guest_instance,
-                mv_root_id=mv_root_id,
-                mv_bdm=mv_bdm)
-        ami = ami_info['ami']
-        log.info('Created encrypted AMI %s based on %s', ami, image_id)
-    finally:
-        instance_ids = []
-        if guest_instance:
-            instance_ids.append(guest_instance.id)
-        if encryptor_instance:
-            instance_ids.append(encryptor_instance.id)
-
-        # Delete volumes explicitly.  They should get cleaned up during
-        # instance deletion, but we've gotten reports that occasionally
-        # volumes can get orphaned.
-        volume_ids = None
+
+def run_cleanup_job(aws_svc, job):
+    return run_sync(run_cleanup_job_co(aws_svc, job))
+
+
+def run_cleanup_job_co(aws_svc, job):
+    """ Wait for the AMI in the CleanupJob to become available and tag
+    it, then delete the resources in the job.  Resources are deleted even
+    if the AMI fails.
+
+    :return True if the AMI became available, or the job has no AMI
+    """
+    ami_ok = True
+    if job.ami:
         try:
-            volumes = aws_svc.get_volumes(
-                tag_key=TAG_ENCRYPTOR_SESSION_ID,
-                tag_value=aws_svc.session_id
-            )
-            volume_ids = [v.id for v in volumes]
-        except EC2ResponseError as e:
-            log.warn('Unable to clean up orphaned volumes: %s', e)
-        except:
-            log.exception('Unable to clean up orphaned volumes')
-
-        sg_ids = []
-        if temp_sg_id:
-            sg_ids.append(temp_sg_id)
-
-        snapshot_ids = []
-        if snapshot_id:
-            snapshot_ids.append(snapshot_id)
-
-        clean_up(
-            aws_svc,
-            instance_ids=instance_ids,
-            volume_ids=volume_ids,
-            snapshot_ids=snapshot_ids,
-            security_group_ids=sg_ids
-        )
+            yield finish_ami_co(
+                aws_svc, job.ami, job.snapshot_name, job.description,
+                timeouts=Timeouts(
+                    image=job.image_timeout or DEFAULT_TIMEOUTS.image))
+            log.info('%s is available', job.ami)
+        except Exception as e:
+            log.error('%s did not become available: %s', job.ami, e)
+            ami_ok = False
+    yield clean_up_co(
+        aws_svc,
+        instance_ids=job.instance_ids,
+        snapshot_ids=job.snapshot_ids,
+        security_group_ids=job.security_group_ids
+    )
+    yield delete_session_volumes_co(aws_svc)
+    raise Return(ami_ok)
+
+
+def make_encrypt_workflow(defer_cleanup=False):
+    """ Return the Workflow that encrypt() runs.
 
+    :param defer_cleanup if True, the workflow completes as soon as the
+        AMI is registered, and the defer_cleanup input is called with a
+        CleanupJob that finishes the AMI and deletes the resources that
+        the session created.  Resources are still cleaned up by the
+        workflow if it fails.
+    """
+    workflow = Workflow('encrypt')
+    workflow.add_step(
+        'images', _get_images_co, cleanup=_delete_session_volumes_co)
+    workflow.add_step(
+        'instance_slot', acquire_instance_slot_co,
+        cleanup=release_instance_slot)
+    workflow.add_step(
+        'guest_instance', _launch_guest_co, cleanup=_terminate_guest_co,
+        independent_cleanup=True)
+    workflow.add_step(
+        'security_group', _security_group_step_co,
+        cleanup=delete_security_group_co)
+    workflow.add_step(
+        'root_snapshot', _snapshot_root_volume_step_co,
+        cleanup=_delete_root_snapshot_co, independent_cleanup=True)
+    workflow.add_step('timeouts', _get_timeouts)
+    workflow.add_step('legacy', _check_legacy_co, retries=2)
+    workflow.add_step(
+        'encryptor_instance', _launch_encryptor_co,
+        cleanup=_terminate_encryptor_co)
+    workflow.add_step(
+        'encrypted_snapshots', _snapshot_encrypted_instance_step_co)
+    if defer_cleanup:
+        workflow.add_step('ami', _create_ami_step_co)
+        workflow.add_step('cleanup_job', _hand_off_cleanup_co)
+    else:
+        workflow.add_step('ami', _register_ami_co)
+    return workflow
+
+
+def encrypt_co(aws_svc, enc_svc_cls, image_id, encryptor_ami,
+               encrypted_ami_name=None, subnet_id=None,
+               security_group_ids=None, guest_instance_type='m3.medium',
+               instance_config=None, save_encryptor_logs=True,
+               status_port=encryptor_service.ENCRYPTOR_STATUS_PORT,
+               max_encryptors=None, timeout_history=None,
+               timeout_overrides=None, defer_cleanup=None):
+    """ Coroutine version of encrypt(). """
+    log.info('Starting encryptor session %s', aws_svc.session_id)
+    workflow = make_encrypt_workflow(defer_cleanup=bool(defer_cleanup))
+    results = yield workflow.run_co(
+        aws_svc=aws_svc,
+        enc_svc_cls=enc_svc_cls,
+        image_id=image_id,
+        encryptor_ami=encryptor_ami,
+        encrypted_ami_name=encrypted_ami_name,
+        subnet_id=subnet_id,
+        security_group_ids=security_group_ids,
+        guest_instance_type=guest_instance_type,
+        instance_config=instance_config,
+        save_encryptor_logs=save_encryptor_logs,
+        status_port=status_port,
+        max_encryptors=max_encryptors,
+        timeout_history=timeout_history,
+        timeout_overrides=timeout_overrides,
+        defer_cleanup=defer_cleanup
+    )
+    ami = results['ami']
+    if defer_cleanup:
+        log.info(
+            'Registered encrypted AMI %s based on %s.  The cleanup job '
+            'waits for it to become available.', ami, image_id)
+        raise Return(ami)
+    log.info('Created encrypted AMI %s based on %s', ami, image_id)
     log.info('Done.')
-    return ami
+    raise Return(ami)
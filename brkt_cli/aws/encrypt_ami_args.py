@@ -28,6 +28,45 @@ def setup_encrypt_ami_args(parser):
         help='Specify the name of the generated encrypted AMI',
         required=False
     )
+    parser.add_argument(
+        '--copy-to-regions',
+        metavar='REGIONS',
+        dest='copy_to_regions',
+        help=(
+            'Comma-separated list of regions that the encrypted AMI is '
+            'copied to, after it is created.  The copies run in parallel.'
+        )
+    )
+    parser.add_argument(
+        '--account-role',
+        metavar='ARN',
+        dest='account_roles',
+        action='append',
+        help=(
+            'Encrypt the AMI in the account that this IAM role belongs to, '
+            'by assuming the role.  May be specified multiple times, to '
+            'encrypt in several accounts concurrently.  The guest AMI must '
+            'be shared with each account.'
+        )
+    )
+    parser.add_argument(
+        '--account-roles-file',
+        metavar='PATH',
+        dest='account_roles_file',
+        help=(
+            'Encrypt the AMI in the accounts of the IAM roles in this '
+            'file, one role ARN per line'
+        )
+    )
+    parser.add_argument(
+        '--cache-credentials',
+        dest='cache_credentials',
+        action='store_true',
+        help=(
+            'Save the assumed-role credentials under ~/.brkt/credentials, '
+            'so that later runs reuse them until they expire'
+        )
+    )
     parser.add_argument(
         '--guest-instance-type',
         metavar='TYPE',
@@ -37,6 +76,38 @@ def setup_encrypt_ami_args(parser):
             'instance'),
         default='m3.medium'
     )
+    parser.add_argument(
+        '--early-return',
+        dest='early_return',
+        action='store_true',
+        help=(
+            'Print the encrypted AMI ID as soon as the AMI is registered.  '
+            'Waiting for the AMI to become available and deleting '
+            'temporary resources continue in a background process.  The '
+            'cleanup job is saved in ~/.brkt/cleanup until it completes.'
+        )
+    )
+    parser.add_argument(
+        '--no-background-cleanup',
+        dest='background_cleanup',
+        action='store_false',
+        default=True,
+        help=(
+            'With --early-return, only save the cleanup job.  Run it later '
+            'with brkt cleanup-sessions.'
+        )
+    )
+    parser.add_argument(
+        '--max-encryptors',
+        metavar='N',
+        type=int,
+        dest='max_encryptors',
+        help=(
+            'Limit the number of encryptor and updater sessions that brkt '
+            'processes on this host run at the same time in the region and '
+            'AWS account.  Sessions over the limit wait in FIFO order.'
+        )
+    )
     parser.add_argument(
         '--pv',
         action='store_true',
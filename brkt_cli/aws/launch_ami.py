@@ -0,0 +1,204 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Launches instances of an encrypted AMI.
+
+The instances are spread evenly across the given subnets, or
+availability zones.  Each subnet or zone gets one RunInstances call that
+launches all of its instances with min and max count, and the calls run
+in parallel.  The instances are tagged with one CreateTags call, and a
+single poller waits for all of them with one DescribeInstances call per
+poll.  If the launch fails after some instances were started, the error
+has the ids of those instances, so that they aren't silently orphaned.
+"""
+
+import collections
+import logging
+
+from brkt_cli.aws.encrypt_ami import InstanceError
+from brkt_cli.engine import Call, Engine, Return, Sleep, gather_co
+from brkt_cli.timeouts import DEFAULT_TIMEOUTS
+from brkt_cli.user_data import gzip_user_data
+from brkt_cli.util import Deadline
+
+log = logging.getLogger(__name__)
+
+# The instances that RunInstances launches in one subnet or zone.
+# subnet_id and zone may be None.
+LaunchGroup = collections.namedtuple(
+    'LaunchGroup', ['count', 'min_count', 'subnet_id', 'zone'])
+
+
+class LaunchError(InstanceError):
+    """ Raised when a launch fails after some of the instances were
+    started.  instance_ids has the ids of those instances.
+    """
+
+    def __init__(self, message, instance_ids):
+        super(LaunchError, self).__init__(message)
+        self.instance_ids = instance_ids
+
+
+def plan_launch(count, min_count=None, subnet_ids=None, zones=None):
+    """ Spread the instances evenly across the subnets, or zones.  Earlier
+    subnets get the extra instances when count doesn't divide evenly.
+
+    :param min_count the minimum total number of instances.  Each group
+        gets its share, so that the launch fails if there's not enough
+        capacity.
+    :return a list of LaunchGroup objects
+    """
+    if min_count is None:
+        min_count = count
+    placements = (
+        [(s, None) for s in subnet_ids or []] or
+        [(None, z) for z in zones or []] or
+        [(None, None)]
+    )
+    placements = placements[:count]
+    groups = []
+    for i, (subnet_id, zone) in enumerate(placements):
+        group_count = count // len(placements)
+        if i < count % len(placements):
+            group_count += 1
+        group_min = max(1, group_count * min_count // count)
+        groups.append(LaunchGroup(group_count, group_min, subnet_id, zone))
+    return groups
+
+
+def wait_for_instances_co(aws_svc, instance_ids,
+                          timeout=DEFAULT_TIMEOUTS.instance):
+    """ Wait for all of the instances to be running, with one
+    DescribeInstances call per poll.
+
+    :return the Instance objects
+    :raise InstanceError if an instance fails to start, or the timeout
+        expires
+    """
+    log.debug(
+        'Waiting for %d instances, timeout=%d', len(instance_ids), timeout)
+    deadline = Deadline(timeout)
+    while True:
+        instances = yield Call(
+            aws_svc.get_instances, instance_ids=instance_ids)
+        states = collections.Counter(i.state for i in instances)
+        log.debug('Instance states: %s', dict(states))
+        for i in instances:
+            if i.state in ('error', 'terminated', 'shutting-down'):
+                raise InstanceError(
+                    'Instance %s is %s: %s' % (
+                        i.id, i.state, getattr(i, 'state_reason', None)))
+        if states['running'] == len(instance_ids):
+            raise Return(instances)
+        if deadline.is_expired():
+            break
+        yield Sleep(5)
+    raise InstanceError(
+        'Timed out waiting for %d of %d instances to be running' %
+        (len(instance_ids) - states['running'], len(instance_ids)))
+
+
+def _run_instances_co(aws_svc, image_id, group, client_token=None,
+                      **kwargs):
+    instances = yield Call(
+        aws_svc.run_instances,
+        image_id,
+        group.min_count,
+        group.count,
+        subnet_id=group.subnet_id,
+        placement=group.zone,
+        client_token=client_token,
+        **kwargs
+    )
+    log.info(
+        'Launched %d instances in %s', len(instances),
+        group.subnet_id or group.zone or aws_svc.region)
+    raise Return(instances)
+
+
+def _run_instances_or_log_co(aws_svc, image_id, group, **kwargs):
+    try:
+        instances = yield _run_instances_co(
+            aws_svc, image_id, group, **kwargs)
+    except Exception as e:
+        log.error(
+            'Unable to launch instances in %s: %s',
+            group.subnet_id or group.zone or aws_svc.region, e)
+        raise Return(None)
+    raise Return(instances)
+
+
+def launch_co(aws_svc, image_id, groups, instance_config, name=None,
+              instance_type='m3.medium', security_group_ids=None,
+              ebs_optimized=False, timeout=DEFAULT_TIMEOUTS.instance):
+    """ Coroutine version of launch(). """
+    user_data = gzip_user_data(instance_config.make_userdata())
+    results = yield gather_co(*[
+        _run_instances_or_log_co(
+            aws_svc, image_id, group,
+            # Makes retried requests idempotent.
+            client_token='%s-%d' % (aws_svc.session_id, i),
+            instance_type=instance_type,
+            security_group_ids=security_group_ids,
+            user_data=user_data,
+            ebs_optimized=ebs_optimized
+        )
+        for i, group in enumerate(groups)
+    ])
+    instance_ids = [
+        i.id for instances in results if instances for i in instances]
+    failed_groups = results.count(None)
+    if failed_groups == len(groups):
+        raise InstanceError('Unable to launch instances')
+
+    try:
+        if failed_groups:
+            raise InstanceError(
+                'Unable to launch instances in %d of %d subnets or zones' %
+                (failed_groups, len(groups)))
+        # CreateTags fails if there are no tags.
+        if name or aws_svc.default_tags:
+            yield Call(aws_svc.tag_resources, instance_ids, name=name)
+        instances = yield wait_for_instances_co(
+            aws_svc, instance_ids, timeout=timeout)
+    except Exception as e:
+        raise LaunchError(
+            '%s.  %d instances were launched and may still be running.' %
+            (e, len(instance_ids)),
+            instance_ids
+        )
+    raise Return(instances)
+
+
+def launch(aws_svc, image_id, groups, instance_config, **kwargs):
+    """ Launch instances of the encrypted AMI and wait for them to be
+    running.
+
+    :param groups a list of LaunchGroup objects, from plan_launch()
+    :param instance_config the InstanceConfig that the metavisor reads
+        from user data
+    :param kwargs passed to launch_co()
+    :return the Instance objects
+    :raise LaunchError if the launch fails after some of the instances
+        were started
+    """
+    engine = Engine(max_workers=max(len(groups), 1))
+    try:
+        return engine.run_until_complete(
+            launch_co(aws_svc, image_id, groups, instance_config, **kwargs),
+            session=aws_svc.session
+        )
+    finally:
+        engine.shutdown()
@@ -0,0 +1,140 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+
+
+def setup_launch_encrypted_ami_args(parser):
+    parser.add_argument(
+        'ami',
+        metavar='ID',
+        help='The encrypted AMI that will be launched'
+    )
+    parser.add_argument(
+        '--count',
+        metavar='N',
+        type=int,
+        default=1,
+        help='The number of instances to launch'
+    )
+    parser.add_argument(
+        '--min-count',
+        metavar='N',
+        type=int,
+        dest='min_count',
+        help=(
+            'Launch as long as at least this many instances can be '
+            'started.  By default, all of the instances must start.'
+        )
+    )
+    parser.add_argument(
+        '--instance-name',
+        metavar='NAME',
+        dest='instance_name',
+        help='Name tag of the instances'
+    )
+    parser.add_argument(
+        '--instance-type',
+        metavar='TYPE',
+        dest='instance_type',
+        default='m3.medium',
+        help='Instance type'
+    )
+    parser.add_argument(
+        '--ebs-optimized',
+        dest='ebs_optimized',
+        action='store_true',
+        help='Launch EBS-optimized instances'
+    )
+    parser.add_argument(
+        '--key',
+        metavar='NAME',
+        dest='key_name',
+        help='The EC2 key pair for the instances'
+    )
+    parser.add_argument(
+        '--no-validate',
+        dest='validate',
+        action='store_false',
+        default=True,
+        help="Don't validate the AMI, subnets and security groups"
+    )
+    parser.add_argument(
+        '--region',
+        metavar='NAME',
+        help='AWS region (e.g. us-west-2)',
+        dest='region',
+        required=True
+    )
+    parser.add_argument(
+        '--security-group',
+        metavar='ID',
+        dest='security_group_ids',
+        action='append',
+        help=(
+            'Use this security group for the instances.  May be specified '
+            'multiple times.'
+        )
+    )
+    parser.add_argument(
+        '--subnet',
+        metavar='ID',
+        dest='subnet_ids',
+        action='append',
+        help=(
+            'Launch instances in this subnet.  May be specified multiple '
+            'times, to spread the instances across subnets.'
+        )
+    )
+    parser.add_argument(
+        '--zone',
+        metavar='NAME',
+        dest='zones',
+        action='append',
+        help=(
+            'Launch instances in this availability zone.  May be specified '
+            'multiple times, to spread the instances across zones.  Not '
+            'used with --subnet, since each subnet is in one zone.'
+        )
+    )
+    parser.add_argument(
+        '--tag',
+        metavar='KEY=VALUE',
+        dest='tags',
+        action='append',
+        help=(
+            'Custom tag for the instances.  May be specified multiple times.'
+        )
+    )
+    parser.add_argument(
+        '-v',
+        '--verbose',
+        dest='launch_encrypted_ami_verbose',
+        action='store_true',
+        help='Print status information to the console'
+    )
+    parser.add_argument(
+        '--retry-timeout',
+        metavar='SECONDS',
+        type=float,
+        help=argparse.SUPPRESS,
+        default=10.0
+    )
+    parser.add_argument(
+        '--retry-initial-sleep-seconds',
+        metavar='SECONDS',
+        type=float,
+        help=argparse.SUPPRESS,
+        default=0.25
+    )
@@ -0,0 +1,135 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Runs a workflow in several AWS accounts at once.
+
+Each account is reached by assuming an IAM role in it.  The workflow for
+each account runs on its own worker thread, with its own AWSService and
+connection pool.  The role is assumed on that thread, so a slow AssumeRole
+call for one account doesn't delay the others.  Credentials come from a
+CredentialCache, which reuses them until they are about to expire.
+"""
+
+import logging
+import re
+
+from brkt_cli.engine import Call, Engine, Return
+from brkt_cli.validation import ValidationError
+
+log = logging.getLogger(__name__)
+
+ROLE_ARN_RE = re.compile(r'^arn:aws[\w-]*:iam::(\d{12}):role/\S+$')
+
+
+def get_account_id(role):
+    """ Return the id of the account that the role belongs to.
+
+    :raise ValidationError if the role is not an IAM role ARN
+    """
+    m = ROLE_ARN_RE.match(role)
+    if not m:
+        raise ValidationError('%s is not an IAM role ARN' % role)
+    return m.group(1)
+
+
+def validate_roles(roles):
+    """ Return the roles without duplicates, in the original order.
+
+    :raise ValidationError if a role is not an IAM role ARN, or two roles
+        are in the same account
+    """
+    result = []
+    account_ids = set()
+    for role in roles:
+        if role in result:
+            continue
+        account_id = get_account_id(role)
+        if account_id in account_ids:
+            raise ValidationError(
+                'More than one role was specified for account %s' %
+                account_id)
+        account_ids.add(account_id)
+        result.append(role)
+    return result
+
+
+def read_roles_file(path):
+    """ Read role ARNs from a file, one per line.  Blank lines and lines
+    starting with # are ignored.
+
+    :raise ValidationError if the file can't be read
+    """
+    try:
+        with open(path) as f:
+            lines = f.read().splitlines()
+    except IOError as e:
+        raise ValidationError('Unable to read %s: %s' % (path, e))
+    return [
+        line.strip() for line in lines
+        if line.strip() and not line.strip().startswith('#')
+    ]
+
+
+def _run_in_account_co(aws_svc, role, region, session_name,
+                       credential_cache, func):
+    yield Call(
+        aws_svc.connect_as, role, region, session_name,
+        credential_cache=credential_cache)
+    account_id = get_account_id(role)
+    log.info('Running in account %s', account_id)
+    result = yield Call(func, aws_svc, account_id)
+    raise Return(result)
+
+
+def run_in_accounts(roles, region, make_service, func, session_name='brkt',
+                    credential_cache=None):
+    """ Call func(aws_svc, account_id) in each of the accounts
+    concurrently.  The calls all start immediately, each with an
+    AWSService that is connected to the region with the role's
+    credentials.  A failure in one account is logged and doesn't affect
+    the others.
+
+    :param roles a list of IAM role ARNs, one per account
+    :param make_service a function that returns a new AWSService that
+        isn't connected yet
+    :param credential_cache the CredentialCache that the credentials are
+        shared through, or None
+    :return a tuple of (dictionary of account id to the value that func
+        returned, list of the account ids where func failed)
+    """
+    engine = Engine(max_workers=max(len(roles), 1))
+    futures = {}
+    try:
+        for role in roles:
+            aws_svc = make_service()
+            futures[get_account_id(role)] = engine.spawn(
+                _run_in_account_co(
+                    aws_svc, role, region, session_name, credential_cache,
+                    func),
+                session=aws_svc.session
+            )
+        engine.run()
+    finally:
+        engine.shutdown()
+
+    results = {}
+    failed = []
+    for account_id in sorted(futures):
+        try:
+            results[account_id] = futures[account_id].result()
+        except Exception as e:
+            log.error('Failed in account %s: %s', account_id, e)
+            failed.append(account_id)
+    return results, failed
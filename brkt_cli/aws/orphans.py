@@ -0,0 +1,159 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Finds and deletes the instances, volumes, snapshots and security groups
+that encryption and update sessions left behind in an AWS region.
+
+Every resource that a session creates is tagged with the session id, so
+one describe call per resource type, filtered by the BrktEncryptorSessionID
+tag key, lists them all.  Log snapshots, and snapshots that back an AMI
+that we own, are never deleted.  Neither are AMIs.
+"""
+
+import logging
+
+from brkt_cli import orphans
+from brkt_cli.aws.encrypt_ami import (
+    TAG_ENCRYPTOR_SESSION_ID,
+    clean_up_co
+)
+from brkt_cli.engine import Engine, gather_co
+from brkt_cli.orphans import Resource
+
+log = logging.getLogger(__name__)
+
+LIVE_INSTANCE_STATES = ('pending', 'running')
+GONE_INSTANCE_STATES = ('shutting-down', 'terminated')
+
+# The number of snapshot ids that we pass to a single DescribeImages call.
+SNAPSHOT_FILTER_CHUNK_SIZE = 100
+
+LOG_SNAPSHOT_PREFIX = 'Bracket logs'
+
+
+def _get_session_id(resource):
+    return resource.tags.get(TAG_ENCRYPTOR_SESSION_ID)
+
+
+def _get_image_snapshot_ids(aws_svc, snapshot_ids):
+    """ Return the ids of the snapshots that back an AMI that we own. """
+    snapshot_ids = list(snapshot_ids)
+    image_snapshot_ids = set()
+    for i in range(0, len(snapshot_ids), SNAPSHOT_FILTER_CHUNK_SIZE):
+        chunk = snapshot_ids[i:i + SNAPSHOT_FILTER_CHUNK_SIZE]
+        images = aws_svc.get_images(
+            filters={'block-device-mapping.snapshot-id': chunk},
+            owners=['self']
+        )
+        for image in images:
+            for bdt in image.block_device_mapping.values():
+                if bdt.snapshot_id:
+                    image_snapshot_ids.add(bdt.snapshot_id)
+    return image_snapshot_ids
+
+
+def list_resources(aws_svc):
+    """ Return the resources that encryption and update sessions created
+    in the current region.
+
+    :return a list of (session_id, Resource) tuples
+    """
+    tag_filter = {'tag-key': TAG_ENCRYPTOR_SESSION_ID}
+    resources = []
+
+    instance_ids = set()
+    for i in aws_svc.get_instances(filters=tag_filter):
+        if i.state in GONE_INSTANCE_STATES:
+            continue
+        instance_ids.add(i.id)
+        resources.append((_get_session_id(i), Resource(
+            type=orphans.RESOURCE_INSTANCE,
+            id=i.id,
+            created_time=orphans.parse_time(i.launch_time),
+            live=i.state in LIVE_INSTANCE_STATES,
+            location=None
+        )))
+
+    for v in aws_svc.get_volumes(filters=tag_filter):
+        attached_to = v.attach_data.instance_id if v.attach_data else None
+        if attached_to and attached_to not in instance_ids:
+            log.debug(
+                'Skipping volume %s, which is attached to %s',
+                v.id, attached_to)
+            continue
+        resources.append((_get_session_id(v), Resource(
+            type=orphans.RESOURCE_VOLUME,
+            id=v.id,
+            created_time=orphans.parse_time(v.create_time),
+            live=False,
+            location=None
+        )))
+
+    snapshots = [
+        s for s in aws_svc.get_owned_snapshots(filters=tag_filter)
+        if not s.tags.get('Name', '').startswith(LOG_SNAPSHOT_PREFIX)
+    ]
+    image_snapshot_ids = _get_image_snapshot_ids(
+        aws_svc, [s.id for s in snapshots])
+    for s in snapshots:
+        if s.id in image_snapshot_ids:
+            continue
+        resources.append((_get_session_id(s), Resource(
+            type=orphans.RESOURCE_SNAPSHOT,
+            id=s.id,
+            created_time=orphans.parse_time(s.start_time),
+            live=False,
+            location=None
+        )))
+
+    # Security groups don't have a creation time.
+    for sg in aws_svc.get_security_groups(filters=tag_filter):
+        resources.append((_get_session_id(sg), Resource(
+            type=orphans.RESOURCE_SECURITY_GROUP,
+            id=sg.id,
+            created_time=None,
+            live=False,
+            location=None
+        )))
+
+    return resources
+
+
+def _delete_session_co(aws_svc, session):
+    log.info('Deleting resources from session %s', session.session_id)
+    yield clean_up_co(
+        aws_svc,
+        instance_ids=session.get_ids(orphans.RESOURCE_INSTANCE),
+        volume_ids=session.get_ids(orphans.RESOURCE_VOLUME),
+        snapshot_ids=session.get_ids(orphans.RESOURCE_SNAPSHOT),
+        security_group_ids=session.get_ids(orphans.RESOURCE_SECURITY_GROUP)
+    )
+
+
+def delete_sessions(aws_svc, sessions, max_workers=8):
+    """ Delete the resources of the given sessions.  Sessions are cleaned
+    up in parallel.  Within a session, instances are terminated before
+    the volumes and security groups that they use are deleted.  Errors
+    are logged.
+    """
+    if not sessions:
+        return
+    engine = Engine(max_workers=max_workers)
+    try:
+        engine.run_until_complete(gather_co(
+            *[_delete_session_co(aws_svc, s) for s in sessions]
+        ))
+    finally:
+        engine.shutdown()
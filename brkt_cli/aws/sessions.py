@@ -0,0 +1,332 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Lists the encryption and update sessions that are running in AWS, and
+the ones that stopped without finishing.
+
+Every resource that a session creates is tagged with the session id, so
+each region is described with four calls no matter how many sessions are
+running: DescribeInstances, DescribeVolumes, DescribeSnapshots and
+DescribeImages, filtered by the BrktEncryptorSessionID tag key.  Regions
+are described in parallel.  Each session's phase is reconstructed from
+the state of its resources, and the time remaining is estimated from the
+rates that recent sessions recorded in the timeout history.
+"""
+
+import collections
+import logging
+import time
+
+from brkt_cli import orphans, util
+from brkt_cli.aws.encrypt_ami import (
+    NAME_ENCRYPTOR,
+    NAME_GUEST_CREATOR,
+    NAME_METAVISOR_UPDATER,
+    TAG_ENCRYPTOR_SESSION_ID
+)
+from brkt_cli.aws.orphans import LOG_SNAPSHOT_PREFIX
+from brkt_cli.engine import Call, Engine, Return, gather_co
+from brkt_cli.timeouts import (
+    ENCRYPTION,
+    ENCRYPTOR_UP,
+    HISTORY_SAFETY_FACTOR,
+    IMAGE,
+    get_timeouts
+)
+
+log = logging.getLogger(__name__)
+
+PHASE_GUEST = 'preparing guest'
+PHASE_ENCRYPTOR_UP = 'starting encryptor'
+PHASE_ENCRYPTING = 'encrypting'
+PHASE_UPDATING = 'updating'
+PHASE_SNAPSHOT = 'snapshotting'
+PHASE_IMAGE = 'creating image'
+
+ENCRYPT_PHASES = (
+    PHASE_GUEST, PHASE_ENCRYPTOR_UP, PHASE_ENCRYPTING, PHASE_SNAPSHOT,
+    PHASE_IMAGE
+)
+UPDATE_PHASES = (PHASE_GUEST, PHASE_UPDATING, PHASE_SNAPSHOT, PHASE_IMAGE)
+
+STATUS_RUNNING = 'running'
+STATUS_STALE = 'stale'
+STATUS_COMPLETED = 'completed'
+
+# Instances in these states may still be used by the session.  Updates
+# stop the guest and updater before moving their volumes.
+ACTIVE_INSTANCE_STATES = ('pending', 'running', 'stopping', 'stopped')
+
+ORIGINAL_VOLUME_PREFIX = 'Original unencrypted root volume'
+
+# phase_time is when the current phase started, if it's known.
+# volume_size_gb is the size of the guest root volume, if it's known.
+SessionStatus = collections.namedtuple('SessionStatus', [
+    'session_id',
+    'region',
+    'status',
+    'phase',
+    'is_update',
+    'start_time',
+    'phase_time',
+    'volume_size_gb',
+    'image_ids',
+    'instance_ids'
+])
+
+
+def _get_name(resource):
+    return resource.tags.get('Name') or ''
+
+
+def _group(resources):
+    groups = collections.defaultdict(list)
+    for r in resources:
+        groups[r.tags.get(TAG_ENCRYPTOR_SESSION_ID)].append(r)
+    return groups
+
+
+def _get_phase(instances, snapshots, images):
+    """ Return the (phase, phase start time) of a session, or
+    (None, None) if nothing is in progress.  Later phases win, since
+    earlier resources may not be cleaned up yet.
+    """
+    pending_images = [i for i in images if i.state == 'pending']
+    if pending_images:
+        return PHASE_IMAGE, orphans.parse_time(
+            getattr(pending_images[0], 'creationDate', None))
+
+    pending_snapshots = [s for s in snapshots if s.status == 'pending']
+    if pending_snapshots:
+        return PHASE_SNAPSHOT, min(
+            orphans.parse_time(s.start_time) for s in pending_snapshots)
+
+    for name, phases in (
+            (NAME_ENCRYPTOR, (PHASE_ENCRYPTOR_UP, PHASE_ENCRYPTING)),
+            (NAME_METAVISOR_UPDATER, (PHASE_UPDATING, PHASE_UPDATING))):
+        for i in instances:
+            if _get_name(i) != name:
+                continue
+            launch_time = orphans.parse_time(i.launch_time)
+            if i.state == 'pending':
+                return phases[0], launch_time
+            if i.state == 'running':
+                return phases[1], launch_time
+            # The encryptor or updater was stopped, and its volumes are
+            # being moved or snapshotted.
+            return PHASE_SNAPSHOT, None
+
+    for i in instances:
+        if _get_name(i) == NAME_GUEST_CREATOR:
+            return PHASE_GUEST, orphans.parse_time(i.launch_time)
+    return None, None
+
+
+def _get_volume_size(volumes):
+    for v in volumes:
+        if _get_name(v).startswith(ORIGINAL_VOLUME_PREFIX):
+            return v.size
+    return None
+
+
+def get_sessions(region, instances, volumes, snapshots, images,
+                 max_age=orphans.DEFAULT_MAX_AGE, now=None):
+    """ Reconstruct the status of each session from its resources.
+
+    A session is completed if it created an AMI and nothing is in
+    progress.  Encrypted AMIs keep their session id tag, so a completed
+    session stays completed no matter how old it is.  Otherwise, a session
+    is running if an image or snapshot is pending, or its instances
+    haven't been terminated, and it's not older than max_age.  Sessions
+    that left resources behind without creating an AMI, or have been
+    running for longer than max_age, are stale.
+
+    :return a list of SessionStatus objects, oldest first
+    """
+    now = now or time.time()
+    instances = [
+        i for i in instances if i.state in ACTIVE_INSTANCE_STATES]
+    snapshots = [
+        s for s in snapshots
+        if not _get_name(s).startswith(LOG_SNAPSHOT_PREFIX)
+    ]
+    groups = {
+        'instances': _group(instances),
+        'volumes': _group(volumes),
+        'snapshots': _group(snapshots),
+        'images': _group(images)
+    }
+    session_ids = set()
+    for group in groups.values():
+        session_ids.update(group.keys())
+    session_ids.discard(None)
+
+    sessions = []
+    for session_id in session_ids:
+        session_instances = groups['instances'].get(session_id, [])
+        session_volumes = groups['volumes'].get(session_id, [])
+        session_snapshots = groups['snapshots'].get(session_id, [])
+        session_images = groups['images'].get(session_id, [])
+
+        times = [orphans.parse_time(i.launch_time)
+                 for i in session_instances]
+        times += [orphans.parse_time(v.create_time) for v in session_volumes]
+        times += [orphans.parse_time(s.start_time)
+                  for s in session_snapshots]
+        times += [orphans.parse_time(getattr(i, 'creationDate', None))
+                  for i in session_images]
+        times = [t for t in times if t]
+        start_time = min(times) if times else None
+
+        phase, phase_time = _get_phase(
+            session_instances, session_snapshots, session_images)
+        if not phase and any(
+                i.state == 'available' for i in session_images):
+            status = STATUS_COMPLETED
+        elif start_time and now - start_time >= max_age:
+            status = STATUS_STALE
+        elif phase:
+            status = STATUS_RUNNING
+        else:
+            status = STATUS_STALE
+
+        is_update = any(
+            _get_name(i) == NAME_METAVISOR_UPDATER
+            for i in session_instances
+        )
+        sessions.append(SessionStatus(
+            session_id=session_id,
+            region=region,
+            status=status,
+            phase=phase,
+            is_update=is_update,
+            start_time=start_time,
+            phase_time=phase_time,
+            volume_size_gb=_get_volume_size(session_volumes),
+            image_ids=sorted(i.id for i in session_images),
+            instance_ids=sorted(i.id for i in session_instances)
+        ))
+    return sorted(sessions, key=lambda s: (s.start_time or now, s.session_id))
+
+
+def get_expected_seconds(phase, volume_size_gb=None, history=None):
+    """ Return the number of seconds that the phase usually takes.  The
+    typical rate from the timeout history is used if there is one.
+    Otherwise the estimate is based on the default timeouts, which are
+    deliberately generous.
+    """
+    history_phase = {
+        PHASE_ENCRYPTOR_UP: ENCRYPTOR_UP,
+        PHASE_ENCRYPTING: ENCRYPTION,
+        PHASE_UPDATING: ENCRYPTOR_UP,
+        PHASE_IMAGE: IMAGE
+    }.get(phase)
+    if history and history_phase and volume_size_gb:
+        seconds_per_gb = history.get_typical_seconds_per_gb(history_phase)
+        if seconds_per_gb:
+            return seconds_per_gb * volume_size_gb
+
+    timeouts = get_timeouts(volume_size_gb=volume_size_gb)
+    seconds = {
+        PHASE_GUEST: timeouts.instance,
+        PHASE_ENCRYPTOR_UP: timeouts.encryptor_up,
+        PHASE_ENCRYPTING: timeouts.encryption_progress,
+        PHASE_UPDATING: timeouts.encryptor_up,
+        PHASE_SNAPSHOT: timeouts.instance,
+        PHASE_IMAGE: timeouts.image
+    }[phase]
+    return seconds / HISTORY_SAFETY_FACTOR
+
+
+def estimate_remaining(session, history=None, now=None):
+    """ Return the estimated number of seconds until the session
+    completes, or None if it isn't running.
+    """
+    if session.status != STATUS_RUNNING:
+        return None
+    now = now or time.time()
+    phases = UPDATE_PHASES if session.is_update else ENCRYPT_PHASES
+    if session.phase not in phases:
+        # The encryptor started before we could tell that this is an
+        # update.
+        phases = ENCRYPT_PHASES
+    remaining = 0
+    for phase in phases[phases.index(session.phase):]:
+        expected = get_expected_seconds(
+            phase, volume_size_gb=session.volume_size_gb, history=history)
+        if phase == session.phase and session.phase_time:
+            expected = max(0, expected - (now - session.phase_time))
+        remaining += expected
+    return remaining
+
+
+def _call_co(function, *args, **kwargs):
+    result = yield Call(function, *args, **kwargs)
+    raise Return(result)
+
+
+def describe_region_co(aws_svc, region, max_age=orphans.DEFAULT_MAX_AGE,
+                       now=None):
+    """ Return the sessions in the region, with four describe calls that
+    run in parallel.
+    """
+    tag_filter = {'tag-key': TAG_ENCRYPTOR_SESSION_ID}
+    instances, volumes, snapshots, images = yield gather_co(
+        _call_co(aws_svc.get_instances, filters=tag_filter),
+        _call_co(aws_svc.get_volumes, filters=tag_filter),
+        _call_co(aws_svc.get_owned_snapshots, filters=tag_filter),
+        _call_co(aws_svc.get_images, filters=tag_filter, owners=['self'])
+    )
+    log.debug(
+        '%s: %d instances, %d volumes, %d snapshots, %d images',
+        region, len(instances), len(volumes), len(snapshots), len(images))
+    raise Return(get_sessions(
+        region, instances, volumes, snapshots, images, max_age=max_age,
+        now=now))
+
+
+def describe_regions(aws_svcs, max_age=orphans.DEFAULT_MAX_AGE, now=None,
+                     max_workers=16):
+    """ Describe the sessions in several regions in parallel.
+
+    :param aws_svcs a dictionary of region name to a connected AWSService
+    :return a list of SessionStatus objects
+    """
+    engine = Engine(max_workers=max_workers)
+    try:
+        results = engine.run_until_complete(gather_co(*[
+            describe_region_co(aws_svc, region, max_age=max_age, now=now)
+            for region, aws_svc in sorted(aws_svcs.iteritems())
+        ]))
+    finally:
+        engine.shutdown()
+    return [session for sessions in results for session in sessions]
+
+
+def render_sessions(sessions, history=None, now=None):
+    now = now or time.time()
+    rows = [[
+        'SESSION', 'REGION', 'STATUS', 'PHASE', 'AGE', 'REMAINING', 'IMAGES'
+    ]]
+    for s in sessions:
+        age = now - s.start_time if s.start_time else None
+        remaining = estimate_remaining(s, history=history, now=now)
+        rows.append([
+            s.session_id, s.region, s.status, s.phase or '-',
+            orphans.format_age(age),
+            orphans.format_age(remaining),
+            ', '.join(s.image_ids) or '-'
+        ])
+    return util.render_table_rows(rows)
@@ -0,0 +1,177 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Shares encrypted AMIs with other AWS accounts.
+
+Another account needs launch permission on the AMI and create volume
+permission on every snapshot in its block device mapping.  One
+ModifyImageAttribute or ModifySnapshotAttribute call adds many accounts,
+so the account ids are sent in batches of ACCOUNTS_PER_CALL, and the
+calls for all of the images and snapshots run at the same time.  When
+they're done, the permissions of each image and snapshot are described
+once, to verify that every account was added.
+"""
+
+import json
+import logging
+import re
+
+from brkt_cli.engine import Call, Engine, Return, gather_co
+from brkt_cli.validation import ValidationError
+
+log = logging.getLogger(__name__)
+
+# AWS doesn't document a limit on the number of accounts in one call.
+# This keeps each request well under the maximum request size.
+ACCOUNTS_PER_CALL = 500
+
+ACCOUNT_ID_RE = re.compile(r'^\d{12}$')
+
+
+def validate_account_ids(account_ids):
+    """ Check the account ids and remove duplicates.
+
+    :return the account ids, in the order they were specified
+    :raise ValidationError if an account id is not 12 digits
+    """
+    result = []
+    for account_id in account_ids:
+        account_id = str(account_id).strip()
+        if not ACCOUNT_ID_RE.match(account_id):
+            raise ValidationError('Invalid AWS account id: %s' % account_id)
+        if account_id not in result:
+            result.append(account_id)
+    return result
+
+
+def read_accounts_file(path):
+    """ Read account ids from a file.  The file is either the JSON output
+    of "aws organizations list-accounts-for-parent" or "list-accounts",
+    in which case only active accounts are read, or a list of account ids,
+    one per line.  Blank lines and lines starting with # are ignored.
+
+    :raise ValidationError if the file can't be read
+    """
+    try:
+        with open(path) as f:
+            content = f.read()
+    except IOError as e:
+        raise ValidationError('Unable to read %s: %s' % (path, e))
+
+    if content.lstrip().startswith('{'):
+        try:
+            accounts = json.loads(content)['Accounts']
+            return [
+                a['Id'] for a in accounts
+                if a.get('Status', 'ACTIVE') == 'ACTIVE'
+            ]
+        except (ValueError, KeyError, TypeError) as e:
+            raise ValidationError(
+                'Unable to parse accounts from %s: %s' % (path, e))
+
+    account_ids = []
+    for line in content.splitlines():
+        line = line.strip()
+        if line and not line.startswith('#'):
+            account_ids.append(line)
+    return account_ids
+
+
+def _make_batches(account_ids, size=ACCOUNTS_PER_CALL):
+    return [
+        account_ids[i:i + size] for i in range(0, len(account_ids), size)
+    ]
+
+
+def _call_co(function, *args, **kwargs):
+    result = yield Call(function, *args, **kwargs)
+    raise Return(result)
+
+
+def get_snapshot_ids(images):
+    """ Return the ids of the snapshots in the images' block device
+    mappings, without duplicates.
+    """
+    snapshot_ids = []
+    for image in images:
+        for device_name in sorted(image.block_device_mapping):
+            bdt = image.block_device_mapping[device_name]
+            if bdt.snapshot_id and bdt.snapshot_id not in snapshot_ids:
+                snapshot_ids.append(bdt.snapshot_id)
+    return snapshot_ids
+
+
+def share_images_co(aws_svc, images, account_ids,
+                    batch_size=ACCOUNTS_PER_CALL):
+    """ Coroutine version of share_images(). """
+    snapshot_ids = get_snapshot_ids(images)
+    batches = _make_batches(account_ids, size=batch_size)
+    log.info(
+        'Sharing %d images and %d snapshots with %d accounts',
+        len(images), len(snapshot_ids), len(account_ids))
+
+    modify = [
+        _call_co(aws_svc.add_launch_permission, image.id, batch)
+        for image in images for batch in batches
+    ]
+    modify += [
+        _call_co(aws_svc.add_create_volume_permission, snapshot_id, batch)
+        for snapshot_id in snapshot_ids for batch in batches
+    ]
+    yield gather_co(*modify)
+
+    resources = [
+        (image.id, aws_svc.get_launch_permission) for image in images
+    ]
+    resources += [
+        (snapshot_id, aws_svc.get_create_volume_permission)
+        for snapshot_id in snapshot_ids
+    ]
+    permissions = yield gather_co(*[
+        _call_co(describe, resource_id)
+        for resource_id, describe in resources
+    ])
+
+    missing = {}
+    for (resource_id, _), user_ids in zip(resources, permissions):
+        user_ids = set(user_ids)
+        not_shared = [a for a in account_ids if a not in user_ids]
+        if not_shared:
+            log.error(
+                '%s is not shared with %d accounts: %s', resource_id,
+                len(not_shared), ', '.join(not_shared))
+            missing[resource_id] = not_shared
+    raise Return(missing)
+
+
+def share_images(aws_svc, images, account_ids, max_workers=16,
+                 batch_size=ACCOUNTS_PER_CALL):
+    """ Share the images and their snapshots with the accounts, and
+    verify that the permissions were added.
+
+    :param images boto Image objects
+    :return a dictionary of image or snapshot id to the account ids that
+        it isn't shared with.  The dictionary is empty if sharing
+        succeeded.
+    """
+    engine = Engine(max_workers=max_workers)
+    try:
+        return engine.run_until_complete(
+            share_images_co(
+                aws_svc, images, account_ids, batch_size=batch_size),
+            session=aws_svc.session
+        )
+    finally:
+        engine.shutdown()
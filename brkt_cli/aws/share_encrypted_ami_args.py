@@ -0,0 +1,79 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+
+
+def setup_share_encrypted_ami_args(parser):
+    parser.add_argument(
+        'amis',
+        metavar='ID',
+        nargs='+',
+        help='The encrypted AMI that will be shared'
+    )
+    parser.add_argument(
+        '--account',
+        metavar='ID',
+        dest='accounts',
+        action='append',
+        help=(
+            'Share with this AWS account.  May be specified multiple '
+            'times.'
+        )
+    )
+    parser.add_argument(
+        '--accounts-file',
+        metavar='PATH',
+        dest='accounts_file',
+        help=(
+            'Share with the AWS accounts in this file: either one account '
+            'id per line, or the JSON output of "aws organizations '
+            'list-accounts-for-parent"'
+        )
+    )
+    parser.add_argument(
+        '--no-validate',
+        dest='validate',
+        action='store_false',
+        default=True,
+        help="Don't validate that the AMIs are encrypted"
+    )
+    parser.add_argument(
+        '--region',
+        metavar='NAME',
+        help='AWS region (e.g. us-west-2)',
+        dest='region',
+        required=True
+    )
+    parser.add_argument(
+        '-v',
+        '--verbose',
+        dest='share_encrypted_ami_verbose',
+        action='store_true',
+        help='Print status information to the console'
+    )
+    parser.add_argument(
+        '--retry-timeout',
+        metavar='SECONDS',
+        type=float,
+        help=argparse.SUPPRESS,
+        default=10.0
+    )
+    parser.add_argument(
+        '--retry-initial-sleep-seconds',
+        metavar='SECONDS',
+        type=float,
+        help=argparse.SUPPRESS,
+        default=0.25
+    )
@@ -11,28 +11,171 @@
 # CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and
 # limitations under the License.
-
 import logging
+import sys
+
 from brkt_cli.aws.encrypt_ami import (
-    snapshot_log_volume
+    SnapshotError,
+    clean_up_co,
+    create_log_snapshot_co,
+    wait_for_snapshots_co
 )
+from brkt_cli.engine import Call, Engine, Return, gather_co
+from brkt_cli.util import BracketError
 
 log = logging.getLogger(__name__)
 
+# Instances in these states still have their log volumes.
+INSTANCE_STATES = ['pending', 'running', 'stopping', 'stopped']
+
+
+def find_instance_ids(aws_svc, tags):
+    """ Return the ids of the instances that have all of the tags.
+
+    :param tags a dictionary of tag key to value
+    """
+    filters = {'tag:%s' % k: v for k, v in tags.iteritems()}
+    filters['instance-state-name'] = INSTANCE_STATES
+    return sorted(i.id for i in aws_svc.get_instances(filters=filters))
+
+
+def _create_log_snapshot_or_log_co(aws_svc, instance, image):
+    try:
+        if not image:
+            raise BracketError('Unable to find %s' % instance.image_id)
+        snapshot = yield create_log_snapshot_co(aws_svc, instance, image)
+    except Exception as e:
+        log.error(
+            'Unable to snapshot the log volume of %s: %s', instance.id, e)
+        raise Return(None)
+    raise Return(snapshot)
+
+
+def _wait_for_log_snapshots_co(aws_svc, snapshots):
+    """ Wait for the snapshots with a single poller.  A snapshot that
+    goes into an error state is logged, deleted and dropped, and the
+    poller keeps waiting for the others.
+
+    :param snapshots a dictionary of instance id to Snapshot
+    :return a dictionary of instance id to Snapshot, for the snapshots
+        that completed
+    """
+    snapshots = dict(snapshots)
+    while snapshots:
+        snapshot_ids = [s.id for s in snapshots.values()]
+        try:
+            yield wait_for_snapshots_co(aws_svc, *snapshot_ids)
+            break
+        except SnapshotError:
+            current = yield Call(aws_svc.get_snapshots, *snapshot_ids)
+            error_ids = set(s.id for s in current if s.status == 'error')
+            if not error_ids:
+                raise
+        for instance_id, snapshot in snapshots.items():
+            if snapshot.id in error_ids:
+                log.error(
+                    'Snapshot %s of the log volume of %s is in an error '
+                    'state', snapshot.id, instance_id)
+                del snapshots[instance_id]
+        yield clean_up_co(aws_svc, snapshot_ids=sorted(error_ids))
+    raise Return(snapshots)
+
 
-def _share_snapshot(snapshot, bracket_aws_account):
+def snapshot_log_volumes_co(aws_svc, instance_ids):
+    """ Snapshot the log volumes of the instances.  The instances and
+    their AMIs are described with one call each, all of the snapshots
+    are started at once, and then a single poller waits for them.  An
+    instance whose snapshot can't be started, or whose snapshot goes
+    into an error state, is logged and skipped.
+
+    :return a dictionary of instance id to Snapshot
+    """
+    instances = yield Call(aws_svc.get_instances, instance_ids=instance_ids)
+    image_ids = sorted(set(i.image_id for i in instances))
+    images = yield Call(aws_svc.get_images, filters={'image-id': image_ids})
+    images_by_id = {image.id: image for image in images}
+
+    results = yield gather_co(*[
+        _create_log_snapshot_or_log_co(
+            aws_svc, instance, images_by_id.get(instance.image_id))
+        for instance in instances
+    ])
+    snapshots = {
+        instance.id: snapshot
+        for instance, snapshot in zip(instances, results)
+        if snapshot
+    }
+    try:
+        snapshots = yield _wait_for_log_snapshots_co(aws_svc, snapshots)
+    except:
+        exc_info = sys.exc_info()
+        yield clean_up_co(
+            aws_svc, snapshot_ids=[s.id for s in snapshots.values()])
+        raise exc_info[0], exc_info[1], exc_info[2]
+    raise Return(snapshots)
+
+
+def snapshot_log_volumes(aws_svc, instance_ids, max_workers=16):
+    """ Snapshot the log volumes of the instances concurrently, and wait
+    for the snapshots to complete.
+
+    :return a dictionary of instance id to Snapshot
+    """
+    engine = Engine(max_workers=max_workers)
+    try:
+        return engine.run_until_complete(
+            snapshot_log_volumes_co(aws_svc, instance_ids),
+            session=aws_svc.session
+        )
+    finally:
+        engine.shutdown()
+
+
+def _share_snapshot_co(aws_svc, snapshot_id, bracket_aws_account):
     log.info(
         'Sharing snapshot %s with AWS account %s',
-        snapshot.id, bracket_aws_account
+        snapshot_id, bracket_aws_account
     )
-    snapshot.share(user_ids=[bracket_aws_account])
+    yield Call(
+        aws_svc.add_create_volume_permission, snapshot_id,
+        [str(bracket_aws_account)])
+
+
+def share_snapshots(aws_svc, snapshot_ids, bracket_aws_account,
+                    max_workers=16):
+    """ Share the snapshots with the Bracket AWS account.  Each snapshot
+    needs its own ModifySnapshotAttribute call, so the calls run
+    concurrently.
+    """
+    engine = Engine(max_workers=max_workers)
+    try:
+        engine.run_until_complete(
+            gather_co(*[
+                _share_snapshot_co(aws_svc, snapshot_id, bracket_aws_account)
+                for snapshot_id in snapshot_ids
+            ]),
+            session=aws_svc.session
+        )
+    finally:
+        engine.shutdown()
+
 
+def share(aws_svc=None, instance_ids=None, bracket_aws_account=None,
+          snapshot_ids=None):
+    """ Snapshot the log volumes of the instances, and share those
+    snapshots and the given snapshots with the Bracket AWS account.
+    Print each shared snapshot id.
 
-def share(aws_svc=None, instance_id=None, bracket_aws_account=None,
-          snapshot_id=None):
-    if instance_id:
-        snapshot = snapshot_log_volume(aws_svc, instance_id)
-    else:
-        snapshot = aws_svc.get_snapshot(snapshot_id)
-    _share_snapshot(snapshot, bracket_aws_account)
-    print snapshot.id
+    :return the number of instances whose logs couldn't be snapshotted
+    """
+    instance_ids = instance_ids or []
+    snapshot_ids = list(snapshot_ids or [])
+    snapshots = {}
+    if instance_ids:
+        snapshots = snapshot_log_volumes(aws_svc, instance_ids)
+        snapshot_ids += [snapshots[i].id for i in instance_ids
+                         if i in snapshots]
+    share_snapshots(aws_svc, snapshot_ids, bracket_aws_account)
+    for snapshot_id in snapshot_ids:
+        print snapshot_id
+    return len(instance_ids) - len(snapshots)
@@ -18,14 +18,33 @@ def setup_share_logs_args(parser):
     parser.add_argument(
         '--snapshot',
         metavar='ID',
-        dest='snapshot_id',
-        help='The snapshot with Bracket system logs to be shared'
+        dest='snapshot_ids',
+        action='append',
+        help=(
+            'The snapshot with Bracket system logs to be shared.  May be '
+            'specified multiple times.'
+        )
     )
     parser.add_argument(
         '--instance',
         metavar='ID',
-        dest='instance_id',
-        help='The instance with Bracket system logs to be shared'
+        dest='instance_ids',
+        action='append',
+        help=(
+            'The instance with Bracket system logs to be shared.  May be '
+            'specified multiple times.'
+        )
+    )
+    parser.add_argument(
+        '--instance-tag',
+        metavar='KEY=VALUE',
+        dest='instance_tags',
+        action='append',
+        help=(
+            'Share the logs of the instances that have this tag.  May be '
+            'specified multiple times, to select instances that have all '
+            'of the tags.'
+        )
     )
     parser.add_argument(
         '--no-validate',
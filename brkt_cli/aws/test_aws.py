@@ -260,6 +260,31 @@ class TestValidation(unittest.TestCase):
         with self.assertRaises(ValidationError):
             brkt_cli.aws._validate_region(aws_svc, 'foobar')
 
+    def test_validate_account_role_options(self):
+        """ Test that options that only work in the caller's account are
+        rejected when encrypting in other accounts.
+        """
+        values = DummyValues()
+        values.detach = False
+        values.session_id = None
+        values.early_return = False
+        brkt_cli.aws._validate_account_role_options(values)
+
+        # Deferred cleanup would run in the caller's account.
+        values.early_return = True
+        with self.assertRaises(ValidationError):
+            brkt_cli.aws._validate_account_role_options(values)
+        values.early_return = False
+
+        values.detach = True
+        with self.assertRaises(ValidationError):
+            brkt_cli.aws._validate_account_role_options(values)
+        values.detach = False
+
+        values.subnet_id = 'subnet-1'
+        with self.assertRaises(ValidationError):
+            brkt_cli.aws._validate_account_role_options(values)
+
 
 class TestVirtualizationType(unittest.TestCase):
 
@@ -11,6 +11,8 @@
 # CONDITIONS OF ANY KIND, either express or implied. See the
 # License for the specific language governing permissions and
 # limitations under the License.
+import collections
+import fnmatch
 import ssl
 import unittest
 import uuid
@@ -18,6 +20,7 @@ import uuid
 from boto.ec2.blockdevicemapping import BlockDeviceType, BlockDeviceMapping
 from boto.ec2.image import Image
 from boto.ec2.instance import Instance, ConsoleOutput
+from boto.ec2.instancestatus import InstanceStatus
 from boto.ec2.keypair import KeyPair
 from boto.ec2.securitygroup import SecurityGroup
 from boto.ec2.snapshot import Snapshot
@@ -74,6 +77,13 @@ class DummyAWSService(aws_service.BaseAWSService):
             RegionInfo(name='eu-west-1')
         ]
         self.volumes = {}
+        self.copy_image_calls = []
+        self.run_instances_calls = []
+        self.tag_resources_calls = []
+        self.default_tags = {}
+        # Resource id to the set of account ids that it's shared with.
+        self.permissions = collections.defaultdict(set)
+        self.modify_attribute_calls = []
 
         vpc = VPC()
         vpc.id = 'vpc-' + new_id()
@@ -97,6 +107,11 @@ class DummyAWSService(aws_service.BaseAWSService):
     def connect(self, region, key_name=None):
         self.region = region
 
+    def connect_as(self, role, region, session_name,
+                   credential_cache=None):
+        self.region = region
+        self.role = role
+
     def run_instance(self,
                      image_id,
                      security_group_ids=None,
@@ -160,9 +175,40 @@ class DummyAWSService(aws_service.BaseAWSService):
                 self.transition_to_running[instance_id] = True
         return instance
 
+    def run_instances(self,
+                      image_id,
+                      min_count,
+                      max_count,
+                      security_group_ids=None,
+                      instance_type='c3.xlarge',
+                      placement=None,
+                      subnet_id=None,
+                      user_data=None,
+                      ebs_optimized=False,
+                      client_token=None):
+        self.run_instances_calls.append((max_count, subnet_id, placement))
+        instances = []
+        for _ in range(max_count):
+            instance = self.run_instance(
+                image_id, security_group_ids=security_group_ids,
+                instance_type=instance_type, placement=placement,
+                subnet_id=subnet_id, user_data=user_data,
+                ebs_optimized=ebs_optimized)
+            instance.subnet_id = subnet_id
+            instances.append(instance)
+        return instances
+
+    def get_instances(self, filters=None, instance_ids=None):
+        if instance_ids:
+            return [self.get_instance(i) for i in instance_ids]
+        return _filter(self.instances.values(), filters)
+
     def create_tags(self, resource_id, name=None, description=None):
         pass
 
+    def tag_resources(self, resource_ids, name=None, description=None):
+        self.tag_resources_calls.append((list(resource_ids), name))
+
     def stop_instance(self, instance_id):
         instance = self.instances[instance_id]
         if self.stop_instance_callback:
@@ -187,15 +233,20 @@ class DummyAWSService(aws_service.BaseAWSService):
             self.get_volume_callback(volume)
         return volume
 
-    def get_volumes(self, tag_key=None, tag_value=None):
+    def get_volumes(self, tag_key=None, tag_value=None, filters=None):
         if tag_key and tag_value:
             return self.tagged_volumes
+        elif filters:
+            return _filter(self.volumes.values(), filters)
         else:
             return []
 
     def get_snapshots(self, *snapshot_ids):
         return [self.get_snapshot(id) for id in snapshot_ids]
 
+    def get_owned_snapshots(self, filters=None):
+        return _filter(self.snapshots.values(), filters)
+
     def get_snapshot(self, snapshot_id):
         snapshot = self.snapshots[snapshot_id]
 
@@ -218,6 +269,8 @@ class DummyAWSService(aws_service.BaseAWSService):
         snapshot = Snapshot()
         snapshot.id = new_id()
         snapshot.status = 'pending'
+        volume = self.volumes.get(volume_id)
+        snapshot.volume_size = volume.size if volume else None
         self.snapshots[snapshot.id] = snapshot
 
         if self.create_snapshot_callback:
@@ -280,6 +333,23 @@ class DummyAWSService(aws_service.BaseAWSService):
         self.images[image.id] = image
         return image.id
 
+    def copy_image(self, source_region, source_image_id, name=None,
+                   description=None):
+        # Only the source region's images are visible to this service,
+        # so the copy gets a new root snapshot.
+        source = self.images.get(source_image_id)
+        bdm = BlockDeviceMapping()
+        bdm['/dev/sda1'] = BlockDeviceType(snapshot_id=new_id())
+        image_id = self.register_image(
+            kernel_id=None, block_device_map=bdm, name=name,
+            description=description)
+        image = self.images[image_id]
+        image.root_device_name = '/dev/sda1'
+        if source:
+            image.virtualization_type = source.virtualization_type
+        self.copy_image_calls.append((source_region, source_image_id))
+        return image_id
+
     def wait_for_image(self, image_id):
         pass
 
@@ -293,13 +363,23 @@ class DummyAWSService(aws_service.BaseAWSService):
             raise e
 
     def get_images(self, filters=None, owners=None):
-        # Only filtering by name is currently supported.
+        # Only filtering by name, snapshot id and tag key is currently
+        # supported.
         name = filters.get('name', None)
+        snapshot_ids = filters.get('block-device-mapping.snapshot-id')
         images = []
         if name:
             for i in self.images.values():
                 if i.name == name:
                     images.append(i)
+        elif snapshot_ids:
+            for i in self.images.values():
+                for bdt in i.block_device_mapping.values():
+                    if bdt.snapshot_id in snapshot_ids:
+                        images.append(i)
+                        break
+        else:
+            images = _filter(self.images.values(), filters)
         return images
 
     def delete_snapshot(self, snapshot_id):
@@ -307,11 +387,27 @@ class DummyAWSService(aws_service.BaseAWSService):
         if self.delete_snapshot_callback:
             self.delete_snapshot_callback(snapshot_id)
 
+    def add_launch_permission(self, image_id, user_ids):
+        self.get_image(image_id)
+        self.modify_attribute_calls.append((image_id, list(user_ids)))
+        self.permissions[image_id].update(user_ids)
+
+    def get_launch_permission(self, image_id):
+        return sorted(self.permissions[image_id])
+
+    def add_create_volume_permission(self, snapshot_id, user_ids):
+        self.modify_attribute_calls.append((snapshot_id, list(user_ids)))
+        self.permissions[snapshot_id].update(user_ids)
+
+    def get_create_volume_permission(self, snapshot_id):
+        return sorted(self.permissions[snapshot_id])
+
     def create_security_group(self, name, description, vpc_id=None):
         if self.create_security_group_callback:
             self.create_security_group_callback(vpc_id)
         sg = SecurityGroup()
         sg.id = 'sg-%s' % new_id()
+        sg.name = name
         sg.vpc_id = vpc_id or self.default_vpc.id
         self.security_groups[sg.id] = sg
         return sg
@@ -319,11 +415,17 @@ class DummyAWSService(aws_service.BaseAWSService):
     def get_security_group(self, sg_id, retry=False):
         return self.security_groups[sg_id]
 
+    def get_security_groups(self, filters=None):
+        return _filter(self.security_groups.values(), filters)
+
+    def get_account_id(self):
+        return '123456789012'
+
     def add_security_group_rule(self, sg_id, **kwargs):
         pass
 
     def delete_security_group(self, sg_id):
-        pass
+        self.security_groups.pop(sg_id, None)
 
     def get_key_pair(self, keyname):
         kp = KeyPair()
@@ -335,6 +437,17 @@ class DummyAWSService(aws_service.BaseAWSService):
         console_output.output = self.console_output_text
         return console_output
 
+    def get_instance_status(self, instance_id):
+        instance = self.instances[instance_id]
+        status = InstanceStatus(
+            id=instance_id,
+            state_code=instance.state_code,
+            state_name=instance.state
+        )
+        status.system_status.status = 'ok'
+        status.instance_status.status = 'ok'
+        return status
+
     def get_subnet(self, subnet_id):
         return self.subnets[subnet_id]
 
@@ -353,6 +466,33 @@ class DummyAWSService(aws_service.BaseAWSService):
         )
 
 
+def _filter(resources, filters):
+    """ Return the resources that match the given filters.  Only the
+    tag-key, tag:KEY, group-name and image-id filters are currently
+    supported.
+    """
+    filters = filters or {}
+    tag_key = filters.get('tag-key')
+    group_name = filters.get('group-name')
+    image_ids = filters.get('image-id')
+    tags = {
+        k[len('tag:'):]: v for k, v in filters.iteritems()
+        if k.startswith('tag:')
+    }
+    result = []
+    for r in resources:
+        if tag_key and tag_key not in r.tags:
+            continue
+        if any(r.tags.get(k) != v for k, v in tags.iteritems()):
+            continue
+        if image_ids and r.id not in image_ids:
+            continue
+        if group_name and not fnmatch.fnmatch(r.name or '', group_name):
+            continue
+        result.append(r)
+    return result
+
+
 def build_aws_service():
     aws_svc = DummyAWSService()
 
@@ -0,0 +1,106 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import unittest
+
+import brkt_cli.util
+from brkt_cli import cassette
+from brkt_cli.aws import encrypt_ami
+from brkt_cli.aws.test_aws_service import build_aws_service
+from brkt_cli.aws.update_ami import update_ami
+from brkt_cli.cassette import Cassette, CallRecorder
+from brkt_cli.test_encryptor_service import DummyEncryptorService
+
+
+class TestCallRecorder(unittest.TestCase):
+
+    def setUp(self):
+        brkt_cli.util.SLEEP_ENABLED = False
+
+    def test_record(self):
+        aws_svc, encryptor_image, guest_image = build_aws_service()
+        recorder = CallRecorder(aws_svc)
+        recorder.get_image(guest_image.id)
+        recorder.get_image(encryptor_image.id)
+        recorder.get_image(guest_image.id)
+        recorder.get_snapshots()
+
+        self.assertEqual(
+            ['get_image(r1)', 'get_image(r2)', 'get_image(r1)',
+             'get_snapshots()'],
+            [repr(c) for c in recorder.calls]
+        )
+
+        # Attributes are passed through to the service.
+        recorder.default_tags = {'a': 'b'}
+        self.assertEqual({'a': 'b'}, aws_svc.default_tags)
+        self.assertEqual(aws_svc.session_id, recorder.session_id)
+
+    def test_budget(self):
+        calls = [
+            cassette.RecordedCall('get_instance', ['r1']),
+            cassette.RecordedCall('get_instance', ['r1']),
+            cassette.RecordedCall('get_image', ['r2'])
+        ]
+        budget = cassette.CallBudget.from_calls(calls)
+        self.assertEqual(3, budget.max_calls)
+        self.assertEqual(2, budget.max_calls_per_resource)
+        cassette.check_budget(calls, budget)
+
+        calls.append(cassette.RecordedCall('get_instance', ['r1']))
+        with self.assertRaisesRegexp(
+                cassette.CallBudgetExceededError, 'resource r1'):
+            cassette.check_budget(calls, budget)
+
+    def test_replay_reports_diff(self):
+        recorded = [cassette.RecordedCall('get_image', ['r1'])]
+        replayed = recorded + [cassette.RecordedCall('get_image', ['r1'])]
+        with self.assertRaisesRegexp(
+                cassette.CallBudgetExceededError, r'\+get_image\(r1\)'):
+            Cassette(recorded).replay(replayed)
+
+
+class TestWorkflowCallBudget(unittest.TestCase):
+    """ Verify that the encrypt and update workflows don't make more AWS
+    API calls than the budgets recorded in brkt_cli/cassettes.
+    """
+
+    def setUp(self):
+        brkt_cli.util.SLEEP_ENABLED = False
+
+    def test_encrypt_ami(self):
+        aws_svc, encryptor_image, guest_image = build_aws_service()
+        recorder = CallRecorder(aws_svc)
+        encrypt_ami.encrypt(
+            aws_svc=recorder,
+            enc_svc_cls=DummyEncryptorService,
+            image_id=guest_image.id,
+            encryptor_ami=encryptor_image.id
+        )
+        cassette.check_cassette('aws_encrypt_ami', recorder.calls)
+
+    def test_update_ami(self):
+        aws_svc, encryptor_image, guest_image = build_aws_service()
+        encrypted_ami_id = encrypt_ami.encrypt(
+            aws_svc=aws_svc,
+            enc_svc_cls=DummyEncryptorService,
+            image_id=guest_image.id,
+            encryptor_ami=encryptor_image.id
+        )
+        recorder = CallRecorder(aws_svc)
+        update_ami(
+            recorder, encrypted_ami_id, encryptor_image.id,
+            'Test updated AMI',
+            enc_svc_class=DummyEncryptorService
+        )
+        cassette.check_cassette('aws_update_ami', recorder.calls)
@@ -0,0 +1,110 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import os
+import shutil
+import tempfile
+import unittest
+
+from boto.ec2.blockdevicemapping import BlockDeviceMapping, BlockDeviceType
+
+from brkt_cli import catalog
+from brkt_cli.aws import catalog as aws_catalog
+from brkt_cli.aws import test_aws_service
+from brkt_cli.aws.encrypt_ami import (
+    TAG_ENCRYPTOR,
+    TAG_ENCRYPTOR_AMI,
+    TAG_ENCRYPTOR_SESSION_ID
+)
+from brkt_cli.catalog import Catalog
+
+
+class TestAWSCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'catalog.db')
+        self.aws_svc, _, _ = test_aws_service.build_aws_service()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _register_encrypted_image(self, session_id):
+        bdm = BlockDeviceMapping()
+        bdm['/dev/sda1'] = BlockDeviceType(snapshot_id='snap-1', size=9)
+        bdm['/dev/sda2'] = BlockDeviceType(snapshot_id='snap-2', size=1)
+        image_id = self.aws_svc.register_image(
+            kernel_id=None, block_device_map=bdm, name='encrypted',
+            description='Based on ami-12345678, encrypted by Bracket '
+                        'Computing')
+        image = self.aws_svc.get_image(image_id)
+        image.root_device_name = '/dev/sda1'
+        image.tags[TAG_ENCRYPTOR] = 'True'
+        image.tags[TAG_ENCRYPTOR_SESSION_ID] = session_id
+        image.tags[TAG_ENCRYPTOR_AMI] = 'ami-e1'
+        return image
+
+    def test_refresh(self):
+        """ Test that refresh reads lineage from the AMI tags, keeps what
+        sessions recorded, and removes AMIs that no longer exist.
+        """
+        image = self._register_encrypted_image('abc')
+        updated = self._register_encrypted_image('def')
+        image_catalog = Catalog(self.path)
+        try:
+            image_catalog.add(catalog.make_record(
+                updated.id, catalog.CLOUD_AWS, location='us-west-2',
+                source_image=image.id,
+                operation=catalog.OPERATION_UPDATE))
+            image_catalog.add(catalog.make_record(
+                'ami-deleted', catalog.CLOUD_AWS, location='us-west-2'))
+
+            self.assertEqual(
+                2, aws_catalog.refresh(
+                    self.aws_svc, 'us-west-2', image_catalog))
+
+            record = image_catalog.get(image.id)
+            self.assertEqual('ami-12345678', record.source_image)
+            self.assertEqual('ami-e1', record.encryptor_image)
+            self.assertEqual('abc', record.session_id)
+            self.assertEqual(['snap-1', 'snap-2'], record.snapshot_ids)
+            self.assertEqual(9, record.volume_size_gb)
+
+            record = image_catalog.get(updated.id)
+            self.assertEqual(image.id, record.source_image)
+            self.assertEqual('def', record.session_id)
+            self.assertEqual(
+                [updated.id, image.id],
+                [r.image_id for r in image_catalog.get_lineage(updated.id)]
+            )
+            self.assertIsNone(image_catalog.get('ami-deleted'))
+        finally:
+            image_catalog.close()
+
+    def test_record_image(self):
+        image = self._register_encrypted_image('abc')
+        aws_catalog.record_image(
+            self.aws_svc, image.id, 'us-west-2', catalog.OPERATION_ENCRYPT,
+            'ami-source', 'ami-e2', phase_durations={'image': 60},
+            path=self.path
+        )
+        image_catalog = Catalog(self.path)
+        try:
+            record = image_catalog.get(image.id)
+        finally:
+            image_catalog.close()
+        self.assertEqual('ami-source', record.source_image)
+        self.assertEqual('ami-e2', record.encryptor_image)
+        self.assertEqual(self.aws_svc.session_id, record.session_id)
+        self.assertEqual({'image': 60}, record.phase_durations)
+        self.assertEqual(catalog.OPERATION_ENCRYPT, record.operation)
@@ -0,0 +1,189 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import datetime
+import os
+import shutil
+import stat
+import tempfile
+import threading
+import unittest
+
+from boto.sts.credentials import Credentials
+
+from brkt_cli.aws.connection_pool import (
+    AssumedRoleCredentials, ConnectionPool, CredentialCache)
+
+
+class DummyConnection(object):
+    def __init__(self, region, **kwargs):
+        self.region = region
+        self.kwargs = kwargs
+        self.closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class DummyCredentials(object):
+    def __init__(self, access_key, expired=False):
+        self.access_key = access_key
+        self.secret_key = 'secret-' + access_key
+        self.session_token = 'token-' + access_key
+        self.expired = expired
+
+    def is_expired(self, time_offset_seconds=0):
+        return self.expired
+
+
+class DummyAssumedRoleCredentials(AssumedRoleCredentials):
+    def __init__(self):
+        super(DummyAssumedRoleCredentials, self).__init__(
+            'arn:aws:iam::123456789012:role/test', 'us-west-2', 'test')
+        self.assume_role_count = 0
+
+    def _assume_role(self):
+        self.assume_role_count += 1
+        return DummyCredentials('key%d' % self.assume_role_count)
+
+
+class TestConnectionPool(unittest.TestCase):
+
+    def test_connection_per_thread(self):
+        pool = ConnectionPool('us-west-2', connect=DummyConnection)
+        conn = pool.get_connection()
+        self.assertIs(conn, pool.get_connection())
+        self.assertEqual('us-west-2', conn.region)
+
+        thread_connections = []
+
+        def _get_connection():
+            thread_connections.append(pool.get_connection())
+            thread_connections.append(pool.get_connection())
+
+        t = threading.Thread(target=_get_connection)
+        t.start()
+        t.join()
+
+        self.assertIs(thread_connections[0], thread_connections[1])
+        self.assertIsNot(conn, thread_connections[0])
+        self.assertEqual(2, pool.get_connection_count())
+
+        pool.close()
+        self.assertTrue(conn.closed)
+        self.assertTrue(thread_connections[0].closed)
+        self.assertEqual(0, pool.get_connection_count())
+
+    def test_credentials_refresh(self):
+        """ Test that assumed-role credentials are cached, and that a new
+        connection is opened after they are refreshed.
+        """
+        creds = DummyAssumedRoleCredentials()
+        pool = ConnectionPool(
+            'us-west-2', credentials=creds, connect=DummyConnection)
+        conn = pool.get_connection()
+        self.assertIs(conn, pool.get_connection())
+        self.assertEqual(1, creds.assume_role_count)
+        self.assertEqual('key1', conn.kwargs['aws_access_key_id'])
+        self.assertEqual('token-key1', conn.kwargs['security_token'])
+
+        creds.get().expired = True
+        new_conn = pool.get_connection()
+        self.assertEqual(2, creds.assume_role_count)
+        self.assertIsNot(conn, new_conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual('key2', new_conn.kwargs['aws_access_key_id'])
+        self.assertEqual(1, pool.get_connection_count())
+
+
+class DummyCachedCredentials(AssumedRoleCredentials):
+    """ Assumes the role by returning credentials that expire in an hour.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(DummyCachedCredentials, self).__init__(*args, **kwargs)
+        self.assume_role_count = 0
+
+    def _assume_role(self):
+        self.assume_role_count += 1
+        creds = Credentials()
+        creds.access_key = 'key%d' % self.assume_role_count
+        creds.secret_key = 'secret'
+        creds.session_token = 'token'
+        creds.expiration = (
+            datetime.datetime.utcnow() + datetime.timedelta(hours=1)
+        ).strftime('%Y-%m-%dT%H:%M:%SZ')
+        return creds
+
+
+class DummyCredentialCache(CredentialCache):
+    credentials_class = DummyCachedCredentials
+
+
+class TestCredentialCache(unittest.TestCase):
+
+    role = 'arn:aws:iam::123456789012:role/brkt'
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_shared(self):
+        """ Test that services that use the same role share credentials,
+        and that the role is only assumed once.
+        """
+        cache = DummyCredentialCache()
+        creds = cache.get(self.role, 'us-west-2', 'test')
+        self.assertIs(creds, cache.get(self.role, 'eu-west-1', 'test'))
+        self.assertIsNot(
+            creds,
+            cache.get('arn:aws:iam::210987654321:role/brkt', 'us-west-2',
+                      'test')
+        )
+        creds.get()
+        creds.get()
+        self.assertEqual(1, creds.assume_role_count)
+        self.assertIsNone(creds.cache_path)
+
+    def test_disk_cache(self):
+        """ Test that credentials are saved to disk and reused by the
+        next run, until they are about to expire.
+        """
+        cache = DummyCredentialCache(directory=self.tmp_dir)
+        creds = cache.get(self.role, 'us-west-2', 'test')
+        self.assertEqual('key1', creds.get().access_key)
+        path = cache.get_path(self.role)
+        self.assertEqual(0o600, stat.S_IMODE(os.stat(path).st_mode))
+
+        # The next run loads the saved credentials.
+        cache = DummyCredentialCache(directory=self.tmp_dir)
+        creds = cache.get(self.role, 'us-west-2', 'test')
+        self.assertEqual('key1', creds.get().access_key)
+        self.assertEqual(0, creds.assume_role_count)
+
+        # Credentials that are about to expire are refreshed.
+        cache = DummyCredentialCache(
+            directory=self.tmp_dir, refresh_seconds=7200)
+        creds = cache.get(self.role, 'us-west-2', 'test')
+        self.assertEqual('key1', creds.get().access_key)
+        self.assertEqual(1, creds.assume_role_count)
+
+    def test_corrupt_cache_file(self):
+        cache = DummyCredentialCache(directory=self.tmp_dir)
+        with open(cache.get_path(self.role), 'w') as f:
+            f.write('{"access_key": ')
+        creds = cache.get(self.role, 'us-west-2', 'test')
+        self.assertEqual('key1', creds.get().access_key)
+        self.assertEqual(1, creds.assume_role_count)
@@ -0,0 +1,104 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import unittest
+
+from boto.ec2.blockdevicemapping import BlockDeviceMapping, BlockDeviceType
+
+from brkt_cli import util
+from brkt_cli.aws import copy_ami
+from brkt_cli.aws.encrypt_ami import NAME_ENCRYPTED_ROOT_SNAPSHOT
+from brkt_cli.aws.test_aws_service import DummyAWSService, build_aws_service
+from brkt_cli.engine import run_sync
+from brkt_cli.util import BracketError
+from brkt_cli.validation import ValidationError
+
+
+class TestCopyAMI(unittest.TestCase):
+
+    def setUp(self):
+        util.SLEEP_ENABLED = False
+        self.source_svc, _, _ = build_aws_service()
+
+        snapshot = self.source_svc.create_snapshot(None)
+        snapshot.tags['Name'] = NAME_ENCRYPTED_ROOT_SNAPSHOT
+        bdm = BlockDeviceMapping()
+        bdm['/dev/sda1'] = BlockDeviceType(snapshot_id=snapshot.id)
+        self.image = self.source_svc.get_image(
+            self.source_svc.register_image(
+                kernel_id=None, block_device_map=bdm, name='encrypted'))
+
+        self.target_svcs = {}
+        self.tags = {}
+        for region in ('eu-west-1', 'us-east-1'):
+            target_svc = DummyAWSService()
+            target_svc.connect(region)
+            target_svc.create_tags = self._make_create_tags(region)
+            self.target_svcs[region] = target_svc
+            self.tags[region] = {}
+
+    def _make_create_tags(self, region):
+        def _create_tags(resource_id, name=None, description=None):
+            self.tags[region][resource_id] = name
+        return _create_tags
+
+    def test_copy(self):
+        """ Test that the AMI is copied to each region, and that the copy
+        and its snapshot are tagged.
+        """
+        copies = copy_ami.copy_amis(
+            self.source_svc, [self.image.id], self.target_svcs)
+        self.assertEqual(['eu-west-1', 'us-east-1'], sorted(copies))
+
+        for region, target_svc in self.target_svcs.iteritems():
+            self.assertEqual(
+                [('us-west-2', self.image.id)], target_svc.copy_image_calls)
+            copy_id = copies[region][self.image.id]
+            copy = target_svc.get_image(copy_id)
+            self.assertEqual('encrypted', copy.name)
+            snapshot_id = copy.block_device_mapping['/dev/sda1'].snapshot_id
+            self.assertEqual(
+                {copy_id: None, snapshot_id: NAME_ENCRYPTED_ROOT_SNAPSHOT},
+                self.tags[region]
+            )
+
+    def test_region_failure(self):
+        """ Test that a failure in one region doesn't stop the copy to
+        the other regions.
+        """
+        def _copy_image(*args, **kwargs):
+            raise Exception('Test')
+        self.target_svcs['eu-west-1'].copy_image = _copy_image
+
+        copies = copy_ami.copy_amis(
+            self.source_svc, [self.image.id], self.target_svcs)
+        self.assertEqual(['us-east-1'], copies.keys())
+
+    def test_wait_for_images_failed(self):
+        self.image.state = 'failed'
+        with self.assertRaises(BracketError):
+            run_sync(copy_ami.wait_for_images_co(
+                self.source_svc, [self.image.id]))
+
+    def test_wait_for_images_timeout(self):
+        self.image.state = 'pending'
+        with self.assertRaises(BracketError):
+            run_sync(copy_ami.wait_for_images_co(
+                self.source_svc, [self.image.id], timeout=0))
+
+    def test_parse_regions(self):
+        self.assertEqual(
+            ['us-east-1', 'eu-west-1'],
+            copy_ami.parse_regions('us-east-1, eu-west-1,'))
+        with self.assertRaises(ValidationError):
+            copy_ami.parse_regions('us-east-1,us-east-1')
@@ -14,6 +14,8 @@
 import email
 import json
 import os
+import shutil
+import tempfile
 import unittest
 import zlib
 
@@ -25,8 +27,8 @@ from boto.vpc import Subnet
 import brkt_cli
 import brkt_cli.aws
 import brkt_cli.util
-from brkt_cli import ValidationError, encryptor_service
-from brkt_cli.aws import aws_service, encrypt_ami, update_ami
+from brkt_cli import ValidationError, encryptor_service, timeouts
+from brkt_cli.aws import aws_service, cleanup_job, encrypt_ami, update_ami
 from brkt_cli.aws import test_aws_service
 from brkt_cli.aws.test_aws_service import build_aws_service
 from brkt_cli.instance_config import BRKT_CONFIG_CONTENT_TYPE
@@ -36,7 +38,8 @@ from brkt_cli.instance_config_args import (
 )
 from brkt_cli.test_encryptor_service import (
     DummyEncryptorService,
-    FailedEncryptionService
+    FailedEncryptionService,
+    NeverUpService
 )
 
 
@@ -107,6 +110,39 @@ class TestRunEncryption(unittest.TestCase):
         )
         self.assertIsNotNone(encrypted_ami_id)
 
+    def test_timeout_history(self):
+        """ Test that the time that each phase took is recorded in the
+        timeout history, and that overrides are used.
+        """
+        aws_svc, encryptor_image, guest_image = build_aws_service()
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            history = timeouts.TimeoutHistory(
+                os.path.join(tmp_dir, 'timeouts.json'))
+            encrypt_ami.encrypt(
+                aws_svc=aws_svc,
+                enc_svc_cls=DummyEncryptorService,
+                image_id=guest_image.id,
+                encryptor_ami=encryptor_image.id,
+                timeout_history=history
+            )
+            for phase in (timeouts.ENCRYPTOR_UP,
+                          timeouts.ENCRYPTION_PROGRESS, timeouts.IMAGE):
+                self.assertIsNotNone(history.get_seconds_per_gb(phase))
+
+            aws_svc, encryptor_image, guest_image = build_aws_service()
+            with self.assertRaisesRegexp(
+                    encryptor_service.EncryptionError, 'than 0 seconds'):
+                encrypt_ami.encrypt(
+                    aws_svc=aws_svc,
+                    enc_svc_cls=DummyEncryptorService,
+                    image_id=guest_image.id,
+                    encryptor_ami=encryptor_image.id,
+                    timeout_overrides={timeouts.ENCRYPTION_PROGRESS: 0}
+                )
+        finally:
+            shutil.rmtree(tmp_dir)
+
     def test_encryption_error_console_output_available(self):
         """ Test that when an encryption failure occurs, we write the
         console log to a temp file.
@@ -147,6 +183,69 @@ class TestRunEncryption(unittest.TestCase):
 
         self.assertTrue(self.encryptor_stopped)
 
+    def test_encryption_error_console_after_stop(self):
+        """ Test that when an encryption failure occurs, we wait for the
+        encryptor instance to stop before reading its console output.
+        """
+        aws_svc, encryptor_image, guest_image = build_aws_service()
+
+        def stop_instance(instance_id):
+            instance = aws_svc.instances[instance_id]
+            instance._state.name = 'stopping'
+            return instance
+
+        def get_instance_callback(instance):
+            if instance.state == 'stopping':
+                instance._state.name = 'stopped'
+
+        console_states = []
+        get_console_output = aws_svc.get_console_output
+
+        def get_console_output_and_state(instance_id):
+            console_states.append(aws_svc.instances[instance_id].state)
+            return get_console_output(instance_id)
+
+        aws_svc.stop_instance = stop_instance
+        aws_svc.get_instance_callback = get_instance_callback
+        aws_svc.get_console_output = get_console_output_and_state
+
+        with self.assertRaises(encryptor_service.EncryptionError) as cm:
+            encrypt_ami.encrypt(
+                aws_svc=aws_svc,
+                enc_svc_cls=FailedEncryptionService,
+                image_id=guest_image.id,
+                encryptor_ami=encryptor_image.id
+            )
+        os.remove(cm.exception.console_output_file.name)
+        self.assertEqual(['stopped'], console_states)
+
+    def test_encryption_error_log_snapshot(self):
+        """ Test that when encryption fails, the log volume snapshot is
+        kept, and that we don't wait for it to complete.
+        """
+        aws_svc, encryptor_image, guest_image = build_aws_service()
+        snapshots = []
+        polled = []
+        aws_svc.create_snapshot_callback = \
+            lambda volume_id, snapshot: snapshots.append(snapshot.id)
+        aws_svc.get_snapshot_callback = \
+            lambda snapshot: polled.append(snapshot.id)
+
+        with self.assertRaises(encryptor_service.EncryptionError) as cm:
+            encrypt_ami.encrypt(
+                aws_svc=aws_svc,
+                enc_svc_cls=FailedEncryptionService,
+                image_id=guest_image.id,
+                encryptor_ami=encryptor_image.id
+            )
+        os.remove(cm.exception.console_output_file.name)
+
+        log_snapshot_id = snapshots[-1]
+        self.assertEqual([log_snapshot_id], aws_svc.snapshots.keys())
+        self.assertEqual(
+            'pending', aws_svc.snapshots[log_snapshot_id].status)
+        self.assertNotIn(log_snapshot_id, polled)
+
     def test_encryption_error_console_output_not_available(self):
         """ Test that we handle the case when encryption fails and console
         output is not available.
@@ -165,6 +264,56 @@ class TestRunEncryption(unittest.TestCase):
         except encryptor_service.EncryptionError as e:
             self.assertIsNone(e.console_output_file)
 
+    def test_encryptor_instance_terminated(self):
+        """ Test that encryption fails as soon as the encryptor instance
+        terminates, and that the console output is written.
+        """
+        aws_svc, encryptor_image, guest_image = build_aws_service()
+        encryptor_instances = []
+        stopped = []
+
+        def run_instance_callback(args):
+            if args.image_id == encryptor_image.id:
+                encryptor_instances.append(args.instance)
+
+        def get_instance_status(instance_id):
+            status = test_aws_service.DummyAWSService.get_instance_status(
+                aws_svc, instance_id)
+            if instance_id in [i.id for i in encryptor_instances]:
+                status.state_name = 'terminated'
+            return status
+
+        aws_svc.run_instance_callback = run_instance_callback
+        aws_svc.stop_instance_callback = lambda i: stopped.append(i.id)
+        aws_svc.get_instance_status = get_instance_status
+
+        check_interval = encryptor_service.INSTANCE_CHECK_INTERVAL
+        encryptor_service.INSTANCE_CHECK_INTERVAL = 0
+        try:
+            encrypt_ami.encrypt(
+                aws_svc=aws_svc,
+                enc_svc_cls=NeverUpService,
+                image_id=guest_image.id,
+                encryptor_ami=encryptor_image.id
+            )
+            self.fail('Encryption should have failed')
+        except encryptor_service.EncryptorInstanceError as e:
+            self.assertEqual('terminated', e.state)
+            self.assertIsNotNone(e.console_output_file)
+            os.remove(e.console_output_file.name)
+        finally:
+            encryptor_service.INSTANCE_CHECK_INTERVAL = check_interval
+
+        # The terminated instance isn't stopped, and there's no log
+        # volume to snapshot.
+        self.assertNotIn(encryptor_instances[0].id, stopped)
+        self.assertFalse(
+            [s for s in aws_svc.snapshots.values()
+             if s.volume_id in [
+                 bdt.volume_id for bdt in
+                 encryptor_instances[0].block_device_mapping.values()]]
+        )
+
     def test_delete_orphaned_volumes(self):
         """ Test that we clean up instance volumes that are orphaned by AWS.
         """
@@ -360,6 +509,76 @@ class TestRunEncryption(unittest.TestCase):
             mv_root_id=mv_root_volume_id
         )
 
+    def test_defer_cleanup(self):
+        """ Test that encrypt() returns as soon as the AMI is registered,
+        and that running the cleanup job finishes the AMI and deletes the
+        session's resources.
+        """
+        aws_svc, encryptor_image, guest_image = build_aws_service()
+        jobs = []
+        ami = encrypt_ami.encrypt(
+            aws_svc=aws_svc,
+            enc_svc_cls=DummyEncryptorService,
+            image_id=guest_image.id,
+            encryptor_ami=encryptor_image.id,
+            defer_cleanup=jobs.append
+        )
+        self.assertEqual(1, len(jobs))
+        job = jobs[0]
+        self.assertEqual(ami, job.ami)
+        self.assertEqual(aws_svc.session_id, job.session_id)
+        self.assertEqual(2, len(job.instance_ids))
+        self.assertEqual(1, len(job.snapshot_ids))
+        for instance_id in job.instance_ids:
+            self.assertNotEqual(
+                'terminated', aws_svc.get_instance(instance_id).state)
+        self.assertIn(job.snapshot_ids[0], aws_svc.snapshots)
+
+        # The job survives a round trip through a file.
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = cleanup_job.save_job(job, directory=tmp_dir)
+            self.assertEqual(
+                [path], cleanup_job.get_pending_job_paths(tmp_dir))
+            lock = cleanup_job.lock_job(path)
+            self.assertIsNone(cleanup_job.lock_job(path))
+            lock.close()
+            job = cleanup_job.load_job(path)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        self.assertTrue(encrypt_ami.run_cleanup_job(aws_svc, job))
+        for instance_id in job.instance_ids:
+            self.assertEqual(
+                'terminated', aws_svc.get_instance(instance_id).state)
+        self.assertNotIn(job.snapshot_ids[0], aws_svc.snapshots)
+
+    def test_defer_cleanup_failure(self):
+        """ Test that resources are cleaned up right away when encryption
+        fails with deferred cleanup.
+        """
+        aws_svc, encryptor_image, guest_image = build_aws_service()
+        instance_ids = []
+
+        def run_instance_callback(args):
+            instance_ids.append(args.instance.id)
+
+        aws_svc.run_instance_callback = run_instance_callback
+        jobs = []
+        with self.assertRaises(encryptor_service.EncryptionError):
+            encrypt_ami.encrypt(
+                aws_svc=aws_svc,
+                enc_svc_cls=FailedEncryptionService,
+                image_id=guest_image.id,
+                encryptor_ami=encryptor_image.id,
+                defer_cleanup=jobs.append
+            )
+        self.assertEqual([], jobs)
+        self.assertEqual(2, len(instance_ids))
+        for instance_id in instance_ids:
+            self.assertEqual(
+                'terminated', aws_svc.get_instance(instance_id).state)
+
     def test_clean_up_root_snapshot(self):
         """ Test that we clean up the root snapshot if an exception is
         raised while waiting for it to complete.
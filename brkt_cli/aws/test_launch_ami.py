@@ -0,0 +1,140 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import unittest
+
+from brkt_cli import util
+from brkt_cli.aws import launch_ami
+from brkt_cli.aws.encrypt_ami import InstanceError
+from brkt_cli.aws.launch_ami import LaunchError, LaunchGroup
+from brkt_cli.aws.test_aws_service import build_aws_service
+from brkt_cli.instance_config import INSTANCE_METAVISOR_MODE, InstanceConfig
+
+
+class TestPlanLaunch(unittest.TestCase):
+
+    def test_subnets(self):
+        """ Test that instances are spread evenly across subnets, and
+        that each subnet gets its share of the minimum count.
+        """
+        self.assertEqual(
+            [
+                LaunchGroup(34, 17, 'subnet-1', None),
+                LaunchGroup(33, 16, 'subnet-2', None),
+                LaunchGroup(33, 16, 'subnet-3', None)
+            ],
+            launch_ami.plan_launch(
+                100, min_count=50,
+                subnet_ids=['subnet-1', 'subnet-2', 'subnet-3'])
+        )
+
+    def test_zones(self):
+        self.assertEqual(
+            [
+                LaunchGroup(1, 1, None, 'us-west-2a'),
+                LaunchGroup(1, 1, None, 'us-west-2b')
+            ],
+            launch_ami.plan_launch(
+                2, zones=['us-west-2a', 'us-west-2b', 'us-west-2c'])
+        )
+
+    def test_default(self):
+        self.assertEqual(
+            [LaunchGroup(5, 5, None, None)], launch_ami.plan_launch(5))
+
+
+class TestLaunch(unittest.TestCase):
+
+    def setUp(self):
+        util.SLEEP_ENABLED = False
+        self.aws_svc, _, self.guest_image = build_aws_service()
+        self.instance_config = InstanceConfig(mode=INSTANCE_METAVISOR_MODE)
+
+    def test_launch(self):
+        """ Test that each subnet gets one RunInstances call, and that
+        the instances are tagged with one call.
+        """
+        groups = launch_ami.plan_launch(
+            100, subnet_ids=['subnet-1', 'subnet-2', 'subnet-3'])
+        instances = launch_ami.launch(
+            self.aws_svc, self.guest_image.id, groups, self.instance_config,
+            name='web')
+
+        self.assertEqual(100, len(instances))
+        self.assertTrue(all(i.state == 'running' for i in instances))
+        self.assertEqual(
+            [(34, 'subnet-1', None), (33, 'subnet-2', None),
+             (33, 'subnet-3', None)],
+            sorted(self.aws_svc.run_instances_calls, key=lambda c: c[1])
+        )
+        self.assertEqual(1, len(self.aws_svc.tag_resources_calls))
+        tagged_ids, name = self.aws_svc.tag_resources_calls[0]
+        self.assertEqual(sorted(i.id for i in instances), sorted(tagged_ids))
+        self.assertEqual('web', name)
+
+    def test_instance_terminated(self):
+        """ Test that launch fails if one of the instances is terminated
+        while it's starting.
+        """
+        terminated_ids = []
+
+        def _get_instance_callback(instance):
+            if not terminated_ids:
+                terminated_ids.append(instance.id)
+            if instance.id in terminated_ids:
+                instance._state.name = 'terminated'
+
+        self.aws_svc.get_instance_callback = _get_instance_callback
+        with self.assertRaises(InstanceError):
+            launch_ami.launch(
+                self.aws_svc, self.guest_image.id,
+                launch_ami.plan_launch(3), self.instance_config)
+
+    def test_no_tags(self):
+        """ Test that CreateTags isn't called when there's no name and no
+        tags, since AWS rejects a call with no tags.
+        """
+        instances = launch_ami.launch(
+            self.aws_svc, self.guest_image.id, launch_ami.plan_launch(2),
+            self.instance_config)
+        self.assertEqual(2, len(instances))
+        self.assertEqual([], self.aws_svc.tag_resources_calls)
+
+        self.aws_svc.default_tags = {'Team': 'web'}
+        launch_ami.launch(
+            self.aws_svc, self.guest_image.id, launch_ami.plan_launch(2),
+            self.instance_config)
+        self.assertEqual(1, len(self.aws_svc.tag_resources_calls))
+
+    def test_group_failure(self):
+        """ Test that the instances launched in the other subnets are
+        reported when one RunInstances call fails.
+        """
+        run_instances = self.aws_svc.run_instances
+
+        def _run_instances(image_id, min_count, max_count, **kwargs):
+            if kwargs.get('subnet_id') == 'subnet-2':
+                raise Exception('InsufficientInstanceCapacity')
+            return run_instances(image_id, min_count, max_count, **kwargs)
+        self.aws_svc.run_instances = _run_instances
+
+        with self.assertRaises(LaunchError) as cm:
+            launch_ami.launch(
+                self.aws_svc, self.guest_image.id,
+                launch_ami.plan_launch(
+                    4, subnet_ids=['subnet-1', 'subnet-2']),
+                self.instance_config)
+        self.assertEqual(2, len(cm.exception.instance_ids))
+        self.assertEqual(
+            sorted(cm.exception.instance_ids),
+            sorted(self.aws_svc.instances))
@@ -0,0 +1,103 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from brkt_cli.aws import multi_account
+from brkt_cli.aws.test_aws_service import DummyAWSService
+from brkt_cli.validation import ValidationError
+
+
+def _role(n):
+    return 'arn:aws:iam::%012d:role/brkt' % n
+
+
+class TestRunInAccounts(unittest.TestCase):
+
+    def test_concurrent(self):
+        """ Test that the workflows for all of the accounts run at the
+        same time, each with a service that is connected with the
+        account's role.
+        """
+        roles = [_role(n) for n in range(1, 6)]
+        started = threading.Semaphore(0)
+        all_started = threading.Event()
+        services = []
+
+        def _func(aws_svc, account_id):
+            services.append(aws_svc)
+            started.release()
+            # Only returns once every account's workflow has started.
+            if not all_started.wait(10):
+                raise Exception('Timed out')
+            return aws_svc.role
+
+        def _wait_for_all():
+            for _ in roles:
+                started.acquire()
+            all_started.set()
+
+        t = threading.Thread(target=_wait_for_all)
+        t.start()
+        results, failed = multi_account.run_in_accounts(
+            roles, 'eu-west-1', DummyAWSService, _func)
+        t.join()
+
+        self.assertEqual([], failed)
+        self.assertEqual(
+            {'%012d' % n: _role(n) for n in range(1, 6)}, results)
+        self.assertEqual(5, len(set(s.session_id for s in services)))
+        self.assertTrue(all(s.region == 'eu-west-1' for s in services))
+
+    def test_failure(self):
+        """ Test that a failure in one account doesn't affect the others.
+        """
+        def _func(aws_svc, account_id):
+            if account_id == '%012d' % 2:
+                raise Exception('Access denied')
+            return 0
+
+        results, failed = multi_account.run_in_accounts(
+            [_role(1), _role(2), _role(3)], 'us-west-2', DummyAWSService,
+            _func)
+        self.assertEqual(['%012d' % 2], failed)
+        self.assertEqual({'%012d' % 1: 0, '%012d' % 3: 0}, results)
+
+
+class TestRoles(unittest.TestCase):
+
+    def test_validate(self):
+        self.assertEqual(
+            [_role(1), _role(2)],
+            multi_account.validate_roles([_role(1), _role(2), _role(1)]))
+        with self.assertRaises(ValidationError):
+            multi_account.validate_roles(['arn:aws:iam::1234:role/brkt'])
+        with self.assertRaises(ValidationError):
+            multi_account.validate_roles(
+                [_role(1), 'arn:aws:iam::%012d:role/other' % 1])
+
+    def test_read_roles_file(self):
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmp_dir, 'roles')
+            with open(path, 'w') as f:
+                f.write('# Encrypt accounts\n%s\n\n%s\n' % (
+                    _role(1), _role(2)))
+            self.assertEqual(
+                [_role(1), _role(2)], multi_account.read_roles_file(path))
+        finally:
+            shutil.rmtree(tmp_dir)
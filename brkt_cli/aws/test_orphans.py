@@ -0,0 +1,102 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import unittest
+
+from boto.ec2.blockdevicemapping import BlockDeviceMapping, BlockDeviceType
+
+from brkt_cli import orphans, util
+from brkt_cli.aws import orphans as aws_orphans
+from brkt_cli.aws import test_aws_service
+from brkt_cli.aws.encrypt_ami import TAG_ENCRYPTOR_SESSION_ID
+
+OLD_TIME = '2016-01-01T00:00:00.000Z'
+
+
+class TestAWSOrphans(unittest.TestCase):
+
+    def setUp(self):
+        util.SLEEP_ENABLED = False
+        self.aws_svc, self.encryptor_image, _ = \
+            test_aws_service.build_aws_service()
+
+    def _tag(self, resource, session_id):
+        resource.tags[TAG_ENCRYPTOR_SESSION_ID] = session_id
+
+    def _run_instance(self, session_id, launch_time):
+        instance = self.aws_svc.run_instance(self.encryptor_image.id)
+        instance.launch_time = launch_time
+        self._tag(instance, session_id)
+        instance._state.name = 'running'
+        return instance
+
+    def _create_snapshot(self, session_id, name=None):
+        snapshot = self.aws_svc.create_snapshot('vol-1')
+        snapshot.start_time = OLD_TIME
+        snapshot.tags['Name'] = name or 'Bracket encryptor original volume'
+        self._tag(snapshot, session_id)
+        return snapshot
+
+    def test_list_and_delete(self):
+        """ Test that the resources of a dead session are deleted, and that
+        log snapshots and the snapshots of AMIs are left alone.
+        """
+        aws_svc = self.aws_svc
+
+        # A dead session: the encryptor was stopped hours ago.
+        dead = self._run_instance('dead', OLD_TIME)
+        dead._state.name = 'stopped'
+        volume = aws_svc.create_volume(8, 'us-west-2a')
+        volume.create_time = OLD_TIME
+        self._tag(volume, 'dead')
+        snapshot = self._create_snapshot('dead')
+        log_snapshot = self._create_snapshot(
+            'dead', name='Bracket logs from %s' % dead.id)
+        sg = aws_svc.create_security_group('Bracket Encryptor dead', 'test')
+        self._tag(sg, 'dead')
+
+        # The encrypted AMI's snapshot is tagged with the session id.
+        ami_snapshot = self._create_snapshot('dead')
+        bdm = BlockDeviceMapping()
+        bdm['/dev/sda1'] = BlockDeviceType(snapshot_id=ami_snapshot.id)
+        aws_svc.register_image(
+            kernel_id=None, name='encrypted', block_device_map=bdm)
+
+        # A live session.
+        live = self._run_instance('live', '2099-01-01T00:00:00.000Z')
+
+        resources = aws_orphans.list_resources(aws_svc)
+        sessions = orphans.group_by_session(resources)
+        self.assertEqual(['dead', 'live'], [s.session_id for s in sessions])
+        dead_session, live_session = sessions
+        self.assertEqual(
+            [dead.id], dead_session.get_ids(orphans.RESOURCE_INSTANCE))
+        self.assertEqual(
+            [volume.id], dead_session.get_ids(orphans.RESOURCE_VOLUME))
+        self.assertEqual(
+            [snapshot.id], dead_session.get_ids(orphans.RESOURCE_SNAPSHOT))
+        self.assertEqual(
+            [sg.id], dead_session.get_ids(orphans.RESOURCE_SECURITY_GROUP))
+        self.assertTrue(live_session.is_live())
+
+        dead_sessions = orphans.get_dead_sessions(sessions)
+        self.assertEqual([dead_session], dead_sessions)
+        aws_orphans.delete_sessions(aws_svc, dead_sessions, max_workers=2)
+
+        self.assertEqual('terminated', dead.state)
+        self.assertEqual('running', live.state)
+        self.assertNotIn(volume.id, aws_svc.volumes)
+        self.assertNotIn(snapshot.id, aws_svc.snapshots)
+        self.assertNotIn(sg.id, aws_svc.security_groups)
+        self.assertIn(log_snapshot.id, aws_svc.snapshots)
+        self.assertIn(ami_snapshot.id, aws_svc.snapshots)
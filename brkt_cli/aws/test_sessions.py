@@ -0,0 +1,216 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import os
+import shutil
+import tempfile
+import unittest
+
+from boto.ec2.blockdevicemapping import BlockDeviceMapping, BlockDeviceType
+
+from brkt_cli import orphans, timeouts, util
+from brkt_cli.aws import sessions as aws_sessions
+from brkt_cli.aws import test_aws_service
+from brkt_cli.aws.encrypt_ami import (
+    NAME_ENCRYPTOR,
+    NAME_GUEST_CREATOR,
+    NAME_METAVISOR_UPDATER,
+    TAG_ENCRYPTOR_SESSION_ID
+)
+from brkt_cli.timeouts import TimeoutHistory
+
+NOW = orphans.parse_time('2016-01-01T12:00:00.000Z')
+
+
+def _time(hours_ago):
+    return '2016-01-01T%02d:00:00.000Z' % (12 - hours_ago)
+
+
+class TestSessions(unittest.TestCase):
+
+    def setUp(self):
+        util.SLEEP_ENABLED = False
+        self.aws_svc, self.encryptor_image, _ = \
+            test_aws_service.build_aws_service()
+
+    def _tag(self, resource, session_id, name=None):
+        resource.tags[TAG_ENCRYPTOR_SESSION_ID] = session_id
+        if name:
+            resource.tags['Name'] = name
+
+    def _run_instance(self, session_id, name, launch_time, state='running'):
+        instance = self.aws_svc.run_instance(self.encryptor_image.id)
+        instance.launch_time = launch_time
+        instance._state.name = state
+        self._tag(instance, session_id, name)
+        return instance
+
+    def _register_image(self, session_id, state, creation_date=None):
+        bdm = BlockDeviceMapping()
+        bdm['/dev/sda1'] = BlockDeviceType()
+        image = self.aws_svc.get_image(self.aws_svc.register_image(
+            kernel_id=None, name=session_id, block_device_map=bdm))
+        image.state = state
+        image.creationDate = creation_date or _time(1)
+        self._tag(image, session_id)
+        return image
+
+    def _describe(self):
+        sessions = aws_sessions.describe_regions(
+            {'us-west-2': self.aws_svc}, now=NOW)
+        return {s.session_id: s for s in sessions}
+
+    def test_phases(self):
+        """ Test that each session's phase and status are reconstructed
+        from the state of its resources.
+        """
+        self._run_instance('encrypting', NAME_GUEST_CREATOR, _time(2))
+        encryptor = self._run_instance('encrypting', NAME_ENCRYPTOR, _time(1))
+        self._run_instance(
+            'starting', NAME_GUEST_CREATOR, _time(1), state='terminated')
+        self._run_instance(
+            'starting', NAME_ENCRYPTOR, _time(1), state='pending')
+        self._run_instance(
+            'updating', NAME_GUEST_CREATOR, _time(1), state='stopped')
+        self._run_instance('updating', NAME_METAVISOR_UPDATER, _time(1))
+        self._register_image('imaging', 'pending')
+        self._register_image('done', 'available')
+
+        # A session that failed, leaving a volume and its log snapshot.
+        volume = self.aws_svc.create_volume(8, 'us-west-2a')
+        volume.create_time = _time(3)
+        self._tag(volume, 'failed')
+        snapshot = self.aws_svc.create_snapshot(volume.id)
+        snapshot.start_time = _time(3)
+        self._tag(snapshot, 'failed', name='Bracket logs from i-1')
+
+        # A session whose encryptor has been running for three days.
+        self._run_instance('stuck', NAME_ENCRYPTOR, '2015-12-29T12:00:00Z')
+
+        sessions = self._describe()
+        self.assertEqual(
+            ['done', 'encrypting', 'failed', 'imaging', 'starting',
+             'stuck', 'updating'],
+            sorted(sessions.keys())
+        )
+
+        s = sessions['encrypting']
+        self.assertEqual(aws_sessions.STATUS_RUNNING, s.status)
+        self.assertEqual(aws_sessions.PHASE_ENCRYPTING, s.phase)
+        self.assertEqual(NOW - 3600, s.phase_time)
+        self.assertEqual(NOW - 7200, s.start_time)
+        self.assertIn(encryptor.id, s.instance_ids)
+        self.assertFalse(s.is_update)
+
+        self.assertEqual(
+            aws_sessions.PHASE_ENCRYPTOR_UP, sessions['starting'].phase)
+        self.assertEqual(
+            aws_sessions.PHASE_UPDATING, sessions['updating'].phase)
+        self.assertTrue(sessions['updating'].is_update)
+        self.assertEqual(aws_sessions.PHASE_IMAGE, sessions['imaging'].phase)
+        self.assertEqual(
+            aws_sessions.STATUS_COMPLETED, sessions['done'].status)
+        self.assertEqual(aws_sessions.STATUS_STALE, sessions['failed'].status)
+        self.assertIsNone(sessions['failed'].phase)
+        self.assertEqual(aws_sessions.STATUS_STALE, sessions['stuck'].status)
+
+    def test_old_completed_image(self):
+        """ Test that an encrypted AMI that was created long ago is a
+        completed session, not a stale one.  Encrypted AMIs keep their
+        session id tag.
+        """
+        self._register_image(
+            'old', 'available', creation_date='2015-06-01T12:00:00.000Z')
+        sessions = self._describe()
+        self.assertEqual(
+            aws_sessions.STATUS_COMPLETED, sessions['old'].status)
+
+    def test_fixed_calls(self):
+        """ Test that a region is described with four calls, no matter how
+        many sessions there are.
+        """
+        for i in range(20):
+            self._run_instance('session-%d' % i, NAME_ENCRYPTOR, _time(1))
+        calls = []
+
+        def _record(method):
+            def _call(*args, **kwargs):
+                calls.append(method.__name__)
+                return method(*args, **kwargs)
+            return _call
+
+        for name in ('get_instances', 'get_volumes', 'get_owned_snapshots',
+                     'get_images', 'get_instance', 'get_image'):
+            setattr(self.aws_svc, name, _record(getattr(self.aws_svc, name)))
+
+        self.assertEqual(20, len(self._describe()))
+        self.assertEqual(4, len(calls))
+
+
+class TestEstimateRemaining(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.history = TimeoutHistory(
+            os.path.join(self.tmp_dir, 'timeouts.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _session(self, phase, phase_time=None, is_update=False,
+                 status=aws_sessions.STATUS_RUNNING):
+        return aws_sessions.SessionStatus(
+            session_id='abc', region='us-west-2', status=status,
+            phase=phase, is_update=is_update, start_time=NOW - 3600,
+            phase_time=phase_time, volume_size_gb=10, image_ids=[],
+            instance_ids=[]
+        )
+
+    def test_history(self):
+        """ Test that the estimate is based on the typical rates in the
+        history, minus the time already spent in the current phase.
+        """
+        self.history.record(timeouts.ENCRYPTION, 1000, 10)
+        self.history.record(timeouts.IMAGE, 300, 10)
+        snapshot = aws_sessions.get_expected_seconds(
+            aws_sessions.PHASE_SNAPSHOT, volume_size_gb=10)
+
+        session = self._session(
+            aws_sessions.PHASE_ENCRYPTING, phase_time=NOW - 400)
+        self.assertEqual(
+            600 + snapshot + 300,
+            aws_sessions.estimate_remaining(
+                session, history=self.history, now=NOW)
+        )
+
+        # Phases that run longer than usual don't go negative.
+        session = self._session(
+            aws_sessions.PHASE_IMAGE, phase_time=NOW - 3600)
+        self.assertEqual(
+            0,
+            aws_sessions.estimate_remaining(
+                session, history=self.history, now=NOW)
+        )
+
+    def test_update(self):
+        session = self._session(aws_sessions.PHASE_GUEST, is_update=True)
+        expected = sum(
+            aws_sessions.get_expected_seconds(p, volume_size_gb=10)
+            for p in aws_sessions.UPDATE_PHASES
+        )
+        self.assertEqual(
+            expected, aws_sessions.estimate_remaining(session, now=NOW))
+
+    def test_not_running(self):
+        session = self._session(None, status=aws_sessions.STATUS_STALE)
+        self.assertIsNone(aws_sessions.estimate_remaining(session, now=NOW))
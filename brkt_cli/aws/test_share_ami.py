@@ -0,0 +1,114 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from boto.ec2.blockdevicemapping import BlockDeviceMapping, BlockDeviceType
+
+from brkt_cli.aws import share_ami
+from brkt_cli.aws.test_aws_service import build_aws_service
+from brkt_cli.validation import ValidationError
+
+
+def _account_id(n):
+    return '%012d' % n
+
+
+class TestShareAMI(unittest.TestCase):
+
+    def setUp(self):
+        self.aws_svc, _, _ = build_aws_service()
+        self.images = []
+        for snapshot_ids in (['snap-1', 'snap-2'], ['snap-2', 'snap-3']):
+            bdm = BlockDeviceMapping()
+            for i, snapshot_id in enumerate(snapshot_ids):
+                bdm['/dev/sda%d' % (i + 1)] = BlockDeviceType(
+                    snapshot_id=snapshot_id)
+            self.images.append(self.aws_svc.get_image(
+                self.aws_svc.register_image(
+                    kernel_id=None, block_device_map=bdm, name='encrypted')))
+        self.account_ids = [_account_id(n) for n in range(120)]
+
+    def test_share(self):
+        """ Test that the images and all of their snapshots are shared,
+        with the accounts sent in batches.
+        """
+        not_shared = share_ami.share_images(
+            self.aws_svc, self.images, self.account_ids, batch_size=100)
+        self.assertEqual({}, not_shared)
+
+        # Two batches for each of the two images and three snapshots.
+        calls = self.aws_svc.modify_attribute_calls
+        self.assertEqual(
+            sorted([100, 20] * 5), sorted(len(ids) for _, ids in calls))
+        for resource_id in [i.id for i in self.images] + \
+                ['snap-1', 'snap-2', 'snap-3']:
+            self.assertEqual(
+                set(self.account_ids), self.aws_svc.permissions[resource_id])
+
+    def test_verify(self):
+        """ Test that accounts that weren't added are reported. """
+        add = self.aws_svc.add_create_volume_permission
+
+        def _add_create_volume_permission(snapshot_id, user_ids):
+            if snapshot_id != 'snap-3':
+                add(snapshot_id, user_ids)
+        self.aws_svc.add_create_volume_permission = \
+            _add_create_volume_permission
+
+        not_shared = share_ami.share_images(
+            self.aws_svc, self.images, self.account_ids)
+        self.assertEqual(['snap-3'], not_shared.keys())
+        self.assertEqual(self.account_ids, not_shared['snap-3'])
+
+
+class TestAccounts(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'accounts')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_read_list(self):
+        with open(self.path, 'w') as f:
+            f.write('# Member accounts\n%s\n\n%s\n' % (
+                _account_id(1), _account_id(2)))
+        self.assertEqual(
+            [_account_id(1), _account_id(2)],
+            share_ami.read_accounts_file(self.path))
+
+    def test_read_organizations_json(self):
+        """ Test that only active accounts are read from the output of
+        aws organizations list-accounts-for-parent.
+        """
+        with open(self.path, 'w') as f:
+            json.dump({'Accounts': [
+                {'Id': _account_id(1), 'Status': 'ACTIVE'},
+                {'Id': _account_id(2), 'Status': 'SUSPENDED'}
+            ]}, f)
+        self.assertEqual(
+            [_account_id(1)], share_ami.read_accounts_file(self.path))
+
+    def test_validate(self):
+        self.assertEqual(
+            [_account_id(1), _account_id(2)],
+            share_ami.validate_account_ids(
+                [_account_id(1), _account_id(2), _account_id(1)]))
+        with self.assertRaises(ValidationError):
+            share_ami.validate_account_ids(['1234'])
@@ -0,0 +1,128 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import unittest
+
+from brkt_cli import util
+from brkt_cli.aws import share_logs
+from brkt_cli.aws.test_aws_service import build_aws_service
+
+
+class TestShareLogs(unittest.TestCase):
+
+    def setUp(self):
+        util.SLEEP_ENABLED = False
+        self.aws_svc, self.encryptor_image, _ = build_aws_service()
+        self.instances = [
+            self.aws_svc.run_instance(self.encryptor_image.id)
+            for _ in range(3)
+        ]
+        self.instance_ids = [i.id for i in self.instances]
+
+        self.get_snapshots_calls = []
+        get_snapshots = self.aws_svc.get_snapshots
+
+        def _get_snapshots(*snapshot_ids):
+            self.get_snapshots_calls.append(snapshot_ids)
+            return get_snapshots(*snapshot_ids)
+        self.aws_svc.get_snapshots = _get_snapshots
+
+    def test_snapshot_log_volumes(self):
+        """ Test that the log volumes of all of the instances are
+        snapshotted, and that one poller waits for all of the snapshots.
+        """
+        volume_ids = {}
+
+        def _create_snapshot_callback(volume_id, snapshot):
+            volume_ids[snapshot.id] = volume_id
+        self.aws_svc.create_snapshot_callback = _create_snapshot_callback
+
+        snapshots = share_logs.snapshot_log_volumes(
+            self.aws_svc, self.instance_ids)
+        self.assertEqual(sorted(self.instance_ids), sorted(snapshots))
+        for instance in self.instances:
+            snapshot = snapshots[instance.id]
+            self.assertEqual(
+                instance.block_device_mapping['/dev/sda3'].volume_id,
+                volume_ids[snapshot.id])
+            self.assertEqual('completed', snapshot.status)
+        self.assertTrue(self.get_snapshots_calls)
+        for snapshot_ids in self.get_snapshots_calls:
+            self.assertEqual(3, len(snapshot_ids))
+
+    def test_snapshot_failure(self):
+        """ Test that an instance whose snapshot can't be created is
+        skipped.
+        """
+        create_snapshot = self.aws_svc.create_snapshot
+        bad_volume_id = \
+            self.instances[1].block_device_mapping['/dev/sda3'].volume_id
+
+        def _create_snapshot(volume_id, name=None, description=None):
+            if volume_id == bad_volume_id:
+                raise Exception('Snapshot limit exceeded')
+            return create_snapshot(
+                volume_id, name=name, description=description)
+        self.aws_svc.create_snapshot = _create_snapshot
+
+        snapshots = share_logs.snapshot_log_volumes(
+            self.aws_svc, self.instance_ids)
+        self.assertEqual(
+            sorted([self.instance_ids[0], self.instance_ids[2]]),
+            sorted(snapshots))
+
+    def test_snapshot_error(self):
+        """ Test that a snapshot that goes into an error state is deleted
+        and skipped, and that the other snapshots are returned.
+        """
+        bad_volume_id = \
+            self.instances[1].block_device_mapping['/dev/sda3'].volume_id
+        bad_snapshot_ids = []
+
+        def _create_snapshot_callback(volume_id, snapshot):
+            if volume_id == bad_volume_id:
+                snapshot.status = 'error'
+                bad_snapshot_ids.append(snapshot.id)
+        self.aws_svc.create_snapshot_callback = _create_snapshot_callback
+
+        snapshots = share_logs.snapshot_log_volumes(
+            self.aws_svc, self.instance_ids)
+        self.assertEqual(
+            sorted([self.instance_ids[0], self.instance_ids[2]]),
+            sorted(snapshots))
+        for snapshot in snapshots.values():
+            self.assertEqual('completed', snapshot.status)
+            self.assertIn(snapshot.id, self.aws_svc.snapshots)
+        self.assertNotIn(bad_snapshot_ids[0], self.aws_svc.snapshots)
+
+    def test_share(self):
+        """ Test that the new and existing snapshots are shared with the
+        Bracket account.
+        """
+        failed = share_logs.share(
+            self.aws_svc, instance_ids=self.instance_ids,
+            bracket_aws_account='123456789012', snapshot_ids=['snap-1'])
+        self.assertEqual(0, failed)
+        calls = self.aws_svc.modify_attribute_calls
+        self.assertEqual(4, len(calls))
+        self.assertIn(('snap-1', ['123456789012']), calls)
+        for _, user_ids in calls:
+            self.assertEqual(['123456789012'], user_ids)
+
+    def test_find_instance_ids(self):
+        self.instances[0].tags['Role'] = 'web'
+        self.instances[2].tags['Role'] = 'web'
+        self.instances[1].tags['Role'] = 'db'
+        self.assertEqual(
+            sorted([self.instance_ids[0], self.instance_ids[2]]),
+            share_logs.find_instance_ids(self.aws_svc, {'Role': 'web'}))
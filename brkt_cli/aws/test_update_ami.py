@@ -22,7 +22,10 @@ from brkt_cli import util
 from brkt_cli.aws import (
     encrypt_ami, test_aws_service, update_ami
 )
+from brkt_cli.aws.encrypt_ami import SnapshotError
 from brkt_cli.aws.test_aws_service import build_aws_service
+from brkt_cli.aws.update_ami import update_amis
+from brkt_cli.instance_config import InstanceConfig
 from brkt_cli.test_encryptor_service import (
     DummyEncryptorService,
     FailedEncryptionService
@@ -171,3 +174,158 @@ class TestRunUpdate(unittest.TestCase):
             os.remove(e.console_output_file.name)
 
         self.assertTrue(self.updater_stopped)
+
+    def test_no_shared_state_modified(self):
+        """ Test that update_ami() doesn't modify the caller's instance
+        config or the NO_PROXY environment variable.
+        """
+        aws_svc, encryptor_image, guest_image = build_aws_service()
+        encrypted_ami_id = encrypt_ami.encrypt(
+            aws_svc=aws_svc,
+            enc_svc_cls=DummyEncryptorService,
+            image_id=guest_image.id,
+            encryptor_ami=encryptor_image.id
+        )
+
+        def run_instance_callback(args):
+            if args.image_id == encryptor_image.id:
+                args.instance.private_ip_address = '10.0.0.5'
+
+        aws_svc.run_instance_callback = run_instance_callback
+        instance_config = InstanceConfig({'ntp_servers': ['0.pool.ntp.org']})
+        no_proxy = os.environ.get('NO_PROXY')
+        update_ami(
+            aws_svc, encrypted_ami_id, encryptor_image.id,
+            'Test updated AMI',
+            enc_svc_class=DummyEncryptorService,
+            instance_config=instance_config
+        )
+
+        self.assertEqual(
+            {'ntp_servers': ['0.pool.ntp.org']}, instance_config.brkt_config)
+        self.assertEqual(no_proxy, os.environ.get('NO_PROXY'))
+        self.assertEqual(['10.0.0.5'], aws_svc.session.no_proxy_hosts)
+
+
+class TestBatchUpdate(unittest.TestCase):
+
+    def setUp(self):
+        util.SLEEP_ENABLED = False
+        self.aws_svc, self.encryptor_image, guest_image = build_aws_service()
+        self.encrypted_amis = [
+            encrypt_ami.encrypt(
+                aws_svc=self.aws_svc,
+                enc_svc_cls=DummyEncryptorService,
+                image_id=guest_image.id,
+                encryptor_ami=self.encryptor_image.id
+            )
+            for _ in range(3)
+        ]
+        self.names = {
+            ami: 'Updated %d' % i for i, ami in enumerate(self.encrypted_amis)
+        }
+
+    def test_batch_update(self):
+        """ Test that the updater runs once, that each AMI is updated, and
+        that the metavisor snapshot is deleted afterwards.
+        """
+        updaters = []
+        snapshots = []
+
+        def run_instance_callback(args):
+            if args.image_id == self.encryptor_image.id:
+                updaters.append(args.instance)
+
+        def create_snapshot_callback(volume_id, snapshot):
+            snapshots.append(snapshot.id)
+
+        self.aws_svc.run_instance_callback = run_instance_callback
+        self.aws_svc.create_snapshot_callback = create_snapshot_callback
+        updated = update_amis(
+            self.aws_svc, self.encrypted_amis, self.encryptor_image.id,
+            self.names, enc_svc_class=DummyEncryptorService, max_guests=2
+        )
+
+        self.assertEqual(1, len(updaters))
+        self.assertEqual('terminated', updaters[0].state)
+        self.assertEqual(set(self.encrypted_amis), set(updated.keys()))
+        for ami, updated_ami in updated.iteritems():
+            image = self.aws_svc.get_image(updated_ami)
+            self.assertEqual(self.names[ami], image.name)
+        # The boot disk snapshot was deleted.  The log and root snapshots
+        # are used by the updated AMIs.
+        self.assertEqual(
+            1, len([s for s in snapshots if s not in self.aws_svc.snapshots]))
+        for instance in self.aws_svc.instances.values():
+            self.assertEqual('terminated', instance.state)
+
+    def test_guest_failure(self):
+        """ Test that a failure updating one AMI doesn't affect the
+        others.
+        """
+        failed_ami = self.encrypted_amis[1]
+
+        def run_instance_callback(args):
+            if args.image_id == failed_ami:
+                raise Exception('Test')
+
+        self.aws_svc.run_instance_callback = run_instance_callback
+        updated = update_amis(
+            self.aws_svc, self.encrypted_amis, self.encryptor_image.id,
+            self.names, enc_svc_class=DummyEncryptorService
+        )
+        self.assertEqual(
+            set(self.encrypted_amis) - {failed_ami}, set(updated.keys()))
+
+    def test_all_guests_fail(self):
+        """ Test that the metavisor snapshots are deleted when no AMI was
+        updated, since no AMI references them.
+        """
+        snapshots = []
+
+        def run_instance_callback(args):
+            if args.image_id in self.encrypted_amis:
+                raise Exception('Test')
+
+        def create_snapshot_callback(volume_id, snapshot):
+            snapshots.append(snapshot.id)
+
+        self.aws_svc.run_instance_callback = run_instance_callback
+        self.aws_svc.create_snapshot_callback = create_snapshot_callback
+        updated = update_amis(
+            self.aws_svc, self.encrypted_amis, self.encryptor_image.id,
+            self.names, enc_svc_class=DummyEncryptorService
+        )
+        self.assertEqual({}, updated)
+        self.assertEqual(3, len(snapshots))
+        for snapshot_id in snapshots:
+            self.assertNotIn(snapshot_id, self.aws_svc.snapshots)
+
+    def test_root_snapshot_failure(self):
+        """ Test that the metavisor log and root snapshots are deleted
+        when snapshotting the metavisor boot disk fails.
+        """
+        updaters = []
+        snapshots = []
+
+        def run_instance_callback(args):
+            if args.image_id == self.encryptor_image.id:
+                updaters.append(args.instance)
+
+        def create_snapshot_callback(volume_id, snapshot):
+            snapshots.append(snapshot.id)
+            boot_volume_id = \
+                updaters[0].block_device_mapping['/dev/sda1'].volume_id
+            if volume_id == boot_volume_id:
+                snapshot.status = 'error'
+
+        self.aws_svc.run_instance_callback = run_instance_callback
+        self.aws_svc.create_snapshot_callback = create_snapshot_callback
+        with self.assertRaises(SnapshotError):
+            update_amis(
+                self.aws_svc, self.encrypted_amis, self.encryptor_image.id,
+                self.names, enc_svc_class=DummyEncryptorService
+            )
+        self.assertEqual(3, len(snapshots))
+        for snapshot_id in snapshots:
+            self.assertNotIn(snapshot_id, self.aws_svc.snapshots)
@@ -21,28 +21,29 @@ AWS_SECRET_ACCESS_KEY environment variables, like you would when
 running the AWS command line utility.
 """
 
+import copy
 import json
 import logging
-import os
+import sys
+import time
 
 from boto.ec2.blockdevicemapping import EBSBlockDeviceType
 
 import encrypt_ami
 from brkt_cli import encryptor_service
-from brkt_cli.encryptor_service import (
-    wait_for_encryptor_up,
-    wait_for_encryption,
-)
+from brkt_cli.encryptor_service import wait_for_encryptor_co
+from brkt_cli.engine import Call, Engine, Return, Sleep, gather_co, run_sync
 from brkt_cli.instance_config import InstanceConfig
+from brkt_cli.timeouts import IMAGE, get_timeouts
 from brkt_cli.user_data import gzip_user_data
-from brkt_cli.util import Deadline
+from brkt_cli.util import BracketError, Deadline
+from brkt_cli.validation import ValidationError
+from brkt_cli.workflow import Workflow
 from encrypt_ami import (
-    clean_up,
-    create_encryptor_security_group,
-    log_exception_console,
-    wait_for_instance,
-    wait_for_image,
-    wait_for_snapshots,
+    clean_up_co,
+    wait_for_instance_co,
+    wait_for_image_co,
+    wait_for_snapshots_co,
     DESCRIPTION_GUEST_CREATOR,
     DESCRIPTION_METAVISOR_UPDATER,
     DESCRIPTION_SNAPSHOT,
@@ -52,6 +53,8 @@ from encrypt_ami import (
     NAME_METAVISOR_GRUB_SNAPSHOT,
     NAME_METAVISOR_ROOT_SNAPSHOT,
     NAME_METAVISOR_LOG_SNAPSHOT,
+    NAME_METAVISOR_GRUB_VOLUME,
+    NAME_METAVISOR_ROOT_VOLUME,
 )
 
 log = logging.getLogger(__name__)
@@ -63,234 +66,684 @@ def update_ami(aws_svc, encrypted_ami, updater_ami, encrypted_ami_name,
                guest_instance_type='m3.medium',
                updater_instance_type='m3.medium',
                instance_config=None,
-               status_port=encryptor_service.ENCRYPTOR_STATUS_PORT):
-    encrypted_guest = None
-    updater = None
-    mv_root_id = None
-    temp_sg_id = None
-    if instance_config is None:
-        instance_config = InstanceConfig()
+               status_port=encryptor_service.ENCRYPTOR_STATUS_PORT,
+               max_encryptors=None, timeout_history=None,
+               timeout_overrides=None):
+    return run_sync(update_ami_co(
+        aws_svc, encrypted_ami, updater_ami, encrypted_ami_name,
+        subnet_id=subnet_id,
+        security_group_ids=security_group_ids,
+        enc_svc_class=enc_svc_class,
+        guest_instance_type=guest_instance_type,
+        updater_instance_type=updater_instance_type,
+        instance_config=instance_config,
+        status_port=status_port,
+        max_encryptors=max_encryptors,
+        timeout_history=timeout_history,
+        timeout_overrides=timeout_overrides
+    ))
+
 
+def _launch_encrypted_guest_co(aws_svc, encrypted_ami, guest_instance_type,
+                              subnet_id, instance_config, instance_slot):
+    # Launched after instance_slot is acquired.
+    #
+    # Use 'updater' mode to avoid chain loading the guest
+    # automatically. We just want this AMI/instance up as the
+    # base to create a new AMI and preserve license
+    # information embedded in the guest AMI
+    log.info("Launching encrypted guest/updater")
+    encrypted_guest = yield Call(
+        aws_svc.run_instance,
+        encrypted_ami,
+        instance_type=guest_instance_type,
+        ebs_optimized=False,
+        subnet_id=subnet_id,
+        user_data=json.dumps(instance_config.brkt_config))
     try:
-        guest_image = aws_svc.get_image(encrypted_ami)
-
-        # Step 1. Launch encrypted guest AMI
-        # Use 'updater' mode to avoid chain loading the guest
-        # automatically. We just want this AMI/instance up as the
-        # base to create a new AMI and preserve license
-        # information embedded in the guest AMI
-        log.info("Launching encrypted guest/updater")
-
-        instance_config.brkt_config['solo_mode'] = 'updater'
-        instance_config.brkt_config['status_port'] = status_port
-
-        encrypted_guest = aws_svc.run_instance(
-            encrypted_ami,
-            instance_type=guest_instance_type,
-            ebs_optimized=False,
-            subnet_id=subnet_id,
-            user_data=json.dumps(instance_config.brkt_config))
-        aws_svc.create_tags(
+        yield Call(
+            aws_svc.create_tags,
             encrypted_guest.id,
             name=NAME_GUEST_CREATOR,
             description=DESCRIPTION_GUEST_CREATOR % {'image_id': encrypted_ami}
         )
-        # Run updater in same zone as guest so we can swap volumes
-
-        user_data = instance_config.make_userdata()
-        compressed_user_data = gzip_user_data(user_data)
-
-        # If the user didn't specify a security group, create a temporary
-        # security group that allows brkt-cli to get status from the updater.
-        run_instance = aws_svc.run_instance
-        if not security_group_ids:
-            vpc_id = None
-            if subnet_id:
-                subnet = aws_svc.get_subnet(subnet_id)
-                vpc_id = subnet.vpc_id
-            temp_sg_id = create_encryptor_security_group(
-                aws_svc, vpc_id=vpc_id, status_port=status_port).id
-            security_group_ids = [temp_sg_id]
-
-            # Wrap with a retry, to handle eventual consistency issues with
-            # the newly-created group.
-            run_instance = aws_svc.retry(
-                aws_svc.run_instance,
-                error_code_regexp='InvalidGroup\.NotFound'
-            )
+    except:
+        exc_info = sys.exc_info()
+        yield clean_up_co(aws_svc, instance_ids=[encrypted_guest.id])
+        raise exc_info[0], exc_info[1], exc_info[2]
+    raise Return(encrypted_guest)
+
+
+def _terminate_encrypted_guest_co(aws_svc, encrypted_guest, mv_root_id=None):
+    # The new metavisor root volume is attached to the guest, so it's
+    # deleted after the guest is terminated.
+    volume_ids = [mv_root_id] if mv_root_id else []
+    yield clean_up_co(
+        aws_svc, instance_ids=[encrypted_guest.id], volume_ids=volume_ids)
 
-        updater = run_instance(
-            updater_ami,
-            instance_type=updater_instance_type,
-            user_data=compressed_user_data,
-            ebs_optimized=False,
-            subnet_id=subnet_id,
-            placement=encrypted_guest.placement,
-            security_group_ids=security_group_ids)
-        aws_svc.create_tags(
+
+def _run_updater_co(aws_svc, updater_ami, updater_instance_type, subnet_id,
+                    instance_config, security_group, security_group_ids,
+                    placement=None):
+    user_data = instance_config.make_userdata()
+    compressed_user_data = gzip_user_data(user_data)
+
+    run_instance = aws_svc.run_instance
+    if security_group:
+        security_group_ids = [security_group]
+        # Wrap with a retry, to handle eventual consistency issues with
+        # the newly-created group.
+        run_instance = aws_svc.retry(
+            aws_svc.run_instance,
+            error_code_regexp='InvalidGroup\.NotFound'
+        )
+
+    updater = yield Call(
+        run_instance,
+        updater_ami,
+        instance_type=updater_instance_type,
+        user_data=compressed_user_data,
+        ebs_optimized=False,
+        subnet_id=subnet_id,
+        placement=placement,
+        security_group_ids=security_group_ids)
+    try:
+        yield Call(
+            aws_svc.create_tags,
             updater.id,
             name=NAME_METAVISOR_UPDATER,
             description=DESCRIPTION_METAVISOR_UPDATER,
         )
-        wait_for_instance(aws_svc, encrypted_guest.id, state="running")
-        log.info("Launched guest: %s Updater: %s" %
-             (encrypted_guest.id, updater.id)
+    except:
+        exc_info = sys.exc_info()
+        yield clean_up_co(aws_svc, instance_ids=[updater.id])
+        raise exc_info[0], exc_info[1], exc_info[2]
+    raise Return(updater)
+
+
+def _launch_updater_co(aws_svc, updater_ami, updater_instance_type,
+                       subnet_id, instance_config, encrypted_guest,
+                       security_group, security_group_ids):
+    # Run updater in same zone as guest so we can swap volumes
+    updater = yield _run_updater_co(
+        aws_svc, updater_ami, updater_instance_type, subnet_id,
+        instance_config, security_group, security_group_ids,
+        placement=encrypted_guest.placement
+    )
+    log.info("Launched guest: %s Updater: %s" %
+         (encrypted_guest.id, updater.id)
+    )
+    raise Return(updater)
+
+
+def _launch_batch_updater_co(aws_svc, updater_ami, updater_instance_type,
+                             subnet_id, instance_config, security_group,
+                             security_group_ids):
+    # The metavisor boot disk is copied from a snapshot, so the updater
+    # can run in any zone.
+    updater = yield _run_updater_co(
+        aws_svc, updater_ami, updater_instance_type, subnet_id,
+        instance_config, security_group, security_group_ids
+    )
+    log.info("Launched updater: %s", updater.id)
+    raise Return(updater)
+
+
+def _terminate_updater_co(aws_svc, updater):
+    yield clean_up_co(aws_svc, instance_ids=[updater.id])
+
+
+def _stop_encrypted_guest_co(aws_svc, encrypted_guest, timeouts):
+    yield wait_for_instance_co(aws_svc, encrypted_guest.id, state="running")
+    yield Call(aws_svc.stop_instance, encrypted_guest.id)
+    stopped_guest = yield wait_for_instance_co(
+        aws_svc, encrypted_guest.id, state="stopped",
+        timeout=timeouts.instance)
+    raise Return(stopped_guest)
+
+
+def _wait_for_updater_co(aws_svc, updater, enc_svc_class, status_port,
+                         timeouts):
+    updater = yield wait_for_instance_co(aws_svc, updater.id, state="running")
+    host_ips = []
+    if updater.ip_address:
+        host_ips.append(updater.ip_address)
+    if updater.private_ip_address:
+        host_ips.append(updater.private_ip_address)
+        log.debug(
+            'Bypassing proxy for %s', updater.private_ip_address)
+        aws_svc.session.add_no_proxy_host(updater.private_ip_address)
+
+    enc_svc = enc_svc_class(
+        host_ips,
+        port=status_port,
+        no_proxy_hosts=aws_svc.session.no_proxy_hosts
+    )
+    log.info('Waiting for updater service on %s (port %s on %s)',
+             updater.id, enc_svc.port, ', '.join(host_ips))
+    watcher = encrypt_ami.make_instance_watcher(aws_svc, updater.id)
+    try:
+        yield wait_for_encryptor_co(
+            enc_svc, timeouts=timeouts, watcher=watcher)
+    except Exception as e:
+        exc_info = sys.exc_info()
+        yield encrypt_ami.collect_failure_info_co(aws_svc, e, updater.id)
+        raise exc_info[0], exc_info[1], exc_info[2]
+
+    yield Call(aws_svc.stop_instance, updater.id)
+    stopped_updater = yield wait_for_instance_co(
+        aws_svc, updater.id, state="stopped", timeout=timeouts.instance)
+    raise Return(stopped_updater)
+
+
+def _get_guest_root(guest_image):
+    if guest_image.virtualization_type == 'paravirtual':
+        return '/dev/sda5'
+    return '/dev/sdf'
+
+
+def _get_timeouts(guest_image, updater_instance_type, timeout_history=None,
+                  timeout_overrides=None):
+    guest_root = guest_image.block_device_mapping.get(
+        _get_guest_root(guest_image))
+    return get_timeouts(
+        volume_size_gb=getattr(guest_root, 'size', None),
+        instance_type=updater_instance_type,
+        history=timeout_history,
+        overrides=timeout_overrides
+    )
+
+
+def _get_boot_snapshot_name(guest_image):
+    if guest_image.virtualization_type == 'paravirtual':
+        return NAME_METAVISOR_GRUB_SNAPSHOT
+    return NAME_METAVISOR_ROOT_SNAPSHOT
+
+
+def _get_root_device_name(guest_image, stopped_updater):
+    if guest_image.virtualization_type == 'paravirtual':
+        # Use updater as base instance for create_image
+        return stopped_updater.root_device_name
+    # Use guest_instance as base instance for create_image
+    return guest_image.root_device_name
+
+
+def _detach_old_metavisor_co(aws_svc, guest_image, stopped_guest):
+    """ Detach old BSD drive(s) from the encrypted guest and delete them.
+
+    :return the guest's block device mapping, without the old drives
+    """
+    guest_bdm = stopped_guest.block_device_mapping
+    if guest_image.virtualization_type == 'paravirtual':
+        d_list = ['/dev/sda1', '/dev/sda2', '/dev/sda3']
+    else:
+        d_list = [stopped_guest.root_device_name]
+    for d in d_list:
+        log.info("Detaching old metavisor disk: %s from %s" %
+            (guest_bdm[d].volume_id, stopped_guest.id))
+        yield Call(aws_svc.detach_volume, guest_bdm[d].volume_id,
+                instance_id=stopped_guest.id,
+                force=True
         )
+        yield Call(aws_svc.delete_volume, guest_bdm[d].volume_id)
 
-        # Step 2. Wait for the updater to finish and stop the instances
-        aws_svc.stop_instance(encrypted_guest.id)
-
-        updater = wait_for_instance(aws_svc, updater.id, state="running")
-        host_ips = []
-        if updater.ip_address:
-            host_ips.append(updater.ip_address)
-        if updater.private_ip_address:
-            host_ips.append(updater.private_ip_address)
-            log.info('Adding %s to NO_PROXY environment variable' %
-                 updater.private_ip_address)
-            if os.environ.get('NO_PROXY'):
-                os.environ['NO_PROXY'] += "," + \
-                    updater.private_ip_address
-            else:
-                os.environ['NO_PROXY'] = updater.private_ip_address
-
-        enc_svc = enc_svc_class(host_ips, port=status_port)
-        log.info('Waiting for updater service on %s (port %s on %s)',
-                 updater.id, enc_svc.port, ', '.join(host_ips))
-        wait_for_encryptor_up(enc_svc, Deadline(600))
-        try:
-            wait_for_encryption(enc_svc)
-        except Exception as e:
-            # Stop the updater instance, to make the console log available.
-            encrypt_ami.stop_and_wait(aws_svc, updater.id)
+    # Preserve volume type for any additional attached volumes
+    d_list.append(_get_guest_root(guest_image))
+    for d in guest_bdm.keys():
+        if d not in d_list:
+            log.debug("Preserving volume type for disk %s", d)
+            vol_id = guest_bdm[d].volume_id
+            vol = yield Call(aws_svc.get_volume, vol_id)
+            guest_bdm[d].volume_type = vol.type
+    raise Return(guest_bdm)
 
-            log_exception_console(aws_svc, e, updater.id)
-            raise
 
-        aws_svc.stop_instance(updater.id)
-        encrypted_guest = wait_for_instance(
-            aws_svc, encrypted_guest.id, state="stopped")
-        updater = wait_for_instance(aws_svc, updater.id, state="stopped")
+def _snapshot_metavisor_co(aws_svc, guest_image, stopped_updater):
+    """ Snapshot the new metavisor volumes that aren't moved to the
+    guest instance.
 
-        guest_bdm = encrypted_guest.block_device_mapping
-        updater_bdm = updater.block_device_mapping
+    :return a dictionary of device name to EBSBlockDeviceType
+    """
+    if guest_image.virtualization_type != 'paravirtual':
+        raise Return({})
 
-        # Step 3. Detach old BSD drive(s) and delete from encrypted guest
-        if guest_image.virtualization_type == 'paravirtual':
-            d_list = ['/dev/sda1', '/dev/sda2', '/dev/sda3']
-        else:
-            d_list = [encrypted_guest.root_device_name]
-        for d in d_list:
-            log.info("Detaching old metavisor disk: %s from %s" %
-                (guest_bdm[d].volume_id, encrypted_guest.id))
-            aws_svc.detach_volume(guest_bdm[d].volume_id,
-                    instance_id=encrypted_guest.id,
-                    force=True
-            )
-            aws_svc.delete_volume(guest_bdm[d].volume_id)
+    updater_bdm = stopped_updater.block_device_mapping
+    description = DESCRIPTION_SNAPSHOT % {'image_id': stopped_updater.id}
+    snap_root = yield Call(
+        aws_svc.create_snapshot,
+        updater_bdm['/dev/sda2'].volume_id,
+        name=NAME_METAVISOR_ROOT_SNAPSHOT,
+        description=description
+    )
+    snap_log = yield Call(
+        aws_svc.create_snapshot,
+        updater_bdm['/dev/sda3'].volume_id,
+        name=NAME_METAVISOR_LOG_SNAPSHOT,
+        description=description
+    )
+    try:
+        yield wait_for_snapshots_co(aws_svc, snap_root.id, snap_log.id)
+    except:
+        exc_info = sys.exc_info()
+        yield clean_up_co(aws_svc, snapshot_ids=[snap_root.id, snap_log.id])
+        raise exc_info[0], exc_info[1], exc_info[2]
+    dev_root = EBSBlockDeviceType(volume_type='gp2',
+                snapshot_id=snap_root.id,
+                delete_on_termination=True)
+    dev_log = EBSBlockDeviceType(volume_type='gp2',
+                snapshot_id=snap_log.id,
+                delete_on_termination=True)
+    raise Return({'/dev/sda2': dev_root, '/dev/sda3': dev_log})
+
+
+def _delete_metavisor_snapshots_co(aws_svc, mv_snapshots):
+    """ Delete the snapshots that _snapshot_metavisor_co() created. """
+    snapshot_ids = [d.snapshot_id for d in mv_snapshots.values()]
+    if snapshot_ids:
+        yield clean_up_co(aws_svc, snapshot_ids=snapshot_ids)
+
+
+def _get_mv_root_id(stopped_updater):
+    return stopped_updater.block_device_mapping['/dev/sda1'].volume_id
+
+
+def _snapshot_metavisor_root_co(aws_svc, guest_image, stopped_updater):
+    """ Snapshot the new metavisor boot disk, so that a copy of it can be
+    attached to each encrypted guest.
+
+    :return the Snapshot
+    """
+    snapshot = yield Call(
+        aws_svc.create_snapshot,
+        _get_mv_root_id(stopped_updater),
+        name=_get_boot_snapshot_name(guest_image),
+        description=DESCRIPTION_SNAPSHOT % {'image_id': stopped_updater.id}
+    )
+    try:
+        yield wait_for_snapshots_co(aws_svc, snapshot.id)
+    except:
+        exc_info = sys.exc_info()
+        yield clean_up_co(aws_svc, snapshot_ids=[snapshot.id])
+        raise exc_info[0], exc_info[1], exc_info[2]
+    raise Return(snapshot)
+
+
+def _delete_metavisor_root_snapshot_co(aws_svc, mv_root_snapshot):
+    yield clean_up_co(aws_svc, snapshot_ids=[mv_root_snapshot.id])
 
-        # Step 4. Snapshot MV volume(s)
-        log.info("Creating snapshots")
+
+def _wait_for_volume_co(aws_svc, volume_id, state='available', timeout=300):
+    deadline = Deadline(timeout)
+    while not deadline.is_expired():
+        volume = yield Call(aws_svc.get_volume, volume_id)
+        if volume.status == state:
+            raise Return(volume)
+        if volume.status == 'error':
+            raise BracketError('Volume %s is in an error state' % volume_id)
+        yield Sleep(2)
+    raise BracketError(
+        'Timed out waiting for %s to be %s' % (volume_id, state))
+
+
+def _create_metavisor_root_co(aws_svc, guest_image, stopped_guest,
+                              mv_root_snapshot):
+    """ Create a metavisor boot disk from the snapshot, in the guest's
+    zone.
+
+    :return the volume id
+    """
+    volume = yield Call(
+        aws_svc.create_volume,
+        mv_root_snapshot.volume_size,
+        stopped_guest.placement,
+        snapshot=mv_root_snapshot.id,
+        volume_type='gp2'
+    )
+    try:
         if guest_image.virtualization_type == 'paravirtual':
-            description = DESCRIPTION_SNAPSHOT % {'image_id': updater.id}
-            snap_root = aws_svc.create_snapshot(
-                updater_bdm['/dev/sda2'].volume_id,
-                name=NAME_METAVISOR_ROOT_SNAPSHOT,
-                description=description
-            )
-            snap_log = aws_svc.create_snapshot(
-                updater_bdm['/dev/sda3'].volume_id,
-                name=NAME_METAVISOR_LOG_SNAPSHOT,
-                description=description
-            )
-            wait_for_snapshots(aws_svc, snap_root.id, snap_log.id)
-            dev_root = EBSBlockDeviceType(volume_type='gp2',
-                        snapshot_id=snap_root.id,
-                        delete_on_termination=True)
-            dev_log = EBSBlockDeviceType(volume_type='gp2',
-                        snapshot_id=snap_log.id,
-                        delete_on_termination=True)
-            guest_bdm['/dev/sda2'] = dev_root
-            guest_bdm['/dev/sda3'] = dev_log
-            # Use updater as base instance for create_image
-            boot_snap_name = NAME_METAVISOR_GRUB_SNAPSHOT
-            root_device_name = updater.root_device_name
-            guest_root = '/dev/sda5'
-            d_list.append(guest_root)
+            name = NAME_METAVISOR_GRUB_VOLUME
         else:
-            # Use guest_instance as base instance for create_image
-            boot_snap_name = NAME_METAVISOR_ROOT_SNAPSHOT
-            root_device_name = guest_image.root_device_name
-            guest_root = '/dev/sdf'
-            d_list.append(guest_root)
-
-        # Preserve volume type for any additional attached volumes
-        for d in guest_bdm.keys():
-            if d not in d_list:
-                log.debug("Preserving volume type for disk %s", d)
-                vol_id = guest_bdm[d].volume_id
-                vol = aws_svc.get_volume(vol_id)
-                guest_bdm[d].volume_type = vol.type
-
-        # Step 5. Move new MV boot disk to base instance
-        log.info("Detach boot volume from %s" % (updater.id,))
-        mv_root_id = updater_bdm['/dev/sda1'].volume_id
-        aws_svc.detach_volume(mv_root_id,
-            instance_id=updater.id,
-            force=True
-        )
+            name = NAME_METAVISOR_ROOT_VOLUME
+        yield Call(aws_svc.create_tags, volume.id, name=name)
+        yield _wait_for_volume_co(aws_svc, volume.id)
+    except:
+        exc_info = sys.exc_info()
+        yield clean_up_co(aws_svc, volume_ids=[volume.id])
+        raise exc_info[0], exc_info[1], exc_info[2]
+    raise Return(volume.id)
 
-        # Step 6. Attach new boot disk to guest instance
-        log.info("Attaching new metavisor boot disk: %s to %s" %
-            (mv_root_id, encrypted_guest.id)
-        )
-        aws_svc.attach_volume(mv_root_id, encrypted_guest.id, root_device_name)
-        encrypted_guest = encrypt_ami.wait_for_volume_attached(
-            aws_svc, encrypted_guest.id, root_device_name)
-        guest_bdm[root_device_name] = \
-            encrypted_guest.block_device_mapping[root_device_name]
-        guest_bdm[root_device_name].delete_on_termination = True
-        guest_bdm[root_device_name].volume_type = 'gp2'
-        guest_root_vol_id = guest_bdm[guest_root].volume_id
-        guest_root_vol = aws_svc.get_volume(guest_root_vol_id)
-        guest_bdm[guest_root].volume_type = guest_root_vol.type
-
-        # Step 7. Create new AMI. Preserve billing/license info
-        log.info("Creating new AMI")
-        ami = aws_svc.create_image(
-            encrypted_guest.id,
-            encrypted_ami_name,
-            description=guest_image.description,
-            no_reboot=True,
-            block_device_mapping=guest_bdm
-        )
-        wait_for_image(aws_svc, ami)
-        image = aws_svc.get_image(ami, retry=True)
-        aws_svc.create_tags(
-            image.block_device_mapping[root_device_name].snapshot_id,
-            name=boot_snap_name,
-        )
-        aws_svc.create_tags(
-            image.block_device_mapping[guest_root].snapshot_id,
-            name=NAME_ENCRYPTED_ROOT_SNAPSHOT,
+
+def _attach_metavisor_root_co(aws_svc, guest_image, stopped_guest,
+                              stopped_updater, mv_root_id, guest_bdm):
+    """ Attach the new metavisor boot disk to the guest, after the old
+    metavisor disks were detached.
+
+    :return the guest Instance
+    """
+    log.info("Attaching new metavisor boot disk: %s to %s" %
+        (mv_root_id, stopped_guest.id)
+    )
+    root_device_name = _get_root_device_name(guest_image, stopped_updater)
+    yield Call(
+        aws_svc.attach_volume,
+        mv_root_id,
+        stopped_guest.id,
+        root_device_name
+    )
+    encrypted_guest = yield encrypt_ami.wait_for_volume_attached_co(
+        aws_svc, stopped_guest.id, root_device_name)
+    raise Return(encrypted_guest)
+
+
+def _move_metavisor_root_co(aws_svc, guest_image, stopped_guest,
+                            stopped_updater, mv_root_id, guest_bdm):
+    """ Move the new metavisor boot disk from the updater to the guest.
+
+    :return the guest Instance
+    """
+    log.info("Detach boot volume from %s" % (stopped_updater.id,))
+    yield Call(aws_svc.detach_volume, mv_root_id,
+        instance_id=stopped_updater.id,
+        force=True
+    )
+    encrypted_guest = yield _attach_metavisor_root_co(
+        aws_svc, guest_image, stopped_guest, stopped_updater, mv_root_id,
+        guest_bdm)
+    raise Return(encrypted_guest)
+
+
+def _create_image_co(aws_svc, guest_image, encrypted_ami_name,
+                     stopped_updater, guest_bdm, mv_snapshots,
+                     attached_guest, timeouts):
+    guest_bdm.update(mv_snapshots)
+    root_device_name = _get_root_device_name(guest_image, stopped_updater)
+    guest_root = _get_guest_root(guest_image)
+    boot_snap_name = _get_boot_snapshot_name(guest_image)
+
+    guest_bdm[root_device_name] = \
+        attached_guest.block_device_mapping[root_device_name]
+    guest_bdm[root_device_name].delete_on_termination = True
+    guest_bdm[root_device_name].volume_type = 'gp2'
+    guest_root_vol_id = guest_bdm[guest_root].volume_id
+    guest_root_vol = yield Call(aws_svc.get_volume, guest_root_vol_id)
+    guest_bdm[guest_root].volume_type = guest_root_vol.type
+
+    # Create new AMI. Preserve billing/license info
+    log.info("Creating new AMI")
+    ami = yield Call(
+        aws_svc.create_image,
+        attached_guest.id,
+        encrypted_ami_name,
+        description=guest_image.description,
+        no_reboot=True,
+        block_device_mapping=guest_bdm
+    )
+    start = time.time()
+    yield wait_for_image_co(aws_svc, ami, timeout=timeouts.image)
+    timeouts.record(IMAGE, time.time() - start)
+    image = yield Call(aws_svc.get_image, ami, retry=True)
+    yield Call(
+        aws_svc.create_tags,
+        image.block_device_mapping[root_device_name].snapshot_id,
+        name=boot_snap_name,
+    )
+    yield Call(
+        aws_svc.create_tags,
+        image.block_device_mapping[guest_root].snapshot_id,
+        name=NAME_ENCRYPTED_ROOT_SNAPSHOT,
+    )
+    yield Call(aws_svc.create_tags, ami)
+    raise Return(ami)
+
+
+def _get_guest_image(aws_svc, encrypted_ami):
+    return aws_svc.get_image(encrypted_ami)
+
+
+def make_update_workflow():
+    """ Return the Workflow that update_ami() runs.  The encrypted guest
+    and the updater are launched concurrently, and the old metavisor
+    disks are swapped out of the guest while the new metavisor volumes
+    are snapshotted.
+    """
+    workflow = Workflow('update')
+    workflow.add_step('guest_image', _get_guest_image, retries=2)
+    workflow.add_step('timeouts', _get_timeouts)
+    workflow.add_step(
+        'instance_slot', encrypt_ami.acquire_instance_slot_co,
+        cleanup=encrypt_ami.release_instance_slot)
+    workflow.add_step(
+        'encrypted_guest', _launch_encrypted_guest_co,
+        cleanup=_terminate_encrypted_guest_co)
+    workflow.add_step(
+        'security_group', encrypt_ami.get_security_group_co,
+        cleanup=encrypt_ami.delete_security_group_co)
+    workflow.add_step(
+        'updater', _launch_updater_co, cleanup=_terminate_updater_co)
+    workflow.add_step('stopped_guest', _stop_encrypted_guest_co)
+    workflow.add_step('stopped_updater', _wait_for_updater_co)
+    workflow.add_step('guest_bdm', _detach_old_metavisor_co)
+    workflow.add_step('mv_snapshots', _snapshot_metavisor_co)
+    workflow.add_step('mv_root_id', _get_mv_root_id)
+    workflow.add_step('attached_guest', _move_metavisor_root_co)
+    workflow.add_step('ami', _create_image_co)
+    return workflow
+
+
+def _make_updater_config(instance_config, status_port):
+    if instance_config is None:
+        instance_config = InstanceConfig()
+    else:
+        # Don't modify the caller's config.
+        instance_config = copy.deepcopy(instance_config)
+    instance_config.brkt_config['solo_mode'] = 'updater'
+    instance_config.brkt_config['status_port'] = status_port
+    return instance_config
+
+
+def update_ami_co(aws_svc, encrypted_ami, updater_ami, encrypted_ami_name,
+                  subnet_id=None, security_group_ids=None,
+                  enc_svc_class=encryptor_service.EncryptorService,
+                  guest_instance_type='m3.medium',
+                  updater_instance_type='m3.medium',
+                  instance_config=None,
+                  status_port=encryptor_service.ENCRYPTOR_STATUS_PORT,
+                  max_encryptors=None, timeout_history=None,
+                  timeout_overrides=None):
+    """ Coroutine version of update_ami(). """
+    instance_config = _make_updater_config(instance_config, status_port)
+    workflow = make_update_workflow()
+    results = yield workflow.run_co(
+        aws_svc=aws_svc,
+        encrypted_ami=encrypted_ami,
+        updater_ami=updater_ami,
+        encrypted_ami_name=encrypted_ami_name,
+        subnet_id=subnet_id,
+        security_group_ids=security_group_ids,
+        enc_svc_class=enc_svc_class,
+        guest_instance_type=guest_instance_type,
+        updater_instance_type=updater_instance_type,
+        instance_config=instance_config,
+        status_port=status_port,
+        max_encryptors=max_encryptors,
+        timeout_history=timeout_history,
+        timeout_overrides=timeout_overrides
+    )
+    raise Return(results['ami'])
+
+
+def make_batch_updater_workflow():
+    """ Return the Workflow that runs the updater once for a batch update.
+    Its results are the snapshots of the new metavisor disks.  The
+    updater is terminated as soon as its disks are snapshotted.
+    """
+    workflow = Workflow('update-metavisor')
+    workflow.add_step('timeouts', _get_timeouts)
+    workflow.add_step(
+        'instance_slot', encrypt_ami.acquire_instance_slot_co,
+        cleanup=encrypt_ami.release_instance_slot)
+    workflow.add_step(
+        'security_group', encrypt_ami.get_security_group_co,
+        cleanup=encrypt_ami.delete_security_group_co)
+    workflow.add_step(
+        'updater', _launch_batch_updater_co, cleanup=_terminate_updater_co)
+    workflow.add_step('stopped_updater', _wait_for_updater_co)
+    workflow.add_step(
+        'mv_snapshots', _snapshot_metavisor_co,
+        compensate=_delete_metavisor_snapshots_co)
+    workflow.add_step(
+        'mv_root_snapshot', _snapshot_metavisor_root_co,
+        compensate=_delete_metavisor_root_snapshot_co)
+    return workflow
+
+
+def make_batch_guest_workflow():
+    """ Return the Workflow that creates one updated AMI in a batch
+    update.  The metavisor boot disk is created from the snapshot that
+    the updater workflow made, instead of being moved from an updater.
+    """
+    workflow = Workflow('update-guest')
+    workflow.add_step('guest_image', _get_guest_image, retries=2)
+    workflow.add_step('timeouts', _get_timeouts)
+    workflow.add_step(
+        'encrypted_guest', _launch_encrypted_guest_co,
+        cleanup=_terminate_encrypted_guest_co)
+    workflow.add_step('stopped_guest', _stop_encrypted_guest_co)
+    workflow.add_step('guest_bdm', _detach_old_metavisor_co)
+    workflow.add_step('mv_root_id', _create_metavisor_root_co)
+    workflow.add_step('attached_guest', _attach_metavisor_root_co)
+    workflow.add_step('ami', _create_image_co)
+    return workflow
+
+
+def update_amis(aws_svc, encrypted_amis, updater_ami, encrypted_ami_names,
+                subnet_id=None, security_group_ids=None,
+                enc_svc_class=encryptor_service.EncryptorService,
+                guest_instance_type='m3.medium',
+                updater_instance_type='m3.medium',
+                instance_config=None,
+                status_port=encryptor_service.ENCRYPTOR_STATUS_PORT,
+                max_encryptors=None, max_guests=8, timeout_history=None,
+                timeout_overrides=None):
+    """ Update several encrypted AMIs to the same metavisor, running the
+    updater instance once.  The new metavisor boot disk is snapshotted,
+    and each AMI gets a volume created from the snapshot.  The AMIs are
+    updated in parallel.
+
+    :param encrypted_amis a list of AMI ids, which must all have the
+        same virtualization type
+    :param encrypted_ami_names a dictionary of AMI id to the name of the
+        updated AMI
+    :param max_guests the maximum number of encrypted guest instances
+        that run at once
+    :return a dictionary of AMI id to updated AMI id, for the AMIs that
+        were updated.  Errors updating individual AMIs are logged.
+    :raise the exception that caused the updater to fail
+    """
+    engine = Engine(max_workers=max(8, max_guests))
+    try:
+        return engine.run_until_complete(
+            update_amis_co(
+                aws_svc, encrypted_amis, updater_ami, encrypted_ami_names,
+                subnet_id=subnet_id,
+                security_group_ids=security_group_ids,
+                enc_svc_class=enc_svc_class,
+                guest_instance_type=guest_instance_type,
+                updater_instance_type=updater_instance_type,
+                instance_config=instance_config,
+                status_port=status_port,
+                max_encryptors=max_encryptors,
+                max_guests=max_guests,
+                timeout_history=timeout_history,
+                timeout_overrides=timeout_overrides
+            ),
+            session=aws_svc.session
         )
-        aws_svc.create_tags(ami)
-        return ami
     finally:
-        instance_ids = set()
-        volume_ids = set()
-        sg_ids = set()
-
-        if encrypted_guest:
-            instance_ids.add(encrypted_guest.id)
-        if updater:
-            instance_ids.add(updater.id)
-        if mv_root_id:
-            volume_ids.add(mv_root_id)
-        if temp_sg_id:
-            sg_ids.add(temp_sg_id)
-
-        clean_up(aws_svc,
-                 instance_ids=instance_ids,
-                 volume_ids=volume_ids,
-                 security_group_ids=sg_ids)
+        engine.shutdown()
+
+
+def _update_guests_co(aws_svc, pending, encrypted_ami_names, updated,
+                      **inputs):
+    """ Update AMIs from the pending list until it's empty. """
+    while pending:
+        encrypted_ami = pending.pop(0)
+        try:
+            results = yield make_batch_guest_workflow().run_co(
+                aws_svc=aws_svc,
+                encrypted_ami=encrypted_ami,
+                encrypted_ami_name=encrypted_ami_names[encrypted_ami],
+                instance_slot=None,
+                **inputs
+            )
+        except Exception as e:
+            log.error('Unable to update %s: %s', encrypted_ami, e)
+            continue
+        log.info('Updated %s to %s', encrypted_ami, results['ami'])
+        updated[encrypted_ami] = results['ami']
+
+
+def update_amis_co(aws_svc, encrypted_amis, updater_ami, encrypted_ami_names,
+                   subnet_id=None, security_group_ids=None,
+                   enc_svc_class=encryptor_service.EncryptorService,
+                   guest_instance_type='m3.medium',
+                   updater_instance_type='m3.medium',
+                   instance_config=None,
+                   status_port=encryptor_service.ENCRYPTOR_STATUS_PORT,
+                   max_encryptors=None, max_guests=8, timeout_history=None,
+                   timeout_overrides=None):
+    """ Coroutine version of update_amis(). """
+    guest_images = []
+    for encrypted_ami in encrypted_amis:
+        image = yield Call(_get_guest_image, aws_svc, encrypted_ami)
+        guest_images.append(image)
+    virtualization_types = set(i.virtualization_type for i in guest_images)
+    if len(virtualization_types) > 1:
+        raise ValidationError(
+            'Unable to update HVM and paravirtual AMIs in the same batch')
+
+    instance_config = _make_updater_config(instance_config, status_port)
+    updater_results = yield make_batch_updater_workflow().run_co(
+        aws_svc=aws_svc,
+        guest_image=guest_images[0],
+        updater_ami=updater_ami,
+        subnet_id=subnet_id,
+        security_group_ids=security_group_ids,
+        enc_svc_class=enc_svc_class,
+        updater_instance_type=updater_instance_type,
+        instance_config=instance_config,
+        status_port=status_port,
+        max_encryptors=max_encryptors,
+        timeout_history=timeout_history,
+        timeout_overrides=timeout_overrides
+    )
+    mv_root_snapshot = updater_results['mv_root_snapshot']
+    log.info(
+        'Updating %d AMIs with metavisor snapshot %s',
+        len(encrypted_amis), mv_root_snapshot.id)
+
+    pending = list(encrypted_amis)
+    updated = {}
+    try:
+        yield gather_co(*[
+            _update_guests_co(
+                aws_svc, pending, encrypted_ami_names, updated,
+                subnet_id=subnet_id,
+                guest_instance_type=guest_instance_type,
+                updater_instance_type=updater_instance_type,
+                instance_config=instance_config,
+                stopped_updater=updater_results['stopped_updater'],
+                mv_snapshots=updater_results['mv_snapshots'],
+                mv_root_snapshot=mv_root_snapshot,
+                timeout_history=timeout_history,
+                timeout_overrides=timeout_overrides
+            )
+            for _ in xrange(min(max_guests, len(encrypted_amis)))
+        ])
+    finally:
+        yield _delete_metavisor_root_snapshot_co(aws_svc, mv_root_snapshot)
+        if not updated:
+            # No AMI references the shared metavisor snapshots.
+            yield _delete_metavisor_snapshots_co(
+                aws_svc, updater_results['mv_snapshots'])
+    raise Return(updated)
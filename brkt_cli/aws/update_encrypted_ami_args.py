@@ -19,9 +19,14 @@ from brkt_cli import encryptor_service
 
 def setup_update_encrypted_ami(parser):
     parser.add_argument(
-        'ami',
+        'amis',
         metavar='ID',
-        help='The encrypted AMI that will be updated'
+        nargs='+',
+        help=(
+            'The encrypted AMI that will be updated.  If more than one AMI '
+            'is specified, the updater runs once and its metavisor disks '
+            'are copied to each AMI.'
+        )
     )
     parser.add_argument(
         '--encrypted-ami-name',
@@ -48,6 +53,29 @@ def setup_update_encrypted_ami(parser):
             'instance. Default: m3.medium'),
         default='m3.medium'
     )
+    parser.add_argument(
+        '--max-encryptors',
+        metavar='N',
+        type=int,
+        dest='max_encryptors',
+        help=(
+            'Limit the number of encryptor and updater sessions that brkt '
+            'processes on this host run at the same time in the region and '
+            'AWS account.  Sessions over the limit wait in FIFO order.'
+        )
+    )
+    parser.add_argument(
+        '--max-guests',
+        metavar='N',
+        type=int,
+        default=8,
+        dest='max_guests',
+        help=(
+            'When updating more than one AMI, the maximum number of '
+            'encrypted guest instances that run at the same time. '
+            'Default: 8'
+        )
+    )
     parser.add_argument(
         '--pv',
         action='store_true',
@@ -0,0 +1,330 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Microbenchmarks for the CPU-bound helpers that run once per instance or
+token, like generating user data and signing tokens.
+
+Run all benchmarks and save the results as a baseline:
+
+    python -m brkt_cli.benchmark --save baseline.json
+
+Run the benchmarks again and compare against the baseline:
+
+    python -m brkt_cli.benchmark --compare baseline.json
+
+Each benchmark reports the best ops/sec over several repeats, which is
+more stable than the mean on a busy machine, and the number of objects
+that are still tracked by the garbage collector after each operation.
+"""
+
+from __future__ import print_function
+
+import argparse
+import gc
+import json
+import sys
+import time
+
+import brkt_cli
+import brkt_cli.crypto
+from brkt_cli import brkt_jwt, util
+from brkt_cli.aws import aws_service
+from brkt_cli.brkt_jwt import jwk
+from brkt_cli.instance_config import InstanceConfig
+from brkt_cli.proxy import Proxy, generate_proxy_config
+from brkt_cli.user_data import gzip_user_data
+
+# Report a regression when ops/sec drops by more than this fraction.
+DEFAULT_THRESHOLD = 0.10
+
+
+class Benchmark(object):
+    """ A named operation to be timed.  setup() is called once, and its
+    return value is passed to each call to function().
+    """
+
+    def __init__(self, name, function, setup=None):
+        self.name = name
+        self.function = function
+        self.setup = setup
+
+
+class BenchmarkResult(object):
+    def __init__(self, name, ops_per_sec, retained_objects_per_op=0.0):
+        self.name = name
+        self.ops_per_sec = ops_per_sec
+        self.retained_objects_per_op = retained_objects_per_op
+
+    def to_dict(self):
+        return {
+            'ops_per_sec': self.ops_per_sec,
+            'retained_objects_per_op': self.retained_objects_per_op
+        }
+
+    @classmethod
+    def from_dict(cls, name, d):
+        return BenchmarkResult(
+            name,
+            d['ops_per_sec'],
+            d.get('retained_objects_per_op', 0.0)
+        )
+
+
+def _make_instance_config():
+    ic = InstanceConfig({
+        'api_host': 'yetiapi.mgmt.brkt.com:443',
+        'hsmproxy_host': 'hsmproxy.mgmt.brkt.com:443',
+        'ntp_servers': ['0.pool.ntp.org', '1.pool.ntp.org'],
+        'identity_token': 'x' * 400
+    })
+    ic.add_brkt_file(
+        'proxy.yaml', generate_proxy_config(Proxy('10.0.0.1', 3128)))
+    ic.add_brkt_file('ca_cert.pem.example.com', 'x' * 1500)
+    return ic
+
+
+def _make_tag_strings():
+    return ['key%d=value%d' % (i, i) for i in xrange(20)]
+
+
+def get_benchmarks():
+    """ Return the list of benchmarks that are run by default. """
+    return [
+        Benchmark(
+            'make_userdata',
+            lambda ic: ic.make_userdata(),
+            setup=_make_instance_config
+        ),
+        Benchmark(
+            'gzip_user_data',
+            gzip_user_data,
+            setup=lambda: _make_instance_config().make_userdata()
+        ),
+        Benchmark(
+            'make_jwt',
+            brkt_jwt.make_jwt,
+            setup=brkt_cli.crypto.new
+        ),
+        Benchmark(
+            'get_thumbprint',
+            lambda c: jwk.get_thumbprint(c.x, c.y),
+            setup=brkt_cli.crypto.new
+        ),
+        Benchmark(
+            'parse_tags',
+            brkt_cli.parse_tags,
+            setup=_make_tag_strings
+        ),
+        Benchmark(
+            'validate_dns_name_ip_address',
+            util.validate_dns_name_ip_address,
+            setup=lambda: 'hsmproxy.mgmt.brkt.com'
+        ),
+        Benchmark(
+            'validate_ntp_servers',
+            brkt_cli.validate_ntp_servers,
+            setup=lambda: ['0.pool.ntp.org', '10.4.5.6', 'time.example.com']
+        ),
+        Benchmark(
+            'validate_image_name',
+            aws_service.validate_image_name,
+            setup=lambda: 'Ubuntu 14.04 (encrypted 787ace7a)'
+        ),
+        Benchmark(
+            'validate_tag_key',
+            aws_service.validate_tag_key,
+            setup=lambda: 'BrktEncryptorSessionID'
+        )
+    ]
+
+
+def _time_iterations(function, arg, iterations):
+    start = time.time()
+    for _ in xrange(iterations):
+        function(arg)
+    return time.time() - start
+
+
+def run_benchmark(benchmark, min_time=0.2, repeat=5):
+    """ Run the benchmark and return a BenchmarkResult.  The number of
+    iterations is calibrated so that each repeat runs for at least
+    min_time seconds.
+    """
+    arg = benchmark.setup() if benchmark.setup else None
+    function = benchmark.function
+
+    # Calibrate.
+    iterations = 1
+    while True:
+        elapsed = _time_iterations(function, arg, iterations)
+        if elapsed >= min_time or iterations >= 1000000:
+            break
+        if elapsed <= 0:
+            iterations *= 10
+        else:
+            iterations = max(
+                iterations * 2, int(iterations * min_time / elapsed) + 1)
+
+    # Keep the garbage collector from adding noise to the timings.
+    gc.collect()
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        best = None
+        for _ in xrange(repeat):
+            elapsed = _time_iterations(function, arg, iterations)
+            if best is None or elapsed < best:
+                best = elapsed
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+
+    # Count objects that survive each operation, which shows up caching
+    # and leaks.
+    gc.collect()
+    before = len(gc.get_objects())
+    _time_iterations(function, arg, iterations)
+    gc.collect()
+    retained = len(gc.get_objects()) - before
+
+    ops_per_sec = iterations / best if best > 0 else float(iterations)
+    return BenchmarkResult(
+        benchmark.name,
+        ops_per_sec,
+        retained_objects_per_op=float(retained) / iterations
+    )
+
+
+def compare(results, baseline, threshold=DEFAULT_THRESHOLD):
+    """ Compare results to the baseline.
+
+    :param results a list of BenchmarkResult objects
+    :param baseline a dictionary of BenchmarkResult objects, keyed by name
+    :return a tuple of (table rows, names of regressed benchmarks)
+    """
+    rows = [['NAME', 'OPS/SEC', 'BASELINE', 'CHANGE']]
+    regressions = []
+    for r in results:
+        base = baseline.get(r.name)
+        if not base:
+            rows.append([r.name, '%.1f' % r.ops_per_sec, '-', '-'])
+            continue
+        change = (r.ops_per_sec - base.ops_per_sec) / base.ops_per_sec
+        rows.append([
+            r.name,
+            '%.1f' % r.ops_per_sec,
+            '%.1f' % base.ops_per_sec,
+            '%+.1f%%' % (change * 100)
+        ])
+        if change < -threshold:
+            regressions.append(r.name)
+    return rows, regressions
+
+
+def load_results(path):
+    with open(path) as f:
+        d = json.load(f)
+    return {
+        str(name): BenchmarkResult.from_dict(str(name), value)
+        for name, value in d.iteritems()
+    }
+
+
+def save_results(results, path):
+    d = {r.name: r.to_dict() for r in results}
+    with open(path, 'w') as f:
+        json.dump(d, f, indent=2, sort_keys=True, separators=(',', ': '))
+        f.write('\n')
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='Run brkt-cli microbenchmarks.')
+    parser.add_argument(
+        '--compare',
+        metavar='PATH',
+        help='Compare results against a baseline saved with --save'
+    )
+    parser.add_argument(
+        '--filter',
+        metavar='TEXT',
+        help='Only run benchmarks whose name contains TEXT'
+    )
+    parser.add_argument(
+        '--min-time',
+        metavar='SECONDS',
+        type=float,
+        default=0.2,
+        help='Minimum time for each repeat of a benchmark'
+    )
+    parser.add_argument(
+        '--repeat',
+        metavar='N',
+        type=int,
+        default=5,
+        help='Number of times to repeat each benchmark'
+    )
+    parser.add_argument(
+        '--save',
+        metavar='PATH',
+        help='Save the results as JSON'
+    )
+    parser.add_argument(
+        '--threshold',
+        metavar='FRACTION',
+        type=float,
+        default=DEFAULT_THRESHOLD,
+        help='Report a regression when ops/sec drops by more than this'
+    )
+    values = parser.parse_args(argv)
+
+    benchmarks = get_benchmarks()
+    if values.filter:
+        benchmarks = [b for b in benchmarks if values.filter in b.name]
+
+    results = []
+    for b in benchmarks:
+        result = run_benchmark(
+            b, min_time=values.min_time, repeat=values.repeat)
+        results.append(result)
+
+    if values.save:
+        save_results(results, values.save)
+
+    if values.compare:
+        rows, regressions = compare(
+            results, load_results(values.compare), values.threshold)
+        print(util.render_table_rows(rows))
+        if regressions:
+            print(
+                'Regressed by more than %d%%: %s' %
+                (values.threshold * 100, ', '.join(regressions)),
+                file=sys.stderr
+            )
+            return 1
+    else:
+        rows = [['NAME', 'OPS/SEC', 'RETAINED/OP']]
+        for r in results:
+            rows.append([
+                r.name,
+                '%.1f' % r.ops_per_sec,
+                '%.2f' % r.retained_objects_per_op
+            ])
+        print(util.render_table_rows(rows))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
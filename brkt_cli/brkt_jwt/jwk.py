@@ -20,11 +20,14 @@ log = logging.getLogger(__name__)
 
 
 def _long_to_byte_array(long_int):
-    bys = bytearray()
-    while long_int:
-        long_int, r = divmod(long_int, 256)
-        bys.insert(0, r)
-    return bys
+    # Convert through hex, since inserting each byte at the front of the
+    # array is quadratic in the key size.
+    if not long_int:
+        return bytearray()
+    hex_string = '%x' % long_int
+    if len(hex_string) % 2:
+        hex_string = '0' + hex_string
+    return bytearray.fromhex(hex_string)
 
 
 def _long_to_base64(n):
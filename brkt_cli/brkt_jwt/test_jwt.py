@@ -114,3 +114,8 @@ class TestJWK(unittest.TestCase):
         l = long('deadbeef', 16)
         ba = brkt_jwt.jwk._long_to_byte_array(l)
         self.assertEqual(bytearray.fromhex('deadbeef'), ba)
+
+    def test_long_to_byte_array_odd_length(self):
+        ba = brkt_jwt.jwk._long_to_byte_array(long('abcde', 16))
+        self.assertEqual(bytearray.fromhex('0abcde'), ba)
+        self.assertEqual(bytearray(), brkt_jwt.jwk._long_to_byte_array(0))
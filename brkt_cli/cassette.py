@@ -0,0 +1,345 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Record the calls that a workflow makes to the AWS or GCE service layer,
+and check them against a committed call budget.
+
+A cassette is a JSON file that contains the sequence of service calls
+that a workflow made when it was recorded, along with the budget that the
+workflow must stay within:
+
+    {
+        "budget": {
+            "max_calls": 70,
+            "max_calls_per_resource": 9,
+            "max_calls_by_method": {"get_instance": 20}
+        },
+        "calls": [
+            {"method": "get_image", "resources": ["r1"]},
+            ...
+        ]
+    }
+
+Resource ids are replaced with symbolic names (r1, r2, ...) in the order
+in which they first appear, so that a workflow run against the dummy
+services always produces the same cassette.
+"""
+
+import collections
+import difflib
+import inspect
+import json
+import logging
+import os
+
+from brkt_cli.util import BracketError
+
+log = logging.getLogger(__name__)
+
+CASSETTE_DIR = os.path.join(os.path.dirname(__file__), 'cassettes')
+
+# Set this environment variable to rewrite the cassettes, after making a
+# change that is expected to alter the number of API calls.
+RECORD_ENV_VAR = 'BRKT_RECORD_CASSETTES'
+
+# Methods that don't make an API call, and are not recorded.
+UNRECORDED_METHODS = frozenset([
+    'connect',
+    'get_session_id',
+    'retry'
+])
+
+# Names of arguments that identify the resource that a call operates on.
+# The "name" argument is only used when none of these are present, since
+# it's also used for the Name tag on AWS resources.
+RESOURCE_ARG_NAMES = frozenset([
+    'disk',
+    'diskName',
+    'disk_name',
+    'group_id',
+    'image',
+    'image_id',
+    'image_name',
+    'instance',
+    'instance_id',
+    'resource_id',
+    'sg_id',
+    'snapshot',
+    'snapshot_id',
+    'snapshot_ids',
+    'snapshot_name',
+    'vol_id',
+    'volume_id'
+])
+
+
+class CallBudgetExceededError(BracketError):
+    pass
+
+
+class RecordedCall(object):
+    def __init__(self, method, resources):
+        self.method = method
+        # A list of the ids of the resources that the call operated on.
+        self.resources = resources
+
+    def __repr__(self):
+        return '%s(%s)' % (self.method, ', '.join(self.resources))
+
+
+def _get_resource_ids(function, args, kwargs):
+    """ Return the ids of the resources that a call operates on, based
+    on the names of the function arguments.
+    """
+    try:
+        arg_names, varargs_name, _, _ = inspect.getargspec(function)
+    except TypeError:
+        return []
+    if arg_names and arg_names[0] == 'self':
+        arg_names = arg_names[1:]
+
+    named = dict(zip(arg_names, args))
+    named.update(kwargs)
+    resource_ids = [
+        named[n] for n in arg_names + sorted(kwargs.keys())
+        if n in RESOURCE_ARG_NAMES and n in named
+    ]
+    if varargs_name in RESOURCE_ARG_NAMES:
+        resource_ids.extend(args[len(arg_names):])
+    if not resource_ids and 'name' in named:
+        resource_ids.append(named['name'])
+
+    # Ignore non-string values, like the boto Image object.
+    result = []
+    for value in resource_ids:
+        if isinstance(value, (list, tuple)):
+            result.extend(v for v in value if isinstance(v, basestring))
+        elif isinstance(value, basestring) and value not in result:
+            result.append(value)
+    return result
+
+
+class CallRecorder(object):
+    """ Wraps a BaseAWSService or BaseGCEService and records every call
+    that the caller makes to the service.  Attribute reads and writes are
+    passed through to the wrapped service.
+
+    Calls that the service makes to itself are not recorded, since they
+    don't go through the recorder.
+    """
+
+    def __init__(self, svc):
+        object.__setattr__(self, '_svc', svc)
+        object.__setattr__(self, 'calls', [])
+        object.__setattr__(self, '_symbolic_ids', {})
+
+    def __getattr__(self, name):
+        value = getattr(self._svc, name)
+        if (name.startswith('_') or name in UNRECORDED_METHODS or
+                not callable(value)):
+            return value
+
+        def _recorded(*args, **kwargs):
+            self._record(name, value, args, kwargs)
+            return value(*args, **kwargs)
+
+        # util.retry() logs the function name.
+        _recorded.__name__ = name
+        return _recorded
+
+    def __setattr__(self, name, value):
+        setattr(self._svc, name, value)
+
+    def _symbolic_id(self, resource_id):
+        if resource_id not in self._symbolic_ids:
+            self._symbolic_ids[resource_id] = \
+                'r%d' % (len(self._symbolic_ids) + 1)
+        return self._symbolic_ids[resource_id]
+
+    def _record(self, method, function, args, kwargs):
+        resource_ids = _get_resource_ids(function, args, kwargs)
+        call = RecordedCall(
+            method, [self._symbolic_id(r) for r in resource_ids])
+        log.debug('Recorded %s', call)
+        self.calls.append(call)
+
+
+class CallBudget(object):
+    def __init__(self, max_calls=None, max_calls_per_resource=None,
+                 max_calls_by_method=None):
+        self.max_calls = max_calls
+        self.max_calls_per_resource = max_calls_per_resource
+        self.max_calls_by_method = max_calls_by_method or {}
+
+    def to_dict(self):
+        return {
+            'max_calls': self.max_calls,
+            'max_calls_per_resource': self.max_calls_per_resource,
+            'max_calls_by_method': self.max_calls_by_method
+        }
+
+    @classmethod
+    def from_dict(cls, d):
+        return CallBudget(
+            max_calls=d.get('max_calls'),
+            max_calls_per_resource=d.get('max_calls_per_resource'),
+            max_calls_by_method=d.get('max_calls_by_method')
+        )
+
+    @classmethod
+    def from_calls(cls, calls):
+        """ Return a budget that allows exactly the given calls. """
+        return CallBudget(
+            max_calls=len(calls),
+            max_calls_per_resource=max_calls_per_resource(calls),
+            max_calls_by_method=dict(count_by_method(calls))
+        )
+
+
+def count_by_method(calls):
+    return collections.Counter(c.method for c in calls)
+
+
+def count_by_resource(calls):
+    counter = collections.Counter()
+    for c in calls:
+        for r in c.resources:
+            counter[r] += 1
+    return counter
+
+
+def max_calls_per_resource(calls):
+    counts = count_by_resource(calls)
+    if not counts:
+        return 0
+    return max(counts.values())
+
+
+def check_budget(calls, budget):
+    """ Verify that the given calls are within the budget.
+
+    :raise CallBudgetExceededError if the budget was exceeded
+    """
+    errors = []
+    if budget.max_calls is not None and len(calls) > budget.max_calls:
+        errors.append(
+            '%d calls exceeds the budget of %d' %
+            (len(calls), budget.max_calls)
+        )
+
+    if budget.max_calls_per_resource is not None:
+        for resource, n in sorted(count_by_resource(calls).iteritems()):
+            if n > budget.max_calls_per_resource:
+                errors.append(
+                    '%d calls for resource %s exceeds the budget of %d' %
+                    (n, resource, budget.max_calls_per_resource)
+                )
+
+    by_method = count_by_method(calls)
+    for method, limit in sorted(budget.max_calls_by_method.iteritems()):
+        if by_method[method] > limit:
+            errors.append(
+                '%d calls to %s exceeds the budget of %d' %
+                (by_method[method], method, limit)
+            )
+
+    if errors:
+        raise CallBudgetExceededError('; '.join(errors))
+
+
+class Cassette(object):
+    def __init__(self, calls=None, budget=None):
+        self.calls = calls or []
+        self.budget = budget or CallBudget.from_calls(self.calls)
+
+    def to_dict(self):
+        return {
+            'budget': self.budget.to_dict(),
+            'calls': [
+                {'method': c.method, 'resources': c.resources}
+                for c in self.calls
+            ]
+        }
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(
+                self.to_dict(), f, indent=2, sort_keys=True,
+                separators=(',', ': ')
+            )
+            f.write('\n')
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            d = json.load(f)
+        calls = [
+            RecordedCall(str(c['method']), [str(r) for r in c['resources']])
+            for c in d.get('calls', [])
+        ]
+        return Cassette(calls, CallBudget.from_dict(d.get('budget', {})))
+
+    def diff(self, calls):
+        """ Compare the given calls to the calls in this cassette.
+
+        :return a unified diff as a string, or an empty string if the
+        calls match
+        """
+        lines = difflib.unified_diff(
+            [repr(c) for c in self.calls],
+            [repr(c) for c in calls],
+            fromfile='cassette',
+            tofile='replay',
+            lineterm=''
+        )
+        return '\n'.join(lines)
+
+    def replay(self, calls):
+        """ Check calls made by replaying the workflow against this
+        cassette's budget.  The diff against the recorded calls is included
+        in the error message, to show where the extra calls came from.
+
+        :raise CallBudgetExceededError if the budget was exceeded
+        """
+        try:
+            check_budget(calls, self.budget)
+        except CallBudgetExceededError as e:
+            diff = self.diff(calls)
+            if diff:
+                raise CallBudgetExceededError(
+                    '%s\n%s' % (e.message, diff))
+            raise
+
+
+def check_cassette(name, calls):
+    """ Replay the calls against the named cassette in CASSETTE_DIR.  If
+    the BRKT_RECORD_CASSETTES environment variable is set, record the
+    calls to the cassette instead.
+
+    :raise CallBudgetExceededError if the budget was exceeded
+    """
+    path = os.path.join(CASSETTE_DIR, name + '.json')
+    if os.environ.get(RECORD_ENV_VAR):
+        log.info('Recording %d calls to %s', len(calls), path)
+        Cassette(calls).save(path)
+        return
+    try:
+        Cassette.load(path).replay(calls)
+    except CallBudgetExceededError as e:
+        raise CallBudgetExceededError(
+            'API call budget exceeded for %s.  If this is expected, run '
+            'with %s=1 to update the cassette.\n%s' %
+            (name, RECORD_ENV_VAR, e.message)
+        )
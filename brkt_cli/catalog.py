@@ -0,0 +1,261 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A local catalog of the images that brkt encrypted or updated, stored in
+SQLite under ~/.brkt.
+
+encrypt-ami, update-encrypted-ami, encrypt-gce-image and update-gce-image
+add the image that they create, along with the image it was based on, the
+encryptor image, the session id, the snapshots, the root volume size and
+the number of seconds that each phase took.  "brkt catalog refresh"
+rescans the images in an AWS region by their Bracket tags.  "brkt catalog
+query" answers questions like "which images were encrypted with
+encryptor X from source Y" without calling the cloud.
+
+The catalog is only a record: errors writing it are logged and otherwise
+ignored, so that they never fail a session.
+"""
+
+import collections
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+
+from brkt_cli.config import CONFIG_DIR
+
+log = logging.getLogger(__name__)
+
+CATALOG_PATH = os.path.join(CONFIG_DIR, 'catalog.db')
+
+CLOUD_AWS = 'aws'
+CLOUD_GCE = 'gce'
+
+OPERATION_ENCRYPT = 'encrypt'
+OPERATION_UPDATE = 'update'
+OPERATION_COPY = 'copy'
+
+# location is the AWS region or the GCE project.  snapshot_ids is a list
+# and phase_durations is a dictionary of phase name to seconds.
+ImageRecord = collections.namedtuple('ImageRecord', [
+    'image_id',
+    'cloud',
+    'location',
+    'name',
+    'operation',
+    'source_image',
+    'encryptor_image',
+    'session_id',
+    'created_time',
+    'volume_size_gb',
+    'snapshot_ids',
+    'phase_durations'
+])
+
+# Fields that are stored as JSON.
+_JSON_FIELDS = ('snapshot_ids', 'phase_durations')
+
+# Fields that can be passed to Catalog.query().
+QUERY_FIELDS = (
+    'cloud', 'location', 'source_image', 'encryptor_image', 'session_id'
+)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS images (
+    image_id TEXT PRIMARY KEY,
+    cloud TEXT NOT NULL,
+    location TEXT,
+    name TEXT,
+    operation TEXT,
+    source_image TEXT,
+    encryptor_image TEXT,
+    session_id TEXT,
+    created_time REAL,
+    volume_size_gb INTEGER,
+    snapshot_ids TEXT,
+    phase_durations TEXT,
+    recorded_time REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS images_location ON images (cloud, location);
+CREATE INDEX IF NOT EXISTS images_source_image ON images (source_image);
+CREATE INDEX IF NOT EXISTS images_encryptor_image ON images (encryptor_image);
+CREATE INDEX IF NOT EXISTS images_session_id ON images (session_id);
+"""
+
+_COLUMNS = ', '.join(ImageRecord._fields)
+
+
+def make_record(image_id, cloud, **kwargs):
+    """ Return an ImageRecord.  Fields that aren't specified are None. """
+    values = dict.fromkeys(ImageRecord._fields)
+    values.update(kwargs)
+    values['image_id'] = image_id
+    values['cloud'] = cloud
+    return ImageRecord(**values)
+
+
+def _row_to_record(row):
+    values = list(row)
+    for field in _JSON_FIELDS:
+        i = ImageRecord._fields.index(field)
+        if values[i] is not None:
+            values[i] = json.loads(values[i])
+    return ImageRecord(*values)
+
+
+class Catalog(object):
+    """ Stores ImageRecords in a SQLite database.  Safe to use from
+    multiple threads.
+    """
+
+    def __init__(self, path=CATALOG_PATH):
+        """
+        :param path the path to the database file, or ':memory:'
+        """
+        self.path = path
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._db.executescript(_SCHEMA)
+            self._db.commit()
+
+    def _query(self, sql, *args):
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    def add(self, record, replace=True):
+        """ Add the record to the catalog.  If the image is already in the
+        catalog, fields that are None in the new record keep their
+        current values.
+
+        :param replace if False, only fill in the fields of an existing
+            record that are None
+        """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT %s FROM images WHERE image_id = ?' % _COLUMNS,
+                (record.image_id,)
+            ).fetchall()
+            if rows:
+                old, new = _row_to_record(rows[0]), record
+                if not replace:
+                    old, new = new, old
+                record = old._replace(**{
+                    k: v for k, v in new._asdict().iteritems()
+                    if v is not None
+                })
+            values = [
+                json.dumps(v) if f in _JSON_FIELDS and v is not None else v
+                for f, v in zip(ImageRecord._fields, record)
+            ]
+            self._db.execute(
+                'INSERT OR REPLACE INTO images (%s, recorded_time) '
+                'VALUES (%s)' % (
+                    _COLUMNS, ', '.join('?' * (len(values) + 1))),
+                values + [time.time()]
+            )
+            self._db.commit()
+        log.debug('Added %s to the catalog', record.image_id)
+
+    def get(self, image_id):
+        """ Return the ImageRecord with the given id, or None. """
+        rows = self._query(
+            'SELECT %s FROM images WHERE image_id = ?' % _COLUMNS, image_id)
+        if not rows:
+            return None
+        return _row_to_record(rows[0])
+
+    def delete(self, image_id):
+        with self._lock:
+            self._db.execute(
+                'DELETE FROM images WHERE image_id = ?', (image_id,))
+            self._db.commit()
+
+    def query(self, **kwargs):
+        """ Return the records whose fields equal the given values, newest
+        first.  The keyword arguments are the names in QUERY_FIELDS.
+        Arguments that are None are ignored.
+        """
+        conditions = []
+        args = []
+        for field, value in sorted(kwargs.iteritems()):
+            if field not in QUERY_FIELDS:
+                raise ValueError('Unable to query by %s' % field)
+            if value is not None:
+                conditions.append('%s = ?' % field)
+                args.append(value)
+        sql = 'SELECT %s FROM images' % _COLUMNS
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY created_time DESC, image_id'
+        return [_row_to_record(row) for row in self._query(sql, *args)]
+
+    def get_lineage(self, image_id):
+        """ Return the records for the image and the images that it was
+        based on, starting with the given image.  The lineage ends at the
+        first image that isn't in the catalog.
+        """
+        lineage = []
+        seen = set()
+        while image_id and image_id not in seen:
+            seen.add(image_id)
+            record = self.get(image_id)
+            if not record:
+                break
+            lineage.append(record)
+            image_id = record.source_image
+        return lineage
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+def record_image(record, path=CATALOG_PATH):
+    """ Add the record to the catalog at the given path.  Errors are
+    logged and ignored.
+    """
+    try:
+        catalog = Catalog(path)
+        try:
+            catalog.add(record)
+        finally:
+            catalog.close()
+    except (sqlite3.Error, OSError) as e:
+        log.warn('Unable to add %s to %s: %s', record.image_id, path, e)
+
+
+def format_records(records):
+    """ Return the rows of a table that shows the records. """
+    rows = [[
+        'IMAGE', 'CLOUD', 'LOCATION', 'OPERATION', 'SOURCE', 'ENCRYPTOR',
+        'SESSION', 'CREATED'
+    ]]
+    for r in records:
+        created = '-'
+        if r.created_time:
+            created = time.strftime(
+                '%Y-%m-%d %H:%M', time.gmtime(r.created_time))
+        rows.append([
+            r.image_id, r.cloud, r.location or '-', r.operation or '-',
+            r.source_image or '-', r.encryptor_image or '-',
+            r.session_id or '-', created
+        ])
+    return rows
@@ -0,0 +1,373 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Detached sessions, which keep running after the brkt command that started
+them exits.
+
+"brkt encrypt-ami --detach" validates its arguments, records the session
+in a JobQueue under ~/.brkt/sessions, starts a background brkt process
+that runs the session, and prints the session id.  The session id is the
+one in the BrktEncryptorSessionID tag of the resources that the session
+creates.  The background process records progress and the result in the
+queue.  "brkt status" reports a session, and "brkt wait" blocks until it
+completes.
+
+The background process holds a lock on <session id>.lock while it runs.
+If status finds a running session whose lock is free, the process died,
+and the session is marked as failed.
+"""
+
+from __future__ import print_function
+
+import argparse
+import errno
+import fcntl
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+
+import brkt_cli
+from brkt_cli import job_queue, util
+from brkt_cli.config import CONFIG_DIR
+from brkt_cli.job_queue import JobQueue
+from brkt_cli.subcommand import Subcommand
+from brkt_cli.validation import ValidationError
+
+log = logging.getLogger(__name__)
+
+SESSIONS_DIR = os.path.join(CONFIG_DIR, 'sessions')
+DATABASE_NAME = 'sessions.db'
+
+# A queued session that the background process hasn't claimed after
+# this many seconds is marked as failed.
+START_TIMEOUT = 120
+
+FINISHED_STATES = (job_queue.JOB_SUCCEEDED, job_queue.JOB_FAILED)
+
+
+def start_detached(brkt_args, log_path):
+    """ Run brkt with the given arguments in a new session, so that it
+    keeps running after this process exits.  Output is appended to the
+    log file.
+
+    :return the process id
+    """
+    with open(os.devnull) as devnull, open(log_path, 'a') as log_file:
+        process = subprocess.Popen(
+            [
+                sys.executable, '-c',
+                'import sys, brkt_cli; sys.exit(brkt_cli.main())',
+                '--no-check-version'
+            ] + list(brkt_args),
+            stdin=devnull,
+            stdout=log_file,
+            stderr=subprocess.STDOUT,
+            close_fds=True,
+            preexec_fn=os.setsid
+        )
+    return process.pid
+
+
+def lock_file(path, create=False):
+    """ Take an exclusive lock on the file, without blocking.
+
+    :param create if True, create the file if it doesn't exist
+    :return the file object that holds the lock, or None if another
+        process holds it
+    """
+    f = open(path, 'a' if create else 'r')
+    try:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError as e:
+        f.close()
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            return None
+        raise
+    return f
+
+
+def _is_locked(path):
+    try:
+        lock = lock_file(path)
+    except IOError as e:
+        if e.errno == errno.ENOENT:
+            return False
+        raise
+    if not lock:
+        return True
+    lock.close()
+    return False
+
+
+class SessionStore(object):
+    """ Stores detached sessions in a JobQueue, with a lock file and log
+    file for each session.  The session arguments may include secrets,
+    such as the API token, so the directory and database are only
+    accessible by the owner.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory or SESSIONS_DIR
+        path = os.path.join(self.directory, DATABASE_NAME)
+        try:
+            try:
+                os.makedirs(self.directory, 0o700)
+            except OSError as e:
+                if e.errno != errno.EEXIST:
+                    raise
+            os.chmod(self.directory, 0o700)
+            os.close(os.open(path, os.O_WRONLY | os.O_CREAT, 0o600))
+            os.chmod(path, 0o600)
+        except OSError as e:
+            raise ValidationError(
+                'Unable to create %s: %s' % (self.directory, e))
+        self.queue = JobQueue(path)
+
+    def get_lock_path(self, session_id):
+        return os.path.join(self.directory, session_id + '.lock')
+
+    def get_log_path(self, session_id):
+        return os.path.join(self.directory, session_id + '.log')
+
+    def start(self, session_id, job_type, brkt_args, region=None):
+        """ Record the session and start a background brkt process that
+        runs it.
+
+        :param brkt_args the arguments of the brkt command that runs the
+            session
+        :return the Job that represents the session
+        """
+        job = self.queue.submit(
+            job_type, {'args': list(brkt_args)}, region=region,
+            job_id=session_id)
+        pid = start_detached(brkt_args, self.get_log_path(session_id))
+        log.info(
+            'Started session %s in process %d.  Writing log to %s',
+            session_id, pid, self.get_log_path(session_id))
+        return job
+
+    def run(self, session, function):
+        """ Run function() in the background process for a detached
+        session, with the session active, and record progress and the
+        result in the queue.
+
+        :return the result of function()
+        :raise ValidationError if the session is unknown or another process
+            is already running it
+        """
+        session_id = session.session_id
+        lock = lock_file(self.get_lock_path(session_id), create=True)
+        if not lock:
+            raise ValidationError(
+                'Session %s is already running' % session_id)
+        try:
+            if not self.queue.start(session_id):
+                raise ValidationError(
+                    'Session %s is not waiting to run' % session_id)
+            session.add_progress_callback(
+                lambda state, percent: self.queue.set_progress(
+                    session_id, state, percent)
+            )
+            try:
+                with session.activate():
+                    result = function()
+            except BaseException as e:
+                self.queue.finish(
+                    session_id, error=str(e) or e.__class__.__name__)
+                raise
+            self.queue.finish(session_id, result=result)
+            return result
+        finally:
+            lock.close()
+
+    def get(self, session_id):
+        """ Return the Job for the session.  If the background process
+        stopped without recording a result, mark the session as failed.
+
+        :raise ValidationError if the session is unknown
+        """
+        job = self.queue.get(session_id)
+        if not job:
+            raise ValidationError('Unknown session %s' % session_id)
+        if job.state in FINISHED_STATES or \
+                _is_locked(self.get_lock_path(session_id)):
+            return job
+
+        error = None
+        if job.state == job_queue.JOB_RUNNING:
+            # Check the state again, in case the session finished after
+            # we read it.
+            job = self.queue.get(session_id)
+            if job.state == job_queue.JOB_RUNNING:
+                error = 'The session process exited before it completed'
+        elif time.time() - job.submitted_time > START_TIMEOUT:
+            error = 'The session process did not start'
+        if error:
+            log.debug('Session %s failed: %s', session_id, error)
+            self.queue.finish(session_id, error=error)
+            job = self.queue.get(session_id)
+        return job
+
+    def wait(self, session_id, timeout=None, poll_interval=10):
+        """ Wait for the session to complete.
+
+        :return the Job for the session
+        :raise BracketError if the timeout expires
+        """
+        deadline = util.Deadline(timeout) if timeout else None
+        last_progress = None
+        while True:
+            job = self.get(session_id)
+            if job.state in FINISHED_STATES:
+                return job
+            progress = (job.progress_state, job.percent_complete)
+            if job.percent_complete is not None and progress != last_progress:
+                log.info(
+                    'Session %s is %s, %d%% complete',
+                    session_id, job.progress_state, job.percent_complete)
+                last_progress = progress
+            if deadline and deadline.is_expired():
+                raise util.BracketError(
+                    'Timed out waiting for session %s after %d seconds' %
+                    (session_id, timeout)
+                )
+            util.sleep(poll_interval)
+
+    def close(self):
+        self.queue.close()
+
+
+def get_session_dict(store, job):
+    """ Return the Job as a dictionary that can be written as JSON. """
+    d = job._asdict()
+    d['log_path'] = store.get_log_path(job.id)
+    return d
+
+
+def setup_detach_args(parser):
+    parser.add_argument(
+        '--detach',
+        action='store_true',
+        help=(
+            'Validate the arguments, start the session in a background '
+            'process and print the session id.  Use brkt status and brkt '
+            'wait to follow the session.'
+        )
+    )
+    # Set by the background process that runs a detached session.
+    parser.add_argument(
+        '--session-id',
+        dest='session_id',
+        help=argparse.SUPPRESS
+    )
+
+
+def get_detached_args(argv, session_id):
+    """ Return the arguments for the background process that runs a
+    detached session, given the arguments of the brkt command that started
+    it.  Arguments were already validated by that command.
+    """
+    args = [a for a in argv if a != '--detach']
+    return args + ['--no-validate', '--session-id', session_id]
+
+
+class StatusSubcommand(Subcommand):
+
+    def name(self):
+        return 'status'
+
+    def verbose(self, values):
+        return values.status_verbose
+
+    def register(self, subparsers, parsed_config):
+        parser = subparsers.add_parser(
+            self.name(),
+            description=(
+                'Print the state of a session that was started with '
+                '--detach, as JSON.'
+            ),
+            formatter_class=brkt_cli.SortingHelpFormatter
+        )
+        parser.add_argument('session_id', metavar='SESSION-ID')
+        parser.add_argument(
+            '-v',
+            '--verbose',
+            dest='status_verbose',
+            action='store_true',
+            help='Print status information to the console'
+        )
+
+    def run(self, values):
+        store = SessionStore()
+        try:
+            job = store.get(values.session_id)
+            print(json.dumps(
+                get_session_dict(store, job), indent=2, sort_keys=True))
+        finally:
+            store.close()
+        return 0
+
+
+class WaitSubcommand(Subcommand):
+
+    def name(self):
+        return 'wait'
+
+    def verbose(self, values):
+        return values.wait_verbose
+
+    def register(self, subparsers, parsed_config):
+        parser = subparsers.add_parser(
+            self.name(),
+            description=(
+                'Wait for a session that was started with --detach to '
+                'complete, and print its result.'
+            ),
+            formatter_class=brkt_cli.SortingHelpFormatter
+        )
+        parser.add_argument('session_id', metavar='SESSION-ID')
+        parser.add_argument(
+            '--timeout',
+            metavar='SECONDS',
+            type=int,
+            help='Stop waiting after this many seconds'
+        )
+        parser.add_argument(
+            '-v',
+            '--verbose',
+            dest='wait_verbose',
+            action='store_true',
+            help='Print status information to the console'
+        )
+
+    def run(self, values):
+        store = SessionStore()
+        try:
+            job = store.wait(values.session_id, timeout=values.timeout)
+        finally:
+            store.close()
+        if job.state != job_queue.JOB_SUCCEEDED:
+            log.error('Session %s failed: %s', job.id, job.error)
+            log.error('See %s', store.get_log_path(job.id))
+            return 1
+        print(job.result)
+        return 0
+
+
+def get_subcommands():
+    return [StatusSubcommand(), WaitSubcommand()]
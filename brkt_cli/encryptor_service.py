@@ -15,14 +15,22 @@
 import abc
 import json
 import logging
+import sys
 import time
 import urllib2
 
 from brkt_cli import validation
+from brkt_cli.engine import Call, Return, Sleep, Spawn, Wait, run_sync
+from brkt_cli.session import get_current_session
+from brkt_cli.timeouts import (
+    DEFAULT_TIMEOUTS,
+    ENCRYPTION,
+    ENCRYPTION_PROGRESS,
+    ENCRYPTOR_UP
+)
 from brkt_cli.util import (
         BracketError,
-        Deadline,
-        sleep
+        Deadline
 )
 
 ENCRYPT_INITIALIZING = 'initial'
@@ -33,9 +41,21 @@ ENCRYPT_SUCCESSFUL = 'finished'
 ENCRYPT_FAILED = 'failed'
 ENCRYPT_ENCRYPTING = 'encrypting'
 ENCRYPTOR_STATUS_PORT = 80
+# How often a session that is waiting for encryption checks the status.
+STATUS_POLL_INTERVAL = 10
 FAILURE_CODE_UNSUPPORTED_GUEST = 'unsupported_guest'
 FAILURE_CODE_AWS_PERMISSIONS = 'insufficient_aws_permissions'
 FAILURE_CODE_INVALID_NTP_SERVERS = 'invalid_ntp_servers'
+# How often the encryptor instance is checked while waiting for encryption.
+INSTANCE_CHECK_INTERVAL = 15
+CONSOLE_CHECK_INTERVAL = 60
+# Console output that means that the encryptor instance has crashed.
+FATAL_CONSOLE_MARKERS = [
+    'Kernel panic',
+    'kernel BUG at',
+    'Out of memory: Kill process',
+    'Unable to mount root fs'
+]
 
 log = logging.getLogger(__name__)
 
@@ -46,6 +66,18 @@ class EncryptionError(BracketError):
         self.console_output_file = None
 
 
+class EncryptorInstanceError(EncryptionError):
+    """ The encryptor instance stopped, terminated or crashed. """
+
+    def __init__(self, message, state=None):
+        """
+        :param state the instance state, if the instance is no longer
+            running
+        """
+        super(EncryptorInstanceError, self).__init__(message)
+        self.state = state
+
+
 class UnsupportedGuestError(BracketError):
     pass
 
@@ -61,9 +93,22 @@ class InvalidNtpServerError(BracketError):
 class BaseEncryptorService(object):
     __metaclass__ = abc.ABCMeta
 
-    def __init__(self, hostnames, port=ENCRYPTOR_STATUS_PORT):
+    # A brkt_cli.status_poller.StatusPoller that gets the status of many
+    # encryptors on one thread, or None.  Set by StatusPoller.bind().
+    status_poller = None
+
+    def __init__(self, hostnames, port=ENCRYPTOR_STATUS_PORT,
+                 no_proxy_hosts=None):
+        """
+        :param hostnames the hostnames or IP addresses of the encryptor
+        :param port the encryptor status port
+        :param no_proxy_hosts hostnames that are contacted directly,
+            instead of through the proxy that is configured in the
+            environment
+        """
         self.hostnames = hostnames
         self.port = port
+        self.no_proxy_hosts = no_proxy_hosts or []
 
     @abc.abstractmethod
     def is_encryptor_up(self):
@@ -73,6 +118,23 @@ class BaseEncryptorService(object):
     def get_status(self):
         pass
 
+    def is_encryptor_up_co(self):
+        """ Coroutine version of is_encryptor_up(). """
+        is_up = yield Call(self.is_encryptor_up)
+        raise Return(is_up)
+
+    def get_status_co(self, previous=None):
+        """ Coroutine that returns the encryptor status.  If previous is
+        specified, first wait for the status to change, for up to
+        STATUS_POLL_INTERVAL seconds.  This implementation waits for the
+        whole interval and then calls get_status().  Subclasses can return
+        as soon as the status changes.
+        """
+        if previous is not None:
+            yield Sleep(STATUS_POLL_INTERVAL)
+        status = yield Call(self.get_status)
+        raise Return(status)
+
 
 class EncryptorConnectionError(Exception):
 
@@ -89,8 +151,34 @@ class EncryptorConnectionError(Exception):
         super(EncryptorConnectionError, self).__init__(msg)
 
 
+def parse_status(data):
+    """ Parse the JSON returned by the encryptor status port, and add the
+    percent_complete field.
+
+    :raise ValueError if the data can't be parsed
+    """
+    info = json.loads(data)
+    info['percent_complete'] = 0
+    bytes_total = info.get('bytes_total')
+    if info['state'] == ENCRYPT_SUCCESSFUL:
+        info['percent_complete'] = 100
+    elif ((bytes_total is not None) and
+          (bytes_total > 0)):
+        ratio = float(info['bytes_written']) / info['bytes_total']
+        info['percent_complete'] = int(100 * ratio)
+    return info
+
+
 class EncryptorService(BaseEncryptorService):
 
+    # Opens URLs without using a proxy.
+    _direct_opener = urllib2.build_opener(urllib2.ProxyHandler({}))
+
+    def _urlopen(self, hostname, url, timeout_secs):
+        if hostname in self.no_proxy_hosts:
+            return self._direct_opener.open(url, timeout=timeout_secs)
+        return urllib2.urlopen(url, timeout=timeout_secs)
+
     def is_encryptor_up(self):
         try:
             self.get_status()
@@ -108,7 +196,7 @@ class EncryptorService(BaseEncryptorService):
         for hostname in self.hostnames:
             url = 'http://%s:%d' % (hostname, self.port)
             try:
-                r = urllib2.urlopen(url, timeout=timeout_secs)
+                r = self._urlopen(hostname, url, timeout_secs)
                 data = r.read()
             except IOError as e:
                 log.debug(
@@ -117,15 +205,7 @@ class EncryptorService(BaseEncryptorService):
                 exceptions_by_host[hostname] = e
                 continue
 
-            info = json.loads(data)
-            info['percent_complete'] = 0
-            bytes_total = info.get('bytes_total')
-            if info['state'] == ENCRYPT_SUCCESSFUL:
-                info['percent_complete'] = 100
-            elif ((bytes_total is not None) and
-                  (bytes_total > 0)):
-                ratio = float(info['bytes_written']) / info['bytes_total']
-                info['percent_complete'] = int(100 * ratio)
+            info = parse_status(data)
             successful_hostname = hostname
             break
 
@@ -137,17 +217,176 @@ class EncryptorService(BaseEncryptorService):
         else:
             raise EncryptorConnectionError(self.port, exceptions_by_host)
 
+    def is_encryptor_up_co(self):
+        if not self.status_poller:
+            is_up = yield super(EncryptorService, self).is_encryptor_up_co()
+            raise Return(is_up)
+        try:
+            yield self.get_status_co()
+        except Exception as e:
+            log.debug("Couldn't get encryptor status: %s", e)
+            raise Return(False)
+        log.debug("Successfully got encryptor status")
+        raise Return(True)
+
+    def get_status_co(self, previous=None):
+        """ When a status poller is set, the status comes from the poller's
+        connection to the encryptor, and a change in status is reported as
+        soon as the poller sees it.
+        """
+        if not self.status_poller:
+            status = yield super(EncryptorService, self).get_status_co(
+                previous=previous)
+            raise Return(status)
+        future = self.status_poller.request_status(
+            self, previous=previous, max_wait=STATUS_POLL_INTERVAL)
+        yield Wait(future)
+        hostname, status = future.result()
+        self.hostnames = [hostname]
+        raise Return(status)
+
+
+def find_fatal_console_output(console_output):
+    """ Return the first line of console output that contains one of
+    FATAL_CONSOLE_MARKERS, or None.
+    """
+    for line in (console_output or '').splitlines():
+        for marker in FATAL_CONSOLE_MARKERS:
+            if marker in line:
+                return line.strip()
+    return None
+
+
+class InstanceWatcher(object):
+    """ Checks that the encryptor instance is still alive while a session
+    waits for its status port, so that a crashed encryptor is detected
+    within seconds instead of when the wait times out.
+    """
+
+    def __init__(self, instance_name, check_state,
+                 get_console_output=None, interval=None,
+                 console_interval=None):
+        """
+        :param instance_name the instance name or id, for error messages
+        :param check_state a function that raises EncryptorInstanceError
+            if the instance has stopped, terminated or failed its status
+            checks
+        :param get_console_output a function that returns the instance's
+            console output, which is scanned for FATAL_CONSOLE_MARKERS, or
+            None to not scan the console
+        :param interval seconds between checks, INSTANCE_CHECK_INTERVAL
+            by default
+        :param console_interval seconds between console scans,
+            CONSOLE_CHECK_INTERVAL by default
+        """
+        if interval is None:
+            interval = INSTANCE_CHECK_INTERVAL
+        if console_interval is None:
+            console_interval = CONSOLE_CHECK_INTERVAL
+        self.instance_name = instance_name
+        self.check_state = check_state
+        self.get_console_output = get_console_output
+        self.interval = interval
+        self.console_interval = console_interval
+        # The instance was just launched, so it doesn't need to be checked
+        # right away.
+        now = time.time()
+        self._next_check = now + interval
+        self._next_console_check = now + console_interval
+        self._exc_info = None
+        self._checking = False
+
+    def is_due(self):
+        return not self._checking and time.time() >= self._next_check
+
+    def raise_if_dead(self):
+        """ Raise the error from a check that found the instance dead. """
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+
+    def check_co(self):
+        """ Check the instance.  Errors other than EncryptorInstanceError,
+        for example API throttling, are logged and ignored.
+
+        :raise EncryptorInstanceError if the instance has died
+        """
+        self._checking = True
+        try:
+            yield Call(self.check_state)
+            if self.get_console_output and \
+                    time.time() >= self._next_console_check:
+                self._next_console_check = time.time() + self.console_interval
+                output = yield Call(self.get_console_output)
+                line = find_fatal_console_output(output)
+                if line:
+                    raise EncryptorInstanceError(
+                        'Encryptor instance %s crashed: %s' %
+                        (self.instance_name, line)
+                    )
+        except EncryptorInstanceError:
+            self._exc_info = sys.exc_info()
+            raise
+        except Exception as e:
+            log.debug(
+                'Unable to check instance %s: %s', self.instance_name, e)
+        finally:
+            self._checking = False
+            self._next_check = time.time() + self.interval
+
+    def watch_co(self, coroutine):
+        """ Run the coroutine.  If the instance is due to be checked, check
+        it at the same time, and raise as soon as the check fails.  A check
+        that completes after the coroutine is reported by the next call.
+
+        :return the coroutine's return value
+        :raise EncryptorInstanceError if the instance has died
+        """
+        self.raise_if_dead()
+        if not self.is_due():
+            result = yield coroutine
+            raise Return(result)
+
+        check = yield Spawn(self.check_co())
+        probe = yield Spawn(coroutine)
+        done = yield Wait(check, probe)
+        if done is check:
+            self.raise_if_dead()
+            yield Wait(probe)
+        raise Return(probe.result())
+
+
+def _watch_co(watcher, coroutine):
+    if watcher:
+        return watcher.watch_co(coroutine)
+    return coroutine
+
+
+def _sleep_co(seconds):
+    yield Sleep(seconds)
+
+
+def wait_for_encryptor_up(enc_svc, deadline, watcher=None):
+    run_sync(wait_for_encryptor_up_co(enc_svc, deadline, watcher=watcher))
 
-def wait_for_encryptor_up(enc_svc, deadline):
+
+def wait_for_encryptor_up_co(enc_svc, deadline, watcher=None):
+    """ Coroutine version of wait_for_encryptor_up().
+
+    :param watcher an InstanceWatcher that checks the encryptor instance
+        while waiting
+    :raise EncryptorInstanceError if the watcher finds that the encryptor
+        instance has died
+    """
     start = time.time()
     while not deadline.is_expired():
-        if enc_svc.is_encryptor_up():
+        is_up = yield _watch_co(watcher, enc_svc.is_encryptor_up_co())
+        if is_up:
             log.debug(
                 'Encryption service is up after %.1f seconds',
                 time.time() - start
             )
             return
-        sleep(5)
+        yield _watch_co(watcher, _sleep_co(5))
     raise BracketError(
         'Unable to contact encryptor instance at %s.' %
         ', '.join(enc_svc.hostnames)
@@ -155,29 +394,56 @@ def wait_for_encryptor_up(enc_svc, deadline):
 
 
 def wait_for_encryption(enc_svc,
-                        progress_timeout=ENCRYPTION_PROGRESS_TIMEOUT):
+                        progress_timeout=ENCRYPTION_PROGRESS_TIMEOUT,
+                        watcher=None):
+    return run_sync(wait_for_encryption_co(
+        enc_svc, progress_timeout, watcher=watcher))
+
+
+def wait_for_encryption_co(enc_svc,
+                           progress_timeout=ENCRYPTION_PROGRESS_TIMEOUT,
+                           watcher=None):
+    """ Coroutine version of wait_for_encryption().
+
+    :param watcher an InstanceWatcher that checks the encryptor instance
+        while waiting
+    :return the longest time in seconds that progress stalled
+    :raise EncryptorInstanceError if the watcher finds that the encryptor
+        instance has died
+    """
     err_count = 0
     max_errs = 10
     start_time = time.time()
     last_log_time = start_time
     progress_deadline = Deadline(progress_timeout)
     last_progress = 0
+    last_progress_time = start_time
+    longest_stall = 0
     last_state = ''
+    status = None
 
     while err_count < max_errs:
         try:
-            status = enc_svc.get_status()
+            # Returns when the status changes, or after the poll interval.
+            status = yield _watch_co(
+                watcher, enc_svc.get_status_co(previous=status))
             err_count = 0
+        except EncryptorInstanceError:
+            raise
         except Exception as e:
             log.warn("Failed getting encryption status: %s", e)
             log.warn("Retrying. . .")
             err_count += 1
-            sleep(10)
+            status = None
+            yield _watch_co(watcher, _sleep_co(10))
             continue
 
         state = status['state']
         percent_complete = status['percent_complete']
         log.debug('state=%s, percent_complete=%d', state, percent_complete)
+        session = get_current_session()
+        if session:
+            session.report_progress(state, percent_complete)
 
         # Make sure that encryption progress hasn't stalled.
         if progress_deadline.is_expired():
@@ -189,6 +455,9 @@ def wait_for_encryption(enc_svc,
             last_progress = percent_complete
             last_state = state
             progress_deadline = Deadline(progress_timeout)
+            now = time.time()
+            longest_stall = max(longest_stall, now - last_progress_time)
+            last_progress_time = now
 
         # Log progress once a minute.
         now = time.time()
@@ -205,7 +474,7 @@ def wait_for_encryption(enc_svc,
 
         if state == ENCRYPT_SUCCESSFUL:
             log.info('Encrypted root drive created.')
-            return
+            raise Return(longest_stall)
         elif state == ENCRYPT_FAILED:
             log.debug('Encryption failed with status %s', status)
             failure_code = status.get('failure_code')
@@ -225,13 +494,32 @@ def wait_for_encryption(enc_svc,
             if failure_code:
                 msg += ' with code %s' % failure_code
             raise EncryptionError(msg)
-
-        sleep(10)
     # We've failed to get encryption status for _max_errs_ consecutive tries.
     # Assume that the server has crashed.
     raise EncryptionError('Encryption service unavailable')
 
 
+def wait_for_encryptor_co(enc_svc, timeouts=DEFAULT_TIMEOUTS, watcher=None):
+    """ Wait for the encryption service to come up and then for
+    encryption to finish, using the given timeouts, and record how long
+    each phase took.
+
+    :param timeouts a Timeouts object
+    :param watcher an InstanceWatcher that checks the encryptor instance
+        while waiting
+    """
+    start = time.time()
+    yield wait_for_encryptor_up_co(
+        enc_svc, Deadline(timeouts.encryptor_up), watcher=watcher)
+    timeouts.record(ENCRYPTOR_UP, time.time() - start)
+    start = time.time()
+    longest_stall = yield wait_for_encryption_co(
+        enc_svc, progress_timeout=timeouts.encryption_progress,
+        watcher=watcher)
+    timeouts.record(ENCRYPTION_PROGRESS, longest_stall)
+    timeouts.record(ENCRYPTION, time.time() - start)
+
+
 def status_port(value):
     if not value:
         return ENCRYPTOR_STATUS_PORT
@@ -0,0 +1,399 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A small event loop for running many encryption sessions in one process.
+
+An encryption session spends nearly all of its time sleeping between
+status polls.  Running each session on its own thread ties up a thread
+for the whole session.  Instead, the long-running parts of the workflows
+are written as generator-based coroutines, which yield operations to the
+code that is running them:
+
+    def wait_for_something_co(aws_svc, instance_id):
+        while True:
+            instance = yield Call(aws_svc.get_instance, instance_id)
+            if instance.state == 'running':
+                raise Return(instance)
+            yield Sleep(2)
+
+Yielding a Call runs a blocking function, like a boto or googleapiclient
+call, and sends back its return value or raises its exception.  Yielding
+a Sleep pauses the coroutine.  Yielding another coroutine runs it and
+sends back the value that it passed to Return.  Spawn and Wait run
+coroutines concurrently, for example to wait for several snapshots at
+once (see gather_co() and brkt_cli.workflow).
+
+The same coroutine can be run two ways.  run_sync() runs it in the
+calling thread, making calls inline and sleeping with util.sleep().  This
+is what the brkt command does.  Engine runs many coroutines on one
+thread.  Blocking calls run on a bounded pool of worker threads, and
+sleeping coroutines don't use a thread at all.
+
+asyncio would be the natural fit, but brkt-cli runs on Python 2.7.
+"""
+
+import abc
+import heapq
+import logging
+import Queue
+import sys
+import threading
+import time
+import types
+
+from brkt_cli import util
+from brkt_cli.executor import Future, ThreadPoolExecutor
+
+log = logging.getLogger(__name__)
+
+
+class Return(Exception):
+    """ Raised by a coroutine to return a value, since Python 2 generators
+    can't use return with a value.
+    """
+
+    def __init__(self, value=None):
+        super(Return, self).__init__()
+        self.value = value
+
+
+class Sleep(object):
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+
+class Call(object):
+    """ Call a blocking function and send its return value back to the
+    coroutine.
+    """
+
+    def __init__(self, function, *args, **kwargs):
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+
+    def __call__(self):
+        return self.function(*self.args, **self.kwargs)
+
+
+class Spawn(object):
+    """ Start running a coroutine alongside the one that yielded Spawn.
+    A Future for the new coroutine's result is sent back.
+    """
+
+    def __init__(self, coroutine):
+        self.coroutine = coroutine
+
+
+class Wait(object):
+    """ Wait until one of the given futures is done, and send it back. """
+
+    def __init__(self, *futures):
+        self.futures = futures
+
+
+def gather_co(*coroutines):
+    """ Run the coroutines concurrently and wait for all of them to
+    complete.
+
+    :return a list of their results
+    :raise the exception raised by the first coroutine that failed, after
+        all of the coroutines have completed
+    """
+    futures = []
+    for coroutine in coroutines:
+        future = yield Spawn(coroutine)
+        futures.append(future)
+    for future in futures:
+        yield Wait(future)
+    raise Return([f.result() for f in futures])
+
+
+class _Task(object):
+    """ Steps a coroutine, and any coroutines that it yields, until it
+    yields an operation for the scheduler, or completes.
+    """
+
+    def __init__(self, coroutine, session=None):
+        self.stack = [coroutine]
+        self.session = session
+        self.future = Future()
+        self.future.session_id = session.session_id if session else None
+
+    def step(self, value=None, exc_info=None):
+        """ Resume the coroutine with the given value or exception.
+
+        :return the operation that the coroutine yielded, or None if the
+            coroutine completed
+        """
+        while self.stack:
+            gen = self.stack[-1]
+            try:
+                if exc_info:
+                    yielded = gen.throw(*exc_info)
+                else:
+                    yielded = gen.send(value)
+            except Return as r:
+                self.stack.pop()
+                value, exc_info = r.value, None
+                continue
+            except StopIteration:
+                self.stack.pop()
+                value, exc_info = None, None
+                continue
+            except BaseException:
+                self.stack.pop()
+                value, exc_info = None, sys.exc_info()
+                continue
+
+            value, exc_info = None, None
+            if isinstance(yielded, types.GeneratorType):
+                self.stack.append(yielded)
+            elif isinstance(yielded, (Sleep, Call, Spawn, Wait)):
+                return yielded
+            else:
+                exc_info = (
+                    TypeError,
+                    TypeError('Coroutine yielded %r' % (yielded,)),
+                    None
+                )
+
+        if exc_info:
+            self.future.set_exception_info(exc_info)
+        else:
+            self.future.set_result(value)
+        return None
+
+
+class _Scheduler(object):
+    """ Runs coroutines on the thread that calls _run().  Subclasses
+    decide how blocking calls are made and how to wait for the next event.
+    """
+    __metaclass__ = abc.ABCMeta
+
+    def __init__(self):
+        # Tasks that are ready to run: (task, value, exc_info).  Tasks are
+        # resumed through this queue so that blocking calls and futures can
+        # complete on other threads.
+        self._events = Queue.Queue()
+        # Heap of sleeping tasks: (wake time, sequence number, task).
+        self._sleeping = []
+        self._sequence = 0
+        self._lock = threading.Lock()
+        self._active_tasks = 0
+
+    def get_active_task_count(self):
+        with self._lock:
+            return self._active_tasks
+
+    def _start(self, task):
+        with self._lock:
+            self._active_tasks += 1
+        self._resume(task)
+
+    def _resume(self, task, value=None, exc_info=None):
+        self._events.put((task, value, exc_info))
+
+    @abc.abstractmethod
+    def _call(self, task, call):
+        pass
+
+    @abc.abstractmethod
+    def _wait_for_events(self, timeout):
+        """ Wait up to timeout seconds for a task to be resumed.  A timeout
+        of None means that no tasks are sleeping.
+
+        :return the (task, value, exc_info) tuple for the resumed task, or
+            None
+        """
+        pass
+
+    def _run_task(self, task, value, exc_info):
+        if task.session:
+            with task.session.activate():
+                op = task.step(value, exc_info)
+        else:
+            op = task.step(value, exc_info)
+
+        if op is None:
+            with self._lock:
+                self._active_tasks -= 1
+        elif isinstance(op, Sleep):
+            seconds = op.seconds if util.SLEEP_ENABLED else 0
+            self._sequence += 1
+            heapq.heappush(
+                self._sleeping, (time.time() + seconds, self._sequence, task))
+        elif isinstance(op, Spawn):
+            child = _Task(op.coroutine, session=task.session)
+            self._start(child)
+            self._resume(task, child.future)
+        elif isinstance(op, Wait):
+            self._wait(task, op.futures)
+        else:
+            self._call(task, op)
+
+    def _wait(self, task, futures):
+        if not futures:
+            exc_info = (ValueError, ValueError('No futures to wait for'), None)
+            self._resume(task, None, exc_info)
+            return
+        waiting = [True]
+
+        def _on_done(future):
+            with self._lock:
+                if not waiting[0]:
+                    return
+                waiting[0] = False
+            self._resume(task, future)
+
+        for future in futures:
+            future.add_done_callback(_on_done)
+
+    def _run(self, is_complete):
+        """ Run tasks until is_complete() returns True. """
+        while True:
+            # Run the tasks that are ready.
+            now = time.time()
+            while self._sleeping and self._sleeping[0][0] <= now:
+                _, _, task = heapq.heappop(self._sleeping)
+                self._resume(task)
+            while True:
+                try:
+                    item = self._events.get_nowait()
+                except Queue.Empty:
+                    break
+                self._run_task(*item)
+
+            if is_complete():
+                return
+            if not self._events.empty():
+                continue
+            if self._sleeping:
+                timeout = max(0, self._sleeping[0][0] - time.time())
+            else:
+                timeout = None
+            item = self._wait_for_events(timeout)
+            if item:
+                self._run_task(*item)
+
+
+class _InlineScheduler(_Scheduler):
+    """ Makes blocking calls on the scheduler thread, and sleeps with
+    util.sleep().
+    """
+
+    def _call(self, task, call):
+        try:
+            value = call()
+        except BaseException:
+            self._resume(task, None, sys.exc_info())
+        else:
+            self._resume(task, value)
+
+    def _wait_for_events(self, timeout):
+        if timeout is None:
+            # Waiting for a future that completes on another thread.
+            # Queue.get() without a timeout can't be interrupted.
+            try:
+                return self._events.get(timeout=60)
+            except Queue.Empty:
+                return None
+
+        try:
+            util.sleep(timeout)
+        except BaseException:
+            # Raise the exception, usually KeyboardInterrupt, inside the
+            # sleeping coroutines, so that they can clean up.
+            exc_info = sys.exc_info()
+            while self._sleeping:
+                _, _, task = heapq.heappop(self._sleeping)
+                self._resume(task, None, exc_info)
+        return None
+
+
+def run_sync(coroutine):
+    """ Run the coroutine in the calling thread, and return its result.
+    Blocking calls are made one at a time, but coroutines started with
+    Spawn can sleep concurrently.
+
+    :raise the exception raised by the coroutine
+    """
+    task = _Task(coroutine)
+    scheduler = _InlineScheduler()
+    scheduler._start(task)
+    scheduler._run(task.future.done)
+    return task.future.result()
+
+
+class Engine(_Scheduler):
+    """ Runs coroutines on the thread that calls run().  Blocking calls
+    are made on a pool of max_workers threads.
+    """
+
+    def __init__(self, max_workers=8):
+        super(Engine, self).__init__()
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix='brkt-engine')
+
+    def spawn(self, coroutine, session=None):
+        """ Schedule the coroutine to run.  If a SessionContext is given,
+        it is activated whenever the coroutine runs.  Can be called from
+        any thread.
+
+        :return a Future for the coroutine's result
+        """
+        task = _Task(coroutine, session=session)
+        self._start(task)
+        return task.future
+
+    def _call(self, task, call):
+        self._executor.submit(self._make_call, task, call)
+
+    def _make_call(self, task, call):
+        """ Make a blocking call on a worker thread. """
+        try:
+            if task.session:
+                with task.session.activate():
+                    value = call()
+            else:
+                value = call()
+        except BaseException:
+            self._resume(task, None, sys.exc_info())
+        else:
+            self._resume(task, value)
+
+    def _wait_for_events(self, timeout):
+        if timeout is None:
+            # Queue.get() without a timeout can't be interrupted.
+            timeout = 60
+        try:
+            return self._events.get(timeout=timeout)
+        except Queue.Empty:
+            return None
+
+    def run(self):
+        """ Run until all spawned coroutines have completed. """
+        self._run(lambda: not self.get_active_task_count())
+
+    def run_until_complete(self, coroutine, session=None):
+        """ Run the coroutine, along with any other spawned coroutines,
+        and return its result.
+        """
+        future = self.spawn(coroutine, session=session)
+        self.run()
+        return future.result()
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
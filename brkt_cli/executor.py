@@ -0,0 +1,253 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A minimal thread pool and Future, modeled on concurrent.futures, which is
+not part of the Python 2.7 standard library.  Futures also accept
+progress callbacks, which are called while the operation is running.
+"""
+
+import logging
+import Queue
+import sys
+import threading
+
+from brkt_cli.util import BracketError
+
+log = logging.getLogger(__name__)
+
+
+class TimeoutError(BracketError):
+    pass
+
+
+class CancelledError(BracketError):
+    pass
+
+
+class Future(object):
+    """ The result of an operation that runs asynchronously. """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._done = False
+        self._cancelled = False
+        self._running = False
+        self._result = None
+        self._exc_info = None
+        self._done_callbacks = []
+        self._progress_callbacks = []
+        self.progress = None
+
+    def done(self):
+        with self._condition:
+            return self._done
+
+    def running(self):
+        with self._condition:
+            return self._running
+
+    def cancelled(self):
+        with self._condition:
+            return self._cancelled
+
+    def cancel(self):
+        """ Cancel the operation if it hasn't started running.
+
+        :return True if the operation was cancelled
+        """
+        with self._condition:
+            if self._running or self._done:
+                return self._cancelled
+            self._cancelled = True
+            self._done = True
+            self._condition.notify_all()
+        self._call_done_callbacks()
+        return True
+
+    def set_running(self):
+        """ Mark the future as running.
+
+        :return False if the future was cancelled
+        """
+        with self._condition:
+            if self._cancelled:
+                return False
+            self._running = True
+            return True
+
+    def _wait(self, timeout):
+        with self._condition:
+            if not self._done:
+                self._condition.wait(timeout)
+            if not self._done:
+                raise TimeoutError(
+                    'Operation did not complete in %s seconds' % timeout)
+            if self._cancelled:
+                raise CancelledError('Operation was cancelled')
+
+    def result(self, timeout=None):
+        """ Wait for the operation to complete and return its result.
+
+        :raise the exception raised by the operation
+        :raise TimeoutError if the operation didn't complete in time
+        :raise CancelledError if the operation was cancelled
+        """
+        self._wait(timeout)
+        if self._exc_info:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+    def exception(self, timeout=None):
+        """ Wait for the operation to complete and return the exception
+        that it raised, or None.
+        """
+        self._wait(timeout)
+        if self._exc_info:
+            return self._exc_info[1]
+        return None
+
+    def exception_info(self, timeout=None):
+        """ Like exception(), but return the (type, value, traceback)
+        tuple, or None.
+        """
+        self._wait(timeout)
+        return self._exc_info
+
+    def set_result(self, result):
+        with self._condition:
+            self._result = result
+            self._running = False
+            self._done = True
+            self._condition.notify_all()
+        self._call_done_callbacks()
+
+    def set_exception_info(self, exc_info):
+        with self._condition:
+            self._exc_info = exc_info
+            self._running = False
+            self._done = True
+            self._condition.notify_all()
+        self._call_done_callbacks()
+
+    def add_done_callback(self, callback):
+        """ Call callback(future) when the operation completes.  If the
+        operation has already completed, the callback is called
+        immediately.
+        """
+        with self._condition:
+            if not self._done:
+                self._done_callbacks.append(callback)
+                return
+        _call_safely(callback, self)
+
+    def _call_done_callbacks(self):
+        with self._condition:
+            callbacks = self._done_callbacks
+            self._done_callbacks = []
+        for callback in callbacks:
+            _call_safely(callback, self)
+
+    def add_progress_callback(self, callback):
+        """ Call callback(future, progress) each time the operation reports
+        progress.
+        """
+        with self._condition:
+            self._progress_callbacks.append(callback)
+
+    def set_progress(self, progress):
+        with self._condition:
+            self.progress = progress
+            callbacks = list(self._progress_callbacks)
+        for callback in callbacks:
+            _call_safely(callback, self, progress)
+
+
+def _call_safely(callback, *args):
+    try:
+        callback(*args)
+    except Exception:
+        log.exception('Callback %s failed', callback)
+
+
+class ThreadPoolExecutor(object):
+    """ Runs functions on a fixed number of worker threads. """
+
+    def __init__(self, max_workers=4, thread_name_prefix='brkt-worker'):
+        self.max_workers = max_workers
+        self.thread_name_prefix = thread_name_prefix
+        self._queue = Queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+        self._shutdown = False
+
+    def _start_thread(self):
+        t = threading.Thread(
+            target=self._work,
+            name='%s-%d' % (self.thread_name_prefix, len(self._threads))
+        )
+        t.daemon = True
+        t.start()
+        self._threads.append(t)
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            future, function, args, kwargs = item
+            if not future.set_running():
+                continue
+            try:
+                result = function(*args, **kwargs)
+            except BaseException:
+                future.set_exception_info(sys.exc_info())
+            else:
+                future.set_result(result)
+
+    def submit(self, function, *args, **kwargs):
+        """ Run function(*args, **kwargs) on a worker thread.
+
+        :return a Future
+        """
+        return self.submit_future(Future(), function, *args, **kwargs)
+
+    def submit_future(self, future, function, *args, **kwargs):
+        """ Run function(*args, **kwargs) on a worker thread, and report
+        the result to an existing Future.  This allows the caller to hook
+        up the Future before the function starts running.
+
+        :return the Future
+        """
+        with self._lock:
+            if self._shutdown:
+                raise BracketError('Executor has been shut down')
+            self._queue.put((future, function, args, kwargs))
+            if len(self._threads) < self.max_workers:
+                self._start_thread()
+        return future
+
+    def shutdown(self, wait=True):
+        """ Stop accepting new work.  Work that was already submitted
+        finishes before the worker threads exit.
+        """
+        with self._lock:
+            if self._shutdown:
+                return
+            self._shutdown = True
+            for _ in self._threads:
+                self._queue.put(None)
+        if wait:
+            for t in self._threads:
+                t.join()
@@ -1,7 +1,16 @@
 import argparse
 import brkt_cli
 import logging
-
+import time
+
+from brkt_cli.catalog import (
+    CLOUD_GCE,
+    OPERATION_ENCRYPT,
+    OPERATION_UPDATE,
+    make_record,
+    record_image
+)
+from brkt_cli.orphans import collect_garbage, setup_gc_args
 from brkt_cli.subcommand import Subcommand
 
 from brkt_cli import encryptor_service, util
@@ -20,9 +29,11 @@ from brkt_cli.gce import (
     gce_service,
     launch_gce_image,
     launch_gce_image_args,
+    orphans as gce_orphans,
     update_gce_image,
     update_encrypted_gce_image_args,
 )
+from brkt_cli.timeouts import TimeoutHistory, setup_phase_timeout_args
 from brkt_cli.validation import ValidationError
 
 log = logging.getLogger(__name__)
@@ -45,6 +56,7 @@ class EncryptGCEImageSubcommand(Subcommand):
             encrypt_gce_image_parser, parsed_config)
         setup_instance_config_args(encrypt_gce_image_parser,
                                    brkt_env_default=BRKT_ENV_PROD)
+        setup_phase_timeout_args(encrypt_gce_image_parser)
 
     def setup_config(self, config):
         config.register_option(
@@ -74,6 +86,7 @@ class UpdateGCEImageSubcommand(Subcommand):
         update_encrypted_gce_image_args.setup_update_gce_image_args(update_gce_image_parser)
         setup_instance_config_args(update_gce_image_parser,
                                    brkt_env_default=BRKT_ENV_PROD)
+        setup_phase_timeout_args(update_gce_image_parser)
 
     def run(self, values):
         return _run_subcommand(self.name(), values)
@@ -97,10 +110,38 @@ class LaunchGCEImageSubcommand(Subcommand):
         return _run_subcommand(self.name(), values)
 
 
+class GCGCESubcommand(Subcommand):
+
+    def name(self):
+        return 'gc-gce'
+
+    def register(self, subparsers, parsed_config):
+        parser = subparsers.add_parser(
+            'gc-gce',
+            description=(
+                'Delete the instances, disks and encryptor images that '
+                'interrupted encryption and update sessions left behind in '
+                'a project.'
+            ),
+            formatter_class=brkt_cli.SortingHelpFormatter
+        )
+        parser.add_argument(
+            '--project',
+            help='GCE project name',
+            dest='project',
+            required=True
+        )
+        setup_gc_args(parser)
+
+    def run(self, values):
+        return _run_subcommand(self.name(), values)
+
+
 def get_subcommands():
     return [EncryptGCEImageSubcommand(),
             UpdateGCEImageSubcommand(),
-            LaunchGCEImageSubcommand()]
+            LaunchGCEImageSubcommand(),
+            GCGCESubcommand()]
 
 
 def _run_subcommand(subcommand, values):
@@ -110,6 +151,24 @@ def _run_subcommand(subcommand, values):
         return command_update_encrypted_gce_image(values, log)
     if subcommand == 'launch-gce-image':
         return command_launch_gce_image(values, log)
+    if subcommand == 'gc-gce':
+        return command_gc_gce(values, log)
+
+
+def command_gc_gce(values, log):
+    if values.min_age > values.max_age:
+        raise ValidationError('--min-age must not be greater than --max-age')
+    gce_svc = gce_service.GCEService(values.project, None, log)
+    if not values.verbose:
+        logging.getLogger('googleapiclient').setLevel(logging.ERROR)
+    collect_garbage(
+        gce_orphans.list_resources(gce_svc),
+        lambda sessions: gce_orphans.delete_sessions(gce_svc, sessions),
+        min_age=values.min_age,
+        max_age=values.max_age,
+        dry_run=values.dry_run
+    )
+    return 0
 
 
 def command_launch_gce_image(values, log):
@@ -161,6 +220,7 @@ def command_update_encrypted_gce_image(values, log):
         brkt_cli.get_prod_brkt_env()
     )
 
+    timeout_history = TimeoutHistory()
     updated_image_id = update_gce_image.update_gce_image(
         gce_svc=gce_svc,
         enc_svc_cls=encryptor_service.EncryptorService,
@@ -174,8 +234,13 @@ def command_update_encrypted_gce_image(values, log):
         image_file=values.image_file,
         image_bucket=values.bucket,
         network=values.network,
-        status_port=values.status_port
+        status_port=values.status_port,
+        timeout_history=timeout_history,
+        timeout_overrides=dict(values.phase_timeouts or [])
     )
+    _record_image(
+        gce_svc, values, updated_image_id, OPERATION_UPDATE,
+        timeout_history.durations)
 
     print(updated_image_id)
     return 0
@@ -203,6 +268,7 @@ def command_encrypt_gce_image(values, log):
         brkt_cli.get_prod_brkt_env()
     )
 
+    timeout_history = TimeoutHistory()
     encrypted_image_id = encrypt_gce_image.encrypt(
         gce_svc=gce_svc,
         enc_svc_cls=encryptor_service.EncryptorService,
@@ -217,14 +283,37 @@ def command_encrypt_gce_image(values, log):
         image_file=values.image_file,
         image_bucket=values.bucket,
         network=values.network,
-        status_port=values.status_port
+        status_port=values.status_port,
+        timeout_history=timeout_history,
+        timeout_overrides=dict(values.phase_timeouts or [])
     )
+    _record_image(
+        gce_svc, values, encrypted_image_id, OPERATION_ENCRYPT,
+        timeout_history.durations)
     # Print the image name to stdout, in case the caller wants to process
     # the output.  Log messages go to stderr.
     print(encrypted_image_id)
     return 0
 
 
+def _record_image(gce_svc, values, image_name, operation, phase_durations):
+    """ Add the image to the local catalog.  The encryptor is recorded as
+    the encryptor image or image file that was specified, if any.
+    """
+    record_image(make_record(
+        image_name,
+        CLOUD_GCE,
+        location=values.project,
+        name=image_name,
+        operation=operation,
+        source_image=values.image,
+        encryptor_image=values.encryptor_image or values.image_file,
+        session_id=gce_svc.get_session_id(),
+        created_time=time.time(),
+        phase_durations=phase_durations
+    ))
+
+
 def check_args(values, gce_svc):
     if not gce_svc.network_exists(values.network):
         raise ValidationError("Network provided does not exist")
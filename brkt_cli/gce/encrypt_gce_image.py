@@ -1,43 +1,148 @@
 #!/usr/bin/env python
 
+import collections
 import httplib
 import logging
 import socket
 
 from brkt_cli.encryptor_service import (
     ENCRYPTOR_STATUS_PORT,
-    wait_for_encryption,
-    wait_for_encryptor_up
+    EncryptorInstanceError,
+    InstanceWatcher,
+    wait_for_encryptor_co
 )
+from brkt_cli.engine import Call, Return, run_sync
 from brkt_cli.gce.gce_service import gce_metadata_from_userdata
-from brkt_cli.util import Deadline, retry
+from brkt_cli.timeouts import DEFAULT_TIMEOUTS, get_timeouts
+from brkt_cli.util import retry
+from brkt_cli.workflow import Workflow
 from googleapiclient import errors
 
 
 log = logging.getLogger(__name__)
 
 
-def setup_encryption(gce_svc,
-                     image_id,
-                     encrypted_image_disk,
-                     instance_name,
-                     zone,
-                     image_project):
-    try:
-        # create disk from guest image
-        gce_svc.disk_from_image(zone, image_id, instance_name, image_project)
-        log.info('Waiting for guest root disk to become ready')
-        gce_svc.wait_for_detach(zone, instance_name)
-
-        guest_size = gce_svc.get_disk_size(zone, instance_name)
-        # create blank disk. the encrypted image will be
-        # dd'd to this disk. Blank disk should be 2x the size
-        # of the unencrypted guest root
-        log.info('Creating disk for encrypted image')
-        gce_svc.create_disk(zone, encrypted_image_disk, guest_size * 2 + 1)
-    except Exception as e:
-        log.info('Encryption setup failed')
-        raise
+_Names = collections.namedtuple(
+    '_Names', ['instance_name', 'encryptor', 'encrypted_image_disk'])
+
+
+def clean_up_session(gce_svc, zone, keep_encryptor, metavisor_image=None):
+    """ Delete the instances and disks that were created in this session,
+    and the encryptor image unless keep_encryptor is True.
+    """
+    log.info("Cleaning up")
+    gce_svc.cleanup(zone, metavisor_image, keep_encryptor)
+
+
+def get_metavisor_image(gce_svc, zone, encryptor_image, image_bucket,
+                        image_file):
+    """ Return the encryptor image that the user specified, or create it
+    from the latest file in the GCS bucket.
+    """
+    if encryptor_image:
+        return encryptor_image
+    # create metavisor image from file in GCS bucket
+    log.info('Retrieving encryptor image from GCS bucket')
+    return gce_svc.get_latest_encryptor_image(
+        zone, image_bucket, image_file=image_file)
+
+
+def check_encryptor_instance(gce_svc, zone, instance):
+    """ Check that the encryptor or updater instance is still running.
+
+    :raise EncryptorInstanceError if the instance has stopped or terminated
+    """
+    status = gce_svc.get_instance_status(zone, instance)
+    if status in ('STOPPING', 'STOPPED', 'SUSPENDING', 'SUSPENDED',
+                  'TERMINATED'):
+        raise EncryptorInstanceError(
+            'Encryptor instance %s is %s' % (instance, status.lower()),
+            state=status.lower()
+        )
+
+
+def make_instance_watcher(gce_svc, zone, instance):
+    """ Return an InstanceWatcher that checks the instance status, and
+    scans the serial console for signs of a crash.
+    """
+    return InstanceWatcher(
+        instance,
+        lambda: check_encryptor_instance(gce_svc, zone, instance),
+        get_console_output=lambda: gce_svc.get_serial_console_output(
+            zone, instance)
+    )
+
+
+def _get_names(gce_svc):
+    instance_name = 'brkt-guest-' + gce_svc.get_session_id()
+    return _Names(
+        instance_name=instance_name,
+        encryptor=instance_name + '-encryptor',
+        encrypted_image_disk='encrypted-image-' + gce_svc.get_session_id()
+    )
+
+
+def _create_guest_disk(gce_svc, zone, image_id, image_project, names):
+    """ Create a disk from the guest image.
+
+    :return the size of the guest disk in GB
+    """
+    gce_svc.disk_from_image(
+        zone, image_id, names.instance_name, image_project)
+    log.info('Waiting for guest root disk to become ready')
+    gce_svc.wait_for_detach(zone, names.instance_name)
+    return gce_svc.get_disk_size(zone, names.instance_name)
+
+
+def _create_encrypted_disk(gce_svc, zone, names, guest_disk_size):
+    # create blank disk. the encrypted image will be
+    # dd'd to this disk. Blank disk should be 2x the size
+    # of the unencrypted guest root
+    log.info('Creating disk for encrypted image')
+    gce_svc.create_disk(
+        zone, names.encrypted_image_disk, guest_disk_size * 2 + 1)
+    return names.encrypted_image_disk
+
+
+def _get_timeouts(guest_disk_size, timeout_history=None,
+                  timeout_overrides=None):
+    return get_timeouts(
+        volume_size_gb=guest_disk_size, history=timeout_history,
+        overrides=timeout_overrides)
+
+
+def _encrypt_co(gce_svc, enc_svc_cls, zone, names, metavisor_image,
+                instance_config, network, status_port, encrypted_disk,
+                timeouts):
+    # run encryptor instance with avatar_creator as root,
+    # customer image and blank disk
+    yield do_encryption_co(
+        gce_svc, enc_svc_cls, zone, names.encryptor, metavisor_image,
+        names.instance_name, instance_config, encrypted_disk,
+        network, status_port=status_port, timeouts=timeouts)
+
+
+def _create_image(gce_svc, zone, names, encrypted_image_name, encryption):
+    create_image(gce_svc, zone, names.encrypted_image_disk,
+                 encrypted_image_name, names.encryptor)
+    return encrypted_image_name
+
+
+def make_encrypt_workflow():
+    """ Return the Workflow that encrypt() runs.  The encryptor image is
+    retrieved while the guest disk is created.  Everything that the
+    session created is deleted by the cleanup of the names step, which
+    runs after all of the other steps.
+    """
+    workflow = Workflow('encrypt')
+    workflow.add_step('names', _get_names, cleanup=clean_up_session)
+    workflow.add_step('metavisor_image', get_metavisor_image)
+    workflow.add_step('guest_disk_size', _create_guest_disk)
+    workflow.add_step('timeouts', _get_timeouts)
+    workflow.add_step('encrypted_disk', _create_encrypted_disk)
+    workflow.add_step('encryption', _encrypt_co)
+    workflow.add_step('image', _create_image)
+    return workflow
 
 
 def do_encryption(gce_svc,
@@ -49,29 +154,53 @@ def do_encryption(gce_svc,
                   instance_config,
                   encrypted_image_disk,
                   network,
-                  status_port=ENCRYPTOR_STATUS_PORT):
+                  status_port=ENCRYPTOR_STATUS_PORT,
+                  timeouts=DEFAULT_TIMEOUTS):
+    run_sync(do_encryption_co(
+        gce_svc, enc_svc_cls, zone, encryptor, encryptor_image,
+        instance_name, instance_config, encrypted_image_disk, network,
+        status_port=status_port, timeouts=timeouts
+    ))
+
+
+def do_encryption_co(gce_svc,
+                     enc_svc_cls,
+                     zone,
+                     encryptor,
+                     encryptor_image,
+                     instance_name,
+                     instance_config,
+                     encrypted_image_disk,
+                     network,
+                     status_port=ENCRYPTOR_STATUS_PORT,
+                     timeouts=DEFAULT_TIMEOUTS):
+    """ Coroutine version of do_encryption(). """
     metadata = gce_metadata_from_userdata(instance_config.make_userdata())
     log.info('Launching encryptor instance')
-    gce_svc.run_instance(zone=zone,
-                         name=encryptor,
-                         image=encryptor_image,
-                         network=network,
-                         disks=[gce_svc.get_disk(zone, instance_name),
-                                gce_svc.get_disk(zone, encrypted_image_disk)],
-                         metadata=metadata)
+    guest_disk = yield Call(gce_svc.get_disk, zone, instance_name)
+    encrypted_disk = yield Call(gce_svc.get_disk, zone, encrypted_image_disk)
+    yield Call(gce_svc.run_instance,
+               zone=zone,
+               name=encryptor,
+               image=encryptor_image,
+               network=network,
+               disks=[guest_disk, encrypted_disk],
+               metadata=metadata)
 
     try:
-        enc_svc = enc_svc_cls([gce_svc.get_instance_ip(encryptor, zone)],
-                              port=status_port)
-        wait_for_encryptor_up(enc_svc, Deadline(600))
-        wait_for_encryption(enc_svc)
+        ip = yield Call(gce_svc.get_instance_ip, encryptor, zone)
+        enc_svc = enc_svc_cls([ip], port=status_port)
+        watcher = make_instance_watcher(gce_svc, zone, encryptor)
+        yield wait_for_encryptor_co(
+            enc_svc, timeouts=timeouts, watcher=watcher)
     except Exception as e:
-        f = gce_svc.write_serial_console_file(zone, encryptor)
+        f = yield Call(gce_svc.write_serial_console_file, zone, encryptor)
         if f:
             log.info('Encryption failed. Writing console to %s' % f)
         raise e
-    retry(function=gce_svc.delete_instance,
-            on=[httplib.BadStatusLine, socket.error, errors.HttpError])(zone, encryptor)
+    delete_instance = retry(function=gce_svc.delete_instance,
+            on=[httplib.BadStatusLine, socket.error, errors.HttpError])
+    yield Call(delete_instance, zone, encryptor)
 
 
 def create_image(gce_svc, zone, encrypted_image_disk, encrypted_image_name, encryptor):
@@ -97,42 +226,52 @@ def create_image(gce_svc, zone, encrypted_image_disk, encrypted_image_name, encr
 def encrypt(gce_svc, enc_svc_cls, image_id, encryptor_image,
             encrypted_image_name, zone, instance_config, image_project=None,
             keep_encryptor=False, image_file=None, image_bucket=None,
-            network=None, status_port=ENCRYPTOR_STATUS_PORT):
+            network=None, status_port=ENCRYPTOR_STATUS_PORT,
+            timeout_history=None, timeout_overrides=None):
+    return run_sync(encrypt_co(
+        gce_svc, enc_svc_cls, image_id, encryptor_image,
+        encrypted_image_name, zone, instance_config,
+        image_project=image_project, keep_encryptor=keep_encryptor,
+        image_file=image_file, image_bucket=image_bucket, network=network,
+        status_port=status_port, timeout_history=timeout_history,
+        timeout_overrides=timeout_overrides
+    ))
+
+
+def encrypt_co(gce_svc, enc_svc_cls, image_id, encryptor_image,
+               encrypted_image_name, zone, instance_config,
+               image_project=None, keep_encryptor=False, image_file=None,
+               image_bucket=None, network=None,
+               status_port=ENCRYPTOR_STATUS_PORT, timeout_history=None,
+               timeout_overrides=None):
+    """ Coroutine version of encrypt().  Disk and image operations run
+    as single blocking calls.  Waiting for encryption, which takes most of
+    the time, doesn't tie up a thread.
+    """
+    if encryptor_image:
+        # Keep user provided encryptor image
+        keep_encryptor = True
+
+    workflow = make_encrypt_workflow()
     try:
-        # create metavisor image from file in GCS bucket
-        log.info('Retrieving encryptor image from GCS bucket')
-        if not encryptor_image:
-            try:
-                encryptor_image = gce_svc.get_latest_encryptor_image(zone,
-                    image_bucket, image_file=image_file)
-            except errors.HttpError as e:
-                encryptor_image = None
-                log.exception('GCE API call to create image from file failed: ', e)
-                return
-        else:
-            # Keep user provided encryptor image
-            keep_encryptor = True
-
-        instance_name = 'brkt-guest-' + gce_svc.get_session_id()
-        encryptor = instance_name + '-encryptor'
-        encrypted_image_disk = 'encrypted-image-' + gce_svc.get_session_id()
-
-        # create guest root disk and blank disk to dd to
-        setup_encryption(gce_svc, image_id, encrypted_image_disk,
-                         instance_name, zone, image_project)
-
-        # run encryptor instance with avatar_creator as root,
-        # customer image and blank disk
-        do_encryption(gce_svc, enc_svc_cls, zone, encryptor, encryptor_image,
-                      instance_name, instance_config, encrypted_image_disk,
-                      network, status_port=status_port)
-
-        # create image
-        create_image(gce_svc, zone, encrypted_image_disk, encrypted_image_name, encryptor)
-
-        return encrypted_image_name
+        results = yield workflow.run_co(
+            gce_svc=gce_svc,
+            enc_svc_cls=enc_svc_cls,
+            image_id=image_id,
+            encryptor_image=encryptor_image,
+            encrypted_image_name=encrypted_image_name,
+            zone=zone,
+            instance_config=instance_config,
+            image_project=image_project,
+            keep_encryptor=keep_encryptor,
+            image_file=image_file,
+            image_bucket=image_bucket,
+            network=network,
+            status_port=status_port,
+            timeout_history=timeout_history,
+            timeout_overrides=timeout_overrides
+        )
     except errors.HttpError as e:
-        log.exception('GCE API request failed: ', e)
-    finally:
-        log.info("Cleaning up")
-        gce_svc.cleanup(zone, encryptor_image, keep_encryptor)
+        log.exception('GCE API request failed: %s', e)
+        return
+    raise Return(results['image'])
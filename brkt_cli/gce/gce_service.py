@@ -16,6 +16,11 @@ from brkt_cli.util import (
 from googleapiclient import discovery, errors
 from oauth2client.client import GoogleCredentials
 
+from brkt_cli.session import (
+    RESOURCE_DISK,
+    RESOURCE_INSTANCE,
+    SessionContext
+)
 from brkt_cli.validation import ValidationError
 
 
@@ -48,10 +53,26 @@ class BaseGCEService(object):
     def __init__(self, project, session_id, logger):
         self.log = logger
         self.project = project
-        self.session_id = session_id
+        self.session = SessionContext(session_id)
         self.gce_res_uri = "https://www.googleapis.com/compute/v1/"
-        self.disks = []
-        self.instances = []
+
+    @property
+    def session_id(self):
+        return self.session.session_id
+
+    @property
+    def disks(self):
+        """ The names of the disks created by this session that have not
+        been deleted.
+        """
+        return self.session.get_resources(RESOURCE_DISK)
+
+    @property
+    def instances(self):
+        """ The names of the instances created by this session that have
+        not been deleted.
+        """
+        return self.session.get_resources(RESOURCE_INSTANCE)
 
     @abc.abstractmethod
     def list_zones(self):
@@ -105,6 +126,16 @@ class BaseGCEService(object):
     def get_instance_ip(self, name, zone):
         pass
 
+    @abc.abstractmethod
+    def get_instance_status(self, zone, instance):
+        """ Return the instance status, for example RUNNING or TERMINATED.
+        """
+        pass
+
+    @abc.abstractmethod
+    def get_serial_console_output(self, zone, instance):
+        pass
+
     @abc.abstractmethod
     def detach_disk(self, zone, instance, diskName):
         pass
@@ -187,15 +218,36 @@ class BaseGCEService(object):
     def get_disk(self, zone, disk_name):
         pass
 
+    @abc.abstractmethod
+    def list_instances(self, name_filter=None):
+        """ Return the instances in all zones, as dictionaries with a zone
+        key that contains the zone name.
+
+        :param name_filter a regular expression that instance names match
+        """
+        pass
+
+    @abc.abstractmethod
+    def list_disks(self, name_filter=None):
+        """ Return the disks in all zones, as dictionaries with a zone
+        key that contains the zone name.
+        """
+        pass
+
+    @abc.abstractmethod
+    def list_images(self, name_filter=None):
+        pass
+
     @abc.abstractmethod
     def cleanup(self, zone, encryptor_image, keep_encryptor=False):
         pass
 
 
 class GCEService(BaseGCEService):
-    def __init__(self, project, session_id, logger):
+    def __init__(self, project, session_id, logger, credentials=None):
         super(GCEService, self).__init__(project, session_id, logger)
-        self.credentials = GoogleCredentials.get_application_default()
+        self.credentials = (
+            credentials or GoogleCredentials.get_application_default())
         self.compute = discovery.build('compute', 'v1',
                 credentials=self.credentials)
         self.storage = discovery.build('storage', 'v1',
@@ -203,10 +255,10 @@ class GCEService(BaseGCEService):
 
     def cleanup(self, zone, encryptor_image, keep_encryptor=False):
         try:
-            for instance in self.instances[:]:
+            for instance in self.instances:
                 self.log.info('deleting instance %s' % instance)
                 self.delete_instance(zone, instance)
-            for disk in self.disks[:]:
+            for disk in self.disks:
                 self.log.info('deleting disk %s' % disk)
                 if self.disk_exists(zone, disk):
                     self.wait_for_detach(zone, disk)
@@ -266,8 +318,7 @@ class GCEService(BaseGCEService):
         return True
 
     def delete_instance(self, zone, instance):
-        if instance in self.instances:
-            self.instances.remove(instance)
+        self.session.untrack_resource(RESOURCE_INSTANCE, instance)
         return self.compute.instances().delete(project=self.project,
                zone=zone, instance=instance).execute()
 
@@ -277,8 +328,7 @@ class GCEService(BaseGCEService):
 
     def delete_disk(self, zone, disk):
         # remove disk if we're tracking it
-        if disk in self.disks:
-            self.disks.remove(disk)
+        self.session.untrack_resource(RESOURCE_DISK, disk)
         return self.compute.disks().delete(project=self.project,
                zone=zone, disk=disk).execute()
 
@@ -308,17 +358,26 @@ class GCEService(BaseGCEService):
                 pass
         self.log.info("Couldn't find an IP address for this instance.")
 
+    def get_instance_status(self, zone, instance):
+        instance_req = self.compute.instances().get(project=self.project,
+                zone=zone, instance=instance)
+        return retry(execute_gce_api_call)(instance_req)['status']
+
+    def get_serial_console_output(self, zone, instance):
+        serial_port_out = self.compute.instances().getSerialPortOutput(
+                project=self.project,
+                instance=instance,
+                zone=zone).execute()
+        return serial_port_out.get('contents')
+
     def write_serial_console_file(self, zone, instance):
         try:
-            serial_port_out = self.compute.instances().getSerialPortOutput(
-                    project=self.project,
-                    instance=instance,
-                    zone=zone).execute()
-            if 'contents' in serial_port_out:
+            contents = self.get_serial_console_output(zone, instance)
+            if contents is not None:
                 with tempfile.NamedTemporaryFile(prefix='serial-console-',
                                                  suffix='-%s.out' % self.session_id,
                                                  delete=False) as t:
-                    t.write(serial_port_out['contents'])
+                    t.write(contents)
                 return t.name
         except:
             self.log.exception('Unable to write serial console contents')
@@ -393,7 +452,7 @@ class GCEService(BaseGCEService):
         }
         self.compute.disks().insert(project=self.project,
                 zone=zone, body=body).execute()
-        self.disks.append(name)
+        self.session.track_resource(RESOURCE_DISK, name)
 
     def disk_from_snapshot(self, zone, snapshot, name):
         if self.disk_exists(zone, name):
@@ -410,11 +469,10 @@ class GCEService(BaseGCEService):
         }
         self.compute.disks().insert(project=self.project,
                 zone=zone, body=body).execute()
-        self.disks.append(name)
+        self.session.track_resource(RESOURCE_DISK, name)
 
     def create_disk(self, zone, name, size=25):
-        if name not in self.disks:
-            self.disks.append(name)
+        self.session.track_resource(RESOURCE_DISK, name)
         if self.disk_exists(zone, name):
             return
 
@@ -519,7 +577,7 @@ class GCEService(BaseGCEService):
 
         # if boot disk doesn't autodelete we need to track it
         if not delete_boot:
-            self.disks.append(name)
+            self.session.track_resource(RESOURCE_DISK, name)
         if image_project:
             source_disk_image = "projects/%s/global/images/%s" % (image_project,
                 image)
@@ -573,7 +631,7 @@ class GCEService(BaseGCEService):
         retry(execute_gce_api_call)(instance_req)
         self.wait_instance(name, zone)
         self.get_disk_size(zone, name)
-        self.instances.append(name)
+        self.session.track_resource(RESOURCE_INSTANCE, name)
 
     def get_disk(self, zone, disk_name):
         source_disk = "projects/%s/zones/%s/disks/%s" % (self.project,
@@ -584,6 +642,49 @@ class GCEService(BaseGCEService):
             'source': self.gce_res_uri + source_disk,
         }
 
+    def _list_pages(self, list_method, name_filter=None):
+        """ Call the list or aggregatedList method for every page of
+        results and return the responses.
+        """
+        kwargs = {'project': self.project}
+        if name_filter:
+            kwargs['filter'] = 'name eq %s' % name_filter
+        responses = []
+        page_token = None
+        while True:
+            req = list_method(pageToken=page_token, **kwargs)
+            resp = retry(execute_gce_api_call)(req)
+            responses.append(resp)
+            page_token = resp.get('nextPageToken')
+            if not page_token:
+                return responses
+
+    def _list_aggregated(self, collection, key, name_filter=None):
+        items = []
+        for resp in self._list_pages(
+                collection.aggregatedList, name_filter=name_filter):
+            for scope, scoped_list in resp.get('items', {}).iteritems():
+                zone = scope.split('/')[-1]
+                for item in scoped_list.get(key, []):
+                    item['zone'] = zone
+                    items.append(item)
+        return items
+
+    def list_instances(self, name_filter=None):
+        return self._list_aggregated(
+            self.compute.instances(), 'instances', name_filter=name_filter)
+
+    def list_disks(self, name_filter=None):
+        return self._list_aggregated(
+            self.compute.disks(), 'disks', name_filter=name_filter)
+
+    def list_images(self, name_filter=None):
+        images = []
+        for resp in self._list_pages(
+                self.compute.images().list, name_filter=name_filter):
+            images.extend(resp.get('items', []))
+        return images
+
 
 def gce_metadata_from_userdata(brkt_data, extra_items=None):
     """ brkt_data is a JSON blob containing the brkt-config """
@@ -0,0 +1,125 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Finds and deletes the instances, disks and images that encryption and
+update sessions left behind in a GCE project.
+
+GCE resources aren't tagged with the session id, but their names contain
+it: brkt-guest-<session>, brkt-updater-<session>, the -encryptor instances
+with the same prefix, encrypted-image-<session> and encryptor-<session>.
+Encryptor images are only deleted along with the disks or instances of
+the same session, so that images kept with --keep-encryptor survive.
+"""
+
+import logging
+import re
+
+from brkt_cli import orphans
+from brkt_cli.orphans import Resource
+
+log = logging.getLogger(__name__)
+
+LIVE_INSTANCE_STATES = ('PROVISIONING', 'STAGING', 'RUNNING')
+
+SESSION_NAME_REGEXES = (
+    r'brkt-(?:guest|updater)-([0-9a-f]+)(?:-encryptor)?',
+    r'encrypted-image-([0-9a-f]+)',
+)
+ENCRYPTOR_IMAGE_REGEX = r'encryptor-([0-9a-f]+)'
+
+
+def _get_session_id(name, regexes):
+    for regex in regexes:
+        m = re.match(regex + '$', name)
+        if m:
+            return m.group(1)
+    return None
+
+
+def list_resources(gce_svc):
+    """ Return the resources that encryption and update sessions created
+    in the project.
+
+    :return a list of (session_id, Resource) tuples
+    """
+    name_filter = '|'.join(SESSION_NAME_REGEXES)
+    resources = []
+
+    for i in gce_svc.list_instances(name_filter=name_filter):
+        session_id = _get_session_id(i['name'], SESSION_NAME_REGEXES)
+        if not session_id:
+            continue
+        resources.append((session_id, Resource(
+            type=orphans.RESOURCE_INSTANCE,
+            id=i['name'],
+            created_time=orphans.parse_time(i.get('creationTimestamp')),
+            live=i.get('status') in LIVE_INSTANCE_STATES,
+            location=i['zone']
+        )))
+
+    for d in gce_svc.list_disks(name_filter=name_filter):
+        session_id = _get_session_id(d['name'], SESSION_NAME_REGEXES)
+        if not session_id:
+            continue
+        resources.append((session_id, Resource(
+            type=orphans.RESOURCE_DISK,
+            id=d['name'],
+            created_time=orphans.parse_time(d.get('creationTimestamp')),
+            live=False,
+            location=d['zone']
+        )))
+
+    session_ids = set(session_id for session_id, _ in resources)
+    for image in gce_svc.list_images(name_filter=ENCRYPTOR_IMAGE_REGEX):
+        session_id = _get_session_id(image['name'], [ENCRYPTOR_IMAGE_REGEX])
+        if session_id not in session_ids:
+            continue
+        resources.append((session_id, Resource(
+            type=orphans.RESOURCE_IMAGE,
+            id=image['name'],
+            created_time=orphans.parse_time(image.get('creationTimestamp')),
+            live=False,
+            location=None
+        )))
+
+    return resources
+
+
+def _delete_session(gce_svc, session):
+    log.info('Deleting resources from session %s', session.session_id)
+    for r in session.get_resources(orphans.RESOURCE_INSTANCE):
+        log.info('Deleting instance %s', r.id)
+        gce_svc.delete_instance(r.location, r.id)
+    for r in session.get_resources(orphans.RESOURCE_DISK):
+        log.info('Deleting disk %s', r.id)
+        gce_svc.wait_for_detach(r.location, r.id)
+        gce_svc.delete_disk(r.location, r.id)
+    for r in session.get_resources(orphans.RESOURCE_IMAGE):
+        log.info('Deleting image %s', r.id)
+        gce_svc.delete_image(r.id)
+
+
+def delete_sessions(gce_svc, sessions):
+    """ Delete the resources of the given sessions.  Instances are deleted
+    before the disks that they use.  Sessions are deleted one at a time,
+    because the GCE API client isn't thread safe.  Errors are logged.
+    """
+    for session in sessions:
+        try:
+            _delete_session(gce_svc, session)
+        except Exception:
+            log.exception(
+                'Unable to delete resources from session %s',
+                session.session_id)
@@ -12,18 +12,21 @@
 # License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
+import copy
 import logging
 
 from brkt_cli.gce import encrypt_gce_image
 from brkt_cli.gce.gce_service import gce_metadata_from_userdata
-from brkt_cli.util import Deadline
 from brkt_cli import add_brkt_env_to_brkt_config
 
 from brkt_cli.encryptor_service import (
     ENCRYPTOR_STATUS_PORT,
-    wait_for_encryption,
-    wait_for_encryptor_up
+    wait_for_encryptor_co
 )
+from brkt_cli.engine import Call, Return, run_sync
+from brkt_cli.timeouts import get_timeouts
+from brkt_cli.workflow import Workflow
 
 """
 Create an encrypted GCE image (with new metavisor) based
@@ -32,77 +35,162 @@ on an existing encrypted GCE image.
 
 log = logging.getLogger(__name__)
 
+_Names = collections.namedtuple('_Names', ['updater', 'encrypted_image_disk'])
+
 
 def update_gce_image(gce_svc, enc_svc_cls, image_id, encryptor_image,
                      encrypted_image_name, zone, instance_config,
                      keep_encryptor=False, image_file=None,
                      image_bucket=None, network=None,
-                     status_port=ENCRYPTOR_STATUS_PORT):
-    snap_created = None
-    try:
-        # create image from file in GCS bucket
-        log.info('Retrieving encryptor image from GCS bucket')
-        if not encryptor_image:
-            encryptor_image = gce_svc.get_latest_encryptor_image(zone,
-                image_bucket, image_file=image_file)
-        else:
-            # Keep user provided encryptor image
-            keep_encryptor = True
-
-        instance_name = 'brkt-updater-' + gce_svc.get_session_id()
-        updater = instance_name + '-metavisor'
-        encrypted_image_disk = instance_name + '-guest'
-
-        # Create disk from encrypted guest snapshot. This disk
-        # won't be altered. It will be re-snapshotted and paired
-        # with the new encryptor image.
-        gce_svc.disk_from_snapshot(zone, image_id, encrypted_image_disk)
-        gce_svc.wait_for_disk(zone, encrypted_image_disk)
-        log.info("Creating snapshot of encrypted image disk")
-        gce_svc.create_snapshot(zone, encrypted_image_disk, encrypted_image_name)
-        snap_created = True
-
-        log.info("Launching encrypted updater")
-        instance_config.brkt_config['solo_mode'] = 'updater'
-        user_data = gce_metadata_from_userdata(instance_config.make_userdata())
-        gce_svc.run_instance(zone,
-                             updater,
-                             encryptor_image,
-                             network=network,
-                             disks=[],
-                             metadata=user_data)
-        enc_svc = enc_svc_cls([gce_svc.get_instance_ip(updater, zone)],
-                              port=status_port)
-
-        # wait for updater to finish and guest root disk
-        wait_for_encryptor_up(enc_svc, Deadline(600))
-        try:
-            wait_for_encryption(enc_svc)
-        except:
-            raise
-
-        # delete updater instance
-        log.info('Deleting updater instance')
-        gce_svc.delete_instance(zone, updater)
-
-        # wait for updater root disk
-        gce_svc.wait_for_detach(zone, updater)
-
-        # create image from mv root disk and snapshot
-        # encrypted guest root disk
-        log.info("Creating updated metavisor image")
-        gce_svc.create_gce_image_from_disk(zone, encrypted_image_name, updater)
-        gce_svc.wait_image(encrypted_image_name)
-        gce_svc.wait_snapshot(encrypted_image_name)
-    except:
-        f = gce_svc.write_serial_console_file(zone, updater)
-        if f:
-            log.info('Update failed. Writing console to %s' % f)
-        log.info("Update failed. Cleaning up")
-        if snap_created:
-            gce_svc.delete_snapshot(encrypted_image_name)
-        gce_svc.cleanup(zone, encryptor_image, keep_encryptor)
-        raise
-    finally:
-        gce_svc.cleanup(zone, encryptor_image, keep_encryptor)
-    return encrypted_image_name
+                     status_port=ENCRYPTOR_STATUS_PORT,
+                     timeout_history=None, timeout_overrides=None):
+    return run_sync(update_gce_image_co(
+        gce_svc, enc_svc_cls, image_id, encryptor_image,
+        encrypted_image_name, zone, instance_config,
+        keep_encryptor=keep_encryptor, image_file=image_file,
+        image_bucket=image_bucket, network=network, status_port=status_port,
+        timeout_history=timeout_history, timeout_overrides=timeout_overrides
+    ))
+
+
+def _get_names(gce_svc):
+    instance_name = 'brkt-updater-' + gce_svc.get_session_id()
+    return _Names(
+        updater=instance_name + '-metavisor',
+        encrypted_image_disk=instance_name + '-guest'
+    )
+
+
+def _snapshot_guest_disk_co(gce_svc, zone, image_id, encrypted_image_name,
+                            names):
+    """ Create disk from encrypted guest snapshot. This disk
+    won't be altered. It will be re-snapshotted and paired
+    with the new encryptor image.
+
+    :return the name of the snapshot
+    """
+    yield Call(gce_svc.disk_from_snapshot,
+               zone, image_id, names.encrypted_image_disk)
+    yield Call(gce_svc.wait_for_disk, zone, names.encrypted_image_disk)
+    log.info("Creating snapshot of encrypted image disk")
+    yield Call(gce_svc.create_snapshot,
+               zone, names.encrypted_image_disk, encrypted_image_name)
+    raise Return(encrypted_image_name)
+
+
+def _delete_snapshot(gce_svc, snapshot):
+    gce_svc.delete_snapshot(snapshot)
+
+
+def _launch_updater_co(gce_svc, zone, names, metavisor_image,
+                       instance_config, network):
+    """ Launch the updater instance.
+
+    :return the IP address of the updater
+    """
+    log.info("Launching encrypted updater")
+    instance_config = copy.deepcopy(instance_config)
+    instance_config.brkt_config['solo_mode'] = 'updater'
+    user_data = gce_metadata_from_userdata(instance_config.make_userdata())
+    yield Call(gce_svc.run_instance,
+               zone,
+               names.updater,
+               metavisor_image,
+               network=network,
+               disks=[],
+               metadata=user_data)
+    ip = yield Call(gce_svc.get_instance_ip, names.updater, zone)
+    raise Return(ip)
+
+
+def _write_updater_console_co(gce_svc, zone, names):
+    f = yield Call(gce_svc.write_serial_console_file, zone, names.updater)
+    if f:
+        log.info('Update failed. Writing console to %s' % f)
+
+
+def _get_timeouts(timeout_history=None, timeout_overrides=None):
+    # The size of the guest disk isn't known until the snapshot is
+    # created, and the updater doesn't copy the guest disk, so use the
+    # default timeouts.
+    return get_timeouts(
+        history=timeout_history, overrides=timeout_overrides)
+
+
+def _wait_for_update_co(gce_svc, enc_svc_cls, zone, names, status_port,
+                        updater, timeouts):
+    enc_svc = enc_svc_cls([updater], port=status_port)
+    watcher = encrypt_gce_image.make_instance_watcher(
+        gce_svc, zone, names.updater)
+
+    # wait for updater to finish and guest root disk
+    yield wait_for_encryptor_co(enc_svc, timeouts=timeouts, watcher=watcher)
+
+    # delete updater instance
+    log.info('Deleting updater instance')
+    yield Call(gce_svc.delete_instance, zone, names.updater)
+
+    # wait for updater root disk
+    yield Call(gce_svc.wait_for_detach, zone, names.updater)
+
+
+def _create_image_co(gce_svc, zone, names, encrypted_image_name, snapshot,
+                     update):
+    # create image from mv root disk and snapshot
+    # encrypted guest root disk
+    log.info("Creating updated metavisor image")
+    yield Call(gce_svc.create_gce_image_from_disk,
+               zone, encrypted_image_name, names.updater)
+    yield Call(gce_svc.wait_image, encrypted_image_name)
+    yield Call(gce_svc.wait_snapshot, snapshot)
+    raise Return(encrypted_image_name)
+
+
+def make_update_workflow():
+    """ Return the Workflow that update_gce_image() runs.  The encrypted
+    guest disk is snapshotted while the updater runs.
+    """
+    workflow = Workflow('update')
+    workflow.add_step(
+        'names', _get_names, cleanup=encrypt_gce_image.clean_up_session)
+    workflow.add_step(
+        'metavisor_image', encrypt_gce_image.get_metavisor_image)
+    workflow.add_step(
+        'snapshot', _snapshot_guest_disk_co, compensate=_delete_snapshot)
+    workflow.add_step(
+        'updater', _launch_updater_co, compensate=_write_updater_console_co)
+    workflow.add_step('timeouts', _get_timeouts)
+    workflow.add_step('update', _wait_for_update_co)
+    workflow.add_step('image', _create_image_co)
+    return workflow
+
+
+def update_gce_image_co(gce_svc, enc_svc_cls, image_id, encryptor_image,
+                        encrypted_image_name, zone, instance_config,
+                        keep_encryptor=False, image_file=None,
+                        image_bucket=None, network=None,
+                        status_port=ENCRYPTOR_STATUS_PORT,
+                        timeout_history=None, timeout_overrides=None):
+    """ Coroutine version of update_gce_image(). """
+    if encryptor_image:
+        # Keep user provided encryptor image
+        keep_encryptor = True
+
+    workflow = make_update_workflow()
+    results = yield workflow.run_co(
+        gce_svc=gce_svc,
+        enc_svc_cls=enc_svc_cls,
+        image_id=image_id,
+        encryptor_image=encryptor_image,
+        encrypted_image_name=encrypted_image_name,
+        zone=zone,
+        instance_config=instance_config,
+        keep_encryptor=keep_encryptor,
+        image_file=image_file,
+        image_bucket=image_bucket,
+        network=network,
+        status_port=status_port,
+        timeout_history=timeout_history,
+        timeout_overrides=timeout_overrides
+    )
+    raise Return(results['image'])
@@ -0,0 +1,259 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A persistent queue of encryption jobs, stored in SQLite.
+
+Jobs survive a restart of the server.  Queued jobs are run when the
+server starts again.  Jobs that were running when the server stopped
+are marked as failed, since the encryptor or updater instance that they
+were waiting for can't be picked up again.
+
+Sessions that are started with --detach are stored in their own queue by
+brkt_cli.detach.
+"""
+
+import collections
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+from brkt_cli import util
+
+log = logging.getLogger(__name__)
+
+JOB_QUEUED = 'queued'
+JOB_RUNNING = 'running'
+JOB_SUCCEEDED = 'succeeded'
+JOB_FAILED = 'failed'
+
+Job = collections.namedtuple('Job', [
+    'id',
+    'type',
+    'params',
+    'region',
+    'account',
+    'state',
+    'submitted_time',
+    'start_time',
+    'end_time',
+    'progress_state',
+    'percent_complete',
+    'result',
+    'error'
+])
+
+LogLine = collections.namedtuple('LogLine', ['time', 'message'])
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    id TEXT NOT NULL UNIQUE,
+    type TEXT NOT NULL,
+    params TEXT NOT NULL,
+    region TEXT,
+    account TEXT,
+    state TEXT NOT NULL,
+    submitted_time REAL NOT NULL,
+    start_time REAL,
+    end_time REAL,
+    progress_state TEXT,
+    percent_complete INTEGER,
+    result TEXT,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state);
+CREATE TABLE IF NOT EXISTS job_log (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id TEXT NOT NULL,
+    time REAL NOT NULL,
+    message TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS job_log_job_id ON job_log (job_id);
+"""
+
+_JOB_COLUMNS = ', '.join(Job._fields)
+
+
+def _row_to_job(row):
+    values = list(row)
+    values[Job._fields.index('params')] = json.loads(
+        values[Job._fields.index('params')])
+    return Job(*values)
+
+
+class JobQueue(object):
+    """ Stores jobs in a SQLite database.  Safe to use from multiple
+    threads.
+    """
+
+    def __init__(self, path):
+        """
+        :param path the path to the database file, or ':memory:'
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._db.executescript(_SCHEMA)
+            self._db.commit()
+
+    def _execute(self, sql, *args):
+        with self._lock:
+            cursor = self._db.execute(sql, args)
+            self._db.commit()
+            return cursor
+
+    def _query(self, sql, *args):
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    def submit(self, job_type, params, region=None, account=None,
+               job_id=None):
+        """ Add a job to the end of the queue.
+
+        :param params a dictionary that can be serialized as JSON
+        :return the new Job
+        """
+        job_id = job_id or util.make_nonce()
+        self._execute(
+            'INSERT INTO jobs (id, type, params, region, account, state, '
+            'submitted_time) VALUES (?, ?, ?, ?, ?, ?, ?)',
+            job_id, job_type, json.dumps(params), region, account,
+            JOB_QUEUED, time.time()
+        )
+        log.debug('Queued %s job %s', job_type, job_id)
+        return self.get(job_id)
+
+    def get(self, job_id):
+        """ Return the Job with the given id, or None. """
+        rows = self._query(
+            'SELECT %s FROM jobs WHERE id = ?' % _JOB_COLUMNS, job_id)
+        if not rows:
+            return None
+        return _row_to_job(rows[0])
+
+    def list_jobs(self, state=None, limit=100):
+        """ Return the most recently submitted jobs, newest first. """
+        if state:
+            rows = self._query(
+                'SELECT %s FROM jobs WHERE state = ? ORDER BY seq DESC '
+                'LIMIT ?' % _JOB_COLUMNS, state, limit)
+        else:
+            rows = self._query(
+                'SELECT %s FROM jobs ORDER BY seq DESC LIMIT ?' %
+                _JOB_COLUMNS, limit)
+        return [_row_to_job(row) for row in rows]
+
+    def claim(self, is_allowed=None):
+        """ Mark the oldest queued job that is_allowed(job) accepts as
+        running.  Jobs that is_allowed() rejects stay in the queue, so a
+        busy region doesn't hold up jobs for other regions.
+
+        :return the claimed Job, or None if there is no job to run
+        """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT %s FROM jobs WHERE state = ? ORDER BY seq' %
+                _JOB_COLUMNS, (JOB_QUEUED,)
+            ).fetchall()
+            for row in rows:
+                job = _row_to_job(row)
+                if is_allowed and not is_allowed(job):
+                    continue
+                now = time.time()
+                self._db.execute(
+                    'UPDATE jobs SET state = ?, start_time = ? WHERE id = ?',
+                    (JOB_RUNNING, now, job.id)
+                )
+                self._db.commit()
+                return job._replace(state=JOB_RUNNING, start_time=now)
+        return None
+
+    def start(self, job_id):
+        """ Mark the queued job with the given id as running.
+
+        :return True if the job was queued
+        """
+        cursor = self._execute(
+            'UPDATE jobs SET state = ?, start_time = ? '
+            'WHERE id = ? AND state = ?',
+            JOB_RUNNING, time.time(), job_id, JOB_QUEUED
+        )
+        return cursor.rowcount == 1
+
+    def requeue(self, job_id):
+        """ Put a job that is running or failed back in the queue, so that
+        it runs again.
+
+        :return True if the job was requeued
+        """
+        cursor = self._execute(
+            'UPDATE jobs SET state = ?, start_time = NULL, end_time = NULL, '
+            'progress_state = NULL, percent_complete = NULL, result = NULL, '
+            'error = NULL WHERE id = ? AND state IN (?, ?)',
+            JOB_QUEUED, job_id, JOB_RUNNING, JOB_FAILED
+        )
+        return cursor.rowcount == 1
+
+    def set_progress(self, job_id, progress_state, percent_complete):
+        self._execute(
+            'UPDATE jobs SET progress_state = ?, percent_complete = ? '
+            'WHERE id = ?',
+            progress_state, percent_complete, job_id
+        )
+
+    def finish(self, job_id, result=None, error=None):
+        """ Mark the job as succeeded, or failed if error is specified. """
+        state = JOB_FAILED if error else JOB_SUCCEEDED
+        self._execute(
+            'UPDATE jobs SET state = ?, end_time = ?, result = ?, error = ? '
+            'WHERE id = ?',
+            state, time.time(), result, error, job_id
+        )
+        log.debug('Job %s %s', job_id, state)
+
+    def recover(self):
+        """ Mark jobs that were running when the server stopped as failed.
+
+        :return the number of jobs that were marked as failed
+        """
+        cursor = self._execute(
+            'UPDATE jobs SET state = ?, end_time = ?, error = ? '
+            'WHERE state = ?',
+            JOB_FAILED, time.time(),
+            'The server stopped while the job was running', JOB_RUNNING
+        )
+        return cursor.rowcount
+
+    def add_log(self, job_id, message):
+        self._execute(
+            'INSERT INTO job_log (job_id, time, message) VALUES (?, ?, ?)',
+            job_id, time.time(), message
+        )
+
+    def get_log(self, job_id, offset=0):
+        """ Return the job's log lines, starting at the given offset. """
+        rows = self._query(
+            'SELECT time, message FROM job_log WHERE job_id = ? '
+            'ORDER BY seq LIMIT -1 OFFSET ?',
+            job_id, offset
+        )
+        return [LogLine(*row) for row in rows]
+
+    def close(self):
+        with self._lock:
+            self._db.close()
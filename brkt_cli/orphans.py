@@ -0,0 +1,229 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Decides which of the resources that encryption and update sessions
+created were left behind by sessions that are no longer running.
+
+brkt_cli.aws.orphans and brkt_cli.gce.orphans list the resources in an
+AWS region or GCE project, as Resource objects that are grouped by
+session.  A session is dead if its newest resource is older than
+min_age seconds and none of its instances is running, or if its newest
+resource is older than max_age seconds, in which case its running
+instances are assumed to be stuck.
+"""
+
+from __future__ import print_function
+
+import argparse
+import calendar
+import collections
+import logging
+import time
+
+import iso8601
+
+from brkt_cli import util
+
+log = logging.getLogger(__name__)
+
+RESOURCE_INSTANCE = 'instance'
+RESOURCE_VOLUME = 'volume'
+RESOURCE_DISK = 'disk'
+RESOURCE_SNAPSHOT = 'snapshot'
+RESOURCE_SECURITY_GROUP = 'security-group'
+RESOURCE_IMAGE = 'image'
+
+DEFAULT_MIN_AGE = 6 * 60 * 60
+DEFAULT_MAX_AGE = 48 * 60 * 60
+
+# created_time is in seconds since the epoch, or None if the cloud
+# doesn't report it.  live is True for instances that are running.
+# location is the GCE zone, or None.
+Resource = collections.namedtuple(
+    'Resource', ['type', 'id', 'created_time', 'live', 'location'])
+
+
+def parse_time(timestamp):
+    """ Convert an ISO 8601 timestamp to seconds since the epoch. """
+    if not timestamp:
+        return None
+    return calendar.timegm(iso8601.parse_date(timestamp).utctimetuple())
+
+
+class OrphanedSession(object):
+    """ The resources that one session left behind. """
+
+    def __init__(self, session_id):
+        """
+        :param session_id the session id, or None for resources that can't
+            be attributed to a session
+        """
+        self.session_id = session_id
+        self.resources = []
+
+    def get_resources(self, resource_type):
+        return [r for r in self.resources if r.type == resource_type]
+
+    def get_ids(self, resource_type):
+        return [r.id for r in self.get_resources(resource_type)]
+
+    def get_created_time(self):
+        """ Return the creation time of the newest resource, or None if
+        the creation times are unknown.
+        """
+        times = [r.created_time for r in self.resources if r.created_time]
+        return max(times) if times else None
+
+    def is_live(self):
+        return any(r.live for r in self.resources)
+
+    def __repr__(self):
+        return 'OrphanedSession(%s, %d resources)' % (
+            self.session_id, len(self.resources))
+
+
+def group_by_session(resources):
+    """ Group resources by session.
+
+    :param resources a list of (session_id, Resource) tuples
+    :return a list of OrphanedSession objects, sorted by session id
+    """
+    sessions = collections.OrderedDict()
+    for session_id, resource in sorted(
+            resources, key=lambda t: (t[0] or '', t[1].type, t[1].id)):
+        session = sessions.get(session_id)
+        if not session:
+            session = OrphanedSession(session_id)
+            sessions[session_id] = session
+        session.resources.append(resource)
+    return sessions.values()
+
+
+def is_dead(session, min_age=DEFAULT_MIN_AGE, max_age=DEFAULT_MAX_AGE,
+            now=None):
+    """ Return True if the session's resources can be deleted.  A session
+    whose creation times are all unknown is never dead.  For example, a
+    session that is waiting for an encryptor slot only has its security
+    group, whose creation time isn't reported.
+    """
+    now = now or time.time()
+    created_time = session.get_created_time()
+    if created_time is None:
+        return False
+    age = now - created_time
+    if age >= max_age:
+        return True
+    return age >= min_age and not session.is_live()
+
+
+def get_dead_sessions(sessions, min_age=DEFAULT_MIN_AGE,
+                      max_age=DEFAULT_MAX_AGE, now=None):
+    return [
+        s for s in sessions
+        if is_dead(s, min_age=min_age, max_age=max_age, now=now)
+    ]
+
+
+def format_age(seconds):
+    if seconds is None:
+        return '-'
+    hours = int(seconds) // 3600
+    if hours >= 48:
+        return '%dd' % (hours // 24)
+    return '%dh%02dm' % (hours, (int(seconds) % 3600) // 60)
+
+
+def render_report(sessions, dead_sessions, now=None):
+    """ Return a table with one row per resource, that shows whether
+    the resource will be deleted.
+    """
+    now = now or time.time()
+    dead_ids = set(id(s) for s in dead_sessions)
+    rows = [['SESSION', 'TYPE', 'ID', 'LOCATION', 'AGE', 'ACTION']]
+    for session in sessions:
+        action = 'delete' if id(session) in dead_ids else 'keep'
+        for r in session.resources:
+            age = now - r.created_time if r.created_time else None
+            rows.append([
+                session.session_id or '-', r.type, r.id, r.location or '-',
+                format_age(age), action
+            ])
+    return util.render_table_rows(rows)
+
+
+def collect_garbage(resources, delete_sessions, min_age=DEFAULT_MIN_AGE,
+                    max_age=DEFAULT_MAX_AGE, dry_run=False, now=None):
+    """ Print a report of the resources, and delete the resources of the
+    sessions that are dead.
+
+    :param resources a list of (session_id, Resource) tuples
+    :param delete_sessions a function that takes a list of OrphanedSession
+        objects and deletes their resources
+    :return the dead sessions
+    """
+    sessions = group_by_session(resources)
+    if not sessions:
+        log.info('No resources were left behind')
+        return []
+    dead_sessions = get_dead_sessions(
+        sessions, min_age=min_age, max_age=max_age, now=now)
+    print(render_report(sessions, dead_sessions, now=now))
+    if dry_run:
+        log.info(
+            'Dry run: not deleting resources from %d sessions',
+            len(dead_sessions))
+    elif dead_sessions:
+        delete_sessions(dead_sessions)
+    return dead_sessions
+
+
+def _hours(value):
+    try:
+        hours = float(value)
+    except ValueError:
+        hours = -1
+    if hours < 0:
+        raise argparse.ArgumentTypeError(
+            '%s is not a valid number of hours' % value)
+    return int(hours * 60 * 60)
+
+
+def setup_gc_args(parser):
+    parser.add_argument(
+        '--min-age',
+        metavar='HOURS',
+        type=_hours,
+        # argparse converts string defaults with the type function.
+        default=str(DEFAULT_MIN_AGE // 3600),
+        help=(
+            'Delete the resources of sessions that are at least this many '
+            'hours old and have no running instances'
+        )
+    )
+    parser.add_argument(
+        '--max-age',
+        metavar='HOURS',
+        type=_hours,
+        default=str(DEFAULT_MAX_AGE // 3600),
+        help=(
+            'Delete the resources of sessions that are at least this many '
+            'hours old, even if their instances are running'
+        )
+    )
+    parser.add_argument(
+        '--dry-run',
+        action='store_true',
+        help='Print the resources that would be deleted, and exit'
+    )
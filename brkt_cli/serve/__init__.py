@@ -0,0 +1,152 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import errno
+import logging
+import os
+
+import brkt_cli
+from brkt_cli import session
+from brkt_cli.config import CONFIG_DIR
+from brkt_cli.job_queue import JobQueue
+from brkt_cli.serve.server import HTTPServer, JobServer
+from brkt_cli.subcommand import Subcommand
+from brkt_cli.validation import ValidationError
+
+log = logging.getLogger(__name__)
+
+DEFAULT_DATABASE_PATH = os.path.join(CONFIG_DIR, 'jobs.db')
+DEFAULT_PORT = 8470
+
+
+class ServeSubcommand(Subcommand):
+
+    def name(self):
+        return 'serve'
+
+    def register(self, subparsers, parsed_config):
+        parser = subparsers.add_parser(
+            self.name(),
+            description=(
+                'Run a local HTTP server that accepts encryption and update '
+                'jobs, stores them in a queue, and runs them.'
+            ),
+            formatter_class=brkt_cli.SortingHelpFormatter
+        )
+        parser.add_argument(
+            '--host',
+            default='127.0.0.1',
+            help='The address that the HTTP server listens on'
+        )
+        parser.add_argument(
+            '--port',
+            type=int,
+            default=DEFAULT_PORT,
+            help='The port that the HTTP server listens on'
+        )
+        parser.add_argument(
+            '--database',
+            metavar='PATH',
+            default=DEFAULT_DATABASE_PATH,
+            help='The SQLite database that stores the job queue'
+        )
+        parser.add_argument(
+            '--max-jobs',
+            metavar='N',
+            type=int,
+            default=4,
+            help='The maximum number of jobs that run at once'
+        )
+        parser.add_argument(
+            '--max-jobs-per-region',
+            metavar='N',
+            type=int,
+            help=(
+                'The maximum number of jobs that run at once in an AWS '
+                'region or GCE zone'
+            )
+        )
+        parser.add_argument(
+            '--max-jobs-per-account',
+            metavar='N',
+            type=int,
+            help=(
+                'The maximum number of jobs that run at once in an account. '
+                'The account is specified by the "account" job parameter, '
+                'or the GCE project.'
+            )
+        )
+        parser.add_argument(
+            '--token',
+            help=(
+                'Default token that encrypted instances use to communicate '
+                'with the Bracket service, for jobs that don\'t specify one'
+            ),
+            metavar='TOKEN'
+        )
+        parser.add_argument(
+            '-v',
+            '--verbose',
+            dest='serve_verbose',
+            action='store_true',
+            help='Print status information to the console'
+        )
+
+    def verbose(self, values):
+        return values.serve_verbose
+
+    def run(self, values):
+        for name in ('max_jobs', 'max_jobs_per_region',
+                     'max_jobs_per_account'):
+            value = getattr(values, name)
+            if value is not None and value < 1:
+                raise ValidationError(
+                    '--%s must be at least 1' % name.replace('_', '-'))
+        brkt_cli.validate_jwt(values.token)
+
+        db_dir = os.path.dirname(os.path.abspath(values.database))
+        try:
+            os.makedirs(db_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise ValidationError(
+                    'Unable to create %s: %s' % (db_dir, e))
+
+        session.install_log_filter()
+        job_queue = JobQueue(values.database)
+        job_server = JobServer(
+            job_queue,
+            max_jobs=values.max_jobs,
+            max_jobs_per_region=values.max_jobs_per_region,
+            max_jobs_per_account=values.max_jobs_per_account,
+            token=values.token
+        )
+        http_server = HTTPServer(
+            job_server, host=values.host, port=values.port)
+        job_server.start()
+        log.info(
+            'Serving on http://%s:%d, jobs are stored in %s',
+            values.host, http_server.port, values.database
+        )
+        try:
+            http_server.serve_forever()
+        finally:
+            log.info('Waiting for running jobs to complete')
+            http_server.server_close()
+            job_server.stop()
+            job_queue.close()
+        return 0
+
+
+def get_subcommands():
+    return [ServeSubcommand()]
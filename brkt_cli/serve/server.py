@@ -0,0 +1,428 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Runs encryption jobs from a JobQueue, and exposes them over a local
+HTTP/JSON API.
+
+    POST /jobs                  {"type": "encrypt-ami",
+                                 "params": {"region": "us-west-2",
+                                            "ami": "ami-12345678"}}
+    GET  /jobs[?state=running]  list jobs, newest first
+    GET  /jobs/<id>             job status and progress
+    GET  /jobs/<id>/log         log messages, starting at ?offset=N
+
+A job's id is also the id of its encryption session, so it appears in
+the tags of the resources that the job creates.  Clients are cached by
+region or GCE project, so that connections, credentials and the
+encryptor AMI list are reused across jobs.  All jobs share one
+StatusPoller, which polls their encryptor instances from a single thread.
+"""
+
+import BaseHTTPServer
+import collections
+import inspect
+import json
+import logging
+import SocketServer
+import threading
+import urlparse
+
+from brkt_cli import api, encryptor_service
+from brkt_cli.session import get_current_session
+from brkt_cli.status_poller import StatusPoller
+from brkt_cli.validation import ValidationError
+
+log = logging.getLogger(__name__)
+
+# client_class: the api client that runs the job.
+# client_params: job parameters that are passed to the client's constructor.
+# method_name: the client method that starts the job.
+_JobType = collections.namedtuple(
+    '_JobType', ['client_class', 'client_params', 'method_name'])
+
+JOB_TYPES = {
+    'encrypt-ami': _JobType(
+        api.Client, ['region'], 'encrypt_ami_async'),
+    'update-encrypted-ami': _JobType(
+        api.Client, ['region'], 'update_ami_async'),
+    'encrypt-gce-image': _JobType(
+        api.GCEClient, ['project', 'zone', 'network'],
+        'encrypt_image_async'),
+    'update-gce-image': _JobType(
+        api.GCEClient, ['project', 'zone', 'network'], 'update_image_async')
+}
+
+# Job parameters that are not passed to the client's method.  account is
+# only used for concurrency caps.
+_RESERVED_PARAMS = set(['account'])
+
+# Method arguments that are set by the server.
+_SERVER_ARGS = set(
+    ['self', 'instance_config', 'progress_callback', 'session_id'])
+
+
+def _get_method_args(job_type):
+    method = getattr(job_type.client_class, job_type.method_name)
+    return [a for a in inspect.getargspec(method).args
+            if a not in _SERVER_ARGS]
+
+
+def _get_required_args(cls_or_method):
+    if inspect.isclass(cls_or_method):
+        cls_or_method = cls_or_method.__init__
+    spec = inspect.getargspec(cls_or_method)
+    num_optional = len(spec.defaults or [])
+    return [a for a in spec.args[:len(spec.args) - num_optional]
+            if a not in _SERVER_ARGS]
+
+
+def validate_job(job_type_name, params):
+    """ Check that the job type exists and that the parameters are valid
+    for it.
+
+    :return the region and account that the job runs in
+    :raise ValidationError if the job is invalid
+    """
+    job_type = JOB_TYPES.get(job_type_name)
+    if not job_type:
+        raise ValidationError(
+            'Unknown job type %s.  Valid types: %s' %
+            (job_type_name, ', '.join(sorted(JOB_TYPES.keys())))
+        )
+    if not isinstance(params, dict):
+        raise ValidationError('Job params must be a JSON object')
+
+    valid = set(_get_method_args(job_type) + job_type.client_params)
+    valid |= _RESERVED_PARAMS
+    unknown = set(params.keys()) - valid
+    if unknown:
+        raise ValidationError(
+            'Invalid parameters for %s: %s' %
+            (job_type_name, ', '.join(sorted(unknown)))
+        )
+    required = _get_required_args(job_type.client_class)
+    required += _get_required_args(
+        getattr(job_type.client_class, job_type.method_name))
+    missing = [p for p in required if p not in params]
+    if missing:
+        raise ValidationError(
+            'Missing parameters for %s: %s' %
+            (job_type_name, ', '.join(missing))
+        )
+
+    if job_type.client_class == api.GCEClient:
+        region = params.get('zone')
+        account = params.get('account') or params['project']
+    else:
+        region = params['region']
+        account = params.get('account')
+    return region, account or 'default'
+
+
+class _JobLogHandler(logging.Handler):
+    """ Stores messages that are logged by a running job's session in the
+    job queue.
+    """
+
+    def __init__(self, job_server):
+        super(_JobLogHandler, self).__init__()
+        self.job_server = job_server
+
+    def emit(self, record):
+        session_id = getattr(record, 'session_id', None)
+        if not session_id:
+            session = get_current_session()
+            session_id = session.session_id if session else None
+        if not session_id or not self.job_server.is_running(session_id):
+            return
+        try:
+            self.job_server.job_queue.add_log(session_id, self.format(record))
+        except Exception:
+            self.handleError(record)
+
+
+class JobServer(object):
+    """ Runs queued jobs, subject to concurrency caps. """
+
+    def __init__(self, job_queue, max_jobs=4, max_jobs_per_region=None,
+                 max_jobs_per_account=None, brkt_env=None, token=None,
+                 enc_svc_cls=encryptor_service.EncryptorService):
+        """
+        :param max_jobs the maximum number of jobs that run at once
+        :param max_jobs_per_region the maximum number of jobs that run at
+            once in an AWS region or GCE zone, or None for no limit
+        :param max_jobs_per_account the maximum number of jobs that run at
+            once in an account, or None for no limit
+        :param token the default launch token, used when a job doesn't
+            specify one
+        """
+        self.job_queue = job_queue
+        self.max_jobs = max_jobs
+        self.max_jobs_per_region = max_jobs_per_region
+        self.max_jobs_per_account = max_jobs_per_account
+        self.brkt_env = brkt_env
+        self.token = token
+        self.enc_svc_cls = enc_svc_cls
+        self.status_poller = StatusPoller()
+
+        self._condition = threading.Condition()
+        self._stopping = False
+        self._dispatcher = None
+        # Maps job id to the Job, for jobs that are running.
+        self._running = {}
+        # Maps (client class, client params) to a client.
+        self._clients = {}
+        self._log_handler = _JobLogHandler(self)
+
+    def start(self):
+        """ Start running queued jobs. """
+        failed = self.job_queue.recover()
+        if failed:
+            log.warn(
+                '%d jobs were running when the server stopped, and were '
+                'marked as failed', failed)
+        logging.getLogger().addHandler(self._log_handler)
+        self._dispatcher = threading.Thread(
+            target=self._dispatch, name='brkt-serve-dispatcher')
+        self._dispatcher.daemon = True
+        self._dispatcher.start()
+
+    def stop(self, wait=True):
+        """ Stop starting new jobs.  If wait is True, wait for running jobs
+        to complete.
+        """
+        with self._condition:
+            self._stopping = True
+            self._condition.notify_all()
+        if self._dispatcher:
+            self._dispatcher.join()
+        for client in self._clients.values():
+            client.shutdown(wait=wait)
+        self.status_poller.stop()
+        logging.getLogger().removeHandler(self._log_handler)
+
+    def submit(self, job_type, params):
+        """ Add a job to the queue.
+
+        :return the new Job
+        :raise ValidationError if the job is invalid
+        """
+        region, account = validate_job(job_type, params)
+        job = self.job_queue.submit(
+            job_type, params, region=region, account=account)
+        log.info('Queued %s job %s', job_type, job.id)
+        with self._condition:
+            self._condition.notify_all()
+        return job
+
+    def is_running(self, job_id):
+        # Called by the log handler, so it doesn't take the condition.
+        # Otherwise, a thread that logs while holding the condition could
+        # deadlock with a thread that holds the handler's lock.
+        return job_id in self._running
+
+    def get_running_count(self):
+        with self._condition:
+            return len(self._running)
+
+    def _is_allowed(self, job):
+        """ Return True if running the job would not exceed the caps.
+        Called with the condition held.
+        """
+        running = self._running.values()
+        if self.max_jobs_per_region is not None:
+            in_region = [j for j in running if j.region == job.region]
+            if len(in_region) >= self.max_jobs_per_region:
+                return False
+        if self.max_jobs_per_account is not None:
+            in_account = [j for j in running if j.account == job.account]
+            if len(in_account) >= self.max_jobs_per_account:
+                return False
+        return True
+
+    def _dispatch(self):
+        while True:
+            with self._condition:
+                if self._stopping:
+                    return
+                job = None
+                if len(self._running) < self.max_jobs:
+                    job = self.job_queue.claim(self._is_allowed)
+                if not job:
+                    # Wake up periodically, in case a job was added to the
+                    # database by another process.
+                    self._condition.wait(5)
+                    continue
+                self._running[job.id] = job
+            self._start_job(job)
+
+    def _get_client(self, job_type, params):
+        client_params = tuple(
+            (p, params[p]) for p in job_type.client_params if p in params)
+        key = (job_type.client_class, client_params)
+        client = self._clients.get(key)
+        if not client:
+            client = self._new_client(job_type.client_class,
+                                      dict(client_params))
+            self._clients[key] = client
+        return client
+
+    def _new_client(self, client_class, client_params):
+        return client_class(
+            brkt_env=self.brkt_env,
+            max_workers=self.max_jobs,
+            enc_svc_cls=self.status_poller.bind(self.enc_svc_cls),
+            **client_params
+        )
+
+    def _start_job(self, job):
+        """ Start running the job on its client. """
+        log.info('Starting %s job %s', job.type, job.id)
+        job_type = JOB_TYPES[job.type]
+        params = dict(job.params)
+        kwargs = dict(
+            (p, params[p]) for p in _get_method_args(job_type)
+            if p in params
+        )
+        if self.token and not kwargs.get('token'):
+            kwargs['token'] = self.token
+
+        def _on_progress(future, progress):
+            self.job_queue.set_progress(
+                job.id, progress.state, progress.percent_complete)
+
+        try:
+            client = self._get_client(job_type, params)
+            method = getattr(client, job_type.method_name)
+            future = method(
+                session_id=job.id, progress_callback=_on_progress, **kwargs)
+        except Exception as e:
+            log.debug('Unable to start job %s', job.id, exc_info=True)
+            self._finish_job(job, error=str(e) or e.__class__.__name__)
+            return
+        future.add_done_callback(lambda f: self._on_done(job, f))
+
+    def _on_done(self, job, future):
+        exception = future.exception()
+        if exception:
+            log.info('Job %s failed: %s', job.id, exception)
+            error = str(exception) or exception.__class__.__name__
+            self._finish_job(job, error=error)
+        else:
+            log.info('Job %s completed: %s', job.id, future.result())
+            self._finish_job(job, result=future.result())
+
+    def _finish_job(self, job, result=None, error=None):
+        self.job_queue.finish(job.id, result=result, error=error)
+        with self._condition:
+            self._running.pop(job.id, None)
+            self._condition.notify_all()
+
+
+class _RequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        log.debug('%s %s', self.address_string(), format % args)
+
+    def _send_json(self, status, content):
+        body = json.dumps(content, indent=2, sort_keys=True)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, status, message):
+        self._send_json(status, {'error': message})
+
+    def _parse_path(self):
+        url = urlparse.urlparse(self.path)
+        parts = [p for p in url.path.split('/') if p]
+        query = dict(urlparse.parse_qsl(url.query))
+        return parts, query
+
+    def do_GET(self):
+        parts, query = self._parse_path()
+        job_queue = self.server.job_server.job_queue
+        if parts == ['jobs']:
+            try:
+                limit = int(query.get('limit', 100))
+            except ValueError:
+                self._send_error(400, 'limit must be an integer')
+                return
+            jobs = job_queue.list_jobs(state=query.get('state'), limit=limit)
+            self._send_json(200, {'jobs': [j._asdict() for j in jobs]})
+            return
+        if len(parts) not in (2, 3) or parts[0] != 'jobs':
+            self._send_error(404, 'Not found: %s' % self.path)
+            return
+
+        job = job_queue.get(parts[1])
+        if not job:
+            self._send_error(404, 'Job %s not found' % parts[1])
+        elif len(parts) == 2:
+            self._send_json(200, job._asdict())
+        elif parts[2] == 'log':
+            try:
+                offset = int(query.get('offset', 0))
+            except ValueError:
+                self._send_error(400, 'offset must be an integer')
+                return
+            lines = job_queue.get_log(job.id, offset=offset)
+            self._send_json(200, {
+                'job_id': job.id,
+                'offset': offset,
+                'lines': [l._asdict() for l in lines]
+            })
+        else:
+            self._send_error(404, 'Not found: %s' % self.path)
+
+    def do_POST(self):
+        parts, _ = self._parse_path()
+        if parts != ['jobs']:
+            self._send_error(404, 'Not found: %s' % self.path)
+            return
+        try:
+            length = int(self.headers.getheader('Content-Length') or 0)
+            request = json.loads(self.rfile.read(length))
+        except ValueError as e:
+            self._send_error(400, 'Invalid JSON: %s' % e)
+            return
+        if not isinstance(request, dict):
+            self._send_error(400, 'Request must be a JSON object')
+            return
+
+        try:
+            job = self.server.job_server.submit(
+                request.get('type'), request.get('params', {}))
+        except ValidationError as e:
+            self._send_error(400, str(e))
+            return
+        self._send_json(201, job._asdict())
+
+
+class HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """ Serves the HTTP API for a JobServer. """
+
+    daemon_threads = True
+
+    def __init__(self, job_server, host='127.0.0.1', port=0):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, (host, port), _RequestHandler)
+        self.job_server = job_server
+
+    @property
+    def port(self):
+        return self.server_address[1]
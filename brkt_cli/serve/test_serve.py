@@ -0,0 +1,265 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import urllib2
+
+from brkt_cli import job_queue, util
+from brkt_cli.aws.test_aws_service import build_aws_service
+from brkt_cli.job_queue import JobQueue
+from brkt_cli.serve import server
+from brkt_cli.session import SessionContext
+from brkt_cli.test_api import DummyClient
+from brkt_cli.validation import ValidationError
+
+
+class TestJobQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'jobs.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_claim_order(self):
+        q = JobQueue(self.path)
+        j1 = q.submit('encrypt-ami', {'ami': 'ami-1'}, region='us-west-2')
+        j2 = q.submit('encrypt-ami', {'ami': 'ami-2'}, region='us-west-2')
+        j3 = q.submit('encrypt-ami', {'ami': 'ami-3'}, region='us-east-1')
+        self.assertEqual({'ami': 'ami-1'}, j1.params)
+        self.assertEqual(job_queue.JOB_QUEUED, j1.state)
+
+        claimed = q.claim()
+        self.assertEqual(j1.id, claimed.id)
+        self.assertEqual(job_queue.JOB_RUNNING, claimed.state)
+
+        # Jobs that aren't allowed to run stay in the queue.
+        claimed = q.claim(lambda job: job.region != 'us-west-2')
+        self.assertEqual(j3.id, claimed.id)
+        self.assertIsNone(q.claim(lambda job: job.region != 'us-west-2'))
+        self.assertEqual(j2.id, q.claim().id)
+        self.assertIsNone(q.claim())
+
+        q.set_progress(j1.id, 'encrypting', 50)
+        self.assertEqual(50, q.get(j1.id).percent_complete)
+        q.finish(j1.id, result='ami-encrypted')
+        q.finish(j2.id, error='failed')
+        self.assertEqual(job_queue.JOB_SUCCEEDED, q.get(j1.id).state)
+        self.assertEqual('ami-encrypted', q.get(j1.id).result)
+        self.assertEqual(job_queue.JOB_FAILED, q.get(j2.id).state)
+        self.assertEqual(
+            [j3.id], [j.id for j in q.list_jobs(job_queue.JOB_RUNNING)])
+        self.assertEqual(
+            [j3.id, j2.id, j1.id], [j.id for j in q.list_jobs()])
+        self.assertIsNone(q.get('unknown'))
+        q.close()
+
+    def test_persistence(self):
+        """ Test that queued jobs survive a restart, and that jobs that were
+        running are marked as failed.
+        """
+        q = JobQueue(self.path)
+        running = q.submit('encrypt-ami', {})
+        queued = q.submit('encrypt-ami', {})
+        q.claim()
+        q.add_log(running.id, 'line 1')
+        q.add_log(running.id, 'line 2')
+        q.close()
+
+        q = JobQueue(self.path)
+        self.assertEqual(1, q.recover())
+        self.assertEqual(job_queue.JOB_FAILED, q.get(running.id).state)
+        self.assertEqual(queued.id, q.claim().id)
+        self.assertEqual(
+            ['line 1', 'line 2'],
+            [l.message for l in q.get_log(running.id)]
+        )
+        self.assertEqual(
+            ['line 2'], [l.message for l in q.get_log(running.id, offset=1)])
+
+        # Failed jobs can be requeued, but succeeded jobs can't.
+        self.assertTrue(q.requeue(running.id))
+        self.assertEqual(job_queue.JOB_QUEUED, q.get(running.id).state)
+        self.assertIsNone(q.get(running.id).error)
+        q.finish(queued.id, result='ami-encrypted')
+        self.assertFalse(q.requeue(queued.id))
+        q.close()
+
+
+class TestValidateJob(unittest.TestCase):
+
+    def test_validate(self):
+        self.assertEqual(
+            ('us-west-2', 'default'),
+            server.validate_job(
+                'encrypt-ami', {'region': 'us-west-2', 'ami': 'ami-1'})
+        )
+        self.assertEqual(
+            ('us-central1-a', 'my-project'),
+            server.validate_job(
+                'update-gce-image',
+                {'project': 'my-project', 'zone': 'us-central1-a',
+                 'image': 'image-1'}
+            )
+        )
+        with self.assertRaises(ValidationError):
+            server.validate_job('unknown', {})
+        with self.assertRaises(ValidationError):
+            server.validate_job('encrypt-ami', {'region': 'us-west-2'})
+        with self.assertRaises(ValidationError):
+            server.validate_job(
+                'encrypt-ami',
+                {'region': 'us-west-2', 'ami': 'ami-1', 'bogus': 1}
+            )
+        with self.assertRaises(ValidationError):
+            server.validate_job(
+                'encrypt-ami', {'region': 'us-west-2', 'session_id': 'x'})
+
+
+class _DummyClient(DummyClient):
+    """ Runs each session against the same DummyAWSService. """
+
+    def _new_aws_service(self, session_id=None):
+        self.aws_svc.session = SessionContext(session_id)
+        return self.aws_svc
+
+
+class _DummyJobServer(server.JobServer):
+
+    def __init__(self, job_queue, aws_svc, **kwargs):
+        super(_DummyJobServer, self).__init__(job_queue, **kwargs)
+        self.aws_svc = aws_svc
+
+    def _new_client(self, client_class, client_params):
+        return _DummyClient(self.aws_svc)
+
+
+class TestJobServer(unittest.TestCase):
+
+    def setUp(self):
+        util.SLEEP_ENABLED = False
+        self.root_level = logging.getLogger().level
+        logging.getLogger().setLevel(logging.INFO)
+
+    def tearDown(self):
+        logging.getLogger().setLevel(self.root_level)
+
+    def test_is_allowed(self):
+        job_server = server.JobServer(
+            JobQueue(':memory:'), max_jobs_per_region=1,
+            max_jobs_per_account=2)
+        q = job_server.job_queue
+        j1 = q.submit('encrypt-ami', {}, region='r1', account='a1')
+        j2 = q.submit('encrypt-ami', {}, region='r1', account='a1')
+        j3 = q.submit('encrypt-ami', {}, region='r2', account='a1')
+        j4 = q.submit('encrypt-ami', {}, region='r3', account='a1')
+        job_server._running[j1.id] = j1
+        self.assertFalse(job_server._is_allowed(j2))
+        self.assertTrue(job_server._is_allowed(j3))
+        job_server._running[j3.id] = j3
+        self.assertFalse(job_server._is_allowed(j4))
+
+    def _request(self, port, path, body=None):
+        url = 'http://127.0.0.1:%d%s' % (port, path)
+        data = json.dumps(body) if body is not None else None
+        try:
+            response = urllib2.urlopen(url, data, timeout=10)
+            return response.getcode(), json.loads(response.read())
+        except urllib2.HTTPError as e:
+            return e.code, json.loads(e.read())
+
+    def test_http_api(self):
+        aws_svc, encryptor_image, guest_image = build_aws_service()
+        job_server = _DummyJobServer(
+            JobQueue(':memory:'), aws_svc, max_jobs=1)
+        http_server = server.HTTPServer(job_server)
+        port = http_server.port
+        t = threading.Thread(target=http_server.serve_forever)
+        t.daemon = True
+        t.start()
+        job_server.start()
+
+        try:
+            status, job = self._request(port, '/jobs', {
+                'type': 'encrypt-ami',
+                'params': {
+                    'region': 'us-west-2',
+                    'ami': guest_image.id,
+                    'encryptor_ami': encryptor_image.id,
+                    'validate': False
+                }
+            })
+            self.assertEqual(201, status)
+
+            deadline = util.Deadline(30)
+            while job['state'] in (job_queue.JOB_QUEUED,
+                                   job_queue.JOB_RUNNING):
+                self.assertFalse(deadline.is_expired())
+                time.sleep(0.05)
+                status, job = self._request(port, '/jobs/' + job['id'])
+                self.assertEqual(200, status)
+            self.assertEqual(job_queue.JOB_SUCCEEDED, job['state'])
+            self.assertIn(job['result'], aws_svc.images)
+            self.assertEqual(100, job['percent_complete'])
+
+            # The job id is the session id.
+            self.assertEqual(job['id'], aws_svc.session_id)
+            status, content = self._request(
+                port, '/jobs/%s/log' % job['id'])
+            self.assertEqual(200, status)
+            self.assertTrue(content['lines'])
+
+            status, content = self._request(port, '/jobs')
+            self.assertEqual([job['id']], [j['id'] for j in content['jobs']])
+
+            status, content = self._request(
+                port, '/jobs', {'type': 'bogus', 'params': {}})
+            self.assertEqual(400, status)
+            self.assertIn('bogus', content['error'])
+            status, _ = self._request(port, '/jobs/unknown')
+            self.assertEqual(404, status)
+        finally:
+            http_server.shutdown()
+            http_server.server_close()
+            job_server.stop()
+
+    def test_job_fails_to_start(self):
+        """ Test that a job is marked as failed when the client raises an
+        exception before the job starts.
+        """
+        class _FailingJobServer(server.JobServer):
+            def _new_client(self, client_class, client_params):
+                raise ValidationError('Unsupported region')
+
+        job_server = _FailingJobServer(JobQueue(':memory:'))
+        job_server.start()
+        try:
+            job = job_server.submit(
+                'encrypt-ami', {'region': 'us-west-2', 'ami': 'ami-1'})
+            deadline = util.Deadline(10)
+            while job.state != job_queue.JOB_FAILED:
+                self.assertFalse(deadline.is_expired())
+                time.sleep(0.05)
+                job = job_server.job_queue.get(job.id)
+            self.assertEqual('Unsupported region', job.error)
+            self.assertEqual(0, job_server.get_running_count())
+        finally:
+            job_server.stop()
@@ -0,0 +1,135 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+State that belongs to a single encryptor or updater session.
+
+Keeping this state on a SessionContext instead of in process-wide globals
+like os.environ allows several sessions to run in the same process.
+"""
+
+import contextlib
+import logging
+import threading
+
+from brkt_cli import util
+
+log = logging.getLogger(__name__)
+
+RESOURCE_DISK = 'disk'
+RESOURCE_INSTANCE = 'instance'
+
+_current = threading.local()
+
+
+class SessionContext(object):
+
+    def __init__(self, session_id=None):
+        self.session_id = session_id or util.make_nonce()
+        self.log_prefix = '[%s] ' % self.session_id
+
+        # Hosts that brkt-cli connects to directly, bypassing any HTTP
+        # proxy that is configured in the environment.
+        self.no_proxy_hosts = []
+
+        self._lock = threading.Lock()
+        # Maps resource type to a list of ids.
+        self._resources = {}
+        self._progress_callbacks = []
+
+    def add_progress_callback(self, callback):
+        """ Call callback(state, percent_complete) each time the encryptor
+        or updater reports its status while this session is active.
+        """
+        with self._lock:
+            self._progress_callbacks.append(callback)
+
+    def report_progress(self, state, percent_complete):
+        with self._lock:
+            callbacks = list(self._progress_callbacks)
+        for callback in callbacks:
+            try:
+                callback(state, percent_complete)
+            except Exception:
+                log.exception('Progress callback %s failed', callback)
+
+    def add_no_proxy_host(self, host):
+        with self._lock:
+            if host not in self.no_proxy_hosts:
+                self.no_proxy_hosts.append(host)
+
+    def track_resource(self, resource_type, resource_id):
+        """ Remember a resource that was created by this session, so that
+        it can be cleaned up later.
+        """
+        with self._lock:
+            ids = self._resources.setdefault(resource_type, [])
+            if resource_id not in ids:
+                ids.append(resource_id)
+
+    def untrack_resource(self, resource_type, resource_id):
+        with self._lock:
+            ids = self._resources.get(resource_type, [])
+            if resource_id in ids:
+                ids.remove(resource_id)
+
+    def get_resources(self, resource_type):
+        """ Return a copy of the list of tracked resource ids of the given
+        type.
+        """
+        with self._lock:
+            return list(self._resources.get(resource_type, []))
+
+    @contextlib.contextmanager
+    def activate(self):
+        """ Make this the current session for the calling thread.  While
+        the session is active, messages that are logged by the thread are
+        prefixed with the session id when SessionLogFilter is installed.
+        """
+        previous = getattr(_current, 'session', None)
+        _current.session = self
+        try:
+            yield self
+        finally:
+            _current.session = previous
+
+
+def get_current_session():
+    """ Return the SessionContext that is active in the calling thread,
+    or None.
+    """
+    return getattr(_current, 'session', None)
+
+
+class SessionLogFilter(logging.Filter):
+    """ Prefixes log messages with the id of the session that is active
+    in the thread that logged the message.
+    """
+
+    def filter(self, record):
+        session = get_current_session()
+        if session and not getattr(record, 'session_id', None):
+            record.session_id = session.session_id
+            record.msg = '%s%s' % (session.log_prefix, record.msg)
+        return True
+
+
+def install_log_filter(logger=None):
+    """ Add a SessionLogFilter to the handlers of the given logger, or
+    the root logger if not specified.
+    """
+    logger = logger or logging.getLogger()
+    for handler in logger.handlers:
+        if not any(isinstance(f, SessionLogFilter) for f in handler.filters):
+            handler.addFilter(SessionLogFilter())
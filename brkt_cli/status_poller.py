@@ -0,0 +1,762 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Polls the status port of many encryptor instances on one thread.
+
+EncryptorService makes a blocking urllib2 request to each of the
+encryptor's addresses in turn, so every waiting session ties up a thread,
+and an address that doesn't answer holds up the session until it times
+out.  A StatusPoller keeps a non-blocking keep-alive connection to each
+encryptor, and polls all of them from one select() loop.  A session that
+is waiting for its encryptor is woken up as soon as the poller sees the
+status change:
+
+    poller = StatusPoller()
+    client = api.Client('us-west-2', enc_svc_cls=poller.bind(
+        encryptor_service.EncryptorService))
+    ...
+    poller.stop()
+
+All of an encryptor's addresses are polled at the same time, and the
+first one that answers is used from then on.  Host names are resolved
+on a small thread pool, so that a slow DNS lookup doesn't block the
+loop.  Each request has a deadline that covers the lookup, connect and
+response, and the deadlines of all outstanding requests are checked
+together on every pass through the loop.
+"""
+
+import base64
+import errno
+import logging
+import select
+import socket
+import sys
+import threading
+import time
+import urllib
+import urlparse
+
+from brkt_cli.encryptor_service import EncryptorConnectionError, parse_status
+from brkt_cli.executor import Future, ThreadPoolExecutor
+from brkt_cli.util import BracketError
+
+log = logging.getLogger(__name__)
+
+DEFAULT_POLL_INTERVAL = 5
+DEFAULT_REQUEST_TIMEOUT = 5
+
+# How long an encryptor's status and connection are kept after the last
+# session stops asking for it.
+_IDLE_SECS = 60
+# How long the result of a DNS lookup is used.
+_DNS_CACHE_SECS = 60
+_RECV_SIZE = 16384
+_WOULD_BLOCK = (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR)
+
+
+def _parse_chunked(data):
+    """ Decode a chunked response body.
+
+    :return the body, or None if more data is needed
+    """
+    body = []
+    pos = 0
+    while True:
+        line_end = data.find('\r\n', pos)
+        if line_end < 0:
+            return None
+        try:
+            size = int(data[pos:line_end].split(';')[0], 16)
+        except ValueError:
+            raise IOError('Invalid chunk size: %r' % data[pos:line_end])
+        pos = line_end + 2
+        if size == 0:
+            # Skip the trailers, which end with an empty line.
+            if data.startswith('\r\n', pos) or '\r\n\r\n' in data[pos:]:
+                return ''.join(body)
+            return None
+        if len(data) < pos + size + 2:
+            return None
+        body.append(data[pos:pos + size])
+        pos += size + 2
+
+
+def _parse_response(data, eof):
+    """ Parse an HTTP response.
+
+    :param data the bytes that have been received
+    :param eof True if the server has closed the connection
+    :return a (status code, body, keep_alive) tuple, or None if more data
+        is needed
+    :raise IOError if the response is malformed or truncated
+    """
+    header_end = data.find('\r\n\r\n')
+    if header_end < 0:
+        if eof:
+            raise IOError('Connection closed before a response was received')
+        return None
+
+    lines = data[:header_end].split('\r\n')
+    parts = lines[0].split(None, 2)
+    if len(parts) < 2 or not parts[0].startswith('HTTP/'):
+        raise IOError('Invalid status line: %r' % lines[0])
+    version = parts[0]
+    try:
+        code = int(parts[1])
+    except ValueError:
+        raise IOError('Invalid status line: %r' % lines[0])
+    headers = {}
+    for line in lines[1:]:
+        name, sep, value = line.partition(':')
+        if sep:
+            headers[name.strip().lower()] = value.strip()
+
+    connection = headers.get('connection', '').lower()
+    if version == 'HTTP/1.0':
+        keep_alive = connection == 'keep-alive'
+    else:
+        keep_alive = connection != 'close'
+
+    rest = data[header_end + 4:]
+    if 'chunked' in headers.get('transfer-encoding', '').lower():
+        body = _parse_chunked(rest)
+    elif 'content-length' in headers:
+        try:
+            length = int(headers['content-length'])
+        except ValueError:
+            raise IOError(
+                'Invalid Content-Length: %r' % headers['content-length'])
+        body = rest[:length] if len(rest) >= length else None
+    else:
+        # The body ends when the server closes the connection.
+        body = rest if eof else None
+        keep_alive = False
+
+    if body is None:
+        if eof:
+            raise IOError('Connection closed before the response was complete')
+        return None
+    return code, body, keep_alive
+
+
+def _get_proxy(hostname, no_proxy_hosts):
+    """ Return the HTTP proxy that is used to reach the given host, based on
+    the environment, the same way that urllib2.urlopen() chooses it.
+
+    :return a (host, port, Proxy-Authorization header) tuple, or None to
+        connect directly.  The header is None if the proxy URL doesn't
+        have credentials.
+    """
+    if hostname in no_proxy_hosts:
+        return None
+    proxy_url = urllib.getproxies().get('http')
+    if not proxy_url or urllib.proxy_bypass(hostname):
+        return None
+    if '://' not in proxy_url:
+        proxy_url = 'http://' + proxy_url
+    parsed = urlparse.urlparse(proxy_url)
+    authorization = None
+    if parsed.username:
+        credentials = '%s:%s' % (
+            urllib.unquote(parsed.username),
+            urllib.unquote(parsed.password or '')
+        )
+        authorization = 'Basic ' + base64.b64encode(credentials)
+    return parsed.hostname, parsed.port or 80, authorization
+
+
+class _Waiter(object):
+    """ A session that is waiting for an encryptor's status. """
+
+    def __init__(self, previous, max_wait):
+        self.future = Future()
+        self.previous = previous
+        self.deadline = None
+        if max_wait is not None:
+            self.deadline = time.time() + max_wait
+
+
+class _Target(object):
+    """ An encryptor that is being polled. """
+
+    def __init__(self, hostnames, port, no_proxy_hosts):
+        self.hostnames = hostnames
+        self.port = port
+        self.no_proxy_hosts = no_proxy_hosts
+        self.waiters = []
+        # Maps hostname to the outstanding _Request, while a poll is in
+        # progress.
+        self.requests = None
+        self.exceptions_by_host = {}
+        self.next_poll = 0
+        self.last_used = time.time()
+
+        # The result of the last poll.
+        self.polled = False
+        self.hostname = None
+        self.status = None
+        self.error = None
+
+    def has_changed(self, previous):
+        return self.error is not None or self.status != previous
+
+
+class _Request(object):
+    """ A GET request to one of an encryptor's addresses. """
+
+    def __init__(self, target, hostname, deadline):
+        self.target = target
+        self.hostname = hostname
+        self.deadline = deadline
+        self.done = False
+        # The (host, port) that the request is sent to: the encryptor, or
+        # the proxy.
+        self.endpoint = None
+        self.message = None
+        self.unsent = ''
+        self.conn = None
+        # True if the request was sent on a connection that had been used
+        # before, which the server may have closed in the meantime.
+        self.reused = False
+
+
+class _Connection(object):
+
+    def __init__(self, endpoint, sock):
+        self.endpoint = endpoint
+        self.sock = sock
+        self.fileno = sock.fileno()
+        self.connecting = True
+        self.data = ''
+        # The request that is using the connection, or None if the
+        # connection is idle.
+        self.request = None
+        self.idle_since = None
+
+
+class StatusPoller(object):
+    """ Gets the status of many encryptors on one thread.  Safe to use
+    from multiple threads.  The polling thread is started when the first
+    status is requested.
+    """
+
+    def __init__(self, interval=DEFAULT_POLL_INTERVAL,
+                 timeout=DEFAULT_REQUEST_TIMEOUT, max_resolvers=4):
+        """
+        :param interval how often an encryptor is polled while a session
+            is waiting for it to change
+        :param timeout the number of seconds that each request, including
+            the DNS lookup and connect, is allowed to take
+        :param max_resolvers the maximum number of DNS lookups that run
+            at the same time
+        """
+        self.interval = interval
+        self.timeout = timeout
+        self._resolver = ThreadPoolExecutor(
+            max_workers=max_resolvers, thread_name_prefix='brkt-resolver')
+
+        # Functions that run on the polling thread, added by other threads.
+        self._lock = threading.Lock()
+        self._commands = []
+        self._stopping = False
+        self._thread = None
+        self._wake_r, self._wake_w = socket.socketpair()
+        self._wake_r.setblocking(0)
+        self._wake_w.setblocking(0)
+
+        # The rest of the state is only used on the polling thread.
+        # Maps (hostnames, port) to a _Target.
+        self._targets = {}
+        # Maps fileno to the _Connection, including idle connections.
+        self._connections = {}
+        # Maps endpoint to a list of idle connections.
+        self._idle = {}
+        self._requests = set()
+        # Maps endpoint to (expiration time, addrinfo).
+        self._dns_cache = {}
+        # Maps endpoint to the requests that are waiting for its lookup.
+        self._resolving = {}
+
+    def bind(self, enc_svc_cls):
+        """ Return a callable that creates enc_svc_cls objects that get
+        their status from this poller.  It can be passed anywhere that an
+        encryptor service class is expected.
+        """
+        def _new_enc_svc(*args, **kwargs):
+            enc_svc = enc_svc_cls(*args, **kwargs)
+            enc_svc.status_poller = self
+            return enc_svc
+        return _new_enc_svc
+
+    def request_status(self, enc_svc, previous=None, max_wait=None):
+        """ Request the status of the encryptor that enc_svc talks to.
+
+        :param previous if specified, wait for a status that is different
+            from this one
+        :param max_wait the maximum number of seconds to wait for the
+            status to change.  When it expires, the latest status is
+            returned.  None means wait until the status changes.
+        :return a Future whose result is a (hostname, status) tuple, where
+            hostname is the address that answered.  If none of the
+            addresses answered, the Future raises EncryptorConnectionError.
+        """
+        waiter = _Waiter(previous, max_wait)
+        key = (tuple(enc_svc.hostnames), enc_svc.port)
+        self._call_soon(
+            self._add_waiter, key, list(enc_svc.no_proxy_hosts), waiter)
+        return waiter.future
+
+    def get_status(self, enc_svc, previous=None, max_wait=None):
+        """ Blocking version of request_status().
+
+        :return the status dictionary
+        """
+        _, status = self.request_status(
+            enc_svc, previous=previous, max_wait=max_wait).result()
+        return status
+
+    def stop(self):
+        """ Stop polling and close all connections.  Outstanding requests
+        fail with BracketError.
+        """
+        with self._lock:
+            self._stopping = True
+            thread = self._thread
+        self._wake()
+        if thread:
+            thread.join()
+        self._resolver.shutdown(wait=False)
+        self._wake_r.close()
+        self._wake_w.close()
+
+    def _call_soon(self, function, *args):
+        """ Run the function on the polling thread. """
+        with self._lock:
+            if self._stopping:
+                raise BracketError('The status poller has been stopped')
+            self._commands.append((function, args))
+            if not self._thread:
+                self._thread = threading.Thread(
+                    target=self._run, name='brkt-status-poller')
+                self._thread.daemon = True
+                self._thread.start()
+        self._wake()
+
+    def _wake(self):
+        try:
+            self._wake_w.send('x')
+        except socket.error:
+            # The buffer is full, so the thread is already being woken up,
+            # or the poller has been stopped.
+            pass
+
+    def _run(self):
+        try:
+            self._loop()
+            error = BracketError('The status poller has been stopped')
+            exc_info = (BracketError, error, None)
+        except BaseException:
+            exc_info = sys.exc_info()
+            log.error('Status poller failed', exc_info=exc_info)
+            with self._lock:
+                self._stopping = True
+
+        for conn in self._connections.values():
+            conn.sock.close()
+        for target in self._targets.itervalues():
+            for waiter in target.waiters:
+                waiter.future.set_exception_info(exc_info)
+
+    def _loop(self):
+        while True:
+            with self._lock:
+                commands, self._commands = self._commands, []
+                stopping = self._stopping
+            # Run the commands even when stopping, so that the waiters that
+            # they add are told that the poller stopped.
+            for function, args in commands:
+                function(*args)
+            if stopping:
+                return
+
+            now = time.time()
+            self._expire(now)
+            self._start_polls(now)
+
+            readers = [self._wake_r]
+            writers = []
+            for conn in self._connections.itervalues():
+                if conn.connecting or (conn.request and conn.request.unsent):
+                    writers.append(conn.sock)
+                else:
+                    readers.append(conn.sock)
+            try:
+                readable, writable, _ = select.select(
+                    readers, writers, [], self._get_timeout(now))
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+
+            for sock in writable:
+                conn = self._connections.get(sock.fileno())
+                if conn and conn.sock is sock:
+                    self._on_writable(conn)
+            for sock in readable:
+                if sock is self._wake_r:
+                    self._drain_wake()
+                    continue
+                conn = self._connections.get(sock.fileno())
+                if conn and conn.sock is sock:
+                    self._on_readable(conn)
+
+    def _drain_wake(self):
+        try:
+            while self._wake_r.recv(4096):
+                pass
+        except socket.error:
+            pass
+
+    def _get_timeout(self, now):
+        """ Return the number of seconds until the next poll or deadline,
+        or None if there is nothing to do until a command arrives.
+        """
+        times = [r.deadline for r in self._requests]
+        for target in self._targets.itervalues():
+            if not target.waiters:
+                continue
+            if not target.requests:
+                times.append(target.next_poll)
+            times.extend(
+                w.deadline for w in target.waiters if w.deadline is not None)
+        if not times:
+            return None
+        return max(0, min(times) - now)
+
+    def _add_waiter(self, key, no_proxy_hosts, waiter):
+        target = self._targets.get(key)
+        if not target:
+            target = _Target(key[0], key[1], no_proxy_hosts)
+            self._targets[key] = target
+        target.no_proxy_hosts = no_proxy_hosts
+        target.last_used = time.time()
+
+        if waiter.previous is not None and target.polled and \
+                target.has_changed(waiter.previous):
+            self._resolve_waiter(target, waiter)
+            return
+        target.waiters.append(waiter)
+        if waiter.previous is None and not target.requests:
+            # Poll now, instead of at the next interval.
+            target.next_poll = 0
+
+    def _resolve_waiter(self, target, waiter):
+        if target.error:
+            error = target.error
+            waiter.future.set_exception_info((type(error), error, None))
+        else:
+            waiter.future.set_result((target.hostname, target.status))
+
+    def _expire(self, now):
+        for request in list(self._requests):
+            if request.deadline <= now:
+                self._fail_request(
+                    request,
+                    socket.timeout('timed out after %s seconds' % self.timeout)
+                )
+
+        for key, target in self._targets.items():
+            if target.waiters:
+                target.last_used = now
+                if not target.polled:
+                    continue
+                waiters = target.waiters
+                target.waiters = []
+                for waiter in waiters:
+                    if waiter.deadline is not None and waiter.deadline <= now:
+                        self._resolve_waiter(target, waiter)
+                    else:
+                        target.waiters.append(waiter)
+            elif not target.requests and now - target.last_used > _IDLE_SECS:
+                del self._targets[key]
+
+        for conn in self._connections.values():
+            if conn.idle_since and now - conn.idle_since > _IDLE_SECS:
+                self._close(conn)
+
+    def _start_polls(self, now):
+        for target in self._targets.itervalues():
+            if target.requests or not target.waiters:
+                continue
+            if now < target.next_poll:
+                continue
+            target.exceptions_by_host = {}
+            target.requests = {}
+            deadline = now + self.timeout
+            for hostname in target.hostnames:
+                request = _Request(target, hostname, deadline)
+                target.requests[hostname] = request
+                self._requests.add(request)
+            for request in target.requests.values():
+                if not request.done:
+                    self._start_request(request)
+
+    def _start_request(self, request):
+        target = request.target
+        host_header = '%s:%d' % (request.hostname, target.port)
+        headers = [
+            'Host: ' + host_header,
+            'Accept: application/json',
+            'Connection: keep-alive'
+        ]
+        proxy = _get_proxy(request.hostname, target.no_proxy_hosts)
+        if proxy:
+            proxy_host, proxy_port, authorization = proxy
+            request.endpoint = (proxy_host, proxy_port)
+            path = 'http://%s/' % host_header
+            if authorization:
+                headers.append('Proxy-Authorization: ' + authorization)
+        else:
+            request.endpoint = (request.hostname, target.port)
+            path = '/'
+        request.message = 'GET %s HTTP/1.1\r\n%s\r\n\r\n' % (
+            path, '\r\n'.join(headers))
+        request.unsent = request.message
+
+        idle = self._idle.get(request.endpoint)
+        if idle:
+            conn = idle.pop()
+            conn.idle_since = None
+            conn.request = request
+            request.conn = conn
+            request.reused = True
+            return
+        self._resolve(request)
+
+    def _resolve(self, request):
+        """ Look up the request's endpoint, and connect when the address
+        is known.  Requests for the same endpoint share one lookup.
+        """
+        endpoint = request.endpoint
+        cached = self._dns_cache.get(endpoint)
+        if cached and cached[0] > time.time():
+            self._connect(request, cached[1])
+            return
+        waiting = self._resolving.get(endpoint)
+        if waiting is not None:
+            waiting.append(request)
+            return
+
+        host, port = endpoint
+        try:
+            # IP addresses don't need a lookup.
+            addrinfo = socket.getaddrinfo(
+                host, port, 0, socket.SOCK_STREAM, 0, socket.AI_NUMERICHOST)
+        except socket.gaierror:
+            pass
+        else:
+            self._connect(request, addrinfo[0])
+            return
+
+        self._resolving[endpoint] = [request]
+        future = self._resolver.submit(
+            socket.getaddrinfo, host, port, 0, socket.SOCK_STREAM)
+        future.add_done_callback(
+            lambda f: self._on_resolved_threadsafe(endpoint, f))
+
+    def _on_resolved_threadsafe(self, endpoint, future):
+        try:
+            self._call_soon(self._on_resolved, endpoint, future)
+        except BracketError:
+            # The poller was stopped during the lookup.
+            pass
+
+    def _on_resolved(self, endpoint, future):
+        requests = self._resolving.pop(endpoint, [])
+        try:
+            addrinfo = future.result()
+        except Exception as e:
+            for request in requests:
+                self._fail_request(request, e)
+            return
+        self._dns_cache[endpoint] = (
+            time.time() + _DNS_CACHE_SECS, addrinfo[0])
+        for request in requests:
+            if not request.done:
+                self._connect(request, addrinfo[0])
+
+    def _connect(self, request, addrinfo):
+        family, socktype, proto, _, sockaddr = addrinfo
+        try:
+            sock = socket.socket(family, socktype, proto)
+        except socket.error as e:
+            self._fail_request(request, e)
+            return
+        sock.setblocking(0)
+        err = sock.connect_ex(sockaddr)
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            self._fail_request(request, socket.error(err, errno.errorcode.get(
+                err, 'connect failed')))
+            return
+        conn = _Connection(request.endpoint, sock)
+        conn.request = request
+        request.conn = conn
+        self._connections[conn.fileno] = conn
+
+    def _on_writable(self, conn):
+        request = conn.request
+        if conn.connecting:
+            err = conn.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                self._on_connection_error(
+                    conn, socket.error(err, errno.errorcode.get(
+                        err, 'connect failed')))
+                return
+            conn.connecting = False
+        if not request or not request.unsent:
+            return
+        try:
+            sent = conn.sock.send(request.unsent)
+        except socket.error as e:
+            if e.errno not in _WOULD_BLOCK:
+                self._on_connection_error(conn, e)
+            return
+        request.unsent = request.unsent[sent:]
+
+    def _on_readable(self, conn):
+        try:
+            data = conn.sock.recv(_RECV_SIZE)
+        except socket.error as e:
+            if e.errno not in _WOULD_BLOCK:
+                self._on_connection_error(conn, e)
+            return
+        request = conn.request
+        if not request:
+            # The server closed an idle connection.
+            self._close(conn)
+            return
+
+        conn.data += data
+        try:
+            response = _parse_response(conn.data, eof=not data)
+        except IOError as e:
+            self._on_connection_error(conn, e)
+            return
+        if not response:
+            return
+
+        code, body, keep_alive = response
+        if keep_alive:
+            conn.data = ''
+            conn.request = None
+            conn.idle_since = time.time()
+            request.conn = None
+            self._idle.setdefault(conn.endpoint, []).append(conn)
+        else:
+            self._close(conn)
+
+        if code != 200:
+            self._fail_request(request, IOError('HTTP Error %d' % code))
+            return
+        try:
+            status = parse_status(body)
+        except (ValueError, KeyError, TypeError) as e:
+            self._fail_request(
+                request, IOError('Invalid status %r: %s' % (body, e)))
+            return
+        self._complete_request(request, status)
+
+    def _on_connection_error(self, conn, e):
+        request = conn.request
+        retry = request and request.reused and not conn.data
+        self._close(conn)
+        if not request:
+            return
+        if retry:
+            # The server closed the keep-alive connection before the
+            # request arrived.  Try again on a new connection.
+            log.debug(
+                'Connection to %s:%d was closed, reconnecting',
+                conn.endpoint[0], conn.endpoint[1])
+            request.reused = False
+            request.unsent = request.message
+            self._resolve(request)
+            return
+        self._fail_request(request, e)
+
+    def _close(self, conn):
+        self._connections.pop(conn.fileno, None)
+        idle = self._idle.get(conn.endpoint)
+        if idle and conn in idle:
+            idle.remove(conn)
+        conn.sock.close()
+        if conn.request:
+            conn.request.conn = None
+            conn.request = None
+
+    def _fail_request(self, request, e):
+        if request.done:
+            return
+        request.done = True
+        self._requests.discard(request)
+        if request.conn:
+            self._close(request.conn)
+        target = request.target
+        log.debug(
+            'Unable to get status from %s:%d - %s',
+            request.hostname, target.port, e)
+        target.exceptions_by_host[request.hostname] = e
+        del target.requests[request.hostname]
+        if not target.requests:
+            self._finish_poll(
+                target, error=EncryptorConnectionError(
+                    target.port, target.exceptions_by_host)
+            )
+
+    def _complete_request(self, request, status):
+        request.done = True
+        self._requests.discard(request)
+        target = request.target
+        # The first address that answers wins.  Cancel the others.
+        for other in target.requests.values():
+            if other is not request and not other.done:
+                other.done = True
+                self._requests.discard(other)
+                if other.conn:
+                    self._close(other.conn)
+        self._finish_poll(target, hostname=request.hostname, status=status)
+
+    def _finish_poll(self, target, hostname=None, status=None, error=None):
+        """ Record the result of polling the target, and wake up the
+        waiters that it is relevant to.
+        """
+        now = time.time()
+        target.requests = None
+        target.next_poll = now + self.interval
+        target.polled = True
+        target.hostname = hostname
+        target.status = status
+        target.error = error
+
+        waiters = target.waiters
+        target.waiters = []
+        for waiter in waiters:
+            expired = waiter.deadline is not None and waiter.deadline <= now
+            if waiter.previous is None or expired or \
+                    target.has_changed(waiter.previous):
+                self._resolve_waiter(target, waiter)
+            else:
+                target.waiters.append(waiter)
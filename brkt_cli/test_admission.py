@@ -0,0 +1,113 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import os
+import shutil
+import tempfile
+import unittest
+
+from brkt_cli import admission, util
+from brkt_cli.admission import AdmissionTimeoutError, HostSemaphore
+from brkt_cli.aws import encrypt_ami
+from brkt_cli.aws.test_aws_service import build_aws_service
+from brkt_cli.test_encryptor_service import DummyEncryptorService
+
+
+class TestHostSemaphore(unittest.TestCase):
+
+    def setUp(self):
+        util.SLEEP_ENABLED = False
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _new_semaphore(self, limit=2):
+        return HostSemaphore('test', limit, directory=self.tmp_dir)
+
+    def test_fifo(self):
+        semaphores = [self._new_semaphore() for _ in xrange(4)]
+        for s in semaphores:
+            s.enqueue()
+        self.assertEqual(
+            [0, 0, 1, 2], [s.get_position() for s in semaphores])
+
+        # Releasing a semaphore admits the next waiter.
+        semaphores[1].release()
+        self.assertEqual(0, semaphores[2].get_position())
+        self.assertEqual(1, semaphores[3].get_position())
+
+        # Waiters that leave the queue make room for the ones behind them.
+        late = self._new_semaphore()
+        late.enqueue()
+        self.assertEqual(2, late.get_position())
+        semaphores[3].release()
+        self.assertEqual(1, late.get_position())
+
+        for s in semaphores + [late]:
+            s.release()
+        self.assertEqual(
+            [], [f for f in os.listdir(os.path.join(self.tmp_dir, 'test'))
+                 if f.endswith('.ticket')]
+        )
+
+    def test_stale_ticket(self):
+        """ Test that a ticket that isn't locked by a running process is
+        removed.
+        """
+        first = self._new_semaphore(limit=1)
+        first.enqueue()
+        # A ticket that nobody holds the lock on, from a process that was
+        # killed.
+        stale = os.path.join(self.tmp_dir, 'test', '000000000000-1-x.ticket')
+        open(stale, 'w').close()
+
+        second = self._new_semaphore(limit=1)
+        second.enqueue()
+        self.assertEqual(1, second.get_position())
+        self.assertFalse(os.path.exists(stale))
+        first.release()
+        second.acquire()
+        second.release()
+
+    def test_timeout(self):
+        holder = self._new_semaphore(limit=1)
+        holder.acquire()
+        waiter = self._new_semaphore(limit=1)
+        with self.assertRaises(AdmissionTimeoutError):
+            waiter.acquire(timeout=0)
+        # The waiter left the queue.
+        self.assertIsNone(waiter._ticket_path)
+        holder.release()
+        with waiter:
+            self.assertEqual(0, waiter.get_position())
+
+    def test_encrypt(self):
+        """ Test that encrypt() releases its slot when it completes. """
+        admission_dir = admission.ADMISSION_DIR
+        admission.ADMISSION_DIR = self.tmp_dir
+        try:
+            aws_svc, encryptor_image, guest_image = build_aws_service()
+            encrypt_ami.encrypt(
+                aws_svc=aws_svc,
+                enc_svc_cls=DummyEncryptorService,
+                image_id=guest_image.id,
+                encryptor_ami=encryptor_image.id,
+                max_encryptors=1
+            )
+        finally:
+            admission.ADMISSION_DIR = admission_dir
+        path = os.path.join(self.tmp_dir, 'aws-us-west-2-123456789012')
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(
+            [], [f for f in os.listdir(path) if f.endswith('.ticket')])
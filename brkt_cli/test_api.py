@@ -0,0 +1,85 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import unittest
+
+import brkt_cli
+from brkt_cli import api, util
+from brkt_cli.aws.test_aws_service import build_aws_service
+from brkt_cli.test_encryptor_service import DummyEncryptorService
+
+
+class DummyClient(api.Client):
+    """ Runs operations against a DummyAWSService. """
+
+    def __init__(self, aws_svc):
+        super(DummyClient, self).__init__(
+            'us-west-2',
+            brkt_env=brkt_cli.get_prod_brkt_env(),
+            enc_svc_cls=DummyEncryptorService
+        )
+        self.aws_svc = aws_svc
+
+    def _new_aws_service(self, session_id=None):
+        return self.aws_svc
+
+
+class TestClient(unittest.TestCase):
+
+    def setUp(self):
+        util.SLEEP_ENABLED = False
+
+    def test_encrypt_and_update(self):
+        aws_svc, encryptor_image, guest_image = build_aws_service()
+        client = DummyClient(aws_svc)
+
+        progress = []
+        future = client.encrypt_ami_async(
+            guest_image.id,
+            encryptor_ami=encryptor_image.id,
+            validate=False,
+            tags={'Owner': 'test'},
+            progress_callback=lambda f, p: progress.append(p)
+        )
+        encrypted_ami_id = future.result(timeout=30)
+        self.assertEqual(aws_svc.session_id, future.session_id)
+        self.assertIn(encrypted_ami_id, aws_svc.images)
+        self.assertEqual('test', aws_svc.default_tags['Owner'])
+        self.assertEqual(100, progress[-1].percent_complete)
+
+        future = client.update_ami_async(
+            encrypted_ami_id,
+            encryptor_ami=encryptor_image.id,
+            validate=False
+        )
+        self.assertIsNotNone(future.result(timeout=30))
+        client.shutdown()
+
+    def test_encryptor_ami_cached(self):
+        calls = []
+
+        def _get_encryptor_ami_map(pv=False):
+            calls.append(pv)
+            return {'us-west-2': 'ami-%s' % ('pv' if pv else 'hvm')}
+
+        get_encryptor_ami_map = api.get_encryptor_ami_map
+        api.get_encryptor_ami_map = _get_encryptor_ami_map
+        try:
+            client = api.Client('us-west-2')
+            self.assertEqual('ami-hvm', client.get_encryptor_ami())
+            self.assertEqual('ami-hvm', client.get_encryptor_ami())
+            self.assertEqual('ami-pv', client.get_encryptor_ami(pv=True))
+            self.assertEqual([False, True], calls)
+            client.shutdown()
+        finally:
+            api.get_encryptor_ami_map = get_encryptor_ami_map
@@ -0,0 +1,63 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import os
+import tempfile
+import unittest
+
+from brkt_cli import benchmark
+from brkt_cli.benchmark import Benchmark, BenchmarkResult
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_run_benchmark(self):
+        calls = []
+        b = Benchmark('append', calls.append, setup=lambda: 1)
+        result = benchmark.run_benchmark(b, min_time=0.001, repeat=2)
+        self.assertEqual('append', result.name)
+        self.assertTrue(result.ops_per_sec > 0)
+        self.assertTrue(calls)
+
+    def test_all_benchmarks_run(self):
+        """ Verify that each default benchmark runs without an error. """
+        for b in benchmark.get_benchmarks():
+            arg = b.setup() if b.setup else None
+            b.function(arg)
+
+    def test_compare(self):
+        baseline = {
+            'fast': BenchmarkResult('fast', 100.0),
+            'slow': BenchmarkResult('slow', 100.0)
+        }
+        results = [
+            BenchmarkResult('fast', 95.0),
+            BenchmarkResult('slow', 80.0),
+            BenchmarkResult('new', 10.0)
+        ]
+        rows, regressions = benchmark.compare(
+            results, baseline, threshold=0.1)
+        self.assertEqual(['slow'], regressions)
+        self.assertEqual(4, len(rows))
+
+    def test_save_and_load(self):
+        fd, path = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            benchmark.save_results(
+                [BenchmarkResult('a', 12.5, 0.5)], path)
+            loaded = benchmark.load_results(path)
+            self.assertEqual(12.5, loaded['a'].ops_per_sec)
+            self.assertEqual(0.5, loaded['a'].retained_objects_per_op)
+        finally:
+            os.remove(path)
@@ -0,0 +1,111 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import os
+import shutil
+import tempfile
+import unittest
+
+from brkt_cli import catalog
+from brkt_cli.catalog import Catalog, make_record
+
+
+def _record(image_id, **kwargs):
+    return make_record(image_id, catalog.CLOUD_AWS, **kwargs)
+
+
+class TestCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'brkt', 'catalog.db')
+        self.catalog = Catalog(self.path)
+
+    def tearDown(self):
+        self.catalog.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_add_and_get(self):
+        record = _record(
+            'ami-1', location='us-west-2', source_image='ami-0',
+            encryptor_image='ami-e1', session_id='abc', created_time=10,
+            volume_size_gb=8, snapshot_ids=['snap-1', 'snap-2'],
+            phase_durations={'image': 120.5})
+        self.catalog.add(record)
+        self.assertEqual(record, self.catalog.get('ami-1'))
+        self.assertIsNone(self.catalog.get('ami-2'))
+
+        # The catalog survives a restart.
+        self.catalog.close()
+        self.catalog = Catalog(self.path)
+        self.assertEqual(record, self.catalog.get('ami-1'))
+
+    def test_merge(self):
+        """ Test that fields that aren't specified keep their values, and
+        that replace=False only fills in missing fields.
+        """
+        self.catalog.add(_record(
+            'ami-1', source_image='ami-0', phase_durations={'image': 10}))
+        self.catalog.add(_record('ami-1', name='encrypted'))
+        record = self.catalog.get('ami-1')
+        self.assertEqual('encrypted', record.name)
+        self.assertEqual({'image': 10}, record.phase_durations)
+
+        self.catalog.add(
+            _record('ami-1', source_image='ami-x', encryptor_image='ami-e'),
+            replace=False
+        )
+        record = self.catalog.get('ami-1')
+        self.assertEqual('ami-0', record.source_image)
+        self.assertEqual('ami-e', record.encryptor_image)
+
+    def test_query(self):
+        self.catalog.add(_record(
+            'ami-1', location='us-west-2', source_image='ami-0',
+            encryptor_image='ami-e1', created_time=1))
+        self.catalog.add(_record(
+            'ami-2', location='us-west-2', source_image='ami-0',
+            encryptor_image='ami-e2', created_time=2))
+        self.catalog.add(make_record(
+            'image-3', catalog.CLOUD_GCE, location='project',
+            source_image='ubuntu', encryptor_image='ami-e1', created_time=3))
+
+        def _ids(**kwargs):
+            return [r.image_id for r in self.catalog.query(**kwargs)]
+
+        self.assertEqual(['image-3', 'ami-2', 'ami-1'], _ids())
+        self.assertEqual(['ami-2', 'ami-1'], _ids(source_image='ami-0'))
+        self.assertEqual(
+            ['ami-1'], _ids(source_image='ami-0', encryptor_image='ami-e1'))
+        self.assertEqual(['image-3'], _ids(cloud=catalog.CLOUD_GCE))
+        self.assertEqual([], _ids(session_id='bogus'))
+        with self.assertRaises(ValueError):
+            self.catalog.query(name='ami-1')
+
+    def test_lineage(self):
+        self.catalog.add(_record('ami-1', source_image='ami-0'))
+        self.catalog.add(_record('ami-2', source_image='ami-1'))
+        self.catalog.add(_record('ami-3', source_image='ami-2'))
+        self.assertEqual(
+            ['ami-3', 'ami-2', 'ami-1'],
+            [r.image_id for r in self.catalog.get_lineage('ami-3')]
+        )
+        self.assertEqual([], self.catalog.get_lineage('ami-0'))
+
+    def test_record_image_error(self):
+        """ Test that errors writing the catalog are ignored. """
+        path = os.path.join(self.tmp_dir, 'file')
+        with open(path, 'w') as f:
+            f.write('not a directory')
+        catalog.record_image(
+            _record('ami-1'), path=os.path.join(path, 'catalog.db'))
@@ -0,0 +1,139 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from brkt_cli import detach, job_queue, util
+from brkt_cli.detach import SessionStore
+from brkt_cli.session import SessionContext, get_current_session
+from brkt_cli.validation import ValidationError
+
+
+class TestSessionStore(unittest.TestCase):
+
+    def setUp(self):
+        util.SLEEP_ENABLED = False
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store = SessionStore(self.tmp_dir)
+        self.session = SessionContext()
+
+    def tearDown(self):
+        self.store.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _submit(self):
+        self.store.queue.submit(
+            'encrypt-ami', {}, job_id=self.session.session_id)
+
+    def test_run(self):
+        """ Test that the session's progress and result are recorded. """
+        self._submit()
+
+        def _run():
+            self.assertIs(self.session, get_current_session())
+            job = self.store.get(self.session.session_id)
+            self.assertEqual(job_queue.JOB_RUNNING, job.state)
+            self.session.report_progress('encrypting', 50)
+            job = self.store.get(self.session.session_id)
+            self.assertEqual(50, job.percent_complete)
+            return 'ami-12345678'
+
+        self.assertEqual('ami-12345678', self.store.run(self.session, _run))
+        job = self.store.wait(self.session.session_id)
+        self.assertEqual(job_queue.JOB_SUCCEEDED, job.state)
+        self.assertEqual('ami-12345678', job.result)
+
+        # A session only runs once.
+        with self.assertRaises(ValidationError):
+            self.store.run(self.session, _run)
+
+    def test_run_failure(self):
+        self._submit()
+
+        def _run():
+            raise util.BracketError('Encryption failed')
+
+        with self.assertRaises(util.BracketError):
+            self.store.run(self.session, _run)
+        job = self.store.get(self.session.session_id)
+        self.assertEqual(job_queue.JOB_FAILED, job.state)
+        self.assertEqual('Encryption failed', job.error)
+
+    def test_process_exited(self):
+        """ Test that a running session is marked as failed when no
+        process holds its lock.
+        """
+        self._submit()
+        session_id = self.session.session_id
+        self.store.queue.start(session_id)
+
+        lock = detach.lock_file(
+            self.store.get_lock_path(session_id), create=True)
+        try:
+            self.assertEqual(
+                job_queue.JOB_RUNNING, self.store.get(session_id).state)
+            with self.assertRaises(util.BracketError):
+                self.store.wait(session_id, timeout=0.01)
+        finally:
+            lock.close()
+
+        job = self.store.wait(session_id)
+        self.assertEqual(job_queue.JOB_FAILED, job.state)
+        self.assertIn('exited', job.error)
+
+    def test_process_did_not_start(self):
+        self._submit()
+        session_id = self.session.session_id
+        self.assertEqual(
+            job_queue.JOB_QUEUED, self.store.get(session_id).state)
+
+        start_timeout = detach.START_TIMEOUT
+        detach.START_TIMEOUT = -1
+        try:
+            job = self.store.get(session_id)
+        finally:
+            detach.START_TIMEOUT = start_timeout
+        self.assertEqual(job_queue.JOB_FAILED, job.state)
+
+    def test_permissions(self):
+        """ Test that the sessions directory and database are only
+        accessible by the owner, including when the directory already
+        existed.
+        """
+        os.chmod(self.tmp_dir, 0o755)
+        store = SessionStore(self.tmp_dir)
+        store.close()
+        self.assertEqual(0o700, stat.S_IMODE(os.stat(self.tmp_dir).st_mode))
+        path = os.path.join(self.tmp_dir, detach.DATABASE_NAME)
+        self.assertEqual(0o600, stat.S_IMODE(os.stat(path).st_mode))
+
+        directory = os.path.join(self.tmp_dir, 'sessions')
+        SessionStore(directory).close()
+        self.assertEqual(0o700, stat.S_IMODE(os.stat(directory).st_mode))
+
+    def test_unknown_session(self):
+        with self.assertRaises(ValidationError):
+            self.store.get('bogus')
+
+    def test_get_detached_args(self):
+        self.assertEqual(
+            ['encrypt-ami', '--region', 'us-west-2', 'ami-1',
+             '--no-validate', '--session-id', 'abc'],
+            detach.get_detached_args(
+                ['encrypt-ami', '--detach', '--region', 'us-west-2',
+                 'ami-1'], 'abc')
+        )
@@ -26,8 +26,9 @@ class ExpiredDeadline(object):
 
 class DummyEncryptorService(encryptor_service.BaseEncryptorService):
 
-    def __init__(self, hostnames=['test-host'], port=80):
-        super(DummyEncryptorService, self).__init__(hostnames, port)
+    def __init__(self, hostnames=['test-host'], port=80, no_proxy_hosts=None):
+        super(DummyEncryptorService, self).__init__(
+            hostnames, port, no_proxy_hosts=no_proxy_hosts)
         self.is_up = False
         self.progress = 0
 
@@ -64,6 +65,22 @@ class FailedEncryptionService(encryptor_service.BaseEncryptorService):
         }
 
 
+class NeverUpService(encryptor_service.BaseEncryptorService):
+    """ Simulates an encryptor that never answers on its status port. """
+
+    def is_encryptor_up(self):
+        return False
+
+    def get_status(self):
+        raise encryptor_service.EncryptorConnectionError(
+            self.port, {'test-host': IOError('Connection refused')})
+
+
+def _raise_instance_error():
+    raise encryptor_service.EncryptorInstanceError(
+        'Encryptor instance i-1 is terminated', state='terminated')
+
+
 class TestEncryptionService(unittest.TestCase):
 
     def setUp(self):
@@ -119,3 +136,58 @@ class TestEncryptionService(unittest.TestCase):
                 NoProgressService(),
                 progress_timeout=0.100
             )
+
+    def test_encryptor_instance_dies(self):
+        """ Test that waiting for the encryptor stops as soon as the
+        instance is found to be dead.
+        """
+        watcher = encryptor_service.InstanceWatcher(
+            'i-1', _raise_instance_error, interval=0)
+        with self.assertRaisesRegexp(
+                encryptor_service.EncryptorInstanceError, 'terminated'):
+            encryptor_service.wait_for_encryptor_up(
+                NeverUpService(['test-host']), brkt_cli.util.Deadline(600),
+                watcher=watcher
+            )
+        with self.assertRaises(encryptor_service.EncryptorInstanceError):
+            encryptor_service.wait_for_encryption(
+                NeverUpService(['test-host']), watcher=watcher)
+
+    def test_fatal_console_output(self):
+        class StuckService(encryptor_service.BaseEncryptorService):
+            def is_encryptor_up(self):
+                return True
+
+            def get_status(self):
+                return {
+                    'state': encryptor_service.ENCRYPT_ENCRYPTING,
+                    'percent_complete': 10
+                }
+
+        console = 'Booting\nKernel panic - not syncing: VFS\n'
+        watcher = encryptor_service.InstanceWatcher(
+            'i-1', lambda: None, get_console_output=lambda: console,
+            interval=0, console_interval=0
+        )
+        with self.assertRaisesRegexp(
+                encryptor_service.EncryptorInstanceError, 'Kernel panic'):
+            encryptor_service.wait_for_encryption(
+                StuckService(['test-host']), watcher=watcher)
+
+    def test_instance_check_errors_ignored(self):
+        """ Test that an error while checking the instance, for example
+        API throttling, doesn't fail the encryption.
+        """
+        calls = []
+
+        def _check_state():
+            calls.append(1)
+            raise IOError('Rate exceeded')
+
+        watcher = encryptor_service.InstanceWatcher(
+            'i-1', _check_state, interval=0)
+        svc = DummyEncryptorService()
+        encryptor_service.wait_for_encryptor_up(
+            svc, brkt_cli.util.Deadline(600), watcher=watcher)
+        encryptor_service.wait_for_encryption(svc, watcher=watcher)
+        self.assertTrue(calls)
@@ -0,0 +1,187 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import threading
+import unittest
+
+from brkt_cli import encryptor_service, session, util
+from brkt_cli.aws import encrypt_ami
+from brkt_cli.aws.test_aws_service import build_aws_service
+from brkt_cli.engine import Call, Engine, Return, Sleep, gather_co, run_sync
+from brkt_cli.test_encryptor_service import (
+    DummyEncryptorService,
+    FailedEncryptionService
+)
+
+
+class TestException(Exception):
+    pass
+
+
+def _add_co(a, b):
+    yield Sleep(1)
+    result = yield Call(lambda: a + b)
+    raise Return(result)
+
+
+def _sum_co(values):
+    total = 0
+    for v in values:
+        total = yield _add_co(total, v)
+    raise Return(total)
+
+
+def _fail_co():
+    yield Sleep(1)
+    raise TestException('failed')
+
+
+def _catch_co():
+    try:
+        yield _fail_co()
+    except TestException:
+        raise Return('caught')
+
+
+def _call_fails_co():
+    def _fail():
+        raise TestException('call failed')
+    yield Call(_fail)
+
+
+class TestRunSync(unittest.TestCase):
+
+    def setUp(self):
+        util.SLEEP_ENABLED = False
+
+    def test_nested_return(self):
+        self.assertEqual(6, run_sync(_sum_co([1, 2, 3])))
+
+    def test_exception(self):
+        with self.assertRaises(TestException):
+            run_sync(_fail_co())
+        with self.assertRaises(TestException):
+            run_sync(_call_fails_co())
+
+    def test_exception_caught_by_caller(self):
+        self.assertEqual('caught', run_sync(_catch_co()))
+
+    def test_bad_yield(self):
+        def _bad_co():
+            yield 5
+        with self.assertRaises(TypeError):
+            run_sync(_bad_co())
+
+
+class TestEngine(unittest.TestCase):
+
+    def setUp(self):
+        util.SLEEP_ENABLED = False
+
+    def test_many_coroutines(self):
+        engine = Engine(max_workers=2)
+        futures = [engine.spawn(_sum_co(range(n))) for n in xrange(50)]
+        futures.append(engine.spawn(_fail_co()))
+        engine.run()
+        engine.shutdown()
+
+        for n in xrange(50):
+            self.assertEqual(sum(range(n)), futures[n].result())
+        self.assertIsInstance(futures[-1].exception(), TestException)
+        self.assertEqual(0, engine.get_active_task_count())
+
+    def test_session_is_active(self):
+        """ Test that the session is active while the coroutine runs and
+        while its blocking calls are made.
+        """
+        s = session.SessionContext('abc')
+        seen = []
+
+        def _session_co():
+            seen.append(session.get_current_session())
+            current = yield Call(session.get_current_session)
+            seen.append(current)
+
+        engine = Engine()
+        future = engine.spawn(_session_co(), session=s)
+        engine.run()
+        engine.shutdown()
+        future.result()
+        self.assertEqual([s, s], seen)
+        self.assertEqual('abc', future.session_id)
+
+    def test_concurrent_encrypt(self):
+        """ Run several encryption sessions on one engine, and make sure
+        that blocking calls are only made on the engine's worker threads.
+        """
+        max_workers = 3
+        thread_names = set()
+        engine = Engine(max_workers=max_workers)
+
+        class _EncryptorService(DummyEncryptorService):
+            def get_status(self):
+                thread_names.add(threading.current_thread().name)
+                return super(_EncryptorService, self).get_status()
+
+        futures = []
+        for _ in xrange(10):
+            aws_svc, encryptor_image, guest_image = build_aws_service()
+            co = encrypt_ami.encrypt_co(
+                aws_svc=aws_svc,
+                enc_svc_cls=_EncryptorService,
+                image_id=guest_image.id,
+                encryptor_ami=encryptor_image.id
+            )
+            futures.append(engine.spawn(co, session=aws_svc.session))
+
+        aws_svc, encryptor_image, guest_image = build_aws_service()
+        co = encrypt_ami.encrypt_co(
+            aws_svc=aws_svc,
+            enc_svc_cls=FailedEncryptionService,
+            image_id=guest_image.id,
+            encryptor_ami=encryptor_image.id,
+            save_encryptor_logs=False
+        )
+        failed = engine.spawn(co, session=aws_svc.session)
+        engine.run()
+        engine.shutdown()
+
+        ami_ids = set(f.result() for f in futures)
+        self.assertEqual(10, len(ami_ids))
+        self.assertIsInstance(
+            failed.exception(), encryptor_service.EncryptionError)
+
+        # Temporary resources were cleaned up after the failure.
+        for instance in aws_svc.instances.values():
+            self.assertEqual('terminated', instance.state)
+
+        self.assertTrue(thread_names)
+        self.assertLessEqual(len(thread_names), max_workers)
+        for name in thread_names:
+            self.assertTrue(name.startswith('brkt-engine'))
+
+    def test_gather(self):
+        """ Test that gather_co() runs coroutines concurrently and returns
+        their results in order.
+        """
+        def _gather_co():
+            results = yield gather_co(
+                _sum_co([1, 2]), _sum_co([3, 4]), _add_co(5, 6))
+            raise Return(results)
+
+        engine = Engine()
+        self.assertEqual([3, 7, 11], engine.run_until_complete(_gather_co()))
+        self.assertEqual([3, 7, 11], run_sync(_gather_co()))
+        with self.assertRaises(TestException):
+            run_sync(gather_co(_sum_co([1]), _fail_co()))
+        engine.shutdown()
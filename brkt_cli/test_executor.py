@@ -0,0 +1,75 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import threading
+import unittest
+
+from brkt_cli import executor
+from brkt_cli.executor import Future, ThreadPoolExecutor
+
+
+class TestExecutor(unittest.TestCase):
+
+    def test_result(self):
+        pool = ThreadPoolExecutor(max_workers=2)
+        futures = [pool.submit(lambda x: x * 2, i) for i in xrange(5)]
+        self.assertEqual([0, 2, 4, 6, 8], [f.result(5) for f in futures])
+        pool.shutdown()
+
+    def test_exception(self):
+        def _fail():
+            raise ValueError('boom')
+
+        pool = ThreadPoolExecutor(max_workers=1)
+        future = pool.submit(_fail)
+        with self.assertRaisesRegexp(ValueError, 'boom'):
+            future.result(5)
+        self.assertIsInstance(future.exception(), ValueError)
+        pool.shutdown()
+
+    def test_cancel_and_callbacks(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def _block():
+            started.set()
+            release.wait(5)
+            return 'done'
+
+        pool = ThreadPoolExecutor(max_workers=1)
+        running = pool.submit(_block)
+        queued = pool.submit(lambda: 'never')
+        started.wait(5)
+
+        done = []
+        running.add_done_callback(lambda f: done.append(f.result()))
+        self.assertFalse(running.cancel())
+        self.assertTrue(queued.cancel())
+        with self.assertRaises(executor.CancelledError):
+            queued.result()
+
+        release.set()
+        self.assertEqual('done', running.result(5))
+        pool.shutdown()
+        self.assertEqual(['done'], done)
+
+    def test_timeout_and_progress(self):
+        future = Future()
+        with self.assertRaises(executor.TimeoutError):
+            future.result(timeout=0.01)
+
+        progress = []
+        future.add_progress_callback(lambda f, p: progress.append(p))
+        future.set_progress(50)
+        self.assertEqual([50], progress)
+        self.assertEqual(50, future.progress)
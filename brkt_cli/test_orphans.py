@@ -0,0 +1,113 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import argparse
+import unittest
+
+from brkt_cli import orphans
+from brkt_cli.orphans import Resource
+
+NOW = 1000000
+HOUR = 60 * 60
+
+
+def _resource(resource_type, id, age=None, live=False):
+    created_time = NOW - age if age is not None else None
+    return Resource(
+        type=resource_type, id=id, created_time=created_time, live=live,
+        location=None)
+
+
+class TestOrphans(unittest.TestCase):
+
+    def test_parse_time(self):
+        self.assertEqual(0, orphans.parse_time('1970-01-01T00:00:00.000Z'))
+        self.assertEqual(
+            3600, orphans.parse_time('1970-01-01T00:00:00.000-01:00'))
+        self.assertIsNone(orphans.parse_time(None))
+
+    def test_is_dead(self):
+        def _session(*resources):
+            sessions = orphans.group_by_session(
+                [('abc', r) for r in resources])
+            return sessions[0]
+
+        # Young sessions are kept.
+        young = _session(
+            _resource(orphans.RESOURCE_VOLUME, 'v1', age=10 * HOUR),
+            _resource(orphans.RESOURCE_SNAPSHOT, 's1', age=HOUR))
+        self.assertFalse(orphans.is_dead(young, now=NOW))
+
+        # Old sessions are deleted unless an instance is running.
+        old = _session(
+            _resource(orphans.RESOURCE_VOLUME, 'v1', age=10 * HOUR))
+        self.assertTrue(orphans.is_dead(old, now=NOW))
+        running = _session(
+            _resource(orphans.RESOURCE_INSTANCE, 'i1', age=10 * HOUR,
+                      live=True))
+        self.assertFalse(orphans.is_dead(running, now=NOW))
+
+        # Running instances are stuck after max_age.
+        stuck = _session(
+            _resource(orphans.RESOURCE_INSTANCE, 'i1', age=50 * HOUR,
+                      live=True))
+        self.assertTrue(orphans.is_dead(stuck, now=NOW))
+
+        # A session that is waiting for an encryptor slot only has its
+        # security group, whose creation time is unknown.
+        waiting = _session(
+            _resource(orphans.RESOURCE_SECURITY_GROUP, 'sg1'))
+        self.assertFalse(orphans.is_dead(waiting, now=NOW))
+
+        # The security group is deleted along with older resources.
+        old_with_sg = _session(
+            _resource(orphans.RESOURCE_SECURITY_GROUP, 'sg1'),
+            _resource(orphans.RESOURCE_VOLUME, 'v1', age=10 * HOUR))
+        self.assertTrue(orphans.is_dead(old_with_sg, now=NOW))
+
+    def test_collect_garbage(self):
+        resources = [
+            ('old', _resource(orphans.RESOURCE_VOLUME, 'v1', age=10 * HOUR)),
+            ('new', _resource(orphans.RESOURCE_VOLUME, 'v2', age=HOUR)),
+            ('old', _resource(orphans.RESOURCE_SNAPSHOT, 's1', age=9 * HOUR))
+        ]
+        deleted = []
+
+        dead = orphans.collect_garbage(
+            resources, deleted.extend, dry_run=True, now=NOW)
+        self.assertEqual(['old'], [s.session_id for s in dead])
+        self.assertEqual([], deleted)
+
+        orphans.collect_garbage(resources, deleted.extend, now=NOW)
+        self.assertEqual(['old'], [s.session_id for s in deleted])
+        self.assertEqual(
+            ['s1', 'v1'], [r.id for r in deleted[0].resources])
+
+    def test_render_report(self):
+        sessions = orphans.group_by_session([
+            ('old', _resource(orphans.RESOURCE_VOLUME, 'v1', age=50 * HOUR)),
+            ('new', _resource(orphans.RESOURCE_VOLUME, 'v2', age=90 * 60))
+        ])
+        report = orphans.render_report(sessions, sessions[1:], now=NOW)
+        lines = report.splitlines()
+        self.assertEqual(3, len(lines))
+        self.assertIn('1h30m', lines[1])
+        self.assertTrue(lines[1].rstrip().endswith('keep'))
+        self.assertIn('2d', lines[2])
+        self.assertTrue(lines[2].rstrip().endswith('delete'))
+
+    def test_hours(self):
+        self.assertEqual(5400, orphans._hours('1.5'))
+        for value in ('-1', 'x'):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                orphans._hours(value)
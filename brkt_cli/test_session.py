@@ -0,0 +1,60 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import logging
+import unittest
+
+from brkt_cli import session
+from brkt_cli.session import SessionContext, SessionLogFilter
+
+
+class TestSessionContext(unittest.TestCase):
+
+    def test_track_resources(self):
+        s = SessionContext('abc')
+        s.track_resource(session.RESOURCE_DISK, 'disk-1')
+        s.track_resource(session.RESOURCE_DISK, 'disk-2')
+        s.track_resource(session.RESOURCE_DISK, 'disk-1')
+        s.track_resource(session.RESOURCE_INSTANCE, 'instance-1')
+        self.assertEqual(
+            ['disk-1', 'disk-2'], s.get_resources(session.RESOURCE_DISK))
+
+        # The returned list is a copy.
+        for disk in s.get_resources(session.RESOURCE_DISK):
+            s.untrack_resource(session.RESOURCE_DISK, disk)
+        self.assertEqual([], s.get_resources(session.RESOURCE_DISK))
+        self.assertEqual(
+            ['instance-1'], s.get_resources(session.RESOURCE_INSTANCE))
+
+    def test_sessions_are_isolated(self):
+        s1 = SessionContext()
+        s2 = SessionContext()
+        self.assertNotEqual(s1.session_id, s2.session_id)
+
+        s1.add_no_proxy_host('10.0.0.1')
+        s1.add_no_proxy_host('10.0.0.1')
+        self.assertEqual(['10.0.0.1'], s1.no_proxy_hosts)
+        self.assertEqual([], s2.no_proxy_hosts)
+
+    def test_log_filter(self):
+        f = SessionLogFilter()
+        record = logging.LogRecord(
+            'test', logging.INFO, __file__, 1, 'hello %s', ('world',), None)
+        s = SessionContext('abc')
+        with s.activate():
+            self.assertIs(s, session.get_current_session())
+            f.filter(record)
+            # Filtering the same record twice doesn't add a second prefix.
+            f.filter(record)
+        self.assertIsNone(session.get_current_session())
+        self.assertEqual('[abc] hello world', record.getMessage())
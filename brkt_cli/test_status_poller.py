@@ -0,0 +1,221 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import BaseHTTPServer
+import json
+import socket
+import SocketServer
+import threading
+import time
+import unittest
+
+from brkt_cli import encryptor_service, util
+from brkt_cli.encryptor_service import (
+    EncryptorConnectionError,
+    EncryptorService
+)
+from brkt_cli.status_poller import StatusPoller, _parse_response
+
+
+class _StatusHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPServer.BaseHTTPRequestHandler.setup(self)
+        self.server.connection_count += 1
+
+    def do_GET(self):
+        self.server.request_count += 1
+        body = json.dumps(self.server.get_next_status())
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class _EncryptorStandIn(SocketServer.ThreadingMixIn,
+                        BaseHTTPServer.HTTPServer):
+    """ Serves an encryptor's status port on localhost.  Each request
+    returns the next status in the list, and the last one is repeated.
+    """
+    daemon_threads = True
+
+    def __init__(self, statuses):
+        BaseHTTPServer.HTTPServer.__init__(
+            self, ('127.0.0.1', 0), _StatusHandler)
+        self.statuses = list(statuses)
+        self.connection_count = 0
+        self.request_count = 0
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def get_next_status(self):
+        if len(self.statuses) > 1:
+            return self.statuses.pop(0)
+        return self.statuses[0]
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def _status(state, bytes_written=0):
+    return {'state': state, 'bytes_written': bytes_written,
+            'bytes_total': 100}
+
+
+class TestStatusPoller(unittest.TestCase):
+
+    def setUp(self):
+        util.SLEEP_ENABLED = False
+        self.poller = StatusPoller(interval=0.05, timeout=1)
+        self.servers = []
+
+    def tearDown(self):
+        self.poller.stop()
+        for server in self.servers:
+            server.stop()
+
+    def _new_server(self, statuses):
+        server = _EncryptorStandIn(statuses)
+        self.servers.append(server)
+        return server
+
+    def _new_enc_svc(self, hostnames, port):
+        new_enc_svc = self.poller.bind(EncryptorService)
+        return new_enc_svc(hostnames, port=port, no_proxy_hosts=hostnames)
+
+    def test_keep_alive(self):
+        server = self._new_server([_status('encrypting', 25)])
+        enc_svc = self._new_enc_svc(['127.0.0.1'], server.port)
+        for _ in range(3):
+            status = self.poller.get_status(enc_svc)
+            self.assertEqual(25, status['percent_complete'])
+        self.assertEqual(3, server.request_count)
+        self.assertEqual(1, server.connection_count)
+
+    def test_first_address_that_answers(self):
+        """ Test that all addresses are polled, and that the one that
+        answers is used from then on.
+        """
+        server = self._new_server([_status('encrypting')])
+        # Nothing listens on 127.0.0.2.
+        enc_svc = self._new_enc_svc(['127.0.0.2', '127.0.0.1'], server.port)
+        encryptor_service.wait_for_encryptor_up(enc_svc, util.Deadline(10))
+        self.assertEqual(['127.0.0.1'], enc_svc.hostnames)
+
+    def test_dead_host_does_not_block(self):
+        """ Test that an encryptor that accepts connections but never
+        answers doesn't hold up the others.
+        """
+        dead = socket.socket()
+        dead.bind(('127.0.0.1', 0))
+        dead.listen(5)
+        try:
+            server = self._new_server([_status('encrypting', 50)])
+            dead_svc = self._new_enc_svc(
+                ['127.0.0.1'], dead.getsockname()[1])
+            live_svc = self._new_enc_svc(['127.0.0.1'], server.port)
+
+            dead_future = self.poller.request_status(dead_svc)
+            start = time.time()
+            _, status = self.poller.request_status(live_svc).result(5)
+            self.assertEqual(50, status['percent_complete'])
+            self.assertLess(time.time() - start, 0.5)
+            self.assertFalse(dead_future.done())
+
+            with self.assertRaises(EncryptorConnectionError):
+                dead_future.result(5)
+        finally:
+            dead.close()
+
+    def test_publish_change(self):
+        server = self._new_server([_status('encrypting', 10)])
+        enc_svc = self._new_enc_svc(['127.0.0.1'], server.port)
+        status = self.poller.get_status(enc_svc)
+
+        # The status doesn't change, so the latest status is returned
+        # when max_wait expires.
+        self.assertEqual(
+            status,
+            self.poller.get_status(enc_svc, previous=status, max_wait=0.2)
+        )
+
+        # The waiting session is woken up when the status changes.
+        future = self.poller.request_status(enc_svc, previous=status)
+        time.sleep(0.1)
+        self.assertFalse(future.done())
+        server.statuses = [_status('encrypting', 20)]
+        _, new_status = future.result(5)
+        self.assertEqual(20, new_status['percent_complete'])
+
+    def test_wait_for_encryption(self):
+        server = self._new_server([
+            _status('initial'),
+            _status('encrypting', 50),
+            _status('finished', 100)
+        ])
+        enc_svc = self._new_enc_svc(['127.0.0.1'], server.port)
+        encryptor_service.wait_for_encryptor_up(enc_svc, util.Deadline(10))
+        encryptor_service.wait_for_encryption(enc_svc)
+        self.assertEqual(3, server.request_count)
+
+    def test_stop(self):
+        dead = socket.socket()
+        dead.bind(('127.0.0.1', 0))
+        dead.listen(5)
+        try:
+            enc_svc = self._new_enc_svc(['127.0.0.1'], dead.getsockname()[1])
+            future = self.poller.request_status(enc_svc)
+            self.poller.stop()
+            with self.assertRaisesRegexp(util.BracketError, 'stopped'):
+                future.result(5)
+            with self.assertRaisesRegexp(util.BracketError, 'stopped'):
+                self.poller.request_status(enc_svc)
+        finally:
+            dead.close()
+
+
+class TestParseResponse(unittest.TestCase):
+
+    def test_content_length(self):
+        response = 'HTTP/1.1 200 OK\r\nContent-Length: 5\r\n\r\nhello'
+        self.assertIsNone(_parse_response(response[:-1], eof=False))
+        self.assertEqual(
+            (200, 'hello', True), _parse_response(response, eof=False))
+        with self.assertRaises(IOError):
+            _parse_response(response[:-1], eof=True)
+
+    def test_chunked(self):
+        response = (
+            'HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n'
+            '3\r\nhel\r\n2\r\nlo\r\n0\r\n\r\n'
+        )
+        self.assertIsNone(_parse_response(response[:-2], eof=False))
+        self.assertEqual(
+            (200, 'hello', True), _parse_response(response, eof=False))
+
+    def test_read_until_close(self):
+        response = 'HTTP/1.0 200 OK\r\n\r\nhello'
+        self.assertIsNone(_parse_response(response, eof=False))
+        self.assertEqual(
+            (200, 'hello', False), _parse_response(response, eof=True))
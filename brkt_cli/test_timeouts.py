@@ -0,0 +1,117 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import argparse
+import os
+import shutil
+import tempfile
+import unittest
+
+from brkt_cli import timeouts
+from brkt_cli.timeouts import TimeoutHistory, get_timeouts
+
+
+class TestTimeouts(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.history = TimeoutHistory(
+            os.path.join(self.tmp_dir, 'brkt', 'timeouts.json'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_volume_size(self):
+        """ Test that timeouts grow with the volume size, up to the
+        maximum.
+        """
+        self.assertEqual(
+            timeouts.DEFAULT_TIMEOUTS.encryptor_up,
+            get_timeouts().encryptor_up
+        )
+        small = get_timeouts(volume_size_gb=8)
+        large = get_timeouts(volume_size_gb=1024)
+        huge = get_timeouts(volume_size_gb=16384)
+        for phase in timeouts.PHASES:
+            self.assertLess(small.get(phase), large.get(phase))
+            self.assertLessEqual(large.get(phase), huge.get(phase))
+        self.assertLess(
+            small.encryption_progress,
+            timeouts.DEFAULT_TIMEOUTS.encryption_progress
+        )
+        self.assertEqual(7200, huge.encryption_progress)
+
+    def test_instance_type(self):
+        self.assertLess(
+            get_timeouts(volume_size_gb=8, instance_type='c3.xlarge').image,
+            get_timeouts(volume_size_gb=8, instance_type='t2.medium').image
+        )
+
+    def test_overrides(self):
+        t = get_timeouts(
+            volume_size_gb=8, overrides={timeouts.ENCRYPTOR_UP: 42})
+        self.assertEqual(42, t.encryptor_up)
+        t = get_timeouts(overrides={timeouts.IMAGE: 42})
+        self.assertEqual(42, t.image)
+
+    def test_history(self):
+        """ Test that recorded durations lengthen the timeouts, and that
+        the history survives a restart.
+        """
+        self.assertIsNone(self.history.get_seconds_per_gb(timeouts.IMAGE))
+        t = get_timeouts(volume_size_gb=10, history=self.history)
+        original = t.image
+
+        # A fast session doesn't shorten the timeout.
+        t.record(timeouts.IMAGE, 10)
+        self.assertEqual(
+            original,
+            get_timeouts(volume_size_gb=10, history=self.history).image
+        )
+
+        # A slow session lengthens it.
+        t.record(timeouts.IMAGE, original)
+        history = TimeoutHistory(self.history.path)
+        self.assertEqual(
+            original * timeouts.HISTORY_SAFETY_FACTOR,
+            get_timeouts(volume_size_gb=10, history=history).image
+        )
+
+        for _ in range(timeouts.HISTORY_SAMPLES):
+            t.record(timeouts.IMAGE, 10)
+        self.assertEqual(1, history.get_seconds_per_gb(timeouts.IMAGE))
+
+    def test_typical_rate(self):
+        self.assertIsNone(
+            self.history.get_typical_seconds_per_gb(timeouts.ENCRYPTION))
+        for seconds in (100, 10, 20):
+            self.history.record(timeouts.ENCRYPTION, seconds, 10)
+        self.assertEqual(
+            2, self.history.get_typical_seconds_per_gb(timeouts.ENCRYPTION))
+
+    def test_invalid_history(self):
+        os.makedirs(os.path.dirname(self.history.path))
+        with open(self.history.path, 'w') as f:
+            f.write('not json')
+        self.assertIsNone(self.history.get_seconds_per_gb(timeouts.IMAGE))
+        self.history.record(timeouts.IMAGE, 50, 10)
+        self.assertEqual(5, self.history.get_seconds_per_gb(timeouts.IMAGE))
+
+    def test_phase_timeout_argument(self):
+        self.assertEqual(
+            (timeouts.ENCRYPTION_PROGRESS, 3600),
+            timeouts.phase_timeout('encryption-progress=3600')
+        )
+        for value in ('bogus=10', 'image', 'image=0', 'image=x'):
+            with self.assertRaises(argparse.ArgumentTypeError):
+                timeouts.phase_timeout(value)
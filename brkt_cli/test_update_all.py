@@ -0,0 +1,161 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import os
+import shutil
+import tempfile
+import unittest
+
+import brkt_cli
+from brkt_cli import api, catalog, job_queue, update_all, util
+from brkt_cli.aws.encrypt_ami import TAG_ENCRYPTOR, TAG_ENCRYPTOR_AMI
+from brkt_cli.aws.test_aws_service import build_aws_service
+from brkt_cli.catalog import Catalog
+from brkt_cli.job_queue import JobQueue
+from brkt_cli.test_encryptor_service import DummyEncryptorService
+
+
+class DummyClient(api.Client):
+    """ Runs operations against a DummyAWSService, one at a time. """
+
+    def __init__(self, aws_svc, encryptor_ami):
+        super(DummyClient, self).__init__(
+            'us-west-2',
+            brkt_env=brkt_cli.get_prod_brkt_env(),
+            max_workers=1,
+            enc_svc_cls=DummyEncryptorService
+        )
+        self.aws_svc = aws_svc
+        self.encryptor_ami = encryptor_ami
+
+    def _new_aws_service(self, session_id=None):
+        return self.aws_svc
+
+    def get_encryptor_ami(self, pv=False):
+        return self.encryptor_ami
+
+
+class TestUpdateAll(unittest.TestCase):
+
+    def setUp(self):
+        util.SLEEP_ENABLED = False
+        self.tmp_dir = tempfile.mkdtemp()
+        self.catalog_path = os.path.join(self.tmp_dir, 'catalog.db')
+        self.queue = JobQueue(':memory:')
+
+        aws_svc, self.encryptor_image, guest_image = build_aws_service()
+        self.client = DummyClient(aws_svc, self.encryptor_image.id)
+        encrypted_image = aws_svc.get_image(self.client.encrypt_ami_async(
+            guest_image.id, validate=False).result(timeout=30))
+        self.images = []
+        for encryptor_ami in ('ami-old', self.encryptor_image.id, 'ami-old'):
+            image = aws_svc.get_image(aws_svc.register_image(
+                kernel_id=None,
+                block_device_map=encrypted_image.block_device_mapping,
+                name='encrypted'))
+            image.tags[TAG_ENCRYPTOR] = 'True'
+            image.tags[TAG_ENCRYPTOR_AMI] = encryptor_ami
+            self.images.append(image)
+
+    def tearDown(self):
+        self.client.shutdown()
+        self.queue.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def test_find_stale_images(self):
+        """ Test that AMIs with the latest encryptor, and AMIs that the
+        catalog says were already updated, are skipped.
+        """
+        stale = update_all.find_stale_images(self.client)
+        self.assertEqual(
+            sorted([self.images[0].id, self.images[2].id]),
+            sorted(image.id for image, _ in stale)
+        )
+        self.assertEqual(
+            set([self.encryptor_image.id]), set(e for _, e in stale))
+
+        image_catalog = Catalog(self.catalog_path)
+        try:
+            image_catalog.add(catalog.make_record(
+                'ami-updated', catalog.CLOUD_AWS,
+                source_image=self.images[0].id,
+                encryptor_image=self.encryptor_image.id))
+            stale = update_all.find_stale_images(
+                self.client, image_catalog=image_catalog)
+        finally:
+            image_catalog.close()
+        self.assertEqual(
+            [self.images[2].id], [image.id for image, _ in stale])
+
+    def test_run_plan(self):
+        """ Test that the updates run, that the results are saved in the
+        plan and the catalog, and that a resumed plan only runs the jobs
+        that didn't succeed.
+        """
+        stale = update_all.find_stale_images(self.client)
+        update_all.add_to_plan(self.queue, 'us-west-2', stale)
+        self.queue.submit(
+            update_all.JOB_TYPE,
+            {'ami': 'ami-bogus', 'encryptor_ami': self.encryptor_image.id},
+            region='us-west-2', job_id='ami-bogus'
+        )
+
+        failed = update_all.run_plan(
+            self.queue, {'us-west-2': self.client},
+            catalog_path=self.catalog_path, validate=False)
+        self.assertEqual(1, failed)
+
+        jobs = {j.id: j for j in update_all.get_jobs(self.queue)}
+        self.assertEqual(job_queue.JOB_FAILED, jobs['ami-bogus'].state)
+        image_catalog = Catalog(self.catalog_path)
+        try:
+            for image, _ in stale:
+                job = jobs[image.id]
+                self.assertEqual(job_queue.JOB_SUCCEEDED, job.state)
+                self.assertIn(job.result, self.client.aws_svc.images)
+                self.assertEqual(100, job.percent_complete)
+                record = image_catalog.get(job.result)
+                self.assertEqual(image.id, record.source_image)
+                self.assertEqual(
+                    self.encryptor_image.id, record.encryptor_image)
+                self.assertEqual(catalog.OPERATION_UPDATE, record.operation)
+        finally:
+            image_catalog.close()
+
+        self.assertEqual(1, update_all.requeue_unfinished(self.queue))
+        self.assertEqual(1, update_all.run_plan(
+            self.queue, {'us-west-2': self.client},
+            catalog_path=self.catalog_path, validate=False))
+        self.assertEqual(
+            2, len(self.queue.list_jobs(state=job_queue.JOB_SUCCEEDED)))
+
+    def test_run_plan_submit_error(self):
+        """ Test that a job whose update can't be started fails, and
+        doesn't keep run_plan() from returning.
+        """
+        stale = update_all.find_stale_images(self.client)
+        update_all.add_to_plan(self.queue, 'us-west-2', stale[:1])
+        update_all.add_to_plan(self.queue, 'us-east-1', stale[1:])
+        closed_client = DummyClient(
+            self.client.aws_svc, self.encryptor_image.id)
+        closed_client.shutdown()
+
+        failed = update_all.run_plan(
+            self.queue,
+            {'us-west-2': self.client, 'us-east-1': closed_client},
+            catalog_path=self.catalog_path, validate=False)
+        self.assertEqual(1, failed)
+        jobs = {j.id: j for j in update_all.get_jobs(self.queue)}
+        self.assertEqual(job_queue.JOB_SUCCEEDED, jobs[stale[0][0].id].state)
+        self.assertEqual(job_queue.JOB_FAILED, jobs[stale[1][0].id].state)
+        self.assertIn('shut down', jobs[stale[1][0].id].error)
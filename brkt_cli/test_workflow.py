@@ -0,0 +1,265 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+import unittest
+
+from brkt_cli import util
+from brkt_cli.engine import Call, Engine, Return, Sleep
+from brkt_cli.workflow import Workflow
+
+
+class TestException(Exception):
+    pass
+
+
+class TestWorkflow(unittest.TestCase):
+
+    def setUp(self):
+        util.SLEEP_ENABLED = False
+        self.events = []
+
+    def _make_workflow(self, fail_step=None):
+        """ Return a workflow where a and b are independent, and c
+        requires both of them.
+        """
+        events = self.events
+
+        def _step_co(name, value, seconds):
+            events.append('start ' + name)
+            yield Sleep(seconds)
+            if name == fail_step:
+                raise TestException(name)
+            events.append('end ' + name)
+            raise Return(value)
+
+        def _a_co(x):
+            result = yield _step_co('a', x + 1, 2)
+            raise Return(result)
+
+        def _b_co(x):
+            result = yield _step_co('b', x + 2, 1)
+            raise Return(result)
+
+        def _c_co(a, b):
+            result = yield _step_co('c', a + b, 1)
+            raise Return(result)
+
+        def _clean_up_a(a, c=None):
+            events.append('clean up a, c=%s' % c)
+
+        def _clean_up_b(b):
+            events.append('clean up b')
+
+        def _compensate_b():
+            events.append('compensate b')
+
+        workflow = Workflow('test')
+        workflow.add_step('a', _a_co, cleanup=_clean_up_a)
+        workflow.add_step(
+            'b', _b_co, cleanup=_clean_up_b, compensate=_compensate_b)
+        workflow.add_step('c', _c_co)
+        return workflow
+
+    def test_run(self):
+        workflow = self._make_workflow()
+        results = workflow.run(x=1)
+        self.assertEqual(
+            {'x': 1, 'a': 2, 'b': 3, 'c': 5}, results)
+
+        # a and b run concurrently, and c starts after both complete.
+        self.assertEqual(
+            ['start a', 'start b'], sorted(self.events[:2]))
+        self.assertEqual('start c', self.events[4])
+
+        # Cleanup runs without compensation, and optional values are
+        # passed to cleanup functions.
+        self.assertIn('clean up a, c=5', self.events)
+        self.assertIn('clean up b', self.events)
+        self.assertNotIn('compensate b', self.events)
+
+        self.assertEqual(
+            ['a', 'b', 'c'], sorted(t.name for t in workflow.timings))
+        for t in workflow.timings:
+            self.assertTrue(t.succeeded)
+            self.assertEqual(1, t.attempts)
+
+    def test_failure(self):
+        workflow = self._make_workflow(fail_step='c')
+        with self.assertRaises(TestException):
+            workflow.run(x=1)
+        self.assertIn('compensate b', self.events)
+        self.assertIn('clean up a, c=None', self.events)
+        # Compensation runs before cleanup.
+        self.assertLess(
+            self.events.index('compensate b'),
+            self.events.index('clean up b')
+        )
+
+    def test_no_new_steps_after_failure(self):
+        """ Test that steps that are already running complete after
+        another step fails, but no new steps are started.
+        """
+        workflow = self._make_workflow(fail_step='b')
+        with self.assertRaises(TestException):
+            workflow.run(x=1)
+        self.assertIn('end a', self.events)
+        self.assertNotIn('start c', self.events)
+        self.assertIn('clean up a, c=None', self.events)
+        self.assertNotIn('clean up b', self.events)
+
+    def test_cleanup_order(self):
+        """ Test that a step is cleaned up after the steps that required
+        it.
+        """
+        events = []
+
+        def _make_clean_up_co(name):
+            def _clean_up_co():
+                yield Sleep(1)
+                events.append(name)
+            return _clean_up_co
+
+        workflow = Workflow('test')
+        workflow.add_step('a', lambda: 1, cleanup=_make_clean_up_co('a'))
+        workflow.add_step('b', lambda a: 2, cleanup=_make_clean_up_co('b'))
+        workflow.add_step(
+            'c', lambda a, b: 3, cleanup=_make_clean_up_co('c'))
+        workflow.run()
+        self.assertEqual(['c', 'b', 'a'], events)
+
+    def test_independent_cleanup(self):
+        """ Test that a step with independent cleanup is cleaned up at the
+        same time as the steps that required it.
+        """
+        events = []
+
+        def _make_clean_up_co(name):
+            def _clean_up_co():
+                events.append('start ' + name)
+                yield Sleep(1)
+                events.append('end ' + name)
+            return _clean_up_co
+
+        workflow = Workflow('test')
+        workflow.add_step(
+            'a', lambda: 1, cleanup=_make_clean_up_co('a'),
+            independent_cleanup=True)
+        workflow.add_step('b', lambda a: 2, cleanup=_make_clean_up_co('b'))
+        workflow.run()
+        self.assertLess(events.index('start a'), events.index('end b'))
+        self.assertLess(events.index('start b'), events.index('end a'))
+
+    def test_transitive_cleanup_order(self):
+        """ Test that a step is cleaned up after the steps that require
+        it through an independent step, like the instance slot that is
+        released after the encryptor that requires the guest instance is
+        terminated.
+        """
+        events = []
+
+        def _make_clean_up_co(name, sleeps=1):
+            def _clean_up_co():
+                events.append('start ' + name)
+                for _ in range(sleeps):
+                    yield Sleep(1)
+                events.append('end ' + name)
+            return _clean_up_co
+
+        workflow = Workflow('test')
+        workflow.add_step(
+            'slot', lambda: 1, cleanup=_make_clean_up_co('slot'))
+        workflow.add_step(
+            'guest', lambda slot: 2, cleanup=_make_clean_up_co('guest'),
+            independent_cleanup=True)
+        workflow.add_step(
+            'encryptor', lambda guest: 3,
+            cleanup=_make_clean_up_co('encryptor', sleeps=3))
+        workflow.run()
+        self.assertLess(events.index('start guest'),
+                        events.index('end encryptor'))
+        self.assertLess(events.index('end encryptor'),
+                        events.index('start slot'))
+        self.assertLess(events.index('end guest'), events.index('start slot'))
+
+    def test_cleanup_failure(self):
+        """ Test that a cleanup failure doesn't hide the step's result or
+        prevent other cleanups from running.
+        """
+        events = []
+
+        def _fail():
+            raise TestException()
+
+        workflow = Workflow('test')
+        workflow.add_step('a', lambda: 1, cleanup=lambda: events.append('a'))
+        workflow.add_step('b', lambda a: 2, cleanup=_fail)
+        self.assertEqual(2, workflow.run()['b'])
+        self.assertEqual(['a'], events)
+
+    def test_retry(self):
+        attempts = []
+
+        def _flaky():
+            attempts.append(1)
+            if len(attempts) < 3:
+                raise TestException()
+            return 'ok'
+
+        workflow = Workflow('test')
+        workflow.add_step('flaky', _flaky, retries=2)
+        self.assertEqual('ok', workflow.run()['flaky'])
+        self.assertEqual(3, workflow.timings[0].attempts)
+        self.assertIn('flaky=', workflow.get_timings_text())
+
+        del attempts[:]
+        workflow = Workflow('test')
+        workflow.add_step('flaky', _flaky, retries=1)
+        with self.assertRaises(TestException):
+            workflow.run()
+        self.assertFalse(workflow.timings[0].succeeded)
+
+    def test_validation(self):
+        workflow = Workflow('test')
+        workflow.add_step('a', lambda x: 1)
+        with self.assertRaises(ValueError):
+            workflow.add_step('a', lambda: 2)
+        # x is an input.
+        with self.assertRaises(ValueError):
+            workflow.add_step('x', lambda: 2)
+        # Cleanup can't require a step that the step doesn't require.
+        with self.assertRaises(ValueError):
+            workflow.add_step('b', lambda: 2, cleanup=lambda a: None)
+        with self.assertRaises(ValueError):
+            workflow.add_step('b', lambda b: 2)
+        with self.assertRaises(ValueError):
+            workflow.run()
+
+    def test_engine(self):
+        """ Test running a workflow on an engine, with its blocking calls
+        made on worker threads.
+        """
+        def _add_co(a, b):
+            result = yield Call(lambda: a + b)
+            raise Return(result)
+
+        engine = Engine(max_workers=2)
+        futures = []
+        for n in xrange(10):
+            workflow = Workflow('test')
+            workflow.add_step('total', _add_co)
+            workflow.add_step('c', lambda total, b: total * b)
+            futures.append(engine.spawn(workflow.run_co(a=n, b=1)))
+        engine.run()
+        engine.shutdown()
+        for n in xrange(10):
+            self.assertEqual((n + 1) * 1, futures[n].result()['c'])
@@ -0,0 +1,245 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Timeouts for the phases of an encryption or update session.
+
+The defaults suit a small guest volume.  get_timeouts() scales them by
+the size of the guest root volume and the type of the encryptor instance,
+so that small images fail fast and large ones don't time out while they
+are still making progress.  If a TimeoutHistory is passed, timeouts are
+lengthened to cover the slowest rate that was observed on this host.
+Values that the user specifies with --phase-timeout always win.
+"""
+
+import argparse
+import errno
+import json
+import logging
+import os
+import tempfile
+
+from brkt_cli.config import CONFIG_DIR
+
+log = logging.getLogger(__name__)
+
+# Waiting for the encryption service to respond after the encryptor
+# instance is launched.
+ENCRYPTOR_UP = 'encryptor_up'
+# The longest time that encryption progress is allowed to stall.
+ENCRYPTION_PROGRESS = 'encryption_progress'
+# Waiting for an instance to stop.
+INSTANCE = 'instance'
+# Waiting for a new AMI to become available.
+IMAGE = 'image'
+
+PHASES = (ENCRYPTOR_UP, ENCRYPTION_PROGRESS, INSTANCE, IMAGE)
+
+# The total time that encryption took.  It is recorded in the history for
+# estimating how long sessions take, but isn't a timeout.
+ENCRYPTION = 'encryption'
+
+# (seconds, seconds per GB of guest volume, maximum seconds) for each
+# phase.
+_SCALING = {
+    ENCRYPTOR_UP: (300, 1, 1800),
+    ENCRYPTION_PROGRESS: (300, 3, 7200),
+    INSTANCE: (180, 0.5, 1800),
+    IMAGE: (300, 3, 7200)
+}
+
+# Instance types with burstable or older CPUs and networking, which
+# run the encryptor more slowly.
+SLOW_INSTANCE_TYPE_PREFIXES = ('t1.', 't2.', 'm1.')
+SLOW_INSTANCE_FACTOR = 1.5
+
+# Timeouts based on history are this many times the slowest observed
+# rate.
+HISTORY_SAFETY_FACTOR = 2
+HISTORY_SAMPLES = 20
+
+TIMEOUT_HISTORY_PATH = os.path.join(CONFIG_DIR, 'timeouts.json')
+
+
+class Timeouts(object):
+    """ Timeouts in seconds for each phase.  Sessions report how long
+    each phase took by calling record().
+    """
+
+    def __init__(self, encryptor_up=600, encryption_progress=600,
+                 instance=300, image=900, volume_size_gb=None,
+                 history=None):
+        self.encryptor_up = encryptor_up
+        self.encryption_progress = encryption_progress
+        self.instance = instance
+        self.image = image
+        self.volume_size_gb = volume_size_gb
+        self.history = history
+
+    def get(self, phase):
+        return getattr(self, phase)
+
+    def record(self, phase, seconds):
+        """ Add the number of seconds that the phase took to the history,
+        if there is one.
+        """
+        if self.history and self.volume_size_gb:
+            self.history.record(phase, seconds, self.volume_size_gb)
+
+    def __repr__(self):
+        return ', '.join('%s=%ds' % (p, self.get(p)) for p in PHASES)
+
+
+DEFAULT_TIMEOUTS = Timeouts()
+
+
+class TimeoutHistory(object):
+    """ Stores the number of seconds per GB that recent sessions took in
+    each phase, in a JSON file.  Errors reading or writing the file are
+    logged and otherwise ignored, since the history is only a hint.
+    """
+
+    def __init__(self, path=TIMEOUT_HISTORY_PATH):
+        self.path = path
+        # The number of seconds that each phase took, in the sessions
+        # that recorded through this object.
+        self.durations = {}
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                history = json.load(f)
+            if isinstance(history, dict):
+                return history
+        except IOError as e:
+            if e.errno != errno.ENOENT:
+                log.debug('Unable to read %s: %s', self.path, e)
+        except ValueError as e:
+            log.debug('Ignoring invalid timeout history %s: %s', self.path, e)
+        return {}
+
+    def get_seconds_per_gb(self, phase):
+        """ Return the slowest rate that was recorded for the phase, or
+        None if there is no history.
+        """
+        samples = self._load().get(phase)
+        if not samples:
+            return None
+        return max(samples)
+
+    def get_typical_seconds_per_gb(self, phase):
+        """ Return the median rate that was recorded for the phase, or
+        None if there is no history.
+        """
+        samples = self._load().get(phase)
+        if not samples:
+            return None
+        return sorted(samples)[len(samples) // 2]
+
+    def record(self, phase, seconds, volume_size_gb):
+        self.durations[phase] = seconds
+        history = self._load()
+        samples = history.get(phase) or []
+        samples.append(float(seconds) / volume_size_gb)
+        history[phase] = samples[-HISTORY_SAMPLES:]
+
+        # Write to a temporary file and rename, so that concurrent
+        # sessions never see a partially written file.
+        directory = os.path.dirname(self.path)
+        try:
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            fd, tmp_path = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, 'w') as f:
+                json.dump(history, f)
+            os.rename(tmp_path, self.path)
+        except (IOError, OSError) as e:
+            log.debug('Unable to write %s: %s', self.path, e)
+
+
+def get_timeouts(volume_size_gb=None, instance_type=None, history=None,
+                 overrides=None):
+    """ Return the timeouts for a session.
+
+    :param volume_size_gb the size of the guest root volume, or None to
+        use the default timeouts
+    :param instance_type the type of the encryptor or updater instance
+    :param history a TimeoutHistory
+    :param overrides a dictionary of phase names to timeouts in seconds,
+        which are used as-is
+    :return a Timeouts object
+    """
+    values = {}
+    for phase in PHASES:
+        if not volume_size_gb:
+            values[phase] = DEFAULT_TIMEOUTS.get(phase)
+            continue
+        seconds, per_gb, maximum = _SCALING[phase]
+        timeout = seconds + per_gb * volume_size_gb
+        if instance_type and \
+                instance_type.startswith(SLOW_INSTANCE_TYPE_PREFIXES):
+            timeout *= SLOW_INSTANCE_FACTOR
+        if history:
+            observed = history.get_seconds_per_gb(phase)
+            if observed:
+                timeout = max(
+                    timeout,
+                    observed * volume_size_gb * HISTORY_SAFETY_FACTOR
+                )
+        values[phase] = int(min(timeout, maximum))
+    values.update(overrides or {})
+
+    timeouts = Timeouts(
+        volume_size_gb=volume_size_gb, history=history, **values)
+    log.debug('Timeouts for a %s GB volume: %s', volume_size_gb, timeouts)
+    return timeouts
+
+
+def phase_timeout(value):
+    """ Parse a PHASE=SECONDS command line argument.
+
+    :return a (phase, seconds) tuple
+    :raise argparse.ArgumentTypeError if the value is invalid
+    """
+    phase, _, seconds = value.partition('=')
+    phase = phase.strip().replace('-', '_')
+    if phase not in PHASES:
+        raise argparse.ArgumentTypeError(
+            'Phase must be one of %s' %
+            ', '.join(p.replace('_', '-') for p in PHASES)
+        )
+    try:
+        seconds = int(seconds)
+    except ValueError:
+        seconds = 0
+    if seconds < 1:
+        raise argparse.ArgumentTypeError(
+            '%s is not a positive number of seconds' % value)
+    return phase, seconds
+
+
+def setup_phase_timeout_args(parser):
+    parser.add_argument(
+        '--phase-timeout',
+        metavar='PHASE=SECONDS',
+        type=phase_timeout,
+        action='append',
+        dest='phase_timeouts',
+        help=(
+            'Override the timeout for a phase of the session.  By default, '
+            'timeouts are based on the size of the guest volume.  Phases '
+            'are %s.  May be specified multiple times.' %
+            ', '.join(p.replace('_', '-') for p in PHASES)
+        )
+    )
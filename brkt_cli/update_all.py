@@ -0,0 +1,414 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Updates every encrypted AMI that was built with an outdated encryptor.
+
+"brkt update-all" finds the AMIs that we own in each region whose
+BrktEncryptorAMI tag isn't the latest encryptor AMI for the region, and
+saves the plan as a JobQueue under ~/.brkt/update-all, with one job per
+AMI.  The updates run on one api.Client per region, whose worker count is
+the per-region concurrency limit, so all regions make progress at once.
+AMIs that the image catalog shows were already updated to the latest
+encryptor are skipped.
+
+If brkt is interrupted, "brkt update-all --resume PLAN-ID" runs the
+updates that didn't succeed.
+"""
+
+from __future__ import print_function
+
+import argparse
+import errno
+import logging
+import os
+import threading
+import time
+
+import brkt_cli
+from brkt_cli import api, job_queue, util
+from brkt_cli.aws.encrypt_ami import TAG_ENCRYPTOR_AMI
+from brkt_cli.catalog import (
+    CLOUD_AWS,
+    OPERATION_UPDATE,
+    Catalog,
+    make_record,
+    record_image
+)
+from brkt_cli.config import CONFIG_DIR
+from brkt_cli.instance_config import INSTANCE_UPDATER_MODE
+from brkt_cli.instance_config_args import (
+    make_instance_config,
+    setup_instance_config_args
+)
+from brkt_cli.job_queue import JobQueue
+from brkt_cli.subcommand import Subcommand
+from brkt_cli.validation import ValidationError
+
+log = logging.getLogger(__name__)
+
+PLAN_DIR = os.path.join(CONFIG_DIR, 'update-all')
+JOB_TYPE = 'update-encrypted-ami'
+
+
+def get_plan_path(plan_id, directory=None):
+    return os.path.join(directory or PLAN_DIR, plan_id + '.db')
+
+
+def find_stale_images(client, image_catalog=None):
+    """ Return the encrypted AMIs in the client's region that weren't
+    encrypted or updated with the latest encryptor.
+
+    :param image_catalog if specified, skip AMIs that the catalog shows
+        were already updated with the latest encryptor
+    :return a list of (Image, encryptor AMI id) tuples
+    """
+    stale = []
+    for image in client.list_encrypted_images():
+        latest = client.get_encryptor_ami(
+            pv=image.virtualization_type == 'paravirtual')
+        if image.tags.get(TAG_ENCRYPTOR_AMI) == latest:
+            continue
+        if image_catalog and image_catalog.query(
+                source_image=image.id, encryptor_image=latest):
+            log.info(
+                'Skipping %s, which was already updated with %s',
+                image.id, latest)
+            continue
+        stale.append((image, latest))
+    return stale
+
+
+def add_to_plan(queue, region, stale):
+    """ Add a job to the plan for each of the stale images. """
+    for image, encryptor_ami in stale:
+        queue.submit(
+            JOB_TYPE,
+            {
+                'ami': image.id,
+                'name': image.name,
+                'current_encryptor_ami': image.tags.get(TAG_ENCRYPTOR_AMI),
+                'encryptor_ami': encryptor_ami
+            },
+            region=region,
+            job_id=image.id
+        )
+
+
+def get_jobs(queue):
+    """ Return the jobs in the plan, in the order they were added. """
+    return list(reversed(queue.list_jobs(limit=-1)))
+
+
+def requeue_unfinished(queue):
+    """ Put the jobs that were interrupted or failed back in the queue.
+
+    :return the number of jobs that were requeued
+    """
+    count = 0
+    for job in get_jobs(queue):
+        if queue.requeue(job.id):
+            count += 1
+    return count
+
+
+def run_plan(queue, clients, catalog_path=None, **update_kwargs):
+    """ Run the queued jobs in the plan.  Jobs are submitted to the
+    client for their region, so at most max_workers updates run at once
+    in each region.  The result of each job is saved as soon as it
+    completes, so that an interrupted plan can be resumed.
+
+    :param clients a dictionary of region name to api.Client
+    :param update_kwargs passed to api.Client.update_ami_async()
+    :return the number of jobs that failed
+    """
+    jobs = [j for j in get_jobs(queue) if j.state == job_queue.JOB_QUEUED]
+    failed = []
+    lock = threading.Lock()
+    pending = [len(jobs)]
+    all_done = threading.Event()
+    if not jobs:
+        all_done.set()
+
+    def _fail(job, e):
+        queue.finish(job.id, error=str(e) or e.__class__.__name__)
+        failed.append(job.id)
+
+    def _finished():
+        with lock:
+            pending[0] -= 1
+            if not pending[0]:
+                all_done.set()
+
+    def _on_done(job, future):
+        try:
+            try:
+                ami = future.result()
+            except Exception as e:
+                log.error('Unable to update %s: %s', job.id, e)
+                _fail(job, e)
+                return
+            log.info('Updated %s to %s', job.id, ami)
+            queue.finish(job.id, result=ami)
+            record = make_record(
+                ami,
+                CLOUD_AWS,
+                location=job.region,
+                operation=OPERATION_UPDATE,
+                source_image=job.params['ami'],
+                encryptor_image=job.params['encryptor_ami'],
+                session_id=future.session_id,
+                created_time=time.time()
+            )
+            if catalog_path:
+                record_image(record, path=catalog_path)
+            else:
+                record_image(record)
+        finally:
+            _finished()
+
+    for job in jobs:
+        queue.start(job.id)
+        try:
+            future = clients[job.region].update_ami_async(
+                job.params['ami'],
+                encryptor_ami=job.params['encryptor_ami'],
+                progress_callback=(
+                    lambda f, p, job_id=job.id: queue.set_progress(
+                        job_id, p.state, p.percent_complete)
+                ),
+                **update_kwargs
+            )
+        except Exception as e:
+            log.error('Unable to start the update of %s: %s', job.id, e)
+            _fail(job, e)
+            _finished()
+            continue
+        future.add_done_callback(
+            lambda f, job=job: _on_done(job, f))
+
+    # Wait with a timeout, so that the user can interrupt brkt with
+    # Ctrl-C.  An untimed wait blocks KeyboardInterrupt in Python 2.
+    while not all_done.wait(1):
+        pass
+    return len(failed)
+
+
+def render_plan(jobs):
+    rows = [['AMI', 'REGION', 'NAME', 'ENCRYPTOR', 'NEW ENCRYPTOR', 'STATE',
+             'RESULT']]
+    for job in jobs:
+        rows.append([
+            job.id, job.region, job.params.get('name') or '-',
+            job.params.get('current_encryptor_ami') or '-',
+            job.params['encryptor_ami'], job.state,
+            job.result or job.error or '-'
+        ])
+    return util.render_table_rows(rows)
+
+
+class UpdateAllSubcommand(Subcommand):
+
+    def name(self):
+        return 'update-all'
+
+    def verbose(self, values):
+        return values.update_all_verbose
+
+    def register(self, subparsers, parsed_config):
+        parser = subparsers.add_parser(
+            self.name(),
+            description=(
+                'Update every encrypted AMI in the given regions that was '
+                'built with an outdated encryptor.'
+            ),
+            formatter_class=brkt_cli.SortingHelpFormatter
+        )
+        parser.add_argument(
+            '--region',
+            metavar='NAME',
+            dest='regions',
+            action='append',
+            help=(
+                'Update the AMIs in this AWS region.  May be specified '
+                'multiple times.'
+            )
+        )
+        parser.add_argument(
+            '--resume',
+            metavar='PLAN-ID',
+            help='Run the updates in this plan that did not succeed'
+        )
+        parser.add_argument(
+            '--max-updates-per-region',
+            metavar='N',
+            type=int,
+            default=2,
+            help='The number of updates that run at once in each region'
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Print the AMIs that would be updated, and exit'
+        )
+        parser.add_argument(
+            '--guest-instance-type',
+            metavar='TYPE',
+            dest='guest_instance_type',
+            default='m3.medium',
+            help=(
+                'The instance type to use when running the encrypted guest '
+                'instance'
+            )
+        )
+        parser.add_argument(
+            '--updater-instance-type',
+            metavar='TYPE',
+            dest='updater_instance_type',
+            default='m3.medium',
+            help='The instance type to use when running the updater instance'
+        )
+        parser.add_argument(
+            '--tag',
+            metavar='KEY=VALUE',
+            dest='tags',
+            action='append',
+            help=(
+                'Custom tag for resources created during the updates. '
+                'May be specified multiple times.'
+            )
+        )
+        parser.add_argument(
+            '-v',
+            '--verbose',
+            dest='update_all_verbose',
+            action='store_true',
+            help='Print status information to the console'
+        )
+        # Hidden, for development.
+        parser.add_argument(
+            '--plan-dir',
+            metavar='PATH',
+            help=argparse.SUPPRESS
+        )
+        setup_instance_config_args(parser, mode=INSTANCE_UPDATER_MODE)
+
+    def run(self, values):
+        if values.max_updates_per_region < 1:
+            raise ValidationError(
+                '--max-updates-per-region must be at least 1')
+        if bool(values.regions) == bool(values.resume):
+            raise ValidationError(
+                'Specify either --region or --resume')
+
+        brkt_env = (
+            brkt_cli.brkt_env_from_values(values) or
+            brkt_cli.get_prod_brkt_env()
+        )
+        if values.token:
+            brkt_cli.check_jwt_auth(brkt_env, values.token)
+
+        directory = values.plan_dir or PLAN_DIR
+        if values.resume:
+            path = get_plan_path(values.resume, directory)
+            if not os.path.exists(path):
+                raise ValidationError('Unknown plan %s' % values.resume)
+            queue = JobQueue(path)
+            requeue_unfinished(queue)
+            regions = sorted(set(j.region for j in get_jobs(queue)))
+        else:
+            queue = None
+            regions = values.regions
+
+        clients = {
+            region: api.Client(
+                region, brkt_env=brkt_env,
+                max_workers=values.max_updates_per_region)
+            for region in regions
+        }
+        try:
+            if not queue:
+                queue = _make_plan(values, clients, directory)
+                if not queue:
+                    return 0
+            failed = run_plan(
+                queue, clients,
+                guest_instance_type=values.guest_instance_type,
+                updater_instance_type=values.updater_instance_type,
+                instance_config=make_instance_config(
+                    values, brkt_env, mode=INSTANCE_UPDATER_MODE),
+                tags=brkt_cli.parse_tags(values.tags)
+            )
+            print(render_plan(get_jobs(queue)))
+            queue.close()
+        finally:
+            for client in clients.values():
+                client.shutdown(wait=False)
+
+        if failed:
+            log.error(
+                '%d updates failed.  Run brkt update-all --resume %s to '
+                'retry them.', failed, _get_plan_id(queue.path))
+            return 1
+        return 0
+
+
+def _get_plan_id(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+def _make_plan(values, clients, directory):
+    """ Find the stale AMIs in each region and save them as a plan.
+
+    :return the JobQueue for the plan, or None if there is nothing to do
+        or this is a dry run
+    """
+    image_catalog = Catalog()
+    try:
+        stale_by_region = {
+            region: find_stale_images(client, image_catalog=image_catalog)
+            for region, client in clients.iteritems()
+        }
+    finally:
+        image_catalog.close()
+
+    if not any(stale_by_region.values()):
+        log.info('All encrypted AMIs are up to date')
+        return None
+
+    if values.dry_run:
+        queue = JobQueue(':memory:')
+    else:
+        try:
+            os.makedirs(directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        plan_id = util.make_nonce()
+        queue = JobQueue(get_plan_path(plan_id, directory))
+        log.info(
+            'Saved plan %s.  If brkt is interrupted, run brkt update-all '
+            '--resume %s', plan_id, plan_id)
+
+    for region in sorted(stale_by_region):
+        add_to_plan(queue, region, stale_by_region[region])
+    if values.dry_run:
+        print(render_plan(get_jobs(queue)))
+        queue.close()
+        return None
+    return queue
+
+
+def get_subcommands():
+    return [UpdateAllSubcommand()]
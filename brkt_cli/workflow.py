@@ -0,0 +1,285 @@
+# Copyright 2015 Bracket Computing, Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License").
+# You may not use this file except in compliance with the License.
+# A copy of the License is located at
+#
+# https://github.com/brkt/brkt-cli/blob/master/LICENSE
+#
+# or in the "license" file accompanying this file. This file is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR
+# CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Runs a workflow that is expressed as a graph of named steps.
+
+A step is a function or coroutine.  The names of its arguments declare
+what it requires: workflow inputs, or the results of other steps.  Its
+return value is stored under the step's name.  A step starts as soon as
+everything that it requires is available, so independent steps run
+concurrently:
+
+    workflow = Workflow('encrypt')
+    workflow.add_step('guest_instance', _launch_guest_co,
+                      cleanup=_terminate_guest_co)
+    workflow.add_step('security_group', _create_security_group,
+                      cleanup=_delete_security_group)
+    workflow.add_step('encryptor_instance', _launch_encryptor_co)
+    results = workflow.run(aws_svc=aws_svc, image_id=image_id)
+
+A step's cleanup function runs after the workflow completes, whether or
+not it succeeded.  Its compensate function only runs if the workflow
+failed.  Both run after the cleanups of any steps that depended on the
+step, directly or through other steps, so that an instance is terminated
+before the security group that it uses is deleted.  Steps whose
+resources can be deleted while the later steps' resources still exist
+are added with independent_cleanup=True, so that they are cleaned up in
+parallel.  Cleanup functions can take the results of later steps as
+optional arguments, which are passed if those steps completed.
+
+Coroutine steps are run with brkt_cli.engine, so blocking calls should
+be yielded as Calls.  Steps that are plain functions are run as a single
+Call.
+"""
+
+import collections
+import inspect
+import logging
+import sys
+import time
+
+from brkt_cli.engine import Call, Return, Sleep, Spawn, Wait, run_sync
+
+log = logging.getLogger(__name__)
+
+StepTiming = collections.namedtuple(
+    'StepTiming', ['name', 'seconds', 'attempts', 'succeeded'])
+
+
+def _get_arg_names(function, optional=False):
+    """ Return the names of the function's required arguments, or of its
+    optional arguments if optional is True.
+    """
+    spec = inspect.getargspec(function)
+    num_optional = len(spec.defaults or [])
+    if optional:
+        return spec.args[len(spec.args) - num_optional:]
+    return spec.args[:len(spec.args) - num_optional]
+
+
+def _invoke_co(function, values):
+    """ Call the function with the values that it takes as arguments.
+    Optional arguments are only passed if the value is available.
+    """
+    kwargs = {name: values[name] for name in _get_arg_names(function)}
+    for name in _get_arg_names(function, optional=True):
+        if name in values:
+            kwargs[name] = values[name]
+    if inspect.isgeneratorfunction(function):
+        result = yield function(**kwargs)
+    else:
+        result = yield Call(function, **kwargs)
+    raise Return(result)
+
+
+class Step(object):
+    def __init__(self, name, function, cleanup=None, compensate=None,
+                 retries=0, retry_sleep_seconds=5, independent_cleanup=False):
+        self.name = name
+        self.function = function
+        self.requires = _get_arg_names(function)
+        self.cleanup = cleanup
+        self.compensate = compensate
+        self.retries = retries
+        self.retry_sleep_seconds = retry_sleep_seconds
+        self.independent_cleanup = independent_cleanup
+
+
+class Workflow(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.steps = collections.OrderedDict()
+        self.timings = []
+        # Names that steps require, which aren't the names of steps.
+        self._input_names = set()
+
+    def add_step(self, name, function, cleanup=None, compensate=None,
+                 retries=0, retry_sleep_seconds=5, independent_cleanup=False):
+        """ Add a step to the workflow.  A step can only require the
+        results of steps that were added before it, so the graph has no
+        cycles.
+
+        :param name the name that the step's result is stored under
+        :param function a function or coroutine function
+        :param cleanup called after the workflow completes
+        :param compensate called after the workflow fails
+        :param retries the number of times to retry the step if it raises
+            an exception
+        :param independent_cleanup if True, the step is cleaned up at the
+            same time as the steps that required it, instead of after them
+        :raise ValueError if the name is already used, the step requires
+            its own result, or a cleanup
+            function requires the result of a step that this step didn't
+            require
+        """
+        if name in self.steps or name in self._input_names:
+            raise ValueError('%s is already used in %s' % (name, self.name))
+        step = Step(
+            name, function, cleanup=cleanup, compensate=compensate,
+            retries=retries, retry_sleep_seconds=retry_sleep_seconds,
+            independent_cleanup=independent_cleanup
+        )
+        if name in step.requires:
+            raise ValueError('Step %s requires its own result' % name)
+        required = set(step.requires)
+        for f in (cleanup, compensate):
+            if not f:
+                continue
+            for arg_name in _get_arg_names(f):
+                if arg_name in self.steps and arg_name not in required:
+                    raise ValueError(
+                        '%s requires %s, which step %s does not' %
+                        (f.__name__, arg_name, name)
+                    )
+                if arg_name != name:
+                    required.add(arg_name)
+        for arg_name in required:
+            if arg_name not in self.steps:
+                self._input_names.add(arg_name)
+        self.steps[name] = step
+        return step
+
+    def get_timings_text(self):
+        return ', '.join(
+            '%s=%.1fs' % (t.name, t.seconds) for t in self.timings)
+
+    def run(self, **inputs):
+        """ Run the workflow in the calling thread.
+
+        :return a dictionary of inputs and step results
+        :raise the exception raised by the first step that failed
+        """
+        return run_sync(self.run_co(**inputs))
+
+    def run_co(self, **inputs):
+        """ Coroutine version of run(). """
+        missing = self._input_names - set(inputs.keys())
+        if missing:
+            raise ValueError(
+                'Missing inputs for %s: %s' %
+                (self.name, ', '.join(sorted(missing)))
+            )
+
+        self.timings = []
+        results = dict(inputs)
+        started = set()
+        running = {}
+        completed = []
+        exc_info = None
+
+        while True:
+            if not exc_info:
+                for step in self.steps.itervalues():
+                    if step.name in started:
+                        continue
+                    if all(r in results for r in step.requires):
+                        started.add(step.name)
+                        future = yield Spawn(self._run_step_co(step, results))
+                        running[future] = step
+            if not running:
+                break
+
+            # Steps that are already running are allowed to finish after
+            # a failure, so that their resources get cleaned up.
+            future = yield Wait(*running.keys())
+            step = running.pop(future)
+            if future.exception_info():
+                exc_info = exc_info or future.exception_info()
+            else:
+                results[step.name] = future.result()
+                completed.append(step)
+
+        yield self._clean_up_co(completed, results, failed=bool(exc_info))
+        log.debug('%s step timings: %s', self.name, self.get_timings_text())
+        if exc_info:
+            raise exc_info[0], exc_info[1], exc_info[2]
+        raise Return(results)
+
+    def _run_step_co(self, step, results):
+        log.debug('Starting step %s', step.name)
+        start = time.time()
+        attempts = 0
+        while True:
+            attempts += 1
+            try:
+                result = yield _invoke_co(step.function, results)
+            except Exception as e:
+                exc_info = sys.exc_info()
+                if attempts > step.retries:
+                    self.timings.append(StepTiming(
+                        step.name, time.time() - start, attempts, False))
+                    raise exc_info[0], exc_info[1], exc_info[2]
+                log.warn(
+                    'Step %s failed: %s.  Retrying in %d seconds.',
+                    step.name, e, step.retry_sleep_seconds
+                )
+            else:
+                break
+            yield Sleep(step.retry_sleep_seconds)
+
+        seconds = time.time() - start
+        self.timings.append(StepTiming(step.name, seconds, attempts, True))
+        log.debug('Step %s completed in %.1f seconds', step.name, seconds)
+        raise Return(result)
+
+    def _get_dependents(self, step, completed):
+        """ Return the names of the completed steps that require the
+        step, directly or through other steps.
+        """
+        dependents = set()
+        names = [step.name]
+        while names:
+            name = names.pop()
+            for s in completed:
+                if name in s.requires and s.name not in dependents:
+                    dependents.add(s.name)
+                    names.append(s.name)
+        return dependents
+
+    def _clean_up_co(self, completed, results, failed):
+        """ Run cleanup and compensation functions for the completed steps.
+        A step is cleaned up after the steps that required it, directly or
+        through other steps, unless its cleanup is independent.  A step
+        that requires an independent step is still cleaned up before the
+        steps that the independent step required.
+        """
+        pending = list(completed)
+        done = set()
+        running = {}
+        while pending or running:
+            for step in list(pending):
+                dependents = set()
+                if not step.independent_cleanup:
+                    dependents = self._get_dependents(step, completed)
+                if dependents <= done:
+                    pending.remove(step)
+                    future = yield Spawn(
+                        self._clean_up_step_co(step, results, failed))
+                    running[future] = step
+            future = yield Wait(*running.keys())
+            done.add(running.pop(future).name)
+
+    def _clean_up_step_co(self, step, results, failed):
+        functions = [step.cleanup]
+        if failed:
+            functions.insert(0, step.compensate)
+        for function in functions:
+            if not function:
+                continue
+            try:
+                yield _invoke_co(function, results)
+            except Exception:
+                log.exception('Unable to clean up step %s', step.name)
@@ -46,7 +46,8 @@ setup(
         'brkt_cli.gce',
         'brkt_cli.get_public_key',
         'brkt_cli.make_key',
-        'brkt_cli.make_user_data'
+        'brkt_cli.make_user_data',
+        'brkt_cli.serve'
     ],
     install_requires=[
         'boto>=2.38.0',
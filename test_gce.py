@@ -7,10 +7,11 @@ import brkt_cli
 import test
 
 from brkt_cli.validation import ValidationError
-from brkt_cli import util
+from brkt_cli import cassette, orphans, session, util
 from brkt_cli.gce import encrypt_gce_image
 from brkt_cli.gce import update_gce_image
 from brkt_cli.gce import gce_service
+from brkt_cli.gce import orphans as gce_orphans
 from brkt_cli.instance_config import InstanceConfig
 from brkt_cli.test_encryptor_service import (
     DummyEncryptorService,
@@ -32,9 +33,10 @@ def _new_id():
 class DummyGCEService(gce_service.BaseGCEService):
     def __init__(self):
         super(DummyGCEService, self).__init__('testproject', _new_id(), log)
+        self.image_names = []
 
     def cleanup(self, zone, encryptor_image, keep_encryptor=False):
-        for disk in self.disks[:]:
+        for disk in self.disks:
             if self.disk_exists(zone, disk):
                 self.wait_for_detach(zone, disk)
                 self.delete_disk(zone, disk)
@@ -81,12 +83,11 @@ class DummyGCEService(gce_service.BaseGCEService):
             return False
 
     def delete_instance(self, zone, instance):
-        if instance in self.instances:
-            self.instances.remove(instance)
+        self.session.untrack_resource(session.RESOURCE_INSTANCE, instance)
 
     def delete_disk(self, zone, disk):
         if disk in self.disks:
-            self.disks.remove(disk)
+            self.session.untrack_resource(session.RESOURCE_DISK, disk)
             return
         raise test.TestException('disk doesnt exist')
 
@@ -96,6 +97,14 @@ class DummyGCEService(gce_service.BaseGCEService):
     def get_instance_ip(self, name, zone):
         return
 
+    def get_instance_status(self, zone, instance):
+        if instance in self.instances:
+            return 'RUNNING'
+        return 'TERMINATED'
+
+    def get_serial_console_output(self, zone, instance):
+        return ''
+
     def detach_disk(self, zone, instance, diskName):
         return self.wait_for_detach(zone, diskName)
 
@@ -123,7 +132,7 @@ class DummyGCEService(gce_service.BaseGCEService):
         return
 
     def create_disk(self, zone, name, size):
-        self.disks.append(name)
+        self.session.track_resource(session.RESOURCE_DISK, name)
 
     def create_gce_image_from_disk(self, zone, image_name, disk_name):
         return
@@ -169,9 +178,9 @@ class DummyGCEService(gce_service.BaseGCEService):
                      block_project_ssh_keys=False,
                      instance_type='n1-standard-4',
                      image_project=None):
-        self.instances.append(name)
+        self.session.track_resource(session.RESOURCE_INSTANCE, name)
         if not delete_boot:
-            self.disks.append(name)
+            self.session.track_resource(session.RESOURCE_DISK, name)
 
     def get_disk(self, zone, disk_name):
         source_disk = "projects/%s/zones/%s/disks/%s" % (self.project, zone, disk_name)
@@ -181,6 +190,20 @@ class DummyGCEService(gce_service.BaseGCEService):
             'source': self.gce_res_uri + source_disk,
         }
 
+    def list_instances(self, name_filter=None):
+        return [
+            {'name': name, 'zone': 'us-central1-a', 'status': 'RUNNING'}
+            for name in self.instances
+        ]
+
+    def list_disks(self, name_filter=None):
+        return [
+            {'name': name, 'zone': 'us-central1-a'} for name in self.disks
+        ]
+
+    def list_images(self, name_filter=None):
+        return [{'name': name} for name in self.image_names]
+
 
 class TestEncryptedImageName(unittest.TestCase):
 
@@ -272,6 +295,42 @@ class TestRunEncryption(unittest.TestCase):
         self.assertEqual(len(gce_svc.instances), 0)
 
 
+class TestOrphans(unittest.TestCase):
+
+    def test_list_and_delete(self):
+        """ Test that the resources of an interrupted session are found by
+        name, and that encryptor images that no session left behind are
+        kept.
+        """
+        gce_svc = DummyGCEService()
+        session_id = gce_svc.get_session_id()
+        encryptor = 'brkt-guest-%s-encryptor' % session_id
+        gce_svc.run_instance('us-central1-a', encryptor, 'encryptor-image')
+        gce_svc.create_disk(
+            'us-central1-a', 'encrypted-image-' + session_id, 10)
+        gce_svc.image_names = [
+            'encryptor-' + session_id, 'encryptor-0123abcd', 'ubuntu'
+        ]
+
+        resources = gce_orphans.list_resources(gce_svc)
+        sessions = orphans.group_by_session(resources)
+        self.assertEqual([session_id], [s.session_id for s in sessions])
+        session = sessions[0]
+        self.assertEqual(
+            [encryptor], session.get_ids(orphans.RESOURCE_INSTANCE))
+        self.assertEqual(
+            sorted([encryptor, 'encrypted-image-' + session_id]),
+            session.get_ids(orphans.RESOURCE_DISK))
+        self.assertEqual(
+            ['encryptor-' + session_id],
+            session.get_ids(orphans.RESOURCE_IMAGE))
+        self.assertTrue(session.is_live())
+
+        gce_orphans.delete_sessions(gce_svc, sessions)
+        self.assertEqual([], gce_svc.instances)
+        self.assertEqual([], gce_svc.disks)
+
+
 class TestImageValidation(unittest.TestCase):
 
     def setUp(self):
@@ -346,3 +405,38 @@ class TestRunUpdate(unittest.TestCase):
         self.assertIsNotNone(encrypted_image)
         self.assertEqual(len(gce_svc.disks), 0)
         self.assertEqual(len(gce_svc.instances), 0)
+
+
+class TestWorkflowCallBudget(unittest.TestCase):
+    """ Verify that the GCE encrypt and update workflows don't make more
+    API calls than the budgets recorded in brkt_cli/cassettes.
+    """
+
+    def setUp(self):
+        util.SLEEP_ENABLED = False
+
+    def test_encrypt(self):
+        recorder = cassette.CallRecorder(DummyGCEService())
+        encrypt_gce_image.encrypt(
+            gce_svc=recorder,
+            enc_svc_cls=DummyEncryptorService,
+            image_id=IGNORE_IMAGE,
+            encryptor_image='encryptor-image',
+            encrypted_image_name='ubuntu-encrypted',
+            zone='us-central1-a',
+            instance_config=InstanceConfig({'identity_token': TOKEN})
+        )
+        cassette.check_cassette('gce_encrypt_image', recorder.calls)
+
+    def test_update(self):
+        recorder = cassette.CallRecorder(DummyGCEService())
+        update_gce_image.update_gce_image(
+            gce_svc=recorder,
+            enc_svc_cls=DummyEncryptorService,
+            image_id=IGNORE_IMAGE,
+            encryptor_image='encryptor-image',
+            encrypted_image_name='centos-encrypted',
+            zone='us-central1-a',
+            instance_config=InstanceConfig({'identity_token': TOKEN})
+        )
+        cassette.check_cassette('gce_update_image', recorder.calls)